@@ -0,0 +1,275 @@
+"""
+Blocking Executor - 阻塞调用执行器
+把同步的网络调用（LLM / Embedding / TTS / ASR）放到有界线程池中执行，
+避免一个慢请求卡住整个 uvicorn worker 的事件循环
+
+特性：
+1. 全局有界线程池（API_WORKER_THREADS 配置）
+2. 按路由的并发上限（API_ROUTE_LIMITS 配置，如 "chat=8,tts=4"）
+3. 排队深度 / 在途数 / 耗时统计
+"""
+
+import os
+import time
+import asyncio
+import threading
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 默认线程池大小（所有外部调用共享）
+DEFAULT_WORKER_THREADS = 32
+
+# 默认每个路由的并发上限（未列出的路由只受线程池大小限制）
+DEFAULT_ROUTE_LIMITS = {
+    "chat": 16,
+    "moments_save": 4,
+    "tts": 4,
+    "asr": 4,
+}
+
+_STREAM_END = object()
+
+
+def _parse_route_limits(value: str) -> Dict[str, int]:
+    """解析 "chat=8,tts=4" 格式的路由并发配置"""
+    limits = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        route, limit = item.split("=", 1)
+        try:
+            limits[route.strip()] = int(limit)
+        except ValueError:
+            print(f"⚠️ 无效的路由并发配置: {item}")
+    return limits
+
+
+class BlockingExecutor:
+    """
+    阻塞调用执行器
+
+    用法：
+        result = await executor.run("chat", generate_reply, ...)
+        async for chunk in executor.iterate("chat", sync_generator):
+            ...
+    """
+
+    def __init__(self, max_workers: Optional[int] = None,
+                 route_limits: Optional[Dict[str, int]] = None):
+        """
+        初始化执行器
+
+        Args:
+            max_workers: 线程池大小，默认读取 API_WORKER_THREADS
+            route_limits: 路由并发上限，默认读取 API_ROUTE_LIMITS
+        """
+        self.max_workers = max_workers or int(
+            os.getenv("API_WORKER_THREADS", DEFAULT_WORKER_THREADS)
+        )
+
+        self.route_limits = dict(DEFAULT_ROUTE_LIMITS)
+        if route_limits is None:
+            route_limits = _parse_route_limits(os.getenv("API_ROUTE_LIMITS", ""))
+        self.route_limits.update(route_limits)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="api_io_"
+        )
+
+        # 路由信号量（在事件循环中懒创建）
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+        # 统计信息
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._pool_queued = 0  # 已提交到线程池但尚未被线程取走的任务数
+        self._lock = threading.Lock()
+
+        print(f"🧵 BlockingExecutor 初始化: workers={self.max_workers}, limits={self.route_limits}")
+
+    def _get_semaphore(self, route: str) -> asyncio.Semaphore:
+        """获取路由的并发信号量"""
+        if route not in self._semaphores:
+            limit = min(self.route_limits.get(route, self.max_workers), self.max_workers)
+            self._semaphores[route] = asyncio.Semaphore(limit)
+        return self._semaphores[route]
+
+    def _route_stats(self, route: str) -> Dict[str, float]:
+        if route not in self._stats:
+            self._stats[route] = {
+                "waiting": 0,
+                "in_flight": 0,
+                "max_waiting": 0,
+                "completed": 0,
+                "errors": 0,
+                "total_wait_ms": 0.0,
+                "total_run_ms": 0.0,
+            }
+        return self._stats[route]
+
+    def _on_enqueue(self, route: str):
+        with self._lock:
+            stats = self._route_stats(route)
+            stats["waiting"] += 1
+            stats["max_waiting"] = max(stats["max_waiting"], stats["waiting"])
+
+    def _on_start(self, route: str, wait_ms: float):
+        with self._lock:
+            stats = self._route_stats(route)
+            stats["waiting"] -= 1
+            stats["in_flight"] += 1
+            stats["total_wait_ms"] += wait_ms
+
+    def _on_finish(self, route: str, run_ms: float, failed: bool):
+        with self._lock:
+            stats = self._route_stats(route)
+            stats["in_flight"] -= 1
+            stats["completed"] += 1
+            stats["total_run_ms"] += run_ms
+            if failed:
+                stats["errors"] += 1
+
+    def _submit(self, func: Callable, *args) -> asyncio.Future:
+        """提交到线程池并计入排队深度（任务被线程取走或被取消时减一）"""
+        queued = [True]
+
+        def dequeue():
+            with self._lock:
+                if queued[0]:
+                    queued[0] = False
+                    self._pool_queued -= 1
+
+        def task():
+            dequeue()
+            return func(*args)
+
+        with self._lock:
+            self._pool_queued += 1
+        try:
+            future = self._executor.submit(task)
+        except BaseException:
+            dequeue()
+            raise
+        future.add_done_callback(lambda _f: dequeue())
+        return asyncio.wrap_future(future)
+
+    async def run(self, route: str, func: Callable, *args, **kwargs) -> Any:
+        """
+        在线程池中执行阻塞函数
+
+        Args:
+            route: 路由名（用于并发限制和统计）
+            func: 同步函数
+            *args, **kwargs: 函数参数
+
+        Returns:
+            函数返回值（异常原样抛出）
+        """
+        semaphore = self._get_semaphore(route)
+
+        self._on_enqueue(route)
+        enqueued_at = time.perf_counter()
+        started = False
+        try:
+            async with semaphore:
+                started_at = time.perf_counter()
+                self._on_start(route, (started_at - enqueued_at) * 1000)
+                started = True
+                failed = False
+                try:
+                    return await self._submit(partial(func, *args, **kwargs))
+                except BaseException:
+                    failed = True
+                    raise
+                finally:
+                    self._on_finish(route, (time.perf_counter() - started_at) * 1000, failed)
+        finally:
+            if not started:
+                # 排队期间被取消（如客户端断开）
+                with self._lock:
+                    self._route_stats(route)["waiting"] -= 1
+
+    async def iterate(self, route: str, iterator: Iterator) -> AsyncIterator:
+        """
+        在线程池中逐项迭代同步生成器（用于流式响应）
+
+        整个迭代过程占用一个路由并发名额
+
+        Args:
+            route: 路由名
+            iterator: 同步迭代器 / 生成器
+        """
+        semaphore = self._get_semaphore(route)
+
+        self._on_enqueue(route)
+        enqueued_at = time.perf_counter()
+        started = False
+        try:
+            async with semaphore:
+                started_at = time.perf_counter()
+                self._on_start(route, (started_at - enqueued_at) * 1000)
+                started = True
+                failed = False
+                try:
+                    while True:
+                        item = await self._submit(next, iterator, _STREAM_END)
+                        if item is _STREAM_END:
+                            break
+                        yield item
+                except GeneratorExit:
+                    # 客户端提前断开，不算错误
+                    raise
+                except BaseException:
+                    failed = True
+                    raise
+                finally:
+                    if hasattr(iterator, "close"):
+                        iterator.close()
+                    self._on_finish(route, (time.perf_counter() - started_at) * 1000, failed)
+        finally:
+            if not started:
+                with self._lock:
+                    self._route_stats(route)["waiting"] -= 1
+
+    def get_metrics(self) -> Dict:
+        """获取执行器统计信息"""
+        with self._lock:
+            routes = {}
+            for route, stats in self._stats.items():
+                completed = stats["completed"] or 1
+                routes[route] = {
+                    "limit": min(self.route_limits.get(route, self.max_workers), self.max_workers),
+                    "waiting": stats["waiting"],
+                    "in_flight": stats["in_flight"],
+                    "max_waiting": stats["max_waiting"],
+                    "completed": stats["completed"],
+                    "errors": stats["errors"],
+                    "avg_wait_ms": round(stats["total_wait_ms"] / completed, 1),
+                    "avg_run_ms": round(stats["total_run_ms"] / completed, 1),
+                }
+            pool_queue_depth = self._pool_queued
+
+        return {
+            "max_workers": self.max_workers,
+            # 已提交到线程池但尚未被线程取走的任务数
+            "pool_queue_depth": pool_queue_depth,
+            "routes": routes,
+        }
+
+    def shutdown(self, wait: bool = True):
+        """关闭线程池"""
+        self._executor.shutdown(wait=wait)
+
+
+# 全局单例
+_blocking_executor: Optional[BlockingExecutor] = None
+
+
+def get_blocking_executor() -> BlockingExecutor:
+    """获取阻塞调用执行器单例"""
+    global _blocking_executor
+    if _blocking_executor is None:
+        _blocking_executor = BlockingExecutor()
+    return _blocking_executor
@@ -5,30 +5,54 @@ REST API 封装后端功能
 
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 import os
 import json
 import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
 
 # 导入后端模块
-from backend.agent.reply_generator import generate_reply
+from backend.agent.reply_generator import generate_reply, generate_reply_stream
 from backend.audio.tts_engine import text_to_speech as tts_generate
 from backend.audio.asr_engine import speech_to_text as asr_generate
 from backend.memory.moment_manager import MomentManager
-from backend.memory.moment_card import generate_moment_card
 from backend.memory.style_rag import StyleRAG
 from backend.memory.context_rag import ContextRAG
+from backend.memory.storage_context import UserStorageContext
+from backend.memory.embedding_cache import get_embedding_cache
+from backend.memory.query_parser import get_query_parser_stats
+from backend.memory.retrieval_gate import get_gate_stats
+from backend.memory.card_jobs import CardJobQueue
+from backend.memory.moment_digest import get_digest_cache
+from backend.utils.llm_gateway import get_gateway_stats
 from config.persona_config import get_system_prompt, get_greeting
 from data_model.user_session import UserSession
+from api.executor import get_blocking_executor
+from api.manager_registry import ManagerRegistry
+
+# 阻塞调用执行器（LLM / Embedding / TTS / ASR 都在有界线程池中执行）
+executor = get_blocking_executor()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：启动卡片任务 worker；关闭时停止 worker、落盘并释放所有用户的管理器，回收线程池"""
+    card_jobs.start()
+    yield
+    card_jobs.stop()
+    manager_registry.shutdown()
+    executor.shutdown(wait=False)
+
 
 # 创建 FastAPI 应用
 app = FastAPI(
     title="Moment Catcher API",
     description="AI 陪伴 Agent 的 REST API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置 CORS（允许前端跨域请求）
@@ -40,32 +64,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 全局管理器实例（按用户ID存储）
-managers: Dict[str, Dict] = {}
+def _create_managers(user_id: str) -> Dict:
+    """创建某个用户的管理器实例"""
+    user_name = user_id.split('_')[0] if '_' in user_id else user_id
+    agent_name = user_id.split('_')[1] if '_' in user_id else 'Kay'
+    # 与 set_user_id 的规则一致，直接用最终 ID 初始化，避免先建 default_user 再切换
+    storage_user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+    # SQLite + 向量存储每个用户只建一份，MomentManager 和 ContextRAG 共用
+    storage_context = UserStorageContext(user_id=storage_user_id)
+    return {
+        'storage_context': storage_context,
+        'moment_manager': MomentManager(user_id=storage_user_id, storage_context=storage_context),
+        'style_rag': StyleRAG(user_id=storage_user_id),
+        'context_rag': ContextRAG(user_id=storage_user_id, storage_context=storage_context)
+    }
+
+
+# 全局管理器注册表（按用户ID存储，LRU + 闲置回收）
+manager_registry = ManagerRegistry(factory=_create_managers)
 
 
 def get_managers(user_id: str) -> Dict:
-    """获取或创建用户的管理器实例"""
-    if user_id not in managers:
-        managers[user_id] = {
-            'moment_manager': MomentManager(),
-            'style_rag': StyleRAG(),
-            'context_rag': ContextRAG()
-        }
-        # 设置用户ID
-        managers[user_id]['moment_manager'].set_user_id(
-            user_id.split('_')[0] if '_' in user_id else user_id,
-            user_id.split('_')[1] if '_' in user_id else 'Kay'
-        )
-        managers[user_id]['style_rag'].set_user_id(
-            user_id.split('_')[0] if '_' in user_id else user_id,
-            user_id.split('_')[1] if '_' in user_id else 'Kay'
-        )
-        managers[user_id]['context_rag'].set_user_id(
-            user_id.split('_')[0] if '_' in user_id else user_id,
-            user_id.split('_')[1] if '_' in user_id else 'Kay'
-        )
-    return managers[user_id]
+    """获取或创建用户的管理器实例（不持有租约，只用于不再访问存储的场景）"""
+    return manager_registry.get(user_id)
+
+
+@asynccontextmanager
+async def leased_managers(route: str, user_id: str):
+    """请求期间租用用户的管理器（租约归还前不会被 LRU / 闲置回收关闭）"""
+    mgrs = await executor.run(route, manager_registry.acquire, user_id)
+    try:
+        yield mgrs
+    finally:
+        manager_registry.release(mgrs)
+
+
+def _process_card_job(user_id: str, moment_id: str) -> Dict:
+    """卡片任务：实体提取 + Card 生成 + 向量写入"""
+    with manager_registry.lease(user_id) as mgrs:
+        return mgrs['moment_manager'].finalize_moment(moment_id)
+
+
+# Moment 后处理任务队列（SQLite 持久化，重启后继续执行；CARD_JOBS_ENABLED=0 时保存接口同步生成）
+card_jobs = CardJobQueue(handler=_process_card_job)
 
 
 # ============================================================
@@ -119,10 +160,21 @@ class SaveMomentRequest(BaseModel):
 
 
 class SaveMomentResponse(BaseModel):
-    """保存 Moment 响应"""
+    """保存 Moment 响应（异步生成时 card 为占位卡片，status 为 pending）"""
     moment_id: str
     card: Dict
     message: str
+    job_id: Optional[str] = None
+    status: str = "done"
+
+
+class MomentCardStatusResponse(BaseModel):
+    """Moment Card 任务状态响应"""
+    moment_id: str
+    job_id: str
+    status: str
+    card: Optional[Dict] = None
+    error: Optional[str] = None
 
 
 class MomentCard(BaseModel):
@@ -182,8 +234,8 @@ async def init_connection(request: InitRequest):
     try:
         user_id = f"{request.user_name}_{request.agent_name}"
         
-        # 获取管理器
-        mgrs = get_managers(user_id)
+        # 获取管理器（首次创建会初始化存储，放到线程池执行）
+        mgrs = await executor.run("init", get_managers, user_id)
         
         # 生成问候语
         greeting = get_greeting(request.user_name, request.agent_name)
@@ -203,11 +255,9 @@ async def start_moment(request: StartMomentRequest):
     开始新的 Moment
     """
     try:
-        mgrs = get_managers(request.user_id)
-        moment_manager = mgrs['moment_manager']
-        
-        # 开始新 Moment
-        moment_manager.start_new_moment()
+        async with leased_managers("moments_start", request.user_id) as mgrs:
+            # 开始新 Moment（在线程池中修改会话状态，与对话线程按 session_lock 串行）
+            moment_id = await executor.run("moments_start", mgrs['moment_manager'].start_new_moment)
         
         # 生成问候语
         user_name = request.user_id.split('_')[0] if '_' in request.user_id else request.user_id
@@ -215,7 +265,7 @@ async def start_moment(request: StartMomentRequest):
         greeting = get_greeting(user_name, agent_name)
         
         return StartMomentResponse(
-            moment_id=moment_manager.current_moment_id or "",
+            moment_id=moment_id or "",
             greeting=greeting,
             message="✨ 已开始新 Moment"
         )
@@ -223,84 +273,124 @@ async def start_moment(request: StartMomentRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _prepare_chat(request: ChatRequest, mgrs: Dict) -> Tuple[MomentManager, str, UserSession]:
+    """
+    准备一轮对话：学习风格、检索上下文、构建 system prompt 和临时 session
+    
+    Args:
+        request: 聊天请求
+        mgrs: 调用方已租用的用户管理器
+    
+    Returns:
+        Tuple: (moment_manager, system_prompt, temp_session)
+    """
+    moment_manager = mgrs['moment_manager']
+    style_rag = mgrs['style_rag']
+    context_rag = mgrs['context_rag']
+    
+    # 如果没有活跃的 Moment，自动开始一个
+    moment_manager.ensure_moment()
+    
+    # 1. 学习用户风格
+    style_rag.learn_from_message(request.message)
+    
+    # 2. 检索相关历史上下文（门控判定闲聊时跳过）
+    context_prompt = context_rag.generate_context_prompt(
+        request.message,
+        max_context=2,
+        recent_messages=moment_manager.current_messages[-4:]
+    )
+    
+    # 3. 获取风格提示
+    style_prompt = style_rag.get_style_prompt()
+    
+    # 4. 构建完整 prompt
+    user_name = request.user_id.split('_')[0] if '_' in request.user_id else request.user_id
+    agent_name = request.user_id.split('_')[1] if '_' in request.user_id else 'Kay'
+    system_prompt = get_system_prompt(user_name=user_name, kay_name=agent_name)
+    
+    # 添加 RAG 上下文
+    if context_prompt:
+        system_prompt += f"\n\n{context_prompt}"
+    
+    if style_prompt:
+        system_prompt += f"\n\n{style_prompt}"
+    
+    # 5. 创建临时 session
+    temp_session = UserSession(user_name=user_name, kay_name=agent_name)
+    
+    # 将 history 转换为 session.messages 格式
+    if request.history:
+        for msg in request.history:
+            role = msg.get("role", "user")
+            content = msg.get("content", "")
+            temp_session.add_message(role, content, "neutral")
+    
+    return moment_manager, system_prompt, temp_session
+
+
+def _synthesize_reply_audio(text: str) -> Optional[str]:
+    """生成回复语音，返回前端可访问的 URL（失败返回 None）"""
+    audio_url = None
+    try:
+        audio_path = tts_generate(text)
+        # 转换为可访问的 URL（相对路径）
+        if audio_path:
+            # 从绝对路径转换为相对路径，前端可以通过代理访问
+            audio_path_str = str(audio_path)
+            if 'audio_outputs' in audio_path_str:
+                audio_url = f"/api/audio/{Path(audio_path).name}"
+    except Exception as e:
+        print(f"⚠️ TTS 生成失败: {e}")
+    return audio_url
+
+
+def _sse_event(event: str, data: Dict) -> str:
+    """格式化一条 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _record_turn(moment_manager: MomentManager, user_message: str, assistant_reply: str):
+    """把一轮对话写入当前 Moment（持有 session_lock，同一用户并发的两轮消息不会交错）"""
+    with moment_manager.session_lock:
+        moment_manager.add_message("user", user_message, emotion="neutral")
+        moment_manager.add_message("assistant", assistant_reply, emotion="neutral")
+
+
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """
     发送消息并获取回复（带 RAG）
+    非流式版本，保留用于兼容；前端默认使用 /api/chat/stream
     """
     try:
-        mgrs = get_managers(request.user_id)
-        moment_manager = mgrs['moment_manager']
-        style_rag = mgrs['style_rag']
-        context_rag = mgrs['context_rag']
-        
-        # 如果没有活跃的 Moment，自动开始一个
-        if not moment_manager.current_moment_id:
-            moment_manager.start_new_moment()
-        
-        # 1. 学习用户风格
-        style_rag.learn_from_message(request.message)
-        
-        # 2. 检索相关历史上下文
-        context_prompt = context_rag.generate_context_prompt(request.message, max_context=2)
-        
-        # 3. 获取风格提示
-        style_prompt = style_rag.get_style_prompt()
-        
-        # 4. 构建完整 prompt
-        user_name = request.user_id.split('_')[0] if '_' in request.user_id else request.user_id
-        agent_name = request.user_id.split('_')[1] if '_' in request.user_id else 'Kay'
-        system_prompt = get_system_prompt(user_name=user_name, kay_name=agent_name)
-        
-        # 添加 RAG 上下文
-        if context_prompt:
-            system_prompt += f"\n\n{context_prompt}"
-        
-        if style_prompt:
-            system_prompt += f"\n\n{style_prompt}"
-        
-        # 5. 创建临时 session
-        temp_session = UserSession(user_name=user_name, kay_name=agent_name)
-        
-        # 将 history 转换为 session.messages 格式
-        if request.history:
-            for msg in request.history:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                temp_session.add_message(role, content, "neutral")
-        
-        # 6. 生成回复
-        assistant_reply, detected_emotion = generate_reply(
-            user_message=request.message,
-            session=temp_session,
-            system_prompt=system_prompt
-        )
-        
-        # 7. 保存到当前 Moment
-        moment_manager.add_message("user", request.message, emotion="neutral")
-        moment_manager.add_message("assistant", assistant_reply, emotion="neutral")
-        
-        # 8. 生成语音
-        audio_path = None
-        audio_url = None
-        try:
-            audio_path = tts_generate(assistant_reply)
-            # 转换为可访问的 URL（相对路径）
-            if audio_path:
-                # 从绝对路径转换为相对路径，前端可以通过代理访问
-                audio_path_str = str(audio_path)
-                if 'audio_outputs' in audio_path_str:
-                    audio_url = f"/api/audio/{Path(audio_path).name}"
-        except Exception as e:
-            print(f"⚠️ TTS 生成失败: {e}")
-        
-        return ChatResponse(
-            reply=assistant_reply,
-            emotion=detected_emotion or "neutral",
-            audio_path=audio_url,  # 返回 URL 而不是本地路径
-            moment_id=moment_manager.current_moment_id,
-            message_count=len(moment_manager.current_messages)
-        )
+        async with leased_managers("chat", request.user_id) as mgrs:
+            moment_manager, system_prompt, temp_session = await executor.run(
+                "chat", _prepare_chat, request, mgrs
+            )
+            
+            # 6. 生成回复
+            assistant_reply, detected_emotion = await executor.run(
+                "chat",
+                generate_reply,
+                user_message=request.message,
+                session=temp_session,
+                system_prompt=system_prompt
+            )
+            
+            # 7. 保存到当前 Moment
+            await executor.run("chat", _record_turn, moment_manager, request.message, assistant_reply)
+            
+            # 8. 生成语音
+            audio_url = await executor.run("tts", _synthesize_reply_audio, assistant_reply)
+            
+            return ChatResponse(
+                reply=assistant_reply,
+                emotion=detected_emotion or "neutral",
+                audio_path=audio_url,  # 返回 URL 而不是本地路径
+                moment_id=moment_manager.current_moment_id,
+                message_count=len(moment_manager.current_messages)
+            )
     except Exception as e:
         import traceback
         error_detail = f"{str(e)}\n\n{traceback.format_exc()}"
@@ -308,68 +398,162 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=500, detail=f"Chat API 错误: {str(e)}")
 
 
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    发送消息并以 Server-Sent Events 流式返回回复（带 RAG）
+    
+    事件：
+    - token: {"text": "回复片段"}，LLM 每产出一段就推送一次
+    - done: {"reply", "emotion", "audio_path", "moment_id", "message_count"}，回复完成并生成语音后推送
+      （reply 为解析后的完整回复，与 /api/chat 一致，客户端以它为准）
+    - error: {"detail": "错误信息"}
+    """
+    def reply_stream(mgrs: Dict):
+        # 同步生成器：由 executor.iterate 在有界线程池中逐段迭代，不阻塞事件循环
+        # 产出 ("token", 片段)，最后产出 ("reply", (完整回复, 情绪, moment_manager))
+        moment_manager, system_prompt, temp_session = _prepare_chat(request, mgrs)
+        
+        final_reply = ""
+        detected_emotion = None
+        for text, emotion, is_done in generate_reply_stream(
+            user_message=request.message,
+            session=temp_session,
+            system_prompt=system_prompt
+        ):
+            if is_done:
+                # 最后一项是解析后的完整回复（不是增量片段）
+                final_reply = text
+                detected_emotion = emotion
+            elif text:
+                yield "token", text
+        
+        assistant_reply = final_reply.strip() or "哎呀，我脑子卡壳了一下，能再说一遍吗？"
+        
+        _record_turn(moment_manager, request.message, assistant_reply)
+        yield "reply", (assistant_reply, detected_emotion, moment_manager)
+    
+    async def event_stream():
+        try:
+            async with leased_managers("chat", request.user_id) as mgrs:
+                reply = None
+                async for kind, payload in executor.iterate("chat", reply_stream(mgrs)):
+                    if kind == "token":
+                        yield _sse_event("token", {"text": payload})
+                    else:
+                        reply = payload
+                assistant_reply, detected_emotion, moment_manager = reply
+                
+                # 语音合成走 tts 路由（受 tts 并发上限约束，不占用 chat 名额）
+                audio_url = await executor.run("tts", _synthesize_reply_audio, assistant_reply)
+                
+                yield _sse_event("done", {
+                    "reply": assistant_reply,
+                    "emotion": detected_emotion or "neutral",
+                    "audio_path": audio_url,
+                    "moment_id": moment_manager.current_moment_id,
+                    "message_count": len(moment_manager.current_messages)
+                })
+        except Exception as e:
+            import traceback
+            print(f"❌ Chat Stream API 错误: {e}\n\n{traceback.format_exc()}")
+            yield _sse_event("error", {"detail": f"Chat API 错误: {str(e)}"})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # 禁用反向代理缓冲，保证逐段推送
+        }
+    )
+
+
+def _placeholder_card(moment_data: Dict) -> Dict:
+    """卡片生成完成前返回的占位卡片"""
+    return {
+        'moment_id': moment_data['moment_id'],
+        'timestamp': moment_data['timestamp'],
+        'emotion': 'neutral',
+        'title': '',
+        'summary': '',
+        'color': '#D3D3D3',
+        'message_count': moment_data['message_count']
+    }
+
+
 @app.post("/api/moments/save", response_model=SaveMomentResponse)
 async def save_moment(request: SaveMomentRequest):
     """
     保存当前 Moment 并生成 Moment Card
+    
+    Moment 立即写入 SQLite；Card 生成、实体提取、向量写入作为后台任务执行，
+    返回 job_id 和占位卡片，通过 GET /api/moments/{moment_id}/card 查询结果
     """
     try:
-        mgrs = get_managers(request.user_id)
-        moment_manager = mgrs['moment_manager']
-        
-        if not moment_manager.current_moment_id:
-            raise HTTPException(status_code=400, detail="当前没有活跃的 Moment")
-        
-        if len(moment_manager.current_messages) == 0:
-            raise HTTPException(status_code=400, detail="当前 Moment 没有对话，无法保存")
-        
-        # 1. 结束 Moment
-        moment_data = moment_manager.end_moment()
-        
-        # 2. 生成 Moment Card
-        card = generate_moment_card(moment_data)
-        
-        # 3. 更新 Moment 数据
-        moment_manager.update_moment(moment_data['moment_id'], {
-            'summary': card.summary,
-            'emotion_tag': card.emotion,
-            'title': card.title,
-            'color': card.color,
-            'card_generated': True
-        })
-        
-        # 4. 返回结果
-        card_dict = {
-            'moment_id': card.moment_id,
-            'timestamp': card.timestamp,
-            'emotion': card.emotion,
-            'title': card.title,
-            'summary': card.summary,
-            'color': card.color,
-            'message_count': card.message_count
-        }
-        
-        return SaveMomentResponse(
-            moment_id=card.moment_id,
-            card=card_dict,
-            message="✅ Moment 已保存并生成 Moment Card"
-        )
+        async with leased_managers("moments_save", request.user_id) as mgrs:
+            moment_manager = mgrs['moment_manager']
+            
+            if not moment_manager.current_moment_id:
+                raise HTTPException(status_code=400, detail="当前没有活跃的 Moment")
+            
+            if len(moment_manager.current_messages) == 0:
+                raise HTTPException(status_code=400, detail="当前 Moment 没有对话，无法保存")
+            
+            # 1. 结束 Moment（只写 SQLite，后处理交给任务队列）
+            moment_data = await executor.run("moments_save", moment_manager.end_moment, False)
+            moment_id = moment_data['moment_id']
+            
+            # 2. 提交后台任务，返回占位卡片
+            if os.getenv("CARD_JOBS_ENABLED", "1") != "0":
+                job = await executor.run("moments_save", card_jobs.enqueue, request.user_id, moment_id)
+                return SaveMomentResponse(
+                    moment_id=moment_id,
+                    card=_placeholder_card(moment_data),
+                    message="✅ Moment 已保存，Moment Card 生成中",
+                    job_id=job['job_id'],
+                    status=job['status']
+                )
+            
+            # 同步生成（实体提取 + Card 生成 + 向量写入）
+            card = await executor.run("moments_save", moment_manager.finalize_moment, moment_id)
+            return SaveMomentResponse(
+                moment_id=moment_id,
+                card=card,
+                message="✅ Moment 已保存并生成 Moment Card"
+            )
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/api/moments/{moment_id}/card", response_model=MomentCardStatusResponse)
+async def get_moment_card(moment_id: str, user_id: str):
+    """
+    查询 Moment Card 任务状态（pending / running / done / failed），完成后返回卡片
+    """
+    job = await executor.run("moments_card", card_jobs.get_job, moment_id)
+    if not job or job['user_id'] != user_id:
+        raise HTTPException(status_code=404, detail="没有该 Moment 的卡片任务")
+    
+    return MomentCardStatusResponse(
+        moment_id=moment_id,
+        job_id=job['job_id'],
+        status=job['status'],
+        card=job['card'],
+        error=job['error']
+    )
+
+
 @app.get("/api/moments", response_model=MomentsResponse)
 async def get_all_moments(user_id: str):
     """
     获取所有 Moments
     """
     try:
-        mgrs = get_managers(user_id)
-        moment_manager = mgrs['moment_manager']
-        
-        moments = moment_manager.get_all_moments()
+        async with leased_managers("moments", user_id) as mgrs:
+            moments = await executor.run("moments", mgrs['moment_manager'].get_all_moments)
         
         # 反转列表，给每个 Moment 分配编号
         moments_for_numbering = list(reversed(moments))
@@ -395,10 +579,8 @@ async def get_style_profile(user_id: str):
     获取用户风格画像
     """
     try:
-        mgrs = get_managers(user_id)
-        style_rag = mgrs['style_rag']
-        
-        profile = style_rag.get_style_profile()
+        async with leased_managers("style", user_id) as mgrs:
+            profile = mgrs['style_rag'].get_style_profile()
         
         return StyleProfileResponse(profile=profile)
     except Exception as e:
@@ -412,7 +594,7 @@ async def text_to_speech_api(request: TTSRequest):
     返回音频文件路径
     """
     try:
-        audio_path = tts_generate(request.text)
+        audio_path = await executor.run("tts", tts_generate, request.text)
         
         if not audio_path or not os.path.exists(audio_path):
             raise HTTPException(status_code=500, detail="TTS 生成失败")
@@ -445,7 +627,7 @@ async def speech_to_text_api(audio_file: UploadFile = File(...)):
             tmp_file_path = tmp_file.name
         
         # 调用 ASR 引擎
-        text = asr_generate(tmp_file_path)
+        text = await executor.run("asr", asr_generate, tmp_file_path)
         
         # 删除临时文件
         try:
@@ -502,10 +684,11 @@ async def get_audio_file(filename: str):
 
 
 @app.post("/api/update-names")
-async def update_names(request: Dict):
+def update_names(request: Dict):
     """
     更新用户名字和 Agent 名字
     重命名所有相关用户数据，不删除之前的记录
+    （低频、纯同步的文件操作：用普通 def，由 FastAPI 放到线程池执行）
     
     Request body:
     {
@@ -554,7 +737,9 @@ async def update_names(request: Dict):
                 old_moments_dir.rename(new_moments_dir)
                 print(f"📁 Moments 目录已重命名：{old_user_id} -> {new_user_id}")
         
-        # 2. 重命名风格数据文件
+        # 2. 重命名风格数据文件（常驻用户内存中未写盘的风格数据先落盘）
+        if manager_registry.contains(old_user_id):
+            manager_registry.get(old_user_id)['style_rag'].flush()
         old_style_file = Path("storage/user_data") / f"{old_user_id}_style.json"
         new_style_file = Path("storage/user_data") / f"{new_user_id}_style.json"
         
@@ -576,17 +761,12 @@ async def update_names(request: Dict):
                 print(f"📁 风格文件已重命名：{old_user_id} -> {new_user_id}")
         
         # 3. 更新管理器实例（如果存在）
-        if old_user_id in managers:
-            # 更新管理器中的 user_id
-            mgrs = managers[old_user_id]
+        def _rename_managers(mgrs: Dict):
             mgrs['moment_manager'].set_user_id(new_user_name, new_agent_name)
             mgrs['style_rag'].set_user_id(new_user_name, new_agent_name)
             mgrs['context_rag'].set_user_id(new_user_name, new_agent_name)
-            
-            # 将管理器迁移到新的 user_id
-            managers[new_user_id] = mgrs
-            if old_user_id != new_user_id:
-                del managers[old_user_id]
+        
+        if manager_registry.rename(old_user_id, new_user_id, update=_rename_managers):
             print(f"📁 管理器已更新：{old_user_id} -> {new_user_id}")
         
         # 4. 保存名字到 names.json（用于持久化）
@@ -619,6 +799,21 @@ async def health_check():
     return {"status": "ok", "message": "API is running"}
 
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """运行指标：线程池排队深度、各路由并发与耗时、管理器注册表命中与回收、Embedding / 查询解析缓存命中率、检索门控、卡片任务、Moment 摘要缓存、LLM 网关（按模型并发 / 重试 / 耗时）"""
+    return {
+        "executor": executor.get_metrics(),
+        "managers": manager_registry.get_stats(),
+        "embedding_cache": get_embedding_cache().get_stats(),
+        "parse_cache": get_query_parser_stats(),
+        "retrieval_gate": get_gate_stats(),
+        "card_jobs": card_jobs.get_stats(),
+        "moment_digest": get_digest_cache().get_stats(),
+        "llm": get_gateway_stats()
+    }
+
+
 # ============================================================
 # 启动应用
 # ============================================================
@@ -633,12 +828,15 @@ if __name__ == "__main__":
     print("   ✅ POST /api/init - 初始化连接")
     print("   ✅ POST /api/moments/start - 开始新 Moment")
     print("   ✅ POST /api/chat - 发送消息")
+    print("   ✅ POST /api/chat/stream - 发送消息（SSE 流式回复）")
     print("   ✅ POST /api/moments/save - 保存 Moment")
+    print("   ✅ GET  /api/moments/{id}/card - 查询 Moment Card 生成状态")
     print("   ✅ GET  /api/moments - 获取所有 Moments")
     print("   ✅ GET  /api/style/profile - 获取风格画像")
     print("   ✅ POST /api/tts - 文本转语音")
     print("   ✅ POST /api/asr - 语音转文字")
     print("   ✅ POST /api/update-names - 更新用户名字")
+    print("   ✅ GET  /api/metrics - 运行指标")
     print("="*60)
     print("📚 API 文档: http://localhost:8000/docs")
     print("="*60 + "\n")
@@ -0,0 +1,347 @@
+"""
+Manager Registry - 按用户缓存的管理器注册表
+替代全局 managers 字典：限制常驻用户数，闲置超时自动回收
+
+特性：
+1. LRU：超过常驻上限（MAX_RESIDENT_USERS）时回收最久未使用的用户；
+   正在使用或有未保存对话的用户不回收，暂时超出上限，租约归还时再回收
+2. 闲置回收：超过 MANAGER_IDLE_TTL 秒未访问的用户被回收
+3. 回收时干净关闭：落盘 StyleRAG、等待 end_moment 后台任务、关闭 SQLite / ChromaDB
+4. 租约：请求 / 后台任务通过 acquire / release（或 lease）持有管理器；同一用户被回收后再次访问时，
+   等旧管理器关闭完成再创建，同一用户不会同时存在两组管理器
+5. 命中 / 未命中 / 回收计数
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# 默认常驻用户上限
+DEFAULT_MAX_RESIDENT_USERS = 256
+
+# 默认闲置回收时间（秒）
+DEFAULT_IDLE_TTL = 30 * 60
+
+# 闲置扫描最小间隔（秒），避免每次访问都遍历
+SWEEP_INTERVAL = 60
+
+# 应用退出时等待租约归还的最长时间（秒），超时后强制关闭
+SHUTDOWN_LEASE_TIMEOUT = 30
+
+
+class ManagerRegistry:
+    """
+    用户管理器注册表
+
+    每个条目是 {'storage_context', 'moment_manager', 'style_rag', 'context_rag'} 字典，
+    由 factory(user_id) 创建
+    """
+
+    def __init__(self, factory: Callable[[str], Dict],
+                 max_users: Optional[int] = None,
+                 idle_ttl: Optional[float] = None):
+        """
+        初始化注册表
+
+        Args:
+            factory: 创建某个用户管理器字典的函数
+            max_users: 最大常驻用户数，默认读取 MAX_RESIDENT_USERS
+            idle_ttl: 闲置回收秒数，默认读取 MANAGER_IDLE_TTL（<=0 表示不按闲置回收）
+        """
+        self._factory = factory
+        self.max_users = max_users or int(
+            os.getenv("MAX_RESIDENT_USERS", DEFAULT_MAX_RESIDENT_USERS)
+        )
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(
+            os.getenv("MANAGER_IDLE_TTL", DEFAULT_IDLE_TTL)
+        )
+
+        # user_id -> (managers, last_access)，按访问顺序排列（最近访问在末尾）
+        self._entries: "OrderedDict[str, Tuple[Dict, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        # id(managers) -> 未归还的租约数（包括已摘出注册表、等待关闭的条目）
+        self._leases: Dict[int, int] = {}
+        self._released = threading.Condition(self._lock)
+        self._last_sweep = time.monotonic()
+        # 正在创建中的用户 -> 创建锁（避免同一用户并发重复创建）
+        self._creating: Dict[str, threading.Lock] = {}
+        # 正在关闭的用户 -> 关闭完成事件（关闭完成前不为该用户创建新的管理器）
+        self._closing: Dict[str, threading.Event] = {}
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions_lru": 0,
+            "evictions_idle": 0,
+            "overflows": 0,
+        }
+
+        print(f"🗂️ ManagerRegistry 初始化: max_users={self.max_users}, idle_ttl={self.idle_ttl}s")
+
+    def get(self, user_id: str) -> Dict:
+        """
+        获取或创建用户的管理器（线程安全，不持有租约）
+
+        返回后条目仍可能被回收关闭；跨越多步操作使用管理器时用 acquire / lease
+        """
+        return self._get(user_id, lease=False)
+
+    def acquire(self, user_id: str) -> Dict:
+        """获取或创建用户的管理器并持有一个租约，用完必须调用 release"""
+        return self._get(user_id, lease=True)
+
+    def release(self, mgrs: Dict):
+        """归还 acquire 取得的租约（超出常驻上限时顺带回收已空闲的条目）"""
+        evicted = []
+        with self._lock:
+            key = id(mgrs)
+            count = self._leases.get(key, 0) - 1
+            if count > 0:
+                self._leases[key] = count
+            else:
+                self._leases.pop(key, None)
+                self._released.notify_all()
+                evicted = self._collect_over_capacity()
+        self._close_async(evicted)
+
+    @contextmanager
+    def lease(self, user_id: str):
+        """在 with 块内租用用户的管理器"""
+        mgrs = self.acquire(user_id)
+        try:
+            yield mgrs
+        finally:
+            self.release(mgrs)
+
+    def _get(self, user_id: str, lease: bool) -> Dict:
+        mgrs = self._touch(user_id, lease)
+        if mgrs is not None:
+            return mgrs
+
+        # 创建管理器较慢（初始化 SQLite / ChromaDB），只锁当前用户，不阻塞其他用户
+        with self._lock:
+            creating_lock = self._creating.setdefault(user_id, threading.Lock())
+        with creating_lock:
+            mgrs = self._touch(user_id, lease)
+            if mgrs is not None:
+                return mgrs
+
+            # 该用户的旧管理器还在关闭（落盘 StyleRAG、等待后台任务），关闭完成后再创建
+            with self._lock:
+                closing = self._closing.get(user_id)
+            if closing is not None:
+                closing.wait()
+
+            mgrs = self._factory(user_id)
+
+            with self._lock:
+                self._stats["misses"] += 1
+                self._entries[user_id] = (mgrs, time.monotonic())
+                if lease:
+                    self._leases[id(mgrs)] = 1
+                self._creating.pop(user_id, None)
+                evicted = self._collect_over_capacity(keep=user_id)
+
+        self._close_async(evicted)
+        return mgrs
+
+    def _touch(self, user_id: str, lease: bool = False) -> Optional[Dict]:
+        """命中时刷新访问时间（lease=True 时同时加租约）并顺带回收闲置用户，未命中返回 None"""
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._stats["hits"] += 1
+                if lease:
+                    key = id(entry[0])
+                    self._leases[key] = self._leases.get(key, 0) + 1
+                self._entries[user_id] = (entry[0], now)
+                self._entries.move_to_end(user_id)
+            evicted = self._collect_idle(now)
+
+        self._close_async(evicted)
+        return entry[0] if entry is not None else None
+
+    def contains(self, user_id: str) -> bool:
+        """用户是否常驻"""
+        with self._lock:
+            return user_id in self._entries
+
+    def rename(self, old_user_id: str, new_user_id: str,
+               update: Optional[Callable[[Dict], None]] = None) -> bool:
+        """
+        把常驻用户迁移到新的 user_id
+
+        回调在锁外执行（set_user_id 有文件 / 数据库 I/O），执行期间持有租约，条目不会被回收；
+        回调抛出异常时不迁移
+
+        Args:
+            old_user_id: 原用户 ID
+            new_user_id: 新用户 ID
+            update: 迁移前对管理器字典执行的回调（如 set_user_id）
+
+        Returns:
+            bool: 原用户是否常驻
+        """
+        with self._lock:
+            entry = self._entries.get(old_user_id)
+            if entry is None:
+                return False
+            mgrs = entry[0]
+            self._leases[id(mgrs)] = self._leases.get(id(mgrs), 0) + 1
+
+        replaced = None
+        try:
+            if update:
+                update(mgrs)
+            with self._lock:
+                if old_user_id in self._entries and self._entries[old_user_id][0] is mgrs:
+                    del self._entries[old_user_id]
+                replaced = self._entries.pop(new_user_id, None)
+                self._entries[new_user_id] = (mgrs, time.monotonic())
+        finally:
+            self.release(mgrs)
+
+        if replaced is not None and replaced[0] is not mgrs:
+            self._close_async([(new_user_id, replaced[0])])
+        return True
+
+    def _collect_idle(self, now: float) -> List[Tuple[str, Dict]]:
+        """摘出闲置超时的条目（需持有锁）"""
+        if self.idle_ttl <= 0 or now - self._last_sweep < SWEEP_INTERVAL:
+            return []
+        self._last_sweep = now
+
+        evicted = []
+        for user_id, (mgrs, last_access) in list(self._entries.items()):
+            if now - last_access < self.idle_ttl:
+                break  # 之后的条目访问时间更近
+            if self._has_unsaved_messages(mgrs) or self._is_leased(mgrs):
+                continue  # 有未保存的对话或正在使用，保留
+            del self._entries[user_id]
+            evicted.append((user_id, mgrs))
+            self._stats["evictions_idle"] += 1
+        return evicted
+
+    def _collect_over_capacity(self, keep: Optional[str] = None) -> List[Tuple[str, Dict]]:
+        """
+        超过常驻上限时按最久未使用摘出条目，不回收刚创建的 keep（需持有锁）
+
+        只回收没有被租用、也没有未保存对话的用户；都不能回收时暂时超出上限，
+        等租约归还（release）或下次创建用户时再回收
+        """
+        overflow = len(self._entries) - self.max_users
+        if overflow <= 0:
+            return []
+        victims = [
+            user_id for user_id, (mgrs, _) in self._entries.items()
+            if user_id != keep and not self._is_leased(mgrs) and not self._has_unsaved_messages(mgrs)
+        ][:overflow]
+        if len(victims) < overflow:
+            self._stats["overflows"] += 1
+            print(f"⚠️ ManagerRegistry: {overflow - len(victims)} 个用户正在使用或有未保存对话，"
+                  f"暂时超出常驻上限 ({len(self._entries) - len(victims)}/{self.max_users})")
+
+        evicted = []
+        for victim in victims:
+            mgrs, _ = self._entries.pop(victim)
+            evicted.append((victim, mgrs))
+            self._stats["evictions_lru"] += 1
+        return evicted
+
+    @staticmethod
+    def _has_unsaved_messages(mgrs: Dict) -> bool:
+        moment_manager = mgrs.get('moment_manager')
+        return bool(moment_manager and moment_manager.current_messages)
+
+    def _is_leased(self, mgrs: Dict) -> bool:
+        return self._leases.get(id(mgrs), 0) > 0
+
+    def _wait_released(self, user_id: str, mgrs: Dict, timeout: Optional[float] = None) -> bool:
+        """等待条目的所有租约归还，超时返回 False"""
+        with self._released:
+            if self._is_leased(mgrs):
+                print(f"🗂️ ManagerRegistry: 用户 {user_id} 仍在使用，等待租约归还后关闭")
+            return self._released.wait_for(lambda: not self._is_leased(mgrs), timeout=timeout)
+
+    def _close_async(self, evicted: List[Tuple[str, Dict]]):
+        """在后台线程关闭被回收的管理器（会等待 end_moment 后台任务，不阻塞请求）"""
+        if not evicted:
+            return
+        with self._lock:
+            for user_id, _ in evicted:
+                self._closing.setdefault(user_id, threading.Event())
+        threading.Thread(
+            target=self._close_all,
+            args=(evicted,),
+            name="registry_evict",
+            daemon=True
+        ).start()
+
+    def _close_all(self, evicted: List[Tuple[str, Dict]],
+                   lease_timeout: Optional[float] = None):
+        deadline = time.monotonic() + lease_timeout if lease_timeout is not None else None
+        for user_id, mgrs in evicted:
+            timeout = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            if not self._wait_released(user_id, mgrs, timeout):
+                print(f"⚠️ ManagerRegistry: 用户 {user_id} 的租约未归还，强制关闭")
+            try:
+                self._close_managers(user_id, mgrs)
+            finally:
+                with self._lock:
+                    closing = self._closing.pop(user_id, None)
+                if closing is not None:
+                    closing.set()
+
+    @staticmethod
+    def _close_managers(user_id: str, mgrs: Dict):
+        """
+        关闭一个用户的全部管理器
+
+        MomentManager / ContextRAG 使用共享的存储上下文时不会关闭它，
+        UserStorageContext 只在这里关闭一次
+        """
+        try:
+            style_rag = mgrs.get('style_rag')
+            if style_rag:
+                style_rag.flush()
+
+            moment_manager = mgrs.get('moment_manager')
+            if moment_manager:
+                # 等待进行中的 end_moment 异步任务（实体提取 + 向量写入）
+                moment_manager.shutdown()
+
+            context_rag = mgrs.get('context_rag')
+            if context_rag:
+                context_rag.close()
+
+            storage_context = mgrs.get('storage_context')
+            if storage_context:
+                storage_context.close()
+
+            print(f"🗂️ ManagerRegistry: 已回收用户 {user_id}")
+        except Exception as e:
+            print(f"⚠️ ManagerRegistry: 回收用户 {user_id} 失败: {e}")
+
+    def get_stats(self) -> Dict:
+        """获取统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resident_users"] = len(self._entries)
+            stats["leased_entries"] = len(self._leases)
+        stats["max_users"] = self.max_users
+        stats["idle_ttl"] = self.idle_ttl
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def shutdown(self):
+        """关闭所有常驻用户（应用退出时调用，同步等待，最多等 SHUTDOWN_LEASE_TIMEOUT 秒租约归还）"""
+        with self._lock:
+            evicted = list((user_id, entry[0]) for user_id, entry in self._entries.items())
+            self._entries.clear()
+        self._close_all(evicted, lease_timeout=SHUTDOWN_LEASE_TIMEOUT)
@@ -1,17 +1,18 @@
 # /backend/agent/reply_generator.py (V2 流式输出版)
 
 import os
+import re
 import json
 import traceback
-from http import HTTPStatus
 from datetime import datetime
 from typing import Generator, Tuple
 import dashscope
-from dashscope import Generation
+import openai
 from config.persona_config import get_system_prompt
 from config.emotion_color_map import get_all_emotions, DEFAULT_EMOTION
 from data_model.user_session import UserSession
 from dotenv import load_dotenv
+from backend.utils.llm_gateway import get_llm_client
 
 # 初始化 DashScope Key
 DASHSCOPE_API_KEY = os.getenv("ALIYUN_QWEN_KEY")
@@ -26,6 +27,9 @@ print("✅ ALIYUN_QWEN_KEY loaded successfully")
 dashscope.api_key = DASHSCOPE_API_KEY
 QWEN_MODEL = "qwen-plus"
 
+# 对话客户端（共享的 LLM 网关：连接池 + 限流 + 重试）
+client = get_llm_client(DASHSCOPE_API_KEY)
+
 
 def _detect_language(user_message: str, history_messages: list) -> str:
     """检测用户消息的语言"""
@@ -120,20 +124,19 @@ def generate_reply(user_message: str, session: UserSession, system_prompt: str =
     try:
         messages, reply_language = _build_messages(user_message, session, system_prompt)
         
-        response = Generation.call(
-            model=QWEN_MODEL,
-            messages=messages,
-            result_format='message',
-            temperature=0.75,
-            top_p=0.8,
-            max_tokens=256
-        )
-        
-        if response.status_code != HTTPStatus.OK:
-            print(f"DashScope API Error: {response.code} - {response.message}")
+        try:
+            response = client.chat.completions.create(
+                model=QWEN_MODEL,
+                messages=messages,
+                temperature=0.75,
+                top_p=0.8,
+                max_tokens=256
+            )
+        except openai.APIStatusError as e:
+            print(f"DashScope API Error: {e.status_code} - {e.message}")
             return "信号不好，我正在重连...刚才你说什么？", DEFAULT_EMOTION
         
-        raw_output = response.output.choices[0].message.content.strip()
+        raw_output = response.choices[0].message.content.strip()
         
         try:
             cleaned_output = raw_output.strip('```json').strip('```').strip()
@@ -160,95 +163,114 @@ def generate_reply(user_message: str, session: UserSession, system_prompt: str =
         return default_reply_zh, DEFAULT_EMOTION
 
 
+_REPLY_KEY_RE = re.compile(r'"reply"\s*:\s*"')
+
+
+def _decode_partial_reply(text: str) -> str:
+    """
+    从（可能不完整的）JSON 输出中解码 reply 字符串已生成的部分
+
+    按 JSON 转义规则解码（\\" \\n \\uXXXX……），遇到未转义的结束引号停止；
+    末尾不完整的转义序列（如只到了反斜杠、\\u 后不足 4 位、代理对只有前半）留到下一段再解码，
+    保证每次结果都是下一次结果的前缀
+    """
+    match = _REPLY_KEY_RE.search(text)
+    if not match:
+        return ""
+
+    raw = text[match.end():]
+    i, safe_end = 0, 0
+    while i < len(raw):
+        c = raw[i]
+        if c == '"':
+            break
+        if c == '\\':
+            if i + 1 >= len(raw):
+                break
+            if raw[i + 1] == 'u':
+                if i + 6 > len(raw):
+                    break
+                try:
+                    code = int(raw[i + 2:i + 6], 16)
+                except ValueError:
+                    break
+                # 高位代理需要紧跟低位代理一起解码
+                if 0xD800 <= code <= 0xDBFF:
+                    if i + 12 > len(raw):
+                        break
+                    i += 12
+                else:
+                    i += 6
+            else:
+                i += 2
+        else:
+            i += 1
+        safe_end = i
+
+    try:
+        return json.loads('"' + raw[:safe_end] + '"', strict=False)
+    except (json.JSONDecodeError, ValueError):
+        return raw[:safe_end]
+
+
 def generate_reply_stream(user_message: str, session: UserSession, 
                           system_prompt: str = None) -> Generator[Tuple[str, str, bool], None, None]:
     """
     流式生成回复
     
     Yields:
-        Tuple[str, str, bool]: (文本片段, 情绪, 是否完成)
-        - 中间过程: ("文本片段", "", False)
-        - 最终结果: ("", "emotion", True)
+        Tuple[str, str, bool]: (文本, 情绪, 是否完成)
+        - 中间过程: ("新增的回复片段", "", False)，片段已按 JSON 转义解码
+        - 最终结果: ("完整回复", "emotion", True)，完整回复取自解析后的 reply 字段
+          （与 generate_reply 一致，保存和 TTS 使用这一份），出错或未解析出 reply 时为兜底内容
     """
     try:
         messages, reply_language = _build_messages(user_message, session, system_prompt)
         
         # 流式调用
-        responses = Generation.call(
+        responses = client.chat.completions.create(
             model=QWEN_MODEL,
             messages=messages,
-            result_format='message',
             temperature=0.75,
             top_p=0.8,
             max_tokens=256,
-            stream=True,  # 启用流式
-            incremental_output=True  # 增量输出
+            stream=True  # 启用流式（增量输出）
         )
         
         full_response = ""
+        # 已输出的 reply 内容（局部状态，多个请求并发流式生成时互不干扰）
+        last_content = ""
         
         for response in responses:
-            if response.status_code == HTTPStatus.OK:
-                chunk = response.output.choices[0].message.content
+            if response.choices:
+                chunk = response.choices[0].delta.content
                 if chunk:
                     full_response += chunk
                     
-                    # 尝试解析 JSON（可能还不完整）
-                    # 先返回文本片段
-                    # 注意：因为输出是 JSON 格式，我们需要特殊处理
-                    
-                    # 检查是否在 "reply": " 之后
-                    if '"reply"' in full_response:
-                        # 提取 reply 的内容
-                        try:
-                            # 尝试找到 reply 的值
-                            start = full_response.find('"reply"')
-                            if start != -1:
-                                # 找到 reply 后的第一个引号
-                                quote_start = full_response.find('"', start + 8)
-                                if quote_start != -1:
-                                    # 找到内容
-                                    content_start = quote_start + 1
-                                    # 尝试找到结束引号（但可能还没到）
-                                    content_so_far = full_response[content_start:]
-                                    # 移除可能的未完成部分
-                                    if '"' in content_so_far:
-                                        content_so_far = content_so_far[:content_so_far.find('"')]
-                                    
-                                    # 只输出新增的部分
-                                    if hasattr(generate_reply_stream, '_last_content'):
-                                        new_content = content_so_far[len(generate_reply_stream._last_content):]
-                                    else:
-                                        new_content = content_so_far
-                                    
-                                    generate_reply_stream._last_content = content_so_far
-                                    
-                                    if new_content:
-                                        yield (new_content, "", False)
-                        except:
-                            pass
-            else:
-                print(f"Stream Error: {response.code} - {response.message}")
-        
-        # 清理状态
-        if hasattr(generate_reply_stream, '_last_content'):
-            delattr(generate_reply_stream, '_last_content')
+                    # 输出是 JSON，只推送 "reply" 字符串中新解码出的部分
+                    content_so_far = _decode_partial_reply(full_response)
+                    new_content = content_so_far[len(last_content):]
+                    if new_content:
+                        last_content = content_so_far
+                        yield (new_content, "", False)
         
         # 解析完整响应
         try:
             cleaned = full_response.strip('```json').strip('```').strip()
             data = json.loads(cleaned)
+            reply = str(data.get('reply') or last_content or cleaned).strip()
             emotion = data.get('emotion', DEFAULT_EMOTION)
             
             supported_emotions = get_all_emotions()
             if emotion not in supported_emotions:
                 emotion = DEFAULT_EMOTION
             
-            yield ("", emotion, True)
+            yield (reply, emotion, True)
             
         except json.JSONDecodeError:
             print(f"警告：流式输出 JSON 解析失败：{full_response[:200]}")
-            yield ("", DEFAULT_EMOTION, True)
+            # 已解码出 reply 片段时用片段，否则把原始输出作为回复（与 generate_reply 一致）
+            yield (last_content.strip() or full_response.strip(), DEFAULT_EMOTION, True)
             
     except Exception as e:
         print(f"流式生成异常：{e}")
@@ -304,22 +326,20 @@ def generate_reply_stream_simple(user_message: str, session: UserSession,
         messages.append({'role': 'user', 'content': final_prompt})
         
         # 流式调用
-        responses = Generation.call(
+        responses = client.chat.completions.create(
             model=QWEN_MODEL,
             messages=messages,
-            result_format='message',
             temperature=0.75,
             top_p=0.8,
             max_tokens=256,
-            stream=True,
-            incremental_output=True
+            stream=True
         )
         
         full_response = ""
         
         for response in responses:
-            if response.status_code == HTTPStatus.OK:
-                chunk = response.output.choices[0].message.content
+            if response.choices:
+                chunk = response.choices[0].delta.content
                 if chunk:
                     full_response += chunk
                     yield chunk
@@ -339,13 +359,6 @@ def generate_reply_stream_simple(user_message: str, session: UserSession,
 def _detect_emotion(user_message: str, agent_reply: str) -> str:
     """检测情绪（单独调用，快速）"""
     try:
-        from openai import OpenAI
-        
-        client = OpenAI(
-            api_key=DASHSCOPE_API_KEY,
-            base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-        )
-        
         supported_emotions = get_all_emotions()
         
         response = client.chat.completions.create(
@@ -12,6 +12,8 @@ from pathlib import Path
 from dotenv import load_dotenv
 from typing import Optional
 
+from backend.utils.llm_gateway import http_request
+
 # 加载环境变量
 # 先尝试从系统环境变量读取（Railway等云平台）
 MINIMAX_API_KEY = os.getenv("MINIMAX_API_KEY")
@@ -161,7 +163,9 @@ def text_to_speech(
             payload["voice_setting"]["emotion"] = emotion
         
         # 调用 MiniMax API
-        response = requests.post(
+        response = http_request(
+            "minimax-tts",
+            "POST",
             MINIMAX_TTS_API_URL,
             headers=headers,
             json=payload,
@@ -214,7 +218,7 @@ def text_to_speech(
             audio_url = result.get("data", {}).get("audio")
             if audio_url:
                 try:
-                    audio_response = requests.get(audio_url, timeout=60)
+                    audio_response = http_request("minimax-audio", "GET", audio_url, timeout=60)
                     if audio_response.status_code == 200:
                         audio_data = audio_response.content
                     else:
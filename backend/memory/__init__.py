@@ -3,19 +3,33 @@ Memory Module - RAG 记忆系统（V4 混合检索 + Rerank 版）
 
 包含：
 - MomentManager: Moment 会话管理（SQLite + 向量存储）
+- UserStorageContext: 用户存储上下文（MomentManager / ContextRAG 共享）
+- EmbeddingCache: Embedding 两级缓存（内存 LRU + SQLite）
 - ContextRAG: 上下文检索（混合检索 + Rerank）
+- RetrievalGate: 检索门控（闲聊跳过检索）
 - VectorStore: 向量存储层
 - QueryParser: LLM 查询理解
-- Reranker: 检索结果重排序
+- ParseCache: 查询解析缓存（LRU + TTL + 近似命中）
+- QueryClassifier: 本地查询分类（QueryParser 快速通道）
+- Reranker: 检索结果重排序（local / onnx / llm / tiered，RERANKER_BACKEND 选择）
 - StyleRAG: 风格学习（jieba 分词）
 - MomentCard: Moment 卡片生成
+- MomentDigest: Moment 摘要（一次调用生成实体 + 情绪 + 总结 + 标题，按消息哈希缓存）
+- CardJobQueue: Moment 后处理任务队列（Card 生成 + 实体提取 + 向量写入，SQLite 持久化）
 """
 
 from .moment_storage import MomentStorage
+from .storage_context import UserStorageContext
+from .embedding_cache import EmbeddingCache, get_embedding_cache
+from .parse_cache import ParseCache
+from .query_classifier import QueryClassifier, get_query_classifier
 from .moment_manager import MomentManager
 from .moment_card import generate_moment_card, MomentCard
+from .moment_digest import generate_moment_digest, get_digest_cache
+from .card_jobs import CardJobQueue
 from .style_rag import StyleRAG
 from .context_rag import ContextRAG
+from .retrieval_gate import RetrievalGate, get_gate_stats
 
 # 可选模块（可能未安装依赖）
 try:
@@ -30,21 +44,36 @@ except ImportError:
     get_query_parser = None
 
 try:
-    from .reranker import Reranker, get_reranker
+    from .reranker import Reranker, LocalReranker, TieredReranker, get_reranker
 except ImportError:
     Reranker = None
+    LocalReranker = None
+    TieredReranker = None
     get_reranker = None
 
 __all__ = [
     'MomentStorage',
+    'UserStorageContext',
+    'EmbeddingCache',
+    'get_embedding_cache',
+    'ParseCache',
+    'QueryClassifier',
+    'get_query_classifier',
     'MomentManager',
     'generate_moment_card',
     'MomentCard',
+    'generate_moment_digest',
+    'get_digest_cache',
+    'CardJobQueue',
     'StyleRAG',
     'ContextRAG',
+    'RetrievalGate',
+    'get_gate_stats',
     'VectorStore',
     'QueryParser',
     'get_query_parser',
     'Reranker',
+    'LocalReranker',
+    'TieredReranker',
     'get_reranker'
 ]
@@ -0,0 +1,402 @@
+"""
+Card Jobs - Moment 后处理任务队列
+/api/moments/save 只把 Moment 写入 SQLite，Card 生成、实体提取、向量写入作为任务交给后台 worker
+
+特性：
+1. 任务表持久化在 SQLite，进程重启后未完成的任务（pending / 中断的 running）继续执行
+2. 每个 Moment 一个任务，重复提交返回已有任务
+3. 失败按指数退避重试，超过次数标记为 failed
+4. 处理逻辑由调用方传入（handler(user_id, moment_id) -> card），队列本身不依赖管理器
+5. 租约：领取任务时写入 owner（worker ID）和 lease_expires，执行期间定时续租；
+   多个进程共用一个任务表时，只有租约过期（持有者已退出）的 running 任务会被重新领取
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+
+# 默认持久化路径
+DEFAULT_CARD_JOB_PATH = "storage/card_jobs.db"
+
+# 默认 worker 数量
+DEFAULT_WORKERS = 2
+
+# 默认最大尝试次数
+DEFAULT_MAX_ATTEMPTS = 3
+
+# 重试退避基数（秒，第 n 次失败后等待 RETRY_BACKOFF * 2^(n-1)）
+RETRY_BACKOFF = 5.0
+
+# 任务租约时长（秒），执行期间每 1/3 租约续租一次
+DEFAULT_LEASE_SECONDS = 60.0
+
+# 空闲时轮询间隔（秒，用于拾取到期的重试）
+POLL_INTERVAL = 1.0
+
+# 任务状态
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class CardJobQueue:
+    """
+    Moment 后处理任务队列（线程安全，进程内 worker 线程执行）
+    """
+
+    def __init__(self, handler: Callable[[str, str], Dict],
+                 db_path: str = DEFAULT_CARD_JOB_PATH,
+                 workers: Optional[int] = None,
+                 max_attempts: Optional[int] = None,
+                 retry_backoff: Optional[float] = None,
+                 lease_seconds: Optional[float] = None):
+        """
+        初始化任务队列
+
+        Args:
+            handler: 任务处理函数 (user_id, moment_id) -> card 字典，抛出异常表示失败
+            db_path: 任务表 SQLite 路径
+            workers: worker 线程数，默认读取 CARD_JOB_WORKERS
+            max_attempts: 最大尝试次数，默认读取 CARD_JOB_MAX_ATTEMPTS
+            retry_backoff: 重试退避基数（秒），默认读取 CARD_JOB_RETRY_BACKOFF
+            lease_seconds: 任务租约时长（秒），默认读取 CARD_JOB_LEASE_SECONDS
+        """
+        self.handler = handler
+        self.workers = workers or int(os.getenv("CARD_JOB_WORKERS", DEFAULT_WORKERS))
+        self.max_attempts = max_attempts or int(os.getenv("CARD_JOB_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(
+            os.getenv("CARD_JOB_RETRY_BACKOFF", RETRY_BACKOFF)
+        )
+        self.lease_seconds = lease_seconds or float(
+            os.getenv("CARD_JOB_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)
+        )
+        # 本进程内队列的 worker ID（写入任务的 owner 列）
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 多个进程共用任务表时等待对方的写事务
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=10)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS card_jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                moment_id TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                card TEXT,
+                run_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT,
+                lease_expires REAL
+            )
+        """)
+        # 旧任务表补上租约列
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(card_jobs)")}
+        for column, ddl in (("owner", "TEXT"), ("lease_expires", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE card_jobs ADD COLUMN {column} {ddl}")
+        self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_card_jobs_status
+            ON card_jobs(status, run_at)
+        """)
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+        self._stats = {"completed": 0, "failed": 0, "retried": 0, "total_ms": 0.0}
+
+        print(f"🗂️ CardJobQueue 初始化: {self.db_path} (workers={self.workers}, "
+              f"max_attempts={self.max_attempts})")
+
+    # ============================================================
+    # 生命周期
+    # ============================================================
+
+    def start(self):
+        """
+        启动 worker 和续租线程
+
+        上次进程中断时处于 running 的任务不在这里重置：租约过期后由 _claim 重新领取，
+        其他进程仍在执行（租约有效）的任务不受影响
+        """
+        if self._threads:
+            return
+        with self._lock:
+            pending = self._conn.execute(
+                "SELECT COUNT(*) FROM card_jobs WHERE status = ?", (STATUS_PENDING,)
+            ).fetchone()[0]
+            expired = self._conn.execute(
+                "SELECT COUNT(*) FROM card_jobs WHERE status = ? AND lease_expires < ?",
+                (STATUS_RUNNING, time.time())
+            ).fetchone()[0]
+        if pending or expired:
+            print(f"🗂️ CardJobQueue 恢复任务: {pending} 个待处理，{expired} 个租约已过期")
+
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"card_job_{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat_loop, name="card_job_lease", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0):
+        """停止 worker（未完成的任务租约立即过期，下次启动或其他进程重新执行）"""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        with self._lock:
+            self._conn.execute(
+                "UPDATE card_jobs SET lease_expires = ? WHERE owner = ? AND status = ?",
+                (time.time(), self.worker_id, STATUS_RUNNING)
+            )
+            self._conn.commit()
+
+    def close(self):
+        """停止 worker 并关闭连接"""
+        self.stop()
+        with self._lock:
+            self._conn.close()
+
+    # ============================================================
+    # 任务
+    # ============================================================
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        job["job_id"] = job.pop("id")
+        job["card"] = json.loads(job["card"]) if job["card"] else None
+        return job
+
+    def enqueue(self, user_id: str, moment_id: str) -> Dict:
+        """
+        提交任务（同一 Moment 已有任务时直接返回）
+
+        Returns:
+            Dict: 任务（job_id、status、attempts、card……）
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                INSERT OR IGNORE INTO card_jobs
+                (id, user_id, moment_id, status, attempts, run_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 0, ?, ?, ?)
+            """, (uuid.uuid4().hex, user_id, moment_id, STATUS_PENDING, now, now, now))
+            self._conn.commit()
+            row = self._conn.execute(
+                "SELECT * FROM card_jobs WHERE moment_id = ?", (moment_id,)
+            ).fetchone()
+        self._wakeup.set()
+        return self._row_to_job(row)
+
+    def get_job(self, moment_id: str) -> Optional[Dict]:
+        """按 Moment ID 查询任务"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM card_jobs WHERE moment_id = ?", (moment_id,)
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def _claim(self) -> Optional[Dict]:
+        """
+        领取一个任务并标记为 running（写入 owner 和租约）
+
+        可领取：到期的 pending 任务，或租约已过期的 running 任务（持有者已退出）；
+        条件更新保证多个进程不会领取同一个任务
+        """
+        now = time.time()
+        with self._lock:
+            for _ in range(3):
+                row = self._conn.execute("""
+                    SELECT * FROM card_jobs
+                    WHERE (status = ? AND run_at <= ?) OR (status = ? AND lease_expires < ?)
+                    ORDER BY created_at LIMIT 1
+                """, (STATUS_PENDING, now, STATUS_RUNNING, now)).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == STATUS_RUNNING and row["attempts"] >= self.max_attempts:
+                    # 每次执行都没等到结果持有者就退出了，不再重试
+                    self._conn.execute("""
+                        UPDATE card_jobs SET status = ?, error = ?, owner = NULL,
+                            lease_expires = NULL, updated_at = ?
+                        WHERE id = ? AND status = ? AND attempts = ?
+                    """, (STATUS_FAILED, "租约过期次数超过上限", now,
+                          row["id"], STATUS_RUNNING, row["attempts"]))
+                    self._conn.commit()
+                    continue
+                claimed = self._conn.execute("""
+                    UPDATE card_jobs SET status = ?, attempts = attempts + 1, owner = ?,
+                        lease_expires = ?, updated_at = ?
+                    WHERE id = ? AND status = ? AND attempts = ?
+                """, (STATUS_RUNNING, self.worker_id, now + self.lease_seconds, now,
+                      row["id"], row["status"], row["attempts"])).rowcount
+                self._conn.commit()
+                if claimed:
+                    break
+            else:
+                return None  # 连续被其他进程抢先，下一轮再领取
+
+        if row["status"] == STATUS_RUNNING:
+            print(f"🗂️ [任务] 接管租约过期的任务 {row['moment_id']}（原持有者 {row['owner']}）")
+        job = self._row_to_job(row)
+        job["attempts"] += 1
+        job["status"] = STATUS_RUNNING
+        job["owner"] = self.worker_id
+        return job
+
+    def _renew_leases(self):
+        """为本队列正在执行的任务续租"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("""
+                UPDATE card_jobs SET lease_expires = ?
+                WHERE owner = ? AND status = ?
+            """, (now + self.lease_seconds, self.worker_id, STATUS_RUNNING))
+            self._conn.commit()
+
+    def _heartbeat_loop(self):
+        """续租线程：每 1/3 租约时长续租一次"""
+        while not self._stopping.wait(self.lease_seconds / 3):
+            try:
+                self._renew_leases()
+            except sqlite3.Error as e:
+                print(f"⚠️ [任务] 续租失败: {e}")
+
+    def _finish(self, job: Dict, card: Optional[Dict] = None, error: Optional[str] = None):
+        """记录任务结果（失败且未超过次数时按退避重新排队；租约已被其他 worker 接管时放弃）"""
+        now = time.time()
+        if error is None:
+            status, run_at = STATUS_DONE, now
+        elif job["attempts"] < self.max_attempts:
+            status, run_at = STATUS_PENDING, now + self.retry_backoff * 2 ** (job["attempts"] - 1)
+        else:
+            status, run_at = STATUS_FAILED, now
+
+        with self._lock:
+            updated = self._conn.execute("""
+                UPDATE card_jobs SET status = ?, error = ?, card = ?, run_at = ?, updated_at = ?,
+                    owner = NULL, lease_expires = NULL
+                WHERE id = ? AND owner = ? AND status = ?
+            """, (status, error, json.dumps(card, ensure_ascii=False) if card else None,
+                  run_at, now, job["job_id"], self.worker_id, STATUS_RUNNING)).rowcount
+            self._conn.commit()
+            if not updated:
+                print(f"⚠️ [任务] {job['moment_id']} 的租约已被接管，丢弃本次结果")
+                return STATUS_RUNNING
+            if status == STATUS_DONE:
+                self._stats["completed"] += 1
+            elif status == STATUS_FAILED:
+                self._stats["failed"] += 1
+            else:
+                self._stats["retried"] += 1
+        return status
+
+    def _worker_loop(self):
+        """worker：领取任务 → 执行 handler → 记录结果；没有任务时等待唤醒或轮询"""
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+
+            print(f"🗂️ [任务] 开始处理 {job['moment_id']} (第 {job['attempts']} 次)")
+            t0 = time.perf_counter()
+            try:
+                card = self.handler(job["user_id"], job["moment_id"])
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+                with self._lock:
+                    self._stats["total_ms"] += elapsed_ms
+                self._finish(job, card=card)
+                print(f"🗂️ [任务] 完成 {job['moment_id']} ({elapsed_ms:.0f}ms)")
+            except Exception as e:
+                status = self._finish(job, error=str(e))
+                print(f"⚠️ [任务] 处理失败 {job['moment_id']}: {e} → {status}")
+
+    def get_stats(self) -> Dict:
+        """各状态任务数 + 本进程完成 / 失败 / 重试次数、平均耗时"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM card_jobs GROUP BY status"
+            ).fetchall()
+            stats = dict(self._stats)
+        stats["by_status"] = {status: count for status, count in rows}
+        stats["avg_ms"] = round(stats.pop("total_ms") / stats["completed"], 1) if stats["completed"] else 0.0
+        return stats
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_card_jobs():
+    """测试任务队列（含重试和重启恢复）"""
+    import tempfile
+
+    print("\n" + "="*60)
+    print("🧪 测试 CardJobQueue")
+    print("="*60 + "\n")
+
+    db_path = os.path.join(tempfile.mkdtemp(), "card_jobs.db")
+    calls: Dict[str, int] = {}
+
+    def handler(user_id: str, moment_id: str) -> Dict:
+        calls[moment_id] = calls.get(moment_id, 0) + 1
+        time.sleep(0.1)
+        if moment_id == "moment_flaky" and calls[moment_id] == 1:
+            raise RuntimeError("LLM 超时")
+        return {"moment_id": moment_id, "title": f"{user_id} 的卡片"}
+
+    queue = CardJobQueue(handler, db_path=db_path, workers=2, retry_backoff=0.2)
+    queue.start()
+    for moment_id in ["moment_1", "moment_2", "moment_flaky"]:
+        job = queue.enqueue("test_user", moment_id)
+        print(f"   📥 {moment_id}: {job['job_id'][:8]} {job['status']}")
+    queue.enqueue("test_user", "moment_1")  # 重复提交
+
+    time.sleep(2)
+    for moment_id in ["moment_1", "moment_2", "moment_flaky"]:
+        job = queue.get_job(moment_id)
+        print(f"   📤 {moment_id}: {job['status']} attempts={job['attempts']} card={job['card']}")
+    print(f"\n📊 统计: {queue.get_stats()}")
+    queue.close()
+
+    # 模拟另一个进程在任务执行中退出：租约过期的 running 任务被重新领取
+    conn = sqlite3.connect(db_path)
+    conn.execute("""UPDATE card_jobs SET status = 'running', owner = 'dead-worker', lease_expires = 0
+                    WHERE moment_id = 'moment_2'""")
+    conn.commit()
+    conn.close()
+    queue = CardJobQueue(handler, db_path=db_path, workers=1, retry_backoff=0.2)
+    queue.start()
+    time.sleep(1)
+    print(f"\n🔁 重启后 moment_2: {queue.get_job('moment_2')['status']}, 处理次数={calls['moment_2']}")
+    queue.close()
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_card_jobs()
@@ -5,25 +5,24 @@ Context RAG - 上下文检索（V4 混合检索 + Rerank 版）
 1. SQLite 结构化检索（V2）
 2. 向量语义检索（V3）
 3. LLM Query 理解（V3）
-4. 混合检索 + 结果融合（V3）
+4. 混合检索 + 结果融合（V3，RRF / 归一化加权 + MMR）
 5. Rerank 重排序（V4 新增）
+6. 并行检索流水线：LLM 解析的同时推测执行向量化和结构化检索
 """
 
+import os
 import json
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Tuple, Optional
 from datetime import datetime
 
 # 导入存储层
-from .moment_storage import MomentStorage
-
-# 导入向量存储层
-try:
-    from .vector_store import VectorStore
-    VECTOR_AVAILABLE = True
-except ImportError:
-    VECTOR_AVAILABLE = False
+from .moment_storage import epoch_range, score_structured_hits, timestamp_epoch
+from .storage_context import UserStorageContext
 
 # 导入查询解析器
 try:
@@ -32,6 +31,15 @@ try:
 except ImportError:
     QUERY_PARSER_AVAILABLE = False
 
+# 事实查询正则（本地分类器与降级规则共用）
+from .query_classifier import FACT_PATTERNS
+
+# 多路结果融合
+from .fusion import fuse
+
+# 检索门控（闲聊跳过检索）
+from .retrieval_gate import RetrievalGate
+
 # 导入 Reranker
 try:
     from .reranker import Reranker, get_reranker
@@ -39,6 +47,46 @@ try:
 except ImportError:
     RERANKER_AVAILABLE = False
 
+# 中文分词（推测执行的关键词提取）
+try:
+    import jieba
+    jieba.setLogLevel(jieba.logging.INFO)  # 减少日志输出
+    JIEBA_AVAILABLE = True
+except ImportError:
+    JIEBA_AVAILABLE = False
+
+
+# 默认实体类型（降级配置和推测执行的结构化检索使用）
+DEFAULT_ENTITY_TYPES = ["objects", "places", "people", "events"]
+
+# 模糊时间引用（最近 / 这几天）：加权窗口内的 Moment 检索分数乘以 1 + RECENCY_BOOST
+RECENCY_BOOST = float(os.getenv("RECENCY_BOOST", 0.3))
+
+# 检索流水线线程池（所有用户共享）
+_retrieval_executor: Optional[ThreadPoolExecutor] = None
+_retrieval_executor_lock = threading.Lock()
+
+
+def _get_retrieval_executor() -> ThreadPoolExecutor:
+    """获取检索流水线线程池（RETRIEVAL_WORKERS 个线程）"""
+    global _retrieval_executor
+    with _retrieval_executor_lock:
+        if _retrieval_executor is None:
+            _retrieval_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("RETRIEVAL_WORKERS", 8)),
+                thread_name_prefix="retrieval"
+            )
+        return _retrieval_executor
+
+
+def _run_timed(timings: Dict, stage: str, func, *args, **kwargs):
+    """执行并记录阶段耗时（毫秒）"""
+    t0 = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timings[f"{stage}_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
 
 class ContextRAG:
     """
@@ -53,7 +101,8 @@ class ContextRAG:
     """
     
     def __init__(self, user_id: str = None, base_moments_dir: str = "storage", 
-                 enable_rerank: bool = True):
+                 enable_rerank: bool = True,
+                 storage_context: Optional[UserStorageContext] = None):
         """
         初始化 Context RAG
         
@@ -61,25 +110,23 @@ class ContextRAG:
             user_id: 用户唯一标识
             base_moments_dir: Moments 基础目录
             enable_rerank: 是否启用 Rerank
+            storage_context: 共享的用户存储上下文（与 MomentManager 共用），不传则自建
         """
         self.user_id = user_id or "default_user"
         self.base_moments_dir = Path(base_moments_dir)
         self.enable_rerank = enable_rerank
         
-        # SQLite 存储
-        self.storage = MomentStorage(
-            user_id=self.user_id,
-            base_dir=str(self.base_moments_dir)
-        )
-        
-        # 向量存储
-        if VECTOR_AVAILABLE:
-            self.vector_store = VectorStore(
+        # SQLite 存储 + 向量存储（优先使用共享上下文）
+        # 自建的上下文由自己关闭；共享的上下文由持有者（ManagerRegistry）统一关闭
+        self._owns_storage = storage_context is None
+        if storage_context is None:
+            storage_context = UserStorageContext(
                 user_id=self.user_id,
                 base_dir=str(self.base_moments_dir)
             )
-        else:
-            self.vector_store = None
+        self.storage_context = storage_context
+        self.storage = storage_context.storage
+        self.vector_store = storage_context.vector_store
         
         # 查询解析器
         if QUERY_PARSER_AVAILABLE:
@@ -93,29 +140,54 @@ class ContextRAG:
         else:
             self.reranker = None
         
+        # 检索门控（RETRIEVAL_GATE_ENABLED=0 关闭，每轮都检索）
+        if os.getenv("RETRIEVAL_GATE_ENABLED", "1") != "0":
+            self.gate = RetrievalGate(self.storage)
+        else:
+            self.gate = None
+        
         # 兼容旧代码
         self.moments_dir = self.base_moments_dir / "moments" / self.user_id
         
+        # 最近一次检索的各阶段耗时
+        self.last_timings: Dict = {}
+        # 最近一次检索解析出的查询类型（generate_context_prompt 判断事实查询时复用，不再解析一次）
+        self.last_query_type: Optional[str] = None
+        
         print(f"🔍 ContextRAG V4 初始化: user={self.user_id}")
         print(f"   结构化检索: ✅")
         print(f"   向量检索: {'✅' if self.vector_store else '❌'}")
         print(f"   Query 解析: {'✅' if self.query_parser else '❌'}")
         print(f"   Rerank: {'✅' if self.reranker else '❌'}")
+        print(f"   检索门控: {'✅' if self.gate else '❌'}")
     
     def set_user_id(self, user_name: str, agent_name: str):
         """设置用户 ID"""
         self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
-        self.storage.set_user_id(user_name, agent_name)
-        
-        if self.vector_store:
-            self.vector_store.set_user_id(user_name, agent_name)
+        # 共享上下文重复设置同一用户时不会重新初始化
+        self.storage_context.set_user_id(user_name, agent_name)
+        if self.gate:
+            self.gate.invalidate()
         
         self.moments_dir = self.base_moments_dir / "moments" / self.user_id
     
+    def close(self):
+        """释放自建的存储连接（共享的上下文由持有者关闭；Query 解析器和 Reranker 为全局单例，不在此关闭）"""
+        if self._owns_storage:
+            self.storage_context.close()
+    
     def search(self, query: str, top_k: int = 3) -> List[Dict]:
         """
         混合检索（主入口）
         
+        流水线：
+        1. LLM 解析查询的同时，推测执行原始查询的向量化和规则关键词的结构化检索
+        2. 解析完成后剪掉被禁用的分支；推测执行取回的实体命中按解析出的关键词重新打分，
+           只补查推测没覆盖的关键词；解析出的时间范围下推到 SQLite 和向量后端
+        3. 融合 → 加载 Moment → Rerank
+        
+        各阶段耗时记录在 self.last_timings，解析出的查询类型记录在 self.last_query_type
+        
         Args:
             query: 查询文本
             top_k: 返回数量
@@ -124,10 +196,33 @@ class ContextRAG:
             List[Dict]: 检索结果
         """
         print(f"\n🔍 混合检索: '{query}'")
+        timings: Dict = {}
+        t_start = time.perf_counter()
+        executor = _get_retrieval_executor()
+        
+        # 1. 解析查询 + 推测执行
+        spec_embedding_future = None
+        if self.vector_store:
+            spec_embedding_future = executor.submit(
+                _run_timed, timings, "embed_speculative",
+                self.vector_store.get_embeddings_batch, [query]
+            )
         
-        # 1. 解析查询
         if self.query_parser:
-            search_config = self.query_parser.get_search_config(query)
+            # 解析缓存近似层复用推测执行的查询向量（不再单独向量化一次）
+            embed_fn = (lambda _q: spec_embedding_future.result()[0]) if spec_embedding_future else None
+            parse_future = executor.submit(
+                _run_timed, timings, "parse", self.query_parser.get_search_config, query, embed_fn
+            )
+        else:
+            parse_future = None
+        spec_structured_future = executor.submit(
+            _run_timed, timings, "structured_speculative",
+            self._search_structured_speculative, query
+        )
+        
+        if parse_future:
+            search_config = parse_future.result()
             print(f"   📊 检索配置: strategy={search_config.get('use_structured', True)}/{search_config.get('use_vector', True)}")
             print(f"   📊 关键词: {search_config.get('keywords', [])}")
             print(f"   📊 扩展查询: {search_config.get('expanded_queries', [])}")
@@ -139,155 +234,182 @@ class ContextRAG:
                 "structured_weight": 0.5,
                 "vector_weight": 0.5,
                 "keywords": self._extract_keywords_simple(query),
-                "entity_types": ["objects", "places", "people", "events"],
+                "entity_types": DEFAULT_ENTITY_TYPES,
+                "query_type": "fact" if any(re.search(p, query) for p in FACT_PATTERNS) else None,
                 "expanded_queries": [query]
             }
+        self.last_query_type = search_config.get("query_type")
+        
+        # 时间范围下推到存储层（SQLite 时间戳范围 + 向量 metadata 过滤）
+        time_range = search_config.get("time_range")
+        if time_range:
+            print(f"   📊 时间范围: {time_range.get('start')} ~ {time_range.get('end')}")
+        
+        use_structured = search_config.get("use_structured", True)
+        use_vector = search_config.get("use_vector", True) and self.vector_store is not None
+        pruned = []
+        
+        # 2. 结构化检索：推测执行已取回规则关键词的实体命中（不限实体类型和时间），
+        #    只为推测没覆盖的关键词补查一次，再按解析出的关键词 / 实体类型 / 时间范围打分
+        structured_future = None
+        keywords = (search_config.get("keywords") or [])[:5]  # 最多5个关键词
+        entity_types = search_config.get("entity_types") or []
+        if use_structured:
+            spec_keywords, spec_hits = spec_structured_future.result()
+            missing = [kw for kw in keywords if kw not in spec_keywords]
+            if missing:
+                structured_future = executor.submit(
+                    _run_timed, timings, "structured",
+                    self.storage.structured_hits, missing, time_range
+                )
+        else:
+            pruned.append("structured")
+        
+        # 3. 向量检索：原始查询（已推测向量化）+ 扩展查询，最多2个，一次查询
+        vector_future = None
+        if use_vector:
+            vector_queries = list(dict.fromkeys(
+                [query] + (search_config.get("expanded_queries") or [])
+            ))[:2]
+            spec_embedding = spec_embedding_future.result()[0] if spec_embedding_future else None
+            vector_future = executor.submit(
+                _run_timed, timings, "vector",
+                self.vector_store.search_many, vector_queries, top_k,
+                query_embeddings=[spec_embedding] + [None] * (len(vector_queries) - 1),
+                time_range=time_range
+            )
+        else:
+            pruned.append("vector")
         
-        results = []
+        sources = {}
         
-        # 2. 结构化检索
-        if search_config.get("use_structured", True):
-            structured_results = self._search_structured(
-                keywords=search_config.get("keywords", []),
-                entity_types=search_config.get("entity_types", []),
-                top_k=top_k
-            )
+        if use_structured:
+            hits = spec_hits + (structured_future.result() if structured_future else [])
+            structured_results = self._score_structured(hits, keywords, entity_types, top_k, time_range)
+            timings["structured_reused"] = len(keywords) - len(missing)
             print(f"   📦 结构化检索: {len(structured_results)} 条")
-            
-            # 加权
-            weight = search_config.get("structured_weight", 0.5)
-            for r in structured_results:
-                r["source"] = "structured"
-                r["weighted_score"] = r.get("score", 0) * weight
-            results.extend(structured_results)
-        
-        # 3. 向量检索
-        if search_config.get("use_vector", True) and self.vector_store:
-            # 使用扩展查询
-            expanded_queries = search_config.get("expanded_queries", [query])
+            sources["structured"] = (structured_results, search_config.get("structured_weight", 0.5))
+        
+        if vector_future:
             vector_results = []
-            
-            for eq in expanded_queries[:2]:  # 最多用2个扩展查询
-                vr = self.vector_store.search(eq, top_k=top_k)
+            for vr in vector_future.result():
                 vector_results.extend(vr)
             
             print(f"   🔮 向量检索: {len(vector_results)} 条")
-            
-            # 加权
-            weight = search_config.get("vector_weight", 0.5)
-            for r in vector_results:
-                r["source"] = "vector"
-                r["weighted_score"] = r.get("score", 0) * weight
-            results.extend(vector_results)
-        
-        # 4. 结果融合 + 去重
-        merged = self._merge_results(results, top_k * 2)  # 多取一些给 Rerank
+            sources["vector"] = (vector_results, search_config.get("vector_weight", 0.5))
+        
+        timings["retrieval_ms"] = round((time.perf_counter() - t_start) * 1000, 1)
+        
+        # 4. 结果融合（同一 Moment 多条命中取最高分 + RRF / 归一化加权 + 可选 MMR）
+        merged = self._merge_results(sources, top_k * 2)  # 多取一些给 Rerank
         print(f"   ✅ 融合后: {len(merged)} 条")
         
-        # 5. 加载完整 Moment 数据
-        final_results = []
-        seen_ids = set()
-        
-        for r in merged:
-            moment_id = r.get("moment_id", "")
-            if moment_id and moment_id not in seen_ids:
-                moment = self.storage.get_moment(moment_id)
-                if moment:
-                    moment["retrieval_score"] = r.get("weighted_score", 0)
-                    moment["retrieval_source"] = r.get("source", "unknown")
-                    final_results.append(moment)
-                    seen_ids.add(moment_id)
-        
-        # 6. Rerank 重排序
-        if self.reranker and len(final_results) > 1:
-            print(f"   🔄 Rerank 重排序...")
-            final_results = self.reranker.rerank(query, final_results, top_k=top_k)
+        # 5. 批量加载 Moment（一次查询，检索投影）
+        t0 = time.perf_counter()
+        final_results = self.storage.get_moments(
+            [r.get("moment_id", "") for r in merged],
+            projection="retrieval"
+        )
+        merged_map = {r["moment_id"]: r for r in merged}
+        for moment in final_results:
+            r = merged_map[moment["moment_id"]]
+            moment["retrieval_score"] = r.get("weighted_score", 0)
+            moment["retrieval_source"] = r.get("source", "unknown")
+        timings["load_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        
+        # 6. Rerank 重排序 + 模糊时间引用（最近 / 这几天）软加权
+        final_results = self._rank_results(query, final_results, top_k,
+                                           search_config.get("recency_window"), timings)
+        
+        timings["total_ms"] = round((time.perf_counter() - t_start) * 1000, 1)
+        timings["pruned"] = pruned
+        self.last_timings = timings
+        print(f"   ⏱️ 耗时: {timings}")
         
         return final_results[:top_k]
     
-    def _search_structured(self, keywords: List[str], 
-                           entity_types: List[str], 
-                           top_k: int = 5) -> List[Dict]:
-        """结构化检索"""
-        results = []
-        
-        for kw in keywords[:5]:  # 最多5个关键词
-            # 按实体类型检索
-            for et in entity_types:
-                matches = self.storage.search_by_entity(et, kw, top_k=3)
-                for m in matches:
-                    results.append({
-                        "moment_id": m["moment_id"],
-                        "score": 1.0,  # 精确匹配给满分
-                        "match_type": f"{et}:{kw}"
-                    })
-            
-            # 关键词检索
-            kw_matches = self.storage.search_by_keywords([kw], top_k=3)
-            for m in kw_matches:
-                results.append({
-                    "moment_id": m["moment_id"],
-                    "score": 0.8,
-                    "match_type": f"keyword:{kw}"
-                })
-        
-        return results
+    def _search_structured_speculative(self, query: str) -> Tuple[List[str], List[Tuple]]:
+        """推测执行的结构化检索：取规则关键词的实体命中明细，返回 (关键词, 命中)"""
+        keywords = self._extract_keywords_simple(query)[:5]
+        return keywords, self.storage.structured_hits(keywords)
     
-    def _merge_results(self, results: List[Dict], top_k: int) -> List[Dict]:
+    def _rank_results(self, query: str, results: List[Dict], top_k: int,
+                      recency_window: Optional[Dict], timings: Dict) -> List[Dict]:
         """
-        结果融合（按 moment_id 聚合分数）
-        """
-        # 按 moment_id 聚合
-        score_map = {}
+        Rerank 后按最终分数做近期软加权（Rerank 会重新计算分数，加权放在它之后才生效）
         
-        for r in results:
-            mid = r.get("moment_id", "")
-            if not mid:
-                continue
-            
-            if mid not in score_map:
-                score_map[mid] = {
-                    "moment_id": mid,
-                    "weighted_score": 0,
-                    "sources": [],
-                    "match_types": []
-                }
-            
-            score_map[mid]["weighted_score"] += r.get("weighted_score", 0)
-            score_map[mid]["sources"].append(r.get("source", ""))
-            if "match_type" in r:
-                score_map[mid]["match_types"].append(r["match_type"])
-        
-        # 排序
-        merged = list(score_map.values())
-        merged.sort(key=lambda x: x["weighted_score"], reverse=True)
-        
-        # 标记来源
-        for m in merged:
-            sources = set(m["sources"])
-            if "structured" in sources and "vector" in sources:
-                m["source"] = "hybrid"
-            elif "structured" in sources:
-                m["source"] = "structured"
-            else:
-                m["source"] = "vector"
+        有加权窗口时 Rerank 保留全部候选，加权后再截断，窗口内排在 top_k 之外的 Moment 也能上浮
+        """
+        score_key = "retrieval_score"
+        if self.reranker and len(results) > 1:
+            print(f"   🔄 Rerank 重排序...")
+            results = _run_timed(
+                timings, "rerank", self.reranker.rerank, query, results,
+                top_k=len(results) if recency_window else top_k,
+                embed_fn=self.vector_store.get_embeddings_batch if self.vector_store else None,
+                stored_fn=self.vector_store.get_moment_embeddings if self.vector_store else None
+            )
+            score_key = "rerank_score"
+        if recency_window:
+            self._apply_recency_boost(results, recency_window, score_key)
+        return results[:top_k]
+    
+    @staticmethod
+    def _apply_recency_boost(moments: List[Dict], window: Dict, score_key: str = "retrieval_score"):
+        """近期 Moment 软加权（不过滤窗口外的 Moment），按加权后的分数重新排序"""
+        start, end = epoch_range(window)
+        for moment in moments:
+            if start <= timestamp_epoch(moment.get("timestamp")) <= end:
+                moment[score_key] = moment.get(score_key, 0.0) * (1 + RECENCY_BOOST)
+        moments.sort(key=lambda m: m.get(score_key, 0.0), reverse=True)
+    
+    @staticmethod
+    def _score_structured(hits: List[Tuple], keywords: List[str], entity_types: List[str],
+                          top_k: int, time_range: Optional[Dict] = None) -> List[Dict]:
+        """对实体命中按解析结果打分（关键词 / 实体类型 / 时间范围），返回 {"moment_id", "score", "match_types"} 列表"""
+        matches = score_structured_hits(hits, keywords[:5], entity_types, top_k=top_k * 3,
+                                        time_range=time_range)
+        return [
+            {
+                "moment_id": moment_id,
+                "score": score,
+                "match_types": match_types
+            }
+            for moment_id, score, match_types in matches
+        ]
+    
+    def _merge_results(self, sources: Dict[str, Tuple[List[Dict], float]],
+                       top_k: int) -> List[Dict]:
+        """
+        结果融合（按 moment_id 聚合，见 fusion.fuse）
         
-        return merged[:top_k]
+        Args:
+            sources: 来源名 -> (命中列表, 权重)
+            top_k: 返回数量
+        """
+        return fuse(sources, top_k)
     
     def _extract_keywords_simple(self, text: str) -> List[str]:
-        """简单关键词提取（降级方案）"""
+        """简单关键词提取（降级方案 / 推测执行，保持出现顺序）"""
         stopwords = {'的', '了', '是', '在', '我', '你', '吗', '呢', '啊', '吧',
                      '什么', '怎么', '记得', '还', '有', '没有', '那个', '这个'}
         
         keywords = []
         
-        # 简单分词
+        if JIEBA_AVAILABLE:
+            # jieba 分词优先，只保留两字以上的词
+            for word in jieba.lcut(text):
+                word = word.strip()
+                if len(word) >= 2 and word not in stopwords:
+                    keywords.append(word)
+        
+        # 简单分词（补充词典外的词，如"拿铁"）
         for i in range(len(text) - 1):
             bigram = text[i:i+2]
             if bigram not in stopwords:
                 keywords.append(bigram)
         
-        return list(set(keywords))[:10]
+        return list(dict.fromkeys(keywords))[:10]
     
     # ============================================================
     # 兼容旧 API
@@ -318,36 +440,41 @@ class ContextRAG:
             return parsed.get("query_type") == "fact"
         
         # 降级规则
-        fact_patterns = [
-            r'(什么|啥)(颜色|口味|味道|配色|名字)',
-            r'(记得|记不记得).*(吗|嘛)',
-            r'(哪|哪里|哪儿|在哪)',
-            r'(几点|什么时候|多久)',
-            r'(谁|是谁)',
-            r'(多少|几个|几次)',
-        ]
-        return any(re.search(p, query) for p in fact_patterns)
+        return any(re.search(p, query) for p in FACT_PATTERNS)
     
-    def generate_context_prompt(self, query: str, max_context: int = 2) -> str:
+    def generate_context_prompt(self, query: str, max_context: int = 2,
+                                recent_messages: Optional[List[Dict]] = None) -> str:
         """
         生成上下文提示（用于注入到 LLM prompt）
         
         Args:
             query: 当前查询
             max_context: 最多包含几个 Moments 的上下文
+            recent_messages: 当前 Moment 之前的消息（检索门控判断追问用）
         
         Returns:
-            str: 上下文提示文本
+            str: 上下文提示文本，门控判定不需要记忆时为空
         """
-        # 判断是否在问事实
-        is_asking_fact = self.is_fact_query(query)
+        # 检索门控：闲聊等不需要记忆的轮次直接跳过
+        if self.gate:
+            decision = self.gate.decide(query, recent_messages)
+            if not decision["retrieve"]:
+                print(f"⏭️ 跳过检索: {decision['reason']}")
+                self.last_timings = {"gate": decision["reason"]}
+                return ""
+        
+        # 混合检索（查询解析在检索流水线内与向量化、结构化检索并行）
+        t0 = time.perf_counter()
+        results = self.search(query, top_k=max_context)
+        
+        # 判断是否在问事实（复用检索时解析出的查询类型）
+        is_asking_fact = self.last_query_type == "fact"
+        if self.gate:
+            self.gate.record_retrieval((time.perf_counter() - t0) * 1000)
         
         if is_asking_fact:
             print(f"🔍 检测到事实查询: {query}")
             
-            # 混合检索
-            results = self.search(query, top_k=max_context)
-            
             if results:
                 # 找到结果
                 best_result = results[0]
@@ -365,7 +492,7 @@ class ContextRAG:
             return self._build_fact_prompt_not_found()
         
         # 普通对话检索
-        relevant_moments = self.search(query, top_k=max_context)
+        relevant_moments = results
         
         if not relevant_moments:
             return ""
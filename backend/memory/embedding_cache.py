@@ -0,0 +1,332 @@
+"""
+Embedding Cache - 向量缓存
+按内容哈希缓存 Embedding，重复文本和重新索引不再请求 Embedding API
+
+结构：
+1. 内存层：LRU（EMBEDDING_CACHE_MEMORY_ITEMS 条）
+2. 磁盘层：SQLite（所有用户共享，向量以 float32 存储，EMBEDDING_CACHE_DISK_ITEMS 条上限）
+
+缓存键：sha256(model | dimension | text)，换模型或维度不会误命中
+"""
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+# 默认磁盘缓存路径（与 VectorStore 默认目录一致）
+DEFAULT_CACHE_PATH = "storage/vectors/embedding_cache.db"
+
+# 默认内存层条数
+DEFAULT_MEMORY_ITEMS = 4096
+
+# 默认磁盘层条数
+DEFAULT_DISK_ITEMS = 200000
+
+# 每写入多少条检查一次磁盘层容量
+DISK_EVICT_CHECK_INTERVAL = 500
+
+# 磁盘命中的访问时间先记在内存，写入 / 淘汰 / 关闭时一起落盘；积压超过该条数时也落盘
+ACCESS_FLUSH_ITEMS = 1000
+
+
+class EmbeddingCache:
+    """
+    两级 Embedding 缓存（线程安全）
+
+    内存层命中直接返回；内存未命中查磁盘层并回填内存；都未命中由调用方请求 API 后 put
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH,
+                 max_memory_items: Optional[int] = None,
+                 max_disk_items: Optional[int] = None):
+        """
+        初始化缓存
+
+        Args:
+            db_path: 磁盘层 SQLite 路径
+            max_memory_items: 内存层上限，默认读取 EMBEDDING_CACHE_MEMORY_ITEMS
+            max_disk_items: 磁盘层上限，默认读取 EMBEDDING_CACHE_DISK_ITEMS
+        """
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_memory_items = max_memory_items or int(
+            os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", DEFAULT_MEMORY_ITEMS)
+        )
+        self.max_disk_items = max_disk_items or int(
+            os.getenv("EMBEDDING_CACHE_DISK_ITEMS", DEFAULT_DISK_ITEMS)
+        )
+
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_check = 0
+        self._pending_access: Dict[str, float] = {}  # key -> 磁盘命中时间（未落盘）
+
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "puts": 0,
+            "evictions_memory": 0,
+            "evictions_disk": 0,
+        }
+
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dimension INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_embeddings_access ON embeddings(last_access)"
+        )
+        self._conn.commit()
+
+        print(f"🧊 EmbeddingCache 初始化: {self.db_path} "
+              f"(memory={self.max_memory_items}, disk={self.max_disk_items})")
+
+    @staticmethod
+    def make_key(model: str, dimension: int, text: str) -> str:
+        """缓存键：模型 + 维度 + 文本内容哈希"""
+        raw = f"{model}|{dimension}|{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _encode(embedding: List[float]) -> bytes:
+        return array("f", embedding).tobytes()
+
+    @staticmethod
+    def _decode(blob: bytes) -> List[float]:
+        vec = array("f")
+        vec.frombytes(blob)
+        return vec.tolist()
+
+    def get(self, model: str, dimension: int, text: str) -> Optional[List[float]]:
+        """查询单条，未命中返回 None"""
+        return self.get_many(model, dimension, [text])[0]
+
+    def get_many(self, model: str, dimension: int,
+                 texts: List[str]) -> List[Optional[List[float]]]:
+        """批量查询，按输入顺序返回（未命中为 None）"""
+        keys = [self.make_key(model, dimension, t) for t in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+
+        with self._lock:
+            disk_lookup: Dict[str, List[int]] = {}
+            for i, key in enumerate(keys):
+                emb = self._memory.get(key)
+                if emb is not None:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    results[i] = emb
+                else:
+                    disk_lookup.setdefault(key, []).append(i)
+
+            if not disk_lookup:
+                return results
+
+            found = self._disk_get(list(disk_lookup.keys()))
+            for key, positions in disk_lookup.items():
+                emb = found.get(key)
+                if emb is None:
+                    self._stats["misses"] += len(positions)
+                    continue
+                self._stats["disk_hits"] += len(positions)
+                self._memory_put(key, emb)
+                for i in positions:
+                    results[i] = emb
+
+        return results
+
+    def put(self, model: str, dimension: int, text: str, embedding: List[float]):
+        """写入单条"""
+        self.put_many(model, dimension, [text], [embedding])
+
+    def put_many(self, model: str, dimension: int,
+                 texts: List[str], embeddings: List[Optional[List[float]]]):
+        """批量写入（跳过 None）"""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, emb in zip(texts, embeddings):
+                if emb is None:
+                    continue
+                key = self.make_key(model, dimension, text)
+                self._memory_put(key, list(emb))
+                rows.append((key, model, dimension, self._encode(emb), now))
+
+            if not rows:
+                return
+
+            try:
+                self._flush_access(commit=False)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings "
+                    "(key, model, dimension, vector, last_access) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"   ⚠️ EmbeddingCache 写入失败: {e}")
+                return
+
+            self._stats["puts"] += len(rows)
+            self._puts_since_check += len(rows)
+            if self._puts_since_check >= DISK_EVICT_CHECK_INTERVAL:
+                self._puts_since_check = 0
+                self._evict_disk()
+
+    def _memory_put(self, key: str, embedding: List[float]):
+        """写入内存层并按 LRU 淘汰（需持有锁）"""
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+            self._stats["evictions_memory"] += 1
+
+    def _disk_get(self, keys: List[str]) -> Dict[str, List[float]]:
+        """从磁盘层批量读取，访问时间记入待落盘集合（需持有锁）"""
+        found = {}
+        try:
+            # SQLite 参数上限 999，分批查询
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = self._decode(blob)
+
+            now = time.time()
+            for key in found:
+                self._pending_access[key] = now
+            if len(self._pending_access) >= ACCESS_FLUSH_ITEMS:
+                self._flush_access()
+        except sqlite3.Error as e:
+            print(f"   ⚠️ EmbeddingCache 读取失败: {e}")
+        return found
+
+    def _flush_access(self, commit: bool = True):
+        """待落盘的访问时间批量写入磁盘层（需持有锁）"""
+        if not self._pending_access:
+            return
+        pending, self._pending_access = self._pending_access, {}
+        self._conn.executemany(
+            "UPDATE embeddings SET last_access = ? WHERE key = ?",
+            [(ts, key) for key, ts in pending.items()]
+        )
+        if commit:
+            self._conn.commit()
+
+    def _evict_disk(self):
+        """磁盘层超过上限时删除最久未访问的条目（需持有锁）"""
+        try:
+            # 先落盘访问时间，避免刚命中的条目被当作最久未访问
+            self._flush_access()
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            overflow = count - self.max_disk_items
+            if overflow <= 0:
+                return
+            self._conn.execute("""
+                DELETE FROM embeddings WHERE key IN (
+                    SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?
+                )
+            """, (overflow,))
+            self._conn.commit()
+            self._stats["evictions_disk"] += overflow
+        except sqlite3.Error as e:
+            print(f"   ⚠️ EmbeddingCache 淘汰失败: {e}")
+
+    def get_stats(self) -> Dict:
+        """获取统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._memory)
+        try:
+            with self._lock:
+                stats["disk_items"] = self._conn.execute(
+                    "SELECT COUNT(*) FROM embeddings"
+                ).fetchone()[0]
+        except sqlite3.Error:
+            stats["disk_items"] = None
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """清空两级缓存"""
+        with self._lock:
+            self._memory.clear()
+            self._pending_access.clear()
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+
+    def close(self):
+        """落盘访问时间并关闭磁盘层连接"""
+        with self._lock:
+            try:
+                self._flush_access()
+            except sqlite3.Error as e:
+                print(f"   ⚠️ EmbeddingCache 访问时间落盘失败: {e}")
+            self._conn.close()
+
+
+# 全局缓存（按磁盘路径共享）
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(db_path: str = DEFAULT_CACHE_PATH) -> EmbeddingCache:
+    """获取磁盘路径对应的全局缓存"""
+    path = str(Path(db_path).resolve())
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = EmbeddingCache(db_path=db_path)
+        return _caches[path]
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_embedding_cache():
+    """测试 Embedding 缓存"""
+    print("\n" + "="*60)
+    print("🧪 测试 EmbeddingCache")
+    print("="*60 + "\n")
+
+    cache = EmbeddingCache(db_path="storage/test/embedding_cache.db", max_memory_items=2)
+    cache.clear()
+
+    model, dim = "text-embedding-v3", 4
+    cache.put_many(model, dim, ["咖啡", "被主管夸了", "桂花拿铁"],
+                   [[0.1, 0.2, 0.3, 0.4], [0.5, 0.6, 0.7, 0.8], [0.9, 1.0, 1.1, 1.2]])
+
+    # "咖啡" 已被挤出内存层，应从磁盘层命中
+    print(f"   咖啡: {cache.get(model, dim, '咖啡')}")
+    print(f"   不同维度: {cache.get(model, 8, '咖啡')}")
+    print(f"   未缓存: {cache.get(model, dim, '开心的事')}")
+
+    print(f"\n📊 统计: {cache.get_stats()}")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_embedding_cache()
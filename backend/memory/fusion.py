@@ -0,0 +1,192 @@
+"""
+Fusion - 多路检索结果融合
+ContextRAG 把结构化检索和向量检索的结果交给这里合并为按 Moment 排序的候选
+
+步骤：
+1. 最大池化：同一来源中同一 Moment 的多条命中（_full / _msg_i / _summary、多个扩展查询）只保留最高分
+2. 融合：
+   - rrf：倒数排名融合，只看各来源内的名次，不受分数尺度影响（默认）
+   - weighted：各来源分数 min-max 归一化后加权求和
+3. 多样性（可选）：MMR 按文本相似度惩罚与已选候选重复的 Moment
+"""
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+
+# 默认融合方式
+DEFAULT_FUSION_METHOD = "rrf"
+
+# RRF 平滑常数
+RRF_K = 60
+
+# 默认 MMR 系数（1 表示不考虑多样性，即关闭 MMR）
+DEFAULT_MMR_LAMBDA = 1.0
+
+
+def max_pool(results: List[Dict], score_key: str = "score") -> List[Dict]:
+    """
+    同一 Moment 的多条命中只保留最高分，按分数降序返回
+
+    保留的条目带上所有命中的 match_types
+    """
+    best: Dict[str, Dict] = {}
+    match_types: Dict[str, List[str]] = {}
+    for r in results:
+        mid = r.get("moment_id", "")
+        if not mid:
+            continue
+        match_types.setdefault(mid, []).extend(r.get("match_types", []))
+        if mid not in best or r.get(score_key, 0) > best[mid].get(score_key, 0):
+            best[mid] = r
+
+    pooled = []
+    for mid, r in best.items():
+        item = dict(r)
+        item["match_types"] = list(dict.fromkeys(match_types[mid]))
+        pooled.append(item)
+    pooled.sort(key=lambda x: x.get(score_key, 0), reverse=True)
+    return pooled
+
+
+def min_max_normalize(results: List[Dict], score_key: str = "score") -> List[float]:
+    """分数归一化到 0-1（所有分数相同时都为 1）"""
+    scores = [r.get(score_key, 0) for r in results]
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high - low < 1e-9:
+        return [1.0] * len(scores)
+    return [(s - low) / (high - low) for s in scores]
+
+
+def _bigrams(text: str) -> set:
+    text = "".join(text.split())
+    return {text[i:i+2] for i in range(len(text) - 1)} or ({text} if text else set())
+
+
+def text_similarity(a: str, b: str) -> float:
+    """字二元组 Jaccard 相似度"""
+    sa, sb = _bigrams(a), _bigrams(b)
+    if not sa or not sb:
+        return 0.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def mmr(candidates: List[Dict], top_k: int, lambda_: float,
+        score_key: str = "weighted_score") -> List[Dict]:
+    """
+    最大边际相关性选择
+
+    Args:
+        candidates: 已按相关性排序的候选（text 字段用于计算相似度，没有文本的候选不受惩罚）
+        top_k: 选择数量
+        lambda_: 相关性权重（1 为只看相关性）
+        score_key: 相关性分数字段
+    """
+    if lambda_ >= 1.0 or len(candidates) <= 1:
+        return candidates[:top_k]
+
+    top = max(c.get(score_key, 0) for c in candidates) or 1.0
+    remaining = list(candidates)
+    selected: List[Dict] = []
+    while remaining and len(selected) < top_k:
+        best, best_value = None, None
+        for c in remaining:
+            redundancy = max((text_similarity(c.get("text", ""), s.get("text", "")) for s in selected),
+                             default=0.0)
+            value = lambda_ * c.get(score_key, 0) / top - (1 - lambda_) * redundancy
+            if best_value is None or value > best_value:
+                best, best_value = c, value
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+
+def fuse(sources: Dict[str, Tuple[List[Dict], float]], top_k: int,
+         method: Optional[str] = None, mmr_lambda: Optional[float] = None) -> List[Dict]:
+    """
+    融合多路检索结果
+
+    Args:
+        sources: 来源名 -> (该来源的命中列表, 权重)，命中包含 moment_id、score，可选 text / match_types
+        top_k: 返回数量
+        method: rrf / weighted，默认读取 FUSION_METHOD
+        mmr_lambda: MMR 系数，默认读取 FUSION_MMR_LAMBDA（1 关闭）
+
+    Returns:
+        List[Dict]: {"moment_id", "weighted_score", "source", "sources", "match_types", "text"}，
+            weighted_score 降序；只命中一个来源时 source 为该来源，多个来源时为 "hybrid"
+    """
+    method = (method or os.getenv("FUSION_METHOD", DEFAULT_FUSION_METHOD)).lower()
+    if mmr_lambda is None:
+        mmr_lambda = float(os.getenv("FUSION_MMR_LAMBDA", DEFAULT_MMR_LAMBDA))
+
+    fused: Dict[str, Dict] = {}
+    for source, (results, weight) in sources.items():
+        pooled = max_pool(results)
+        if method == "weighted":
+            contributions = [weight * s for s in min_max_normalize(pooled)]
+        else:
+            # 缩放到第一名贡献 weight，便于与 weighted 方式比较
+            contributions = [weight * (RRF_K + 1) / (RRF_K + rank) for rank in range(1, len(pooled) + 1)]
+
+        for r, contribution in zip(pooled, contributions):
+            mid = r["moment_id"]
+            entry = fused.setdefault(mid, {
+                "moment_id": mid,
+                "weighted_score": 0.0,
+                "sources": [],
+                "match_types": [],
+                "text": "",
+            })
+            entry["weighted_score"] += contribution
+            entry["sources"].append(source)
+            entry["match_types"].extend(r.get("match_types", []))
+            if not entry["text"] and r.get("text"):
+                entry["text"] = r["text"]
+
+    merged = sorted(fused.values(), key=lambda x: x["weighted_score"], reverse=True)
+    for m in merged:
+        m["source"] = m["sources"][0] if len(m["sources"]) == 1 else "hybrid"
+
+    return mmr(merged, top_k, mmr_lambda)
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_fusion():
+    """测试结果融合"""
+    print("\n" + "="*60)
+    print("🧪 测试 Fusion")
+    print("="*60 + "\n")
+
+    structured = [
+        {"moment_id": "m1", "score": 1.8, "match_types": ["objects:拿铁"]},
+        {"moment_id": "m2", "score": 0.8, "match_types": ["keyword:咖啡"]},
+    ]
+    # m3 有很多条短消息命中，不应靠数量胜出
+    vector = [
+        {"moment_id": "m3", "score": 0.62, "text": "今天好累"},
+        {"moment_id": "m3", "score": 0.61, "text": "今天好累啊"},
+        {"moment_id": "m3", "score": 0.60, "text": "今天真的好累"},
+        {"moment_id": "m1", "score": 0.58, "text": "下班买了杯桂花拿铁"},
+        {"moment_id": "m4", "score": 0.55, "text": "今天好累好累"},
+    ]
+
+    for method in ("rrf", "weighted"):
+        for lambda_ in (1.0, 0.5):
+            merged = fuse({"structured": (structured, 0.5), "vector": (vector, 0.5)},
+                          top_k=3, method=method, mmr_lambda=lambda_)
+            print(f"   {method:<8} mmr={lambda_}: " +
+                  ", ".join(f"{m['moment_id']}({m['weighted_score']:.2f},{m['source']})" for m in merged))
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_fusion()
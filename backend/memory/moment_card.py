@@ -1,14 +1,26 @@
 """
 Moment Card Generator - Moment Card 生成器
 负责生成第一人称叙事总结、情绪标签、标题
+
+生成方式（MOMENT_CARD_MODE）：
+1. single（默认）：一次结构化输出调用同时生成情绪 + 总结 + 标题
+2. parallel：情绪和总结并发生成，再生成标题
+single 调用失败或缺字段时，缺的字段按 parallel 方式单独生成
+
+模型由 MOMENT_CARD_MODEL 选择（qwen-turbo / qwen-plus / qwen-max，默认 qwen-max）
 """
 
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 from dataclasses import dataclass
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
+
+from ..utils.llm_gateway import get_llm_client
 
 # 加载环境变量
 # 先尝试从系统环境变量读取（Railway等云平台）
@@ -18,11 +30,8 @@ if not QWEN_API_KEY:
     load_dotenv()
     QWEN_API_KEY = os.getenv("ALIYUN_QWEN_KEY")
 
-# 初始化通义千问客户端
-client = OpenAI(
-    api_key=QWEN_API_KEY,
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-)
+# 通义千问客户端（共享的 LLM 网关）
+client = get_llm_client(QWEN_API_KEY)
 
 # 情绪颜色映射
 EMOTION_COLORS = {
@@ -40,102 +49,18 @@ EMOTION_COLORS = {
 }
 
 
-@dataclass
-class MomentCard:
-    """Moment Card 数据类"""
-    moment_id: str
-    title: str
-    summary: str
-    emotion: str
-    color: str
-    timestamp: str
-    message_count: int
+# 有效情绪标签
+VALID_EMOTIONS = list(EMOTION_COLORS)
 
+# 默认模型 / 生成方式
+DEFAULT_CARD_MODEL = "qwen-max"
+DEFAULT_CARD_MODE = "single"
 
-def generate_moment_card(moment_data: Dict) -> MomentCard:
-    """
-    生成 Moment Card
-    
-    Args:
-        moment_data: Moment 数据（包含 messages）
-    
-    Returns:
-        MomentCard: 生成的卡片数据
-    """
-    
-    moment_id = moment_data['moment_id']
-    messages = moment_data['messages']
-    timestamp = moment_data['timestamp']
-    
-    # ⚠️ 重要：只使用用户消息生成 Moment Card，不包含 Agent 回复
-    user_messages_only = [msg for msg in messages if msg['role'] == 'user']
-    
-    print(f"\n🎨 正在生成 Moment Card: {moment_id}")
-    print(f"   总消息数: {len(messages)}")
-    print(f"   用户消息数: {len(user_messages_only)}")
-    
-    # Step 1: 提取主导情绪（只基于用户消息）
-    emotion = _detect_dominant_emotion(user_messages_only)
-    print(f"   情绪: {emotion}")
-    
-    # Step 2: 生成第一人称叙事总结（只基于用户消息）
-    summary = _generate_narrative_summary(user_messages_only, emotion)
-    print(f"   总结: {summary[:50]}...")
-    
-    # Step 3: 生成标题
-    title = _generate_title(summary, emotion)
-    print(f"   标题: {title}")
-    
-    # Step 4: 选择颜色
-    color = EMOTION_COLORS.get(emotion.lower(), EMOTION_COLORS['neutral'])
-    
-    # 创建 Moment Card
-    card = MomentCard(
-        moment_id=moment_id,
-        title=title,
-        summary=summary,
-        emotion=emotion,
-        color=color,
-        timestamp=timestamp,
-        message_count=len(messages)
-    )
-    
-    print(f"✅ Moment Card 生成完成！\n")
-    
-    return card
-
-
-def _detect_dominant_emotion(messages: list) -> str:
-    """
-    检测对话中的主导情绪
-    
-    Args:
-        messages: 消息列表
-    
-    Returns:
-        str: 情绪标签（joy, sadness, anger, fear, love, surprise, neutral, frustration）
-    """
-    
-    # 提取所有用户消息
-    user_messages = [m['content'] for m in messages if m['role'] == 'user']
-    conversation = "\n".join(user_messages)
-    
-    # 【新增】检测"纠正"行为
-    correction_keywords = ["纠正", "不是", "是", "得说一下", "记错了", "哈哈"]
-    correction_count = sum(1 for msg in user_messages 
-                          if any(kw in msg for kw in correction_keywords))
-    
-    # 如果多次纠正，很可能是FRUSTRATION
-    if correction_count >= 2:
-        # 但还是要通过LLM确认，避免误判
-        pass
-    
-    prompt = f"""分析以下对话，判断用户的主导情绪。
-
-对话内容：
-{conversation}
+# 总结生成失败时的兜底文案
+DEFAULT_SUMMARY = "今天记录了一段对话，留下了这个瞬间。"
 
-请从以下情绪中选择一个最符合的：
+# 情绪判断规则（单独调用和结构化调用共用）
+EMOTION_GUIDE = """请从以下情绪中选择一个最符合的：
 - joy（开心、喜悦、兴奋）
 - sadness（悲伤、失落、难过）
 - anger（生气、愤怒、激动）
@@ -156,83 +81,10 @@ def _detect_dominant_emotion(messages: list) -> str:
 - **shame（羞耻）**：用户感到丢脸、羞愧，比embarrassment更严重
 - **awkward（不自在）**：轻微的尴尬、别扭，不如embarrassment强烈
 - 要理解**整体对话氛围**，不只看单个句子
-- 如果对话中提到"社死"、"尴尬"、"当场裂开"、"想原地消失"等，优先选择**embarrassment**
-
-只返回情绪标签，不要解释。例如：joy"""
-
-    try:
-        response = client.chat.completions.create(
-            model="qwen-max",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        
-        emotion = response.choices[0].message.content.strip().lower()
-        
-        # 验证是否是有效情绪（扩展情绪标签）
-        valid_emotions = ['joy', 'sadness', 'anger', 'fear', 'love', 'surprise', 'neutral', 'frustration', 
-                         'embarrassment', 'shame', 'awkward']
-        if emotion not in valid_emotions:
-            print(f"   ⚠️  无效情绪标签: {emotion}，使用 neutral")
-            emotion = 'neutral'
-        
-        return emotion
-        
-    except Exception as e:
-        print(f"   ⚠️  情绪检测失败: {e}，使用 neutral")
-        return 'neutral'
+- 如果对话中提到"社死"、"尴尬"、"当场裂开"、"想原地消失"等，优先选择**embarrassment**"""
 
-
-def _generate_narrative_summary(messages: list, emotion: str) -> str:
-    """
-    生成第一人称叙事总结
-    
-    Args:
-        messages: 消息列表
-        emotion: 情绪标签
-    
-    Returns:
-        str: 第一人称叙事
-    """
-    
-    # 构建对话历史
-    conversation = ""
-    for msg in messages:
-        role_label = "我" if msg['role'] == 'user' else "Ta"
-        conversation += f"{role_label}: {msg['content']}\n"
-    
-    # ========================================
-    # 根据消息数量动态调整字数要求
-    # ========================================
-    message_count = len(messages)
-    
-    if message_count <= 4:
-        # 短对话（2轮以内）：40-60字
-        word_limit = "40-60 字"
-        detail_instruction = "简短总结主要感受，1-2 句话即可"
-    elif message_count <= 8:
-        # 中等对话（4轮以内）：60-90字
-        word_limit = "60-90 字"
-        detail_instruction = "提炼核心话题和主要感受，2-3 句话"
-    elif message_count <= 16:
-        # 较长对话（8轮以内）：80-120字
-        word_limit = "80-120 字"
-        detail_instruction = "提炼核心矛盾和情绪，概括要点，不要流水账"
-    else:
-        # 很长对话（9轮以上）：90-130字
-        word_limit = "90-130 字"
-        detail_instruction = "抓住核心矛盾和主线情绪，高度概括，避免复读所有细节"
-    
-    prompt = f"""基于以下对话，用第一人称视角写一段叙事。
-
-对话内容：
-{conversation}
-
-情绪：{emotion}
-对话轮数：{message_count // 2} 轮
-字数要求：{word_limit}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+# 叙事总结规则（{detail_instruction}、{emotion_instruction} 按对话填充）
+SUMMARY_GUIDE = """━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 ⚠️ **极其重要：这是"提炼"，不是"复述"！**
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
@@ -265,7 +117,7 @@ def _generate_narrative_summary(messages: list, emotion: str) -> str:
 6. 不要用网络流行语、烂梗
 7. **这是你的内心独白，不要提到"对方"、"朋友"、"Ta"、"聊天"**
 8. **直接写你的感受、想法、经历，就像在脑海中回忆**
-9. 体现 {emotion} 这种情绪，但别说教
+9. {emotion_instruction}
 
 ⚠️ **严禁编造！**
 - **只能总结对话中明确提到的内容**
@@ -338,23 +190,394 @@ def _generate_narrative_summary(messages: list, emotion: str) -> str:
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 
 **记住：提炼的本质是"删除 80% 的细节，只留核心"**
-**不是"把所有话用自己的话说一遍"！**
+**不是"把所有话用自己的话说一遍"！**"""
+
+# 标题规则
+TITLE_GUIDE = """要求：
+1. 4-8 个字
+2. 口语化、自然，但不要用网络烂梗
+3. 有质感，不俗气
+4. 不要用引号、书名号
+5. 像在给亲密朋友写短信
+
+好的示例：
+- "这个项目有点难"
+- "今晚睡不着"
+- "终于做完了"
+- "想回家了"
+- "心里暖暖的"
+- "有点慌"
+
+坏的示例（不要模仿）：
+- "压力山大" ← 网络烂梗
+- "心态崩了" ← 太网络化
+- "emo 了" ← 太流行语
+- "破防了" ← 太烂梗
+- "未知挑战前的忐忑" ← 太书面
+- "勇气与坚持" ← 太假"""
+
+# 并发生成线程池（parallel 方式和降级使用，所有请求共享）
+_card_executor: Optional[ThreadPoolExecutor] = None
+_card_executor_lock = threading.Lock()
+
+
+def _get_card_executor() -> ThreadPoolExecutor:
+    """获取 Card 生成线程池（MOMENT_CARD_WORKERS 个线程）"""
+    global _card_executor
+    with _card_executor_lock:
+        if _card_executor is None:
+            _card_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("MOMENT_CARD_WORKERS", 4)),
+                thread_name_prefix="moment_card"
+            )
+        return _card_executor
+
+
+def _card_model() -> str:
+    """Card 生成使用的模型（MOMENT_CARD_MODEL）"""
+    return os.getenv("MOMENT_CARD_MODEL", DEFAULT_CARD_MODEL)
+
+
+@dataclass
+class MomentCard:
+    """Moment Card 数据类"""
+    moment_id: str
+    title: str
+    summary: str
+    emotion: str
+    color: str
+    timestamp: str
+    message_count: int
 
-只返回叙事内容，不要前缀或解释。"""
+
+def generate_moment_card(moment_data: Dict, fields: Optional[Dict] = None) -> MomentCard:
+    """
+    生成 Moment Card
+    
+    Args:
+        moment_data: Moment 数据（包含 messages）
+        fields: 已生成的 emotion / summary / title（如 Moment 摘要的输出），缺少的字段再单独生成
+    
+    Returns:
+        MomentCard: 生成的卡片数据
+    """
+    
+    moment_id = moment_data['moment_id']
+    messages = moment_data['messages']
+    timestamp = moment_data['timestamp']
+    
+    # ⚠️ 重要：只使用用户消息生成 Moment Card，不包含 Agent 回复
+    user_messages_only = [msg for msg in messages if msg['role'] == 'user']
+    
+    print(f"\n🎨 正在生成 Moment Card: {moment_id}")
+    print(f"   总消息数: {len(messages)}")
+    print(f"   用户消息数: {len(user_messages_only)}")
+    
+    # Step 1-3: 情绪 + 第一人称叙事总结 + 标题（只基于用户消息）
+    t0 = time.perf_counter()
+    if fields is None:
+        fields = _generate_card_fields(user_messages_only)
+    else:
+        fields = complete_card_fields(user_messages_only, fields)
+    emotion, summary, title = fields["emotion"], fields["summary"], fields["title"]
+    print(f"   情绪: {emotion}")
+    print(f"   总结: {summary[:50]}...")
+    print(f"   标题: {title}")
+    
+    # Step 4: 选择颜色
+    color = EMOTION_COLORS.get(emotion.lower(), EMOTION_COLORS['neutral'])
+    
+    # 创建 Moment Card
+    card = MomentCard(
+        moment_id=moment_id,
+        title=title,
+        summary=summary,
+        emotion=emotion,
+        color=color,
+        timestamp=timestamp,
+        message_count=len(messages)
+    )
+    
+    print(f"✅ Moment Card 生成完成！({(time.perf_counter() - t0) * 1000:.0f}ms, {_card_model()})\n")
+    
+    return card
+
+
+def _generate_card_fields(messages: list) -> Dict[str, str]:
+    """
+    生成情绪、总结、标题
+
+    single 方式先尝试一次结构化调用；缺少的字段（或 parallel 方式下全部字段）
+    按依赖关系生成：情绪与总结并发，标题依赖总结
+    
+    Returns:
+        Dict: {"emotion", "summary", "title"}
+    """
+    fields: Dict[str, str] = {}
+    if os.getenv("MOMENT_CARD_MODE", DEFAULT_CARD_MODE).lower() == "single":
+        fields = _generate_card_single_call(messages)
+    return complete_card_fields(messages, fields)
+
+
+def complete_card_fields(messages: list, fields: Dict) -> Dict[str, str]:
+    """
+    补全缺少的情绪 / 总结 / 标题：情绪与总结并发，标题依赖总结
+    
+    Args:
+        messages: 消息列表
+        fields: 已有字段（不修改）
+    
+    Returns:
+        Dict: {"emotion", "summary", "title"}
+    """
+    fields = {k: fields[k] for k in ("emotion", "summary", "title") if fields.get(k)}
+    missing = [k for k in ("emotion", "summary", "title") if k not in fields]
+    if missing and len(missing) < 3:
+        print(f"   ⚠️  缺少字段 {missing}，单独生成")
+    
+    if "emotion" not in fields or "summary" not in fields:
+        executor = _get_card_executor()
+        emotion_future = None
+        if "emotion" not in fields:
+            emotion_future = executor.submit(_detect_dominant_emotion, messages)
+        # 已有情绪时总结参考情绪，否则与情绪检测并发、由模型自行体现情绪
+        summary_future = None
+        if "summary" not in fields:
+            summary_future = executor.submit(_generate_narrative_summary, messages, fields.get("emotion"))
+        if emotion_future:
+            fields["emotion"] = emotion_future.result()
+        if summary_future:
+            fields["summary"] = summary_future.result()
+    
+    if "title" not in fields:
+        fields["title"] = _generate_title(fields["summary"], fields["emotion"])
+    
+    return fields
+
+
+def _chat(prompt: str, temperature: float, **kwargs) -> str:
+    """调用 Card 模型，返回去掉首尾空白的回复"""
+    response = client.chat.completions.create(
+        model=_card_model(),
+        messages=[{"role": "user", "content": prompt}],
+        temperature=temperature,
+        **kwargs
+    )
+    return response.choices[0].message.content.strip()
+
+
+def _format_conversation(messages: list) -> str:
+    """对话历史（我 / Ta）"""
+    conversation = ""
+    for msg in messages:
+        role_label = "我" if msg['role'] == 'user' else "Ta"
+        conversation += f"{role_label}: {msg['content']}\n"
+    return conversation
+
+
+def _word_limit(message_count: int):
+    """
+    根据消息数量动态调整字数要求
+
+    Returns:
+        (字数要求, 详略说明)
+    """
+    if message_count <= 4:
+        # 短对话（2轮以内）：40-60字
+        word_limit = "40-60 字"
+        detail_instruction = "简短总结主要感受，1-2 句话即可"
+    elif message_count <= 8:
+        # 中等对话（4轮以内）：60-90字
+        word_limit = "60-90 字"
+        detail_instruction = "提炼核心话题和主要感受，2-3 句话"
+    elif message_count <= 16:
+        # 较长对话（8轮以内）：80-120字
+        word_limit = "80-120 字"
+        detail_instruction = "提炼核心矛盾和情绪，概括要点，不要流水账"
+    else:
+        # 很长对话（9轮以上）：90-130字
+        word_limit = "90-130 字"
+        detail_instruction = "抓住核心矛盾和主线情绪，高度概括，避免复读所有细节"
+    return word_limit, detail_instruction
+
+
+def _normalize_emotion(emotion: str) -> Optional[str]:
+    """情绪标签校验（无效返回 None）"""
+    emotion = (emotion or "").strip().lower()
+    return emotion if emotion in VALID_EMOTIONS else None
+
+
+def _clean_title(title: str) -> str:
+    """移除可能的引号和书名号"""
+    return title.replace('"', '').replace("'", '').replace('《', '').replace('》', '').strip()
+
+
+def _generate_card_single_call(messages: list) -> Dict[str, str]:
+    """
+    一次结构化输出调用生成情绪 + 总结 + 标题
+    
+    Args:
+        messages: 消息列表
+    
+    Returns:
+        Dict: 校验通过的字段（emotion / summary / title），调用失败返回空字典
+    """
+    message_count = len(messages)
+    word_limit, detail_instruction = _word_limit(message_count)
+    guide = SUMMARY_GUIDE.format(
+        detail_instruction=detail_instruction,
+        emotion_instruction="体现你在第一步判断出的情绪，但别说教"
+    )
+    
+    prompt = f"""基于以下对话完成三件事：判断用户的主导情绪，用第一人称视角写一段叙事，再给这段叙事起一个简短的标题。
+
+对话内容：
+{_format_conversation(messages)}
+
+对话轮数：{message_count // 2} 轮
+
+【第一步：情绪 emotion】
+分析对话，判断用户的主导情绪。
+
+{EMOTION_GUIDE}
+
+【第二步：叙事 summary】
+字数要求：{word_limit}
+
+{guide}
+
+【第三步：标题 title】
+基于第二步的叙事生成标题。
+
+{TITLE_GUIDE}
+
+只返回 JSON，不要其他内容：
+{{"emotion": "情绪标签", "summary": "叙事内容", "title": "标题"}}"""
+
+    try:
+        result_text = _chat(prompt, temperature=0.3, response_format={"type": "json_object"})
+        
+        # 清理 markdown 标记
+        if result_text.startswith("```json"):
+            result_text = result_text[7:]
+        if result_text.startswith("```"):
+            result_text = result_text[3:]
+        if result_text.endswith("```"):
+            result_text = result_text[:-3]
+        result = json.loads(result_text.strip())
+    except Exception as e:
+        print(f"   ⚠️  结构化生成失败: {e}")
+        return {}
+    
+    fields = {}
+    emotion = _normalize_emotion(str(result.get("emotion", "")))
+    if emotion:
+        fields["emotion"] = emotion
+    summary = str(result.get("summary") or "").strip()
+    if summary:
+        fields["summary"] = summary
+    title = _clean_title(str(result.get("title") or ""))
+    if title:
+        fields["title"] = title
+    return fields
+
+
+def _detect_dominant_emotion(messages: list) -> str:
+    """
+    检测对话中的主导情绪
+    
+    Args:
+        messages: 消息列表
+    
+    Returns:
+        str: 情绪标签（joy, sadness, anger, fear, love, surprise, neutral, frustration）
+    """
+    
+    # 提取所有用户消息
+    user_messages = [m['content'] for m in messages if m['role'] == 'user']
+    conversation = "\n".join(user_messages)
+    
+    # 【新增】检测"纠正"行为
+    correction_keywords = ["纠正", "不是", "是", "得说一下", "记错了", "哈哈"]
+    correction_count = sum(1 for msg in user_messages 
+                          if any(kw in msg for kw in correction_keywords))
+    
+    # 如果多次纠正，很可能是FRUSTRATION
+    if correction_count >= 2:
+        # 但还是要通过LLM确认，避免误判
+        pass
+    
+    prompt = f"""分析以下对话，判断用户的主导情绪。
+
+对话内容：
+{conversation}
+
+{EMOTION_GUIDE}
+
+只返回情绪标签，不要解释。例如：joy"""
 
     try:
-        response = client.chat.completions.create(
-            model="qwen-max",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1  # 极低温度，严格遵循"提炼 vs 复述"规则
-        )
+        raw = _chat(prompt, temperature=0.3)
+        
+        # 验证是否是有效情绪（扩展情绪标签）
+        emotion = _normalize_emotion(raw)
+        if emotion is None:
+            print(f"   ⚠️  无效情绪标签: {raw}，使用 neutral")
+            emotion = 'neutral'
+        
+        return emotion
         
-        summary = response.choices[0].message.content.strip()
-        return summary
+    except Exception as e:
+        print(f"   ⚠️  情绪检测失败: {e}，使用 neutral")
+        return 'neutral'
+
+
+def _generate_narrative_summary(messages: list, emotion: Optional[str] = None) -> str:
+    """
+    生成第一人称叙事总结
+    
+    Args:
+        messages: 消息列表
+        emotion: 情绪标签（None 时与情绪检测并发生成，由模型自行体现情绪）
+    
+    Returns:
+        str: 第一人称叙事
+    """
+    
+    conversation = _format_conversation(messages)
+    message_count = len(messages)
+    word_limit, detail_instruction = _word_limit(message_count)
+    
+    if emotion:
+        emotion_line = f"情绪：{emotion}\n"
+        emotion_instruction = f"体现 {emotion} 这种情绪，但别说教"
+    else:
+        emotion_line = ""
+        emotion_instruction = "体现对话中的主导情绪，但别说教"
+    guide = SUMMARY_GUIDE.format(
+        detail_instruction=detail_instruction,
+        emotion_instruction=emotion_instruction
+    )
+    
+    prompt = f"""基于以下对话，用第一人称视角写一段叙事。
+
+对话内容：
+{conversation}
+
+{emotion_line}对话轮数：{message_count // 2} 轮
+字数要求：{word_limit}
+
+{guide}
+
+只返回叙事内容，不要前缀或解释。"""
+
+    try:
+        # 极低温度，严格遵循"提炼 vs 复述"规则
+        return _chat(prompt, temperature=0.1)
         
     except Exception as e:
         print(f"   ⚠️  总结生成失败: {e}")
-        return "今天记录了一段对话，留下了这个瞬间。"
+        return DEFAULT_SUMMARY
 
 
 def _generate_title(summary: str, emotion: str) -> str:
@@ -376,42 +599,13 @@ def _generate_title(summary: str, emotion: str) -> str:
 
 情绪：{emotion}
 
-要求：
-1. 4-8 个字
-2. 口语化、自然，但不要用网络烂梗
-3. 有质感，不俗气
-4. 不要用引号、书名号
-5. 像在给亲密朋友写短信
-
-好的示例：
-- "这个项目有点难"
-- "今晚睡不着"
-- "终于做完了"
-- "想回家了"
-- "心里暖暖的"
-- "有点慌"
-
-坏的示例（不要模仿）：
-- "压力山大" ← 网络烂梗
-- "心态崩了" ← 太网络化
-- "emo 了" ← 太流行语
-- "破防了" ← 太烂梗
-- "未知挑战前的忐忑" ← 太书面
-- "勇气与坚持" ← 太假
+{TITLE_GUIDE}
 
 只返回标题，不要解释。"""
 
     try:
-        response = client.chat.completions.create(
-            model="qwen-max",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.8  # 适中温度，保持一定创造性
-        )
-        
-        title = response.choices[0].message.content.strip()
-        # 移除可能的引号和书名号
-        title = title.replace('"', '').replace("'", '').replace('《', '').replace('》', '')
-        return title
+        # 适中温度，保持一定创造性
+        return _clean_title(_chat(prompt, temperature=0.8))
         
     except Exception as e:
         print(f"   ⚠️  标题生成失败: {e}")
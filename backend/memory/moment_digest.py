@@ -0,0 +1,370 @@
+"""
+Moment Digest - Moment 摘要
+一次 Card 模型调用同时生成情绪 + 叙事总结 + 标题，实体由调用方的提取函数（qwen-turbo）并发提取
+（之前 Card 生成 3 次 qwen-max；实体提取本身就便宜，不合并进 qwen-max 调用）
+
+特性：
+1. 输出按字段校验：实体结构、情绪标签、非空总结 / 标题
+2. 缺失或无效的 Card 字段单独降级：走 moment_card 的单项生成
+3. 缓存：按模型 + 用户消息哈希持久化 Card 字段和非空实体，任务重试和重复保存不再调用
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from .moment_card import (
+    EMOTION_GUIDE, SUMMARY_GUIDE, TITLE_GUIDE,
+    _card_model, _chat, _clean_title, _format_conversation, _get_card_executor,
+    _normalize_emotion, _word_limit,
+)
+
+
+# 默认缓存路径
+DEFAULT_DIGEST_CACHE_PATH = "storage/moment_digest_cache.db"
+
+# 默认缓存条数上限
+DEFAULT_DIGEST_CACHE_ITEMS = 2000
+
+# 实体提取范围说明（MomentManager 单独提取实体时共用）
+ENTITY_SCOPE = """⚠️ **极其重要**：
+- **只从用户消息中提取**，不要从Agent回复中提取
+- **只提取用户明确提到的内容**，不要推测或编造
+- **如果用户没有提到，就不要提取**"""
+
+# 实体 JSON 结构
+ENTITY_SCHEMA = """{
+  "people": {
+    "人名1": {"role": "关系/身份", "attributes": ["特征1", "特征2"]}
+  },
+  "places": {
+    "地点1": {"type": "类型", "position": "具体位置"}
+  },
+  "time_info": {
+    "daily_routines": ["完整时间表达1"],
+    "time_markers": ["时间1"]
+  },
+  "objects": {
+    "物品1": {"color": "颜色", "type": "类型", "description": "完整描述"}
+  },
+  "habits": ["习惯1"],
+  "events": ["事件1"]
+}"""
+
+# 实体提取要求
+ENTITY_RULES = """⚠️ **关键要求**：
+1. 物品必须包含完整描述（颜色、类型、特征）
+2. 地点必须包含位置信息
+3. 食物/饮料要完整提取名称和特征
+4. 只提取明确出现的内容，不推测
+5. 如果某类信息没有，返回空对象{}或空列表[]"""
+
+
+def empty_entities() -> Dict:
+    """空的实体结构"""
+    return {
+        "people": {},
+        "places": {},
+        "time_info": {
+            "daily_routines": [],
+            "time_markers": []
+        },
+        "objects": {},
+        "habits": [],
+        "events": []
+    }
+
+
+def merge_entities(entities: Dict) -> Dict:
+    """实体合并到默认结构（补齐缺少的字段）"""
+    default = empty_entities()
+
+    for key in default:
+        if key in entities:
+            if isinstance(default[key], dict):
+                default[key].update(entities[key])
+            elif isinstance(default[key], list):
+                default[key] = entities[key]
+
+    return default
+
+
+def _clean_names(names: list) -> List[str]:
+    """列表字段元素转为非空字符串（数字转字符串，对象 / 列表 / null 丢弃）"""
+    cleaned = []
+    for name in names:
+        if isinstance(name, (str, int, float)) and not isinstance(name, bool):
+            name = str(name).strip()
+            if name:
+                cleaned.append(name)
+    return cleaned
+
+
+def validate_entities(entities) -> Optional[Dict]:
+    """
+    实体结构校验：各字段类型正确时返回补齐后的实体，否则返回 None
+
+    列表字段中的非字符串元素转为字符串或丢弃（写入 entities 表时 entity_name 必须是字符串）
+    """
+    if not isinstance(entities, dict):
+        return None
+    for key in ("people", "places", "objects", "time_info"):
+        if key in entities and not isinstance(entities[key], dict):
+            return None
+    for key in ("habits", "events"):
+        if key in entities and not isinstance(entities[key], list):
+            return None
+    for key in ("daily_routines", "time_markers"):
+        if not isinstance(entities.get("time_info", {}).get(key, []), list):
+            return None
+
+    entities = merge_entities(entities)
+    for key in ("habits", "events"):
+        entities[key] = _clean_names(entities[key])
+    time_info = entities["time_info"]
+    for key in ("daily_routines", "time_markers"):
+        time_info[key] = _clean_names(time_info.get(key, []))
+    return entities
+
+
+def parse_json_reply(text: str) -> Dict:
+    """解析 LLM 返回的 JSON（去掉 markdown 标记，外层有多余文字时取第一个对象）"""
+    text = text.strip()
+    if text.startswith("```json"):
+        text = text[7:]
+    if text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        json_match = re.search(r'\{.*\}', text, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group())
+        raise
+
+
+def digest_key(model: str, messages: List[Dict]) -> str:
+    """缓存键：模型 + 用户消息内容"""
+    contents = [m.get("content", "") for m in messages if m.get("role") == "user"]
+    payload = json.dumps([model, contents], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DigestCache:
+    """
+    摘要缓存（SQLite 持久化，超过条数上限时淘汰最旧的条目）
+
+    只缓存 LLM 输出中校验通过的字段，降级生成的字段不缓存
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DIGEST_CACHE_PATH, max_items: Optional[int] = None):
+        """
+        初始化缓存
+
+        Args:
+            db_path: SQLite 路径
+            max_items: 条数上限，默认读取 DIGEST_CACHE_ITEMS
+        """
+        self.max_items = max_items or int(os.getenv("DIGEST_CACHE_ITEMS", DEFAULT_DIGEST_CACHE_ITEMS))
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS moment_digest (
+                key TEXT PRIMARY KEY,
+                fields TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fields FROM moment_digest WHERE key = ?", (key,)
+            ).fetchone()
+            self._stats["hits" if row else "misses"] += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, fields: Dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO moment_digest (key, fields, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(fields, ensure_ascii=False), time.time())
+            )
+            self._conn.execute("""
+                DELETE FROM moment_digest WHERE key IN (
+                    SELECT key FROM moment_digest ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_items,))
+            self._conn.commit()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._conn.execute("SELECT COUNT(*) FROM moment_digest").fetchone()[0]
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total, 3) if total else 0.0
+        return stats
+
+
+# 全局缓存
+_digest_cache: Optional[DigestCache] = None
+_digest_cache_lock = threading.Lock()
+
+
+def get_digest_cache() -> DigestCache:
+    """获取摘要缓存单例（DIGEST_CACHE_PATH 指定路径）"""
+    global _digest_cache
+    with _digest_cache_lock:
+        if _digest_cache is None:
+            _digest_cache = DigestCache(os.getenv("DIGEST_CACHE_PATH", DEFAULT_DIGEST_CACHE_PATH))
+        return _digest_cache
+
+
+def _digest_single_call(messages: List[Dict]) -> Dict:
+    """
+    一次调用生成情绪 + 总结 + 标题
+
+    Returns:
+        Dict: 校验通过的字段，调用或解析失败返回空字典
+    """
+    message_count = len(messages)
+    word_limit, detail_instruction = _word_limit(message_count)
+    guide = SUMMARY_GUIDE.format(
+        detail_instruction=detail_instruction,
+        emotion_instruction="体现你在第一步判断出的情绪，但别说教"
+    )
+
+    prompt = f"""基于以下对话完成三件事：判断用户的主导情绪，用第一人称视角写一段叙事，再给这段叙事起一个简短的标题。
+
+对话内容：
+{_format_conversation(messages)}
+
+对话轮数：{message_count // 2} 轮
+
+【第一步：情绪 emotion】
+分析对话，判断用户的主导情绪。
+
+{EMOTION_GUIDE}
+
+【第二步：叙事 summary】
+字数要求：{word_limit}
+
+{guide}
+
+【第三步：标题 title】
+基于第二步的叙事生成标题。
+
+{TITLE_GUIDE}
+
+只返回 JSON，不要其他内容：
+{{"emotion": "情绪标签", "summary": "叙事内容", "title": "标题"}}"""
+
+    try:
+        result = parse_json_reply(_chat(prompt, temperature=0.2, response_format={"type": "json_object"}))
+    except Exception as e:
+        print(f"   ⚠️  Moment 摘要生成失败: {e}")
+        return {}
+    if not isinstance(result, dict):
+        return {}
+
+    fields = {}
+    emotion = _normalize_emotion(str(result.get("emotion", "")))
+    if emotion:
+        fields["emotion"] = emotion
+    summary = str(result.get("summary") or "").strip()
+    if summary:
+        fields["summary"] = summary
+    title = _clean_title(str(result.get("title") or ""))
+    if title:
+        fields["title"] = title
+    return fields
+
+
+def generate_moment_digest(messages: List[Dict],
+                           extract_entities_fn: Optional[Callable[[List[Dict]], Dict]] = None) -> Dict:
+    """
+    生成 Moment 摘要
+
+    Args:
+        messages: Moment 消息（只使用用户消息）
+        extract_entities_fn: 实体提取函数（与 Card 字段调用并发），None 时返回空实体
+
+    Returns:
+        Dict: {"entities", "emotion"?, "summary"?, "title"?}，
+            Card 字段缺失时由 generate_moment_card(fields=...) 补全
+    """
+    user_messages = [m for m in messages if m.get("role") == "user"]
+    cache = get_digest_cache()
+    key = digest_key(_card_model(), user_messages)
+
+    cached = cache.get(key)
+    fields = dict(cached or {})
+    if cached is not None:
+        print(f"   🗃️ Moment 摘要命中缓存")
+
+    entity_future = None
+    if "entities" not in fields and extract_entities_fn:
+        entity_future = _get_card_executor().submit(extract_entities_fn, user_messages)
+
+    if cached is None:
+        t0 = time.perf_counter()
+        fields.update(_digest_single_call(user_messages))
+        print(f"   🧾 Moment 摘要: {sorted(fields)} ({(time.perf_counter() - t0) * 1000:.0f}ms)")
+
+    if entity_future:
+        fields["entities"] = entity_future.result()
+    fields.setdefault("entities", empty_entities())
+
+    # 缓存 Card 字段（摘要调用失败时不缓存，下次重试）；实体提取失败与没有实体都是空结构，只缓存非空实体
+    to_cache = {k: v for k, v in fields.items() if k != "entities" or v != empty_entities()}
+    if to_cache != (cached or {}) and any(k != "entities" for k in to_cache):
+        cache.put(key, to_cache)
+    return fields
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_moment_digest():
+    """测试 Moment 摘要（校验 + 缓存）"""
+    print("\n" + "="*60)
+    print("🧪 测试 Moment Digest")
+    print("="*60 + "\n")
+
+    messages = [
+        {"role": "user", "content": "今天在公司楼下买了一杯桂花拿铁"},
+        {"role": "assistant", "content": "好喝吗？"},
+        {"role": "user", "content": "超好喝，下次还要和小王一起去"},
+    ]
+
+    print("📋 实体校验:")
+    print(f"   合法: {validate_entities({'objects': {'桂花拿铁': {}}, 'events': ['买咖啡']}) is not None}")
+    print(f"   非法: {validate_entities({'objects': ['桂花拿铁']}) is not None}")
+
+    digest = generate_moment_digest(messages)
+    print(f"\n🧾 摘要: {json.dumps(digest, ensure_ascii=False)[:200]}")
+    generate_moment_digest(messages)
+    print(f"📊 缓存: {get_digest_cache().get_stats()}")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_moment_digest()
@@ -8,24 +8,25 @@ Moment Manager - Moment 会话管理（V3 混合检索版）
 4. 保持 API 兼容性
 """
 
+import os
 import json
 import uuid
 import threading
+from dataclasses import asdict
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict, Optional
 from concurrent.futures import ThreadPoolExecutor
 
 # 导入存储层
-from .moment_storage import MomentStorage
+from .storage_context import UserStorageContext
 
-# 导入向量存储层
-try:
-    from .vector_store import VectorStore
-    VECTOR_AVAILABLE = True
-except ImportError:
-    VECTOR_AVAILABLE = False
-    print("⚠️ VectorStore 未导入，向量功能不可用")
+# Moment Card 生成 + Moment 摘要（后处理任务使用）
+from .moment_card import generate_moment_card
+from .moment_digest import (
+    ENTITY_RULES, ENTITY_SCHEMA, ENTITY_SCOPE,
+    empty_entities, generate_moment_digest, merge_entities, validate_entities,
+)
 
 
 class MomentManager:
@@ -39,35 +40,35 @@ class MomentManager:
     4. 保持 API 兼容
     """
     
-    def __init__(self, user_id: str = None, base_storage_dir: str = "storage"):
+    def __init__(self, user_id: str = None, base_storage_dir: str = "storage",
+                 storage_context: Optional[UserStorageContext] = None):
         """
         初始化 Moment Manager
         
         Args:
             user_id: 用户唯一标识
             base_storage_dir: 基础存储目录
+            storage_context: 共享的用户存储上下文（与 ContextRAG 共用），不传则自建
         """
         self.user_id = user_id or "default_user"
         self.base_storage_dir = Path(base_storage_dir)
         
-        # 使用 SQLite 存储
-        self.storage = MomentStorage(
-            user_id=self.user_id,
-            base_dir=str(self.base_storage_dir)
-        )
-        
-        # 使用向量存储
-        if VECTOR_AVAILABLE:
-            self.vector_store = VectorStore(
+        # SQLite 存储 + 向量存储（优先使用共享上下文）
+        # 自建的上下文由自己关闭；共享的上下文由持有者（ManagerRegistry）统一关闭
+        self._owns_storage = storage_context is None
+        if storage_context is None:
+            storage_context = UserStorageContext(
                 user_id=self.user_id,
                 base_dir=str(self.base_storage_dir)
             )
-        else:
-            self.vector_store = None
+        self.storage_context = storage_context
+        self.storage = storage_context.storage
+        self.vector_store = storage_context.vector_store
         
-        # 当前会话状态
+        # 当前会话状态（开始 / 添加消息 / 结束可能来自不同请求线程，修改时持有 session_lock）
         self.current_moment_id = None
         self.current_messages = []
+        self.session_lock = threading.RLock()
         
         # 异步任务线程池
         self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="moment_")
@@ -89,12 +90,8 @@ class MomentManager:
         """
         self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
         
-        # 更新存储层
-        self.storage.set_user_id(user_name, agent_name)
-        
-        # 更新向量存储
-        if self.vector_store:
-            self.vector_store.set_user_id(user_name, agent_name)
+        # 更新存储层 + 向量存储（共享上下文重复设置同一用户时不会重新初始化）
+        self.storage_context.set_user_id(user_name, agent_name)
         
         # 兼容旧代码
         self.storage_dir = self.base_storage_dir / "moments" / self.user_id
@@ -108,12 +105,25 @@ class MomentManager:
         Returns:
             str: moment_id
         """
-        self.current_moment_id = f"moment_{uuid.uuid4().hex[:8]}"
-        self.current_messages = []
+        with self.session_lock:
+            self.current_moment_id = f"moment_{uuid.uuid4().hex[:8]}"
+            self.current_messages = []
         
         print(f"\n✨ 开始新 Moment: {self.current_moment_id}")
         return self.current_moment_id
     
+    def ensure_moment(self) -> str:
+        """
+        没有活跃的 Moment 时开始一个（检查和开始在同一把锁内）
+        
+        Returns:
+            str: 当前 moment_id
+        """
+        with self.session_lock:
+            if not self.current_moment_id:
+                self.start_new_moment()
+            return self.current_moment_id
+    
     def add_message(self, role: str, content: str, emotion: str = "neutral"):
         """
         添加对话消息到当前 Moment
@@ -123,9 +133,6 @@ class MomentManager:
             content: 消息内容
             emotion: 情绪标签
         """
-        if not self.current_moment_id:
-            raise ValueError("请先调用 start_new_moment() 开始新 Moment")
-        
         message = {
             "role": role,
             "content": content,
@@ -133,10 +140,13 @@ class MomentManager:
             "timestamp": datetime.now().isoformat()
         }
         
-        self.current_messages.append(message)
+        with self.session_lock:
+            if not self.current_moment_id:
+                raise ValueError("请先调用 start_new_moment() 开始新 Moment")
+            self.current_messages.append(message)
         print(f"  📝 添加消息: {role} - {content[:30]}...")
     
-    def end_moment(self) -> Dict:
+    def end_moment(self, process_async: bool = True) -> Dict:
         """
         结束当前 Moment，保存到存储
         
@@ -145,9 +155,19 @@ class MomentManager:
         2. 异步提取实体并更新
         3. 异步写入向量存储
         
+        Args:
+            process_async: 是否在本进程线程池中提取实体 + 写入向量；
+                交给持久化任务队列（finalize_moment）处理时传 False
+        
         Returns:
             Dict: Moment 数据
         """
+        # 保存和重置期间持有锁，期间到达的消息不会被重置丢掉
+        with self.session_lock:
+            return self._end_moment(process_async)
+    
+    def _end_moment(self, process_async: bool) -> Dict:
+        """end_moment 的实现（需持有 session_lock）"""
         if not self.current_moment_id:
             raise ValueError("没有活跃的 Moment")
         
@@ -180,7 +200,11 @@ class MomentManager:
                 # 1. 提取结构化实体
                 print(f"🔍 [异步] 开始提取实体: {moment_id}")
                 entities = self._extract_structured_info(user_messages)
-                self.storage.update_moment_entities(moment_id, entities)
+                # 排队写入（与其他后台写入合并提交），不等待提交即开始写向量
+                future = self.storage.update_moment_entities_async(moment_id, entities)
+                future.add_done_callback(
+                    lambda f: f.exception() and print(f"⚠️ [异步] 实体写入失败: {f.exception()}")
+                )
                 print(f"🔍 [异步] 实体提取完成: {moment_id}")
                 print(f"   结构化信息：{json.dumps(entities, ensure_ascii=False)[:200]}...")
                 
@@ -198,7 +222,8 @@ class MomentManager:
                 traceback.print_exc()
         
         # 提交异步任务
-        self._executor.submit(async_process)
+        if process_async:
+            self._executor.submit(async_process)
         
         # 重置当前状态
         self.current_moment_id = None
@@ -245,6 +270,49 @@ class MomentManager:
         
         print(f"✅ Moment 已更新: {moment_id}")
     
+    def finalize_moment(self, moment_id: str) -> Dict:
+        """
+        Moment 后处理：提取实体 + 生成 Moment Card + 写入向量（后台任务同步调用）
+        
+        默认一次 Moment 摘要调用生成 Card 字段、实体用 qwen-turbo 并发提取（按消息哈希缓存），
+        缺失的 Card 字段单独生成；
+        MOMENT_DIGEST_ENABLED=0 时实体提取与 Card 生成分别调用（并发）。
+        实体和总结都写入后只向量化一次
+        
+        Args:
+            moment_id: 已保存的 Moment ID
+        
+        Returns:
+            Dict: Moment Card
+        """
+        moment = self.storage.get_moment(moment_id)
+        if not moment:
+            raise ValueError(f"Moment 不存在: {moment_id}")
+        
+        user_messages = [msg for msg in moment.get('messages', []) if msg['role'] == 'user']
+        if os.getenv("MOMENT_DIGEST_ENABLED", "1") != "0":
+            digest = generate_moment_digest(user_messages, extract_entities_fn=self._extract_structured_info)
+            entities = digest['entities']
+            card = generate_moment_card(moment, fields=digest)
+        else:
+            entity_future = self._executor.submit(self._extract_structured_info, user_messages)
+            card = generate_moment_card(moment)
+            entities = entity_future.result()
+        
+        self.storage.update_moment_entities(moment_id, entities)
+        self.storage.update_moment(moment_id, {
+            'summary': card.summary,
+            'emotion_tag': card.emotion,
+            'card_generated': True
+        })
+        
+        if self.vector_store:
+            moment.update(entities=entities, summary=card.summary, emotion_tag=card.emotion)
+            self.vector_store.add_moment(moment_id, moment)
+        
+        print(f"✅ Moment 后处理完成: {moment_id}")
+        return asdict(card)
+    
     def get_moment_count(self) -> int:
         """获取 Moment 总数"""
         return self.storage.get_moment_count()
@@ -288,7 +356,7 @@ class MomentManager:
         
         # 使用 LLM 提取结构化信息
         try:
-            from openai import OpenAI
+            from ..utils.llm_gateway import get_llm_client
             
             # 尝试多种方式获取 API 配置
             import os
@@ -304,10 +372,7 @@ class MomentManager:
                 print("   ⚠️  未配置 QWEN API KEY")
                 return self._get_empty_entities()
             
-            client = OpenAI(
-                api_key=api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+            client = get_llm_client(api_key)
             
             prompt = self._get_extraction_prompt(conversation)
             
@@ -339,8 +404,8 @@ class MomentManager:
                 else:
                     return self._get_empty_entities()
             
-            # 确保所有字段存在
-            return self._merge_with_default(entities)
+            # 校验结构并补齐字段（非字符串的列表元素转为字符串或丢弃）
+            return validate_entities(entities) or self._get_empty_entities()
             
         except Exception as e:
             print(f"   ⚠️  结构化信息提取失败: {e}")
@@ -348,74 +413,33 @@ class MomentManager:
     
     def _get_empty_entities(self) -> Dict:
         """返回空的实体结构"""
-        return {
-            "people": {},
-            "places": {},
-            "time_info": {
-                "daily_routines": [],
-                "time_markers": []
-            },
-            "objects": {},
-            "habits": [],
-            "events": []
-        }
+        return empty_entities()
     
     def _merge_with_default(self, entities: Dict) -> Dict:
         """合并实体与默认结构"""
-        default = self._get_empty_entities()
-        
-        for key in default:
-            if key in entities:
-                if isinstance(default[key], dict):
-                    default[key].update(entities[key])
-                elif isinstance(default[key], list):
-                    default[key] = entities[key]
-        
-        return default
+        return merge_entities(entities)
     
     def _get_extraction_prompt(self, conversation: str) -> str:
         """获取实体提取的 Prompt"""
         return f"""从以下用户消息中提取关键实体信息，用于后续精准检索。
 
-⚠️ **极其重要**：
-- **只从用户消息中提取**，不要从Agent回复中提取
-- **只提取用户明确提到的内容**，不要推测或编造
-- **如果用户没有提到，就不要提取**
+{ENTITY_SCOPE}
 
 用户消息：
 {conversation}
 
 请提取以下信息，以 JSON 格式返回：
-{{
-  "people": {{
-    "人名1": {{"role": "关系/身份", "attributes": ["特征1", "特征2"]}}
-  }},
-  "places": {{
-    "地点1": {{"type": "类型", "position": "具体位置"}}
-  }},
-  "time_info": {{
-    "daily_routines": ["完整时间表达1"],
-    "time_markers": ["时间1"]
-  }},
-  "objects": {{
-    "物品1": {{"color": "颜色", "type": "类型", "description": "完整描述"}}
-  }},
-  "habits": ["习惯1"],
-  "events": ["事件1"]
-}}
+{ENTITY_SCHEMA}
 
-⚠️ **关键要求**：
-1. 物品必须包含完整描述（颜色、类型、特征）
-2. 地点必须包含位置信息
-3. 食物/饮料要完整提取名称和特征
-4. 只提取明确出现的内容，不推测
-5. 如果某类信息没有，返回空对象{{}}或空列表[]
+{ENTITY_RULES}
 6. 只返回 JSON，不要任何其他文字"""
     
     def shutdown(self):
-        """关闭管理器，等待异步任务完成"""
+        """关闭管理器，等待异步任务完成；存储上下文是自建的才释放（共享的由持有者关闭）"""
         print("🔄 等待异步任务完成...")
         self._executor.shutdown(wait=True)
+        if self._owns_storage:
+            self.storage_context.close()
         print("✅ Moment Manager 已关闭")
 
 
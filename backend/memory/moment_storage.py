@@ -1,17 +1,212 @@
 """
 Storage Layer - SQLite 存储层
 替代 JSON 文件遍历，提供高性能索引检索
+
+并发：WAL 日志模式，读连接每线程一个、不会被写阻塞；
+所有写入由单个写线程串行执行，排队的写入合并为一个事务提交
+
+全文检索：FTS5 虚拟表 moments_fts（用户消息、摘要、各类实体名），BM25 排序
+中文按二元组（bigram）切分后写入，unicode61 分词器按空格切词，
+关键词查询转为二元组短语，等价于 LIKE 子串匹配但走倒排索引
 """
 
+import re
+import queue
 import sqlite3
 import json
 import threading
+from concurrent.futures import Future
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from contextlib import contextmanager
 
 
+# 检索投影：保留的前 N 条消息（上下文 prompt 展示前 6 条）
+RETRIEVAL_MESSAGE_LIMIT = 6
+
+# 检索投影：至少保留的前 N 条用户消息（Rerank 使用前 3 条）
+RETRIEVAL_USER_MESSAGE_LIMIT = 3
+
+# 连接参数（每个连接执行）
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",     # WAL 下 NORMAL 足够安全
+    "PRAGMA cache_size = -16000",      # 16MB 页缓存
+    "PRAGMA mmap_size = 268435456",    # 256MB 内存映射
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+# 写线程一次最多合并的写入数
+WRITE_BATCH_SIZE = 64
+
+# 数据库结构版本（PRAGMA user_version）
+# 1: 新增 moments_fts 全文索引
+# 2: moments 新增 timestamp_epoch 列（时间范围过滤按 epoch 秒比较）
+SCHEMA_VERSION = 2
+
+# 全文索引的实体列（entity_type -> FTS 列）
+FTS_ENTITY_COLUMNS = {
+    "people": "people",
+    "places": "places",
+    "objects": "objects",
+    "events": "events",
+    "habits": "habits",
+    "daily_routines": "time_info",
+    "time_markers": "time_info",
+}
+
+# 全文索引列；BM25 权重依次对应 moment_id 及 FTS_COLUMNS 各列
+FTS_COLUMNS = ["content", "summary", "people", "places", "objects", "events", "habits", "time_info"]
+FTS_BM25_WEIGHTS = "0.0, 1.0, 2.0, 3.0, 3.0, 3.0, 3.0, 2.0, 1.0"
+
+# 结构化检索：实体类型命中权重（只计入请求的实体类型）
+STRUCTURED_TYPE_WEIGHTS = {
+    "objects": 1.0,
+    "places": 1.0,
+    "people": 1.0,
+    "events": 0.9,
+    "habits": 0.8,
+    "daily_routines": 0.6,
+    "time_markers": 0.6,
+}
+
+# 结构化检索：关键词命中任意实体的权重（每个关键词计一次）
+KEYWORD_MATCH_WEIGHT = 0.8
+
+# 中日韩文字 / 字母数字
+_FTS_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9A-Za-z]+")
+
+
+def fts_tokens(text: str, for_query: bool = False) -> List[List[str]]:
+    """
+    全文索引切词（按连续片段分组）
+    
+    - 中文片段：二元组；索引时额外补上片段末字，保证单字前缀查询能命中每个位置
+    - 字母数字：整词小写
+    
+    Returns:
+        List[List[str]]: 每个片段的 token 列表
+    """
+    runs = []
+    for run in _FTS_TOKEN_RE.findall(text or ""):
+        if run[0].isascii():
+            runs.append([run.lower()])
+        elif len(run) == 1:
+            runs.append([run])
+        else:
+            tokens = [run[i:i + 2] for i in range(len(run) - 1)]
+            if not for_query:
+                tokens.append(run[-1])
+            runs.append(tokens)
+    return runs
+
+
+def fts_index_text(text: str) -> str:
+    """转换为写入 FTS 的文本（空格分隔的 token）"""
+    return " ".join(" ".join(tokens) for tokens in fts_tokens(text))
+
+
+def fts_query(text: str) -> Optional[str]:
+    """
+    转换为 FTS MATCH 表达式：每个片段一个短语，片段之间 AND
+    
+    单个汉字用前缀查询（"铁"*），末尾为字母数字时也用前缀查询
+    """
+    phrases = []
+    for tokens in fts_tokens(text, for_query=True):
+        phrase = '"' + " ".join(tokens) + '"'
+        if len(tokens) == 1 and (len(tokens[0]) == 1 or tokens[0].isascii()):
+            phrase += "*"
+        phrases.append(phrase)
+    return " AND ".join(phrases) if phrases else None
+
+
+def has_ascii_word(text: str) -> bool:
+    """是否含字母数字片段（FTS 对这类片段是整词 / 前缀匹配，不是子串匹配）"""
+    return any(tokens[0].isascii() for tokens in fts_tokens(text, for_query=True))
+
+
+def merge_moment_results(primary: List[Dict], extra: List[Dict], top_k: int) -> List[Dict]:
+    """全文检索结果在前，补充结果按 moment_id 去重后追加，最多 top_k 条"""
+    seen = {m["moment_id"] for m in primary}
+    merged = list(primary)
+    for moment in extra:
+        if len(merged) >= top_k:
+            break
+        if moment["moment_id"] not in seen:
+            seen.add(moment["moment_id"])
+            merged.append(moment)
+    return merged[:top_k]
+
+
+def timestamp_epoch(timestamp: Optional[str]) -> float:
+    """ISO 时间转 epoch 秒（时间范围比较用；无法解析时为 0）"""
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def epoch_range(time_range: Optional[Dict]) -> Tuple[float, float]:
+    """时间窗口 {"start", "end"}（ISO 时间）转为 epoch 秒闭区间，缺省端不限"""
+    time_range = time_range or {}
+    start = timestamp_epoch(time_range["start"]) if time_range.get("start") else float("-inf")
+    end = timestamp_epoch(time_range["end"]) if time_range.get("end") else float("inf")
+    return start, end
+
+
+def score_structured_hits(hits: List[Tuple[str, str, str, str]], keywords: List[str],
+                          entity_types: List[str], top_k: int = 10,
+                          time_range: Optional[Dict] = None) -> List[Tuple[str, float, List[str]]]:
+    """
+    按 Moment 聚合实体命中并打分（MomentStorage.structured_hits 的结果）
+    
+    打分：
+    - 每个 (实体类型, 关键词) 命中：STRUCTURED_TYPE_WEIGHTS[类型]（只计请求的实体类型）
+    - 每个命中任意实体的关键词：KEYWORD_MATCH_WEIGHT
+    同分按时间倒序
+    
+    Args:
+        hits: (moment_id, entity_type, keyword, timestamp_epoch) 列表，可以来自多次查询（会去重）
+        keywords: 参与打分的关键词（hits 中其他关键词忽略）
+        entity_types: 请求的实体类型
+        top_k: 返回数量
+        time_range: 时间窗口（hits 未按时间过滤时使用）
+    
+    Returns:
+        List[Tuple]: (moment_id, score, match_types)
+    """
+    wanted = set(kw for kw in keywords if kw)
+    type_weights = {et: STRUCTURED_TYPE_WEIGHTS.get(et, 1.0) for et in entity_types}
+    start, end = epoch_range(time_range)
+    
+    moments: Dict[str, Dict] = {}
+    for moment_id, entity_type, keyword, epoch in dict.fromkeys(hits):
+        if keyword not in wanted:
+            continue
+        epoch = epoch or 0.0
+        if time_range and not (start <= epoch <= end):
+            continue
+        m = moments.setdefault(moment_id, {"score": 0.0, "types": [], "keywords": {}, "timestamp": epoch})
+        if entity_type in type_weights:
+            m["score"] += type_weights[entity_type]
+            m["types"].append(f"{entity_type}:{keyword}")
+        m["keywords"][keyword] = None
+    
+    ranked = sorted(
+        moments.items(),
+        key=lambda item: (item[1]["score"] + KEYWORD_MATCH_WEIGHT * len(item[1]["keywords"]),
+                          item[1]["timestamp"]),
+        reverse=True
+    )
+    return [
+        (moment_id, m["score"] + KEYWORD_MATCH_WEIGHT * len(m["keywords"]),
+         m["types"] + [f"keyword:{kw}" for kw in m["keywords"]])
+        for moment_id, m in ranked[:top_k]
+    ]
+
+
 class MomentStorage:
     """
     Moment 存储层（SQLite 实现）
@@ -19,7 +214,7 @@ class MomentStorage:
     特性：
     1. 替代 JSON 文件遍历，检索速度提升 100x
     2. 实体索引，支持精准匹配
-    3. 线程安全
+    3. 线程安全（WAL + 单写线程）
     4. 多用户数据隔离
     """
     
@@ -41,6 +236,20 @@ class MomentStorage:
         # 线程本地存储（每个线程一个连接）
         self._local = threading.local()
         
+        # 所有线程打开过的连接（用于 close 统一释放）
+        self._connections: List[sqlite3.Connection] = []
+        self._conn_lock = threading.Lock()
+        # 连接代数：close / 切换用户后递增，各线程发现代数变化时重新连接
+        self._generation = 0
+        
+        # FTS5 是否可用（_init_db 中检测）
+        self.fts_enabled = False
+        
+        # 单写线程：写入排队后合并提交（首次写入时启动，close 时停止）
+        self._write_queue: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        
         # 初始化数据库
         self._init_db()
         
@@ -48,36 +257,153 @@ class MomentStorage:
     
     def set_user_id(self, user_name: str, agent_name: str):
         """切换用户"""
-        self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+        new_user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+        if new_user_id == self.user_id:
+            return  # 共享存储时多个管理器会重复设置同一用户
+        self.user_id = new_user_id
+        # 关闭旧库的连接，否则当前线程会继续复用指向旧数据库的连接
+        self.close()
         self.db_path = self.base_dir / f"{self.user_id}_moments.db"
         self._init_db()
         print(f"📦 MomentStorage 切换用户: {self.user_id}")
     
+    def _connect(self) -> sqlite3.Connection:
+        """创建连接并应用连接参数"""
+        conn = sqlite3.connect(
+            str(self.db_path),
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
     @contextmanager
     def _get_conn(self):
         """获取线程安全的数据库连接"""
-        if not hasattr(self._local, 'conn') or self._local.conn is None:
-            self._local.conn = sqlite3.connect(
-                str(self.db_path),
-                check_same_thread=False
-            )
-            self._local.conn.row_factory = sqlite3.Row
+        if (getattr(self._local, 'conn', None) is None
+                or getattr(self._local, 'generation', None) != self._generation):
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.generation = self._generation
+            with self._conn_lock:
+                self._connections.append(conn)
         try:
             yield self._local.conn
         except Exception as e:
             self._local.conn.rollback()
             raise e
     
+    def close(self):
+        """等待排队的写入完成，关闭所有线程打开的连接（之后再访问会自动重连）"""
+        self._stop_writer()
+        with self._conn_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._connections = []
+            self._generation += 1
+    
+    # ============================================================
+    # 单写线程
+    # ============================================================
+    
+    def _submit_write(self, func, *args) -> Future:
+        """
+        提交写入任务到写线程
+        
+        Args:
+            func: func(cursor, *args)，在写线程的事务中执行
+            
+        Returns:
+            Future: 事务提交后得到 func 的返回值
+        """
+        future: Future = Future()
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(
+                    target=self._writer_loop,
+                    name=f"storage_writer_{self.user_id}",
+                    daemon=True
+                )
+                self._writer.start()
+            self._write_queue.put((func, args, future))
+        return future
+    
+    def _stop_writer(self):
+        """写完队列中的任务后停止写线程"""
+        with self._writer_lock:
+            writer = self._writer
+            self._writer = None
+            if writer is not None and writer.is_alive():
+                self._write_queue.put(None)
+        if writer is not None and writer is not threading.current_thread():
+            writer.join()
+    
+    def _writer_loop(self):
+        """写线程：取出排队的写入，合并为一个事务提交"""
+        stop = False
+        while not stop:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    item = self._write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._run_write_batch(batch)
+    
+    def _run_write_batch(self, batch: List[Tuple]):
+        """在一个事务中执行一批写入（每个写入一个 SAVEPOINT，失败只回滚自身）"""
+        results = []
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for func, args, future in batch:
+                    cursor.execute("SAVEPOINT write_item")
+                    try:
+                        results.append((future, func(cursor, *args), None))
+                        cursor.execute("RELEASE write_item")
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write_item")
+                        cursor.execute("RELEASE write_item")
+                        results.append((future, None, e))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+        
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
     def _init_db(self):
         """初始化数据库表"""
         with self._get_conn() as conn:
             cursor = conn.cursor()
             
+            # WAL：读不阻塞写、写不阻塞读（持久化在数据库文件中）
+            cursor.execute("PRAGMA journal_mode = WAL")
+            
             # 主表：moments
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS moments (
                     id TEXT PRIMARY KEY,
                     timestamp TEXT NOT NULL,
+                    timestamp_epoch REAL,
                     messages TEXT NOT NULL,
                     summary TEXT,
                     emotion_tag TEXT,
@@ -117,8 +443,110 @@ class MomentStorage:
                 ON entities(moment_id)
             """)
             
+            # 全文索引：moments_fts（SQLite 未编译 FTS5 时退回 LIKE 检索）
+            try:
+                cursor.execute(f"""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS moments_fts USING fts5(
+                        moment_id UNINDEXED, {", ".join(FTS_COLUMNS)},
+                        tokenize = 'unicode61'
+                    )
+                """)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                self.fts_enabled = False
+                print(f"   ⚠️ FTS5 不可用，使用 LIKE 检索: {e}")
+            
+            conn.commit()
+            
+            self._migrate(conn)
+    
+    def _migrate(self, conn):
+        """按 PRAGMA user_version 执行数据库迁移"""
+        cursor = conn.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        
+        if version < 1 and self.fts_enabled:
+            # v1：回填全文索引
+            cursor.execute("DELETE FROM moments_fts")
+            rows = cursor.execute(
+                "SELECT id, messages, summary, entities FROM moments"
+            ).fetchall()
+            for row in rows:
+                self._index_fts(
+                    cursor, row['id'],
+                    json.loads(row['messages']),
+                    row['summary'],
+                    json.loads(row['entities']) if row['entities'] else {}
+                )
+            conn.commit()
+            if rows:
+                print(f"   📦 全文索引回填: {len(rows)} 个 Moments")
+            version = 1
+        
+        if version < 2:
+            # v2：timestamp_epoch 列（可重复执行：只补写为空的行）
+            columns = {row['name'] for row in cursor.execute("PRAGMA table_info(moments)")}
+            if 'timestamp_epoch' not in columns:
+                cursor.execute("ALTER TABLE moments ADD COLUMN timestamp_epoch REAL")
+            rows = cursor.execute(
+                "SELECT id, timestamp FROM moments WHERE timestamp_epoch IS NULL"
+            ).fetchall()
+            cursor.executemany(
+                "UPDATE moments SET timestamp_epoch = ? WHERE id = ?",
+                [(timestamp_epoch(row['timestamp']), row['id']) for row in rows]
+            )
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_moments_timestamp_epoch
+                ON moments(timestamp_epoch)
+            """)
+            conn.commit()
+            if rows:
+                print(f"   🕒 已为 {len(rows)} 个 Moments 补写 timestamp_epoch")
+        
+        # FTS5 不可用时停在 v0，FTS 可用后再回填全文索引
+        if 1 <= version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             conn.commit()
     
+    def _index_fts(self, cursor, moment_id: str, messages: List[Dict],
+                   summary: Optional[str], entities: Dict):
+        """重建单个 Moment 的全文索引"""
+        if not self.fts_enabled:
+            return
+        
+        cursor.execute("DELETE FROM moments_fts WHERE moment_id = ?", (moment_id,))
+        
+        columns = {col: [] for col in FTS_COLUMNS}
+        columns["content"] = [m.get('content', '') for m in messages if m.get('role') == 'user']
+        columns["summary"] = [summary or ""]
+        for entity_type in ("people", "places", "objects"):
+            columns[entity_type] = list((entities.get(entity_type) or {}).keys())
+        for entity_type in ("events", "habits"):
+            columns[entity_type] = list(entities.get(entity_type) or [])
+        time_info = entities.get('time_info') or {}
+        columns["time_info"] = list(time_info.get('daily_routines', [])) + list(time_info.get('time_markers', []))
+        
+        values = [fts_index_text("\n".join(str(v) for v in columns[col])) for col in FTS_COLUMNS]
+        cursor.execute(f"""
+            INSERT INTO moments_fts (moment_id, {", ".join(FTS_COLUMNS)})
+            VALUES (?{", ?" * len(FTS_COLUMNS)})
+        """, [moment_id] + values)
+    
+    def _reindex_fts(self, cursor, moment_id: str):
+        """从 moments 表读取当前数据并重建全文索引"""
+        if not self.fts_enabled:
+            return
+        row = cursor.execute(
+            "SELECT messages, summary, entities FROM moments WHERE id = ?", (moment_id,)
+        ).fetchone()
+        if row:
+            self._index_fts(
+                cursor, moment_id,
+                json.loads(row['messages']),
+                row['summary'],
+                json.loads(row['entities']) if row['entities'] else {}
+            )
+    
     def save_moment(self, moment_data: Dict) -> bool:
         """
         保存 Moment
@@ -129,91 +557,77 @@ class MomentStorage:
         Returns:
             bool: 是否成功
         """
-        with self._get_conn() as conn:
-            cursor = conn.cursor()
-            
-            try:
-                # 插入主记录
-                cursor.execute("""
-                    INSERT OR REPLACE INTO moments 
-                    (id, timestamp, messages, summary, emotion_tag, card_generated, entities)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    moment_data['moment_id'],
-                    moment_data.get('timestamp', datetime.now().isoformat()),
-                    json.dumps(moment_data.get('messages', []), ensure_ascii=False),
-                    moment_data.get('summary'),
-                    moment_data.get('emotion_tag'),
-                    1 if moment_data.get('card_generated') else 0,
-                    json.dumps(moment_data.get('entities', {}), ensure_ascii=False)
-                ))
-                
-                # 删除旧的实体索引
-                cursor.execute("DELETE FROM entities WHERE moment_id = ?", 
-                              (moment_data['moment_id'],))
-                
-                # 插入新的实体索引
-                entities = moment_data.get('entities', {})
-                self._index_entities(cursor, moment_data['moment_id'], entities)
-                
-                conn.commit()
-                return True
-                
-            except Exception as e:
-                print(f"❌ 保存 Moment 失败: {e}")
-                conn.rollback()
-                return False
+        try:
+            self.save_moment_async(moment_data).result()
+            return True
+        except Exception as e:
+            print(f"❌ 保存 Moment 失败: {e}")
+            return False
     
-    def _index_entities(self, cursor, moment_id: str, entities: Dict):
-        """索引实体到 entities 表"""
+    def save_moment_async(self, moment_data: Dict) -> Future:
+        """排队保存 Moment，返回 Future（后台任务使用，与其他写入合并提交）"""
+        return self._submit_write(self._save_moment_tx, moment_data)
+    
+    def _save_moment_tx(self, cursor, moment_data: Dict):
+        """保存 Moment（写线程事务内执行）"""
+        # 插入主记录
+        timestamp = moment_data.get('timestamp', datetime.now().isoformat())
+        cursor.execute("""
+            INSERT OR REPLACE INTO moments 
+            (id, timestamp, timestamp_epoch, messages, summary, emotion_tag, card_generated, entities)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            moment_data['moment_id'],
+            timestamp,
+            timestamp_epoch(timestamp),
+            json.dumps(moment_data.get('messages', []), ensure_ascii=False),
+            moment_data.get('summary'),
+            moment_data.get('emotion_tag'),
+            1 if moment_data.get('card_generated') else 0,
+            json.dumps(moment_data.get('entities', {}), ensure_ascii=False)
+        ))
         
-        # 索引 people
-        for name, info in entities.get('people', {}).items():
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'people', ?, ?)
-            """, (moment_id, name, json.dumps(info, ensure_ascii=False)))
+        # 删除旧的实体索引
+        cursor.execute("DELETE FROM entities WHERE moment_id = ?", 
+                      (moment_data['moment_id'],))
         
-        # 索引 places
-        for name, info in entities.get('places', {}).items():
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'places', ?, ?)
-            """, (moment_id, name, json.dumps(info, ensure_ascii=False)))
+        # 插入新的实体索引
+        entities = moment_data.get('entities', {})
+        self._index_entities(cursor, moment_data['moment_id'], entities)
         
-        # 索引 objects
-        for name, info in entities.get('objects', {}).items():
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'objects', ?, ?)
-            """, (moment_id, name, json.dumps(info, ensure_ascii=False)))
+        # 全文索引
+        self._index_fts(
+            cursor, moment_data['moment_id'],
+            moment_data.get('messages', []),
+            moment_data.get('summary'),
+            entities or {}
+        )
+    
+    def _index_entities(self, cursor, moment_id: str, entities: Dict):
+        """索引实体到 entities 表（一次 executemany）"""
+        rows = []
         
-        # 索引 events
-        for event in entities.get('events', []):
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'events', ?, NULL)
-            """, (moment_id, event))
+        # people / places / objects：名称 + 描述
+        for entity_type in ('people', 'places', 'objects'):
+            for name, info in entities.get(entity_type, {}).items():
+                rows.append((moment_id, entity_type, name, json.dumps(info, ensure_ascii=False)))
         
-        # 索引 habits
-        for habit in entities.get('habits', []):
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'habits', ?, NULL)
-            """, (moment_id, habit))
+        # events / habits：只有名称
+        for entity_type in ('events', 'habits'):
+            for name in entities.get(entity_type, []):
+                rows.append((moment_id, entity_type, name, None))
         
-        # 索引 time_info
+        # time_info
         time_info = entities.get('time_info', {})
-        for routine in time_info.get('daily_routines', []):
-            cursor.execute("""
-                INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'daily_routines', ?, NULL)
-            """, (moment_id, routine))
-        for marker in time_info.get('time_markers', []):
-            cursor.execute("""
+        for entity_type in ('daily_routines', 'time_markers'):
+            for name in time_info.get(entity_type, []):
+                rows.append((moment_id, entity_type, name, None))
+        
+        if rows:
+            cursor.executemany("""
                 INSERT INTO entities (moment_id, entity_type, entity_name, entity_value)
-                VALUES (?, 'time_markers', ?, NULL)
-            """, (moment_id, marker))
+                VALUES (?, ?, ?, ?)
+            """, rows)
     
     def update_moment_entities(self, moment_id: str, entities: Dict) -> bool:
         """
@@ -226,28 +640,32 @@ class MomentStorage:
         Returns:
             bool: 是否成功
         """
-        with self._get_conn() as conn:
-            cursor = conn.cursor()
-            
-            try:
-                # 更新主表
-                cursor.execute("""
-                    UPDATE moments SET entities = ? WHERE id = ?
-                """, (json.dumps(entities, ensure_ascii=False), moment_id))
-                
-                # 删除旧索引
-                cursor.execute("DELETE FROM entities WHERE moment_id = ?", (moment_id,))
-                
-                # 插入新索引
-                self._index_entities(cursor, moment_id, entities)
-                
-                conn.commit()
-                return True
-                
-            except Exception as e:
-                print(f"❌ 更新实体失败: {e}")
-                conn.rollback()
-                return False
+        try:
+            self.update_moment_entities_async(moment_id, entities).result()
+            return True
+        except Exception as e:
+            print(f"❌ 更新实体失败: {e}")
+            return False
+    
+    def update_moment_entities_async(self, moment_id: str, entities: Dict) -> Future:
+        """排队更新实体，返回 Future（后台任务使用，与其他写入合并提交）"""
+        return self._submit_write(self._update_moment_entities_tx, moment_id, entities)
+    
+    def _update_moment_entities_tx(self, cursor, moment_id: str, entities: Dict):
+        """更新实体（写线程事务内执行）"""
+        # 更新主表
+        cursor.execute("""
+            UPDATE moments SET entities = ? WHERE id = ?
+        """, (json.dumps(entities, ensure_ascii=False), moment_id))
+        
+        # 删除旧索引
+        cursor.execute("DELETE FROM entities WHERE moment_id = ?", (moment_id,))
+        
+        # 插入新索引
+        self._index_entities(cursor, moment_id, entities)
+        
+        # 全文索引
+        self._reindex_fts(cursor, moment_id)
     
     def get_moment(self, moment_id: str) -> Optional[Dict]:
         """获取单个 Moment"""
@@ -260,6 +678,42 @@ class MomentStorage:
                 return self._row_to_moment(row)
             return None
     
+    def get_moments(self, moment_ids: List[str], projection: str = "full") -> List[Dict]:
+        """
+        批量获取 Moments（一次 IN 查询）
+        
+        Args:
+            moment_ids: Moment ID 列表
+            projection: "full" 完整数据；"retrieval" 轻量投影
+                （摘要 + 实体 + 前 N 条消息，供检索 / Rerank / 上下文 prompt 使用）
+            
+        Returns:
+            List[Dict]: 按 moment_ids 顺序返回，不存在的 ID 跳过
+        """
+        ids = list(dict.fromkeys(mid for mid in moment_ids if mid))
+        if not ids:
+            return []
+        
+        rows = {}
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            # SQLite 参数上限 999，分批查询
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f"""
+                    SELECT id, timestamp, messages, summary, emotion_tag, card_generated, entities
+                    FROM moments WHERE id IN ({placeholders})
+                """, chunk)
+                for row in cursor.fetchall():
+                    rows[row['id']] = row
+        
+        if projection == "retrieval":
+            convert = self._row_to_retrieval_moment
+        else:
+            convert = self._row_to_moment
+        return [convert(rows[mid]) for mid in ids if mid in rows]
+    
     def get_recent_moments(self, n: int = 5) -> List[Dict]:
         """获取最近 N 个 Moments"""
         with self._get_conn() as conn:
@@ -289,8 +743,17 @@ class MomentStorage:
             top_k: 返回数量
             
         Returns:
-            List[Dict]: 匹配的 Moments
+            List[Dict]: 匹配的 Moments（全文索引可用时按 BM25 排序，
+                字母数字关键词不足 top_k 条时用 LIKE 子串匹配补足）
         """
+        column = FTS_ENTITY_COLUMNS.get(entity_type)
+        match = fts_query(keyword)
+        results = []
+        if self.fts_enabled and column and match:
+            results = self._search_fts(f"{{{column}}} : ({match})", top_k)
+            if len(results) >= top_k or not has_ascii_word(keyword):
+                return results
+        
         with self._get_conn() as conn:
             cursor = conn.cursor()
             
@@ -302,7 +765,7 @@ class MomentStorage:
                 LIMIT ?
             """, (entity_type, f"%{keyword}%", top_k))
             
-            return [self._row_to_moment(row) for row in cursor.fetchall()]
+            return merge_moment_results(results, [self._row_to_moment(row) for row in cursor.fetchall()], top_k)
     
     def search_by_keywords(self, keywords: List[str], top_k: int = 5) -> List[Dict]:
         """
@@ -313,11 +776,21 @@ class MomentStorage:
             top_k: 返回数量
             
         Returns:
-            List[Dict]: 匹配的 Moments（按匹配分数排序）
+            List[Dict]: 匹配的 Moments（按匹配分数排序；全文检索对字母数字关键词是前缀匹配，
+                不足 top_k 条时用 LIKE 子串匹配补足，如 latte 命中 icedlatte）
         """
         if not keywords:
             return []
         
+        matches = [m for m in (fts_query(kw) for kw in keywords) if m]
+        results = []
+        if self.fts_enabled and matches:
+            entity_columns = " ".join(dict.fromkeys(FTS_ENTITY_COLUMNS.values()))
+            expr = " OR ".join(f"({m})" for m in matches)
+            results = self._search_fts(f"{{{entity_columns}}} : ({expr})", top_k)
+            if len(results) >= top_k or not any(has_ascii_word(kw) for kw in keywords):
+                return results
+        
         with self._get_conn() as conn:
             cursor = conn.cursor()
             
@@ -335,11 +808,12 @@ class MomentStorage:
                 LIMIT ?
             """, params + [top_k])
             
-            return [self._row_to_moment(row) for row in cursor.fetchall()]
+            return merge_moment_results(results, [self._row_to_moment(row) for row in cursor.fetchall()], top_k)
     
     def search_by_text(self, query: str, top_k: int = 5) -> List[Dict]:
         """
-        全文检索（在 messages 中搜索）
+        全文检索（全文索引可用时检索用户消息和摘要，按 BM25 排序；否则在 messages 中 LIKE。
+        含字母数字的查询全文检索不足 top_k 条时，用 LIKE 子串匹配补足）
         
         Args:
             query: 查询文本
@@ -348,6 +822,13 @@ class MomentStorage:
         Returns:
             List[Dict]: 匹配的 Moments
         """
+        match = fts_query(query)
+        results = []
+        if self.fts_enabled and match:
+            results = self._search_fts(f"{{content summary}} : ({match})", top_k)
+            if len(results) >= top_k or not has_ascii_word(query):
+                return results
+        
         with self._get_conn() as conn:
             cursor = conn.cursor()
             
@@ -358,45 +839,140 @@ class MomentStorage:
                 LIMIT ?
             """, (f"%{query}%", top_k))
             
-            return [self._row_to_moment(row) for row in cursor.fetchall()]
+            return merge_moment_results(results, [self._row_to_moment(row) for row in cursor.fetchall()], top_k)
     
-    def update_moment(self, moment_id: str, updates: Dict) -> bool:
-        """更新 Moment 字段"""
-        with self._get_conn() as conn:
-            cursor = conn.cursor()
-            
-            # 构建 UPDATE 语句
-            set_clauses = []
-            values = []
-            
-            for key, value in updates.items():
-                if key in ('summary', 'emotion_tag', 'card_generated'):
-                    set_clauses.append(f"{key} = ?")
-                    if key == 'card_generated':
-                        values.append(1 if value else 0)
-                    else:
-                        values.append(value)
-            
-            if not set_clauses:
-                return False
+    def search_structured(self, keywords: List[str], entity_types: List[str],
+                          top_k: int = 10,
+                          time_range: Optional[Dict] = None) -> List[Tuple[str, float, List[str]]]:
+        """
+        结构化检索（一次 SQL 查询取命中，按 Moment 聚合打分，不解码消息 JSON）
+        
+        打分见 score_structured_hits
+        
+        Args:
+            keywords: 关键词列表
+            entity_types: 请求的实体类型
+            top_k: 返回数量
+            time_range: {"start": ISO 时间, "end": ISO 时间}，只检索该时间窗口内的 Moment
+                （按 timestamp_epoch 比较，走 idx_moments_timestamp_epoch 索引）
             
-            values.append(moment_id)
+        Returns:
+            List[Tuple]: (moment_id, score, match_types)，match_types 形如 "objects:咖啡"
+        """
+        hits = self.structured_hits(keywords, time_range)
+        return score_structured_hits(hits, keywords, entity_types, top_k)
+    
+    def structured_hits(self, keywords: List[str],
+                        time_range: Optional[Dict] = None) -> List[Tuple[str, str, str, str]]:
+        """
+        实体命中明细（不限实体类型、不打分，供不同实体类型 / 关键词子集复用）
+        
+        Args:
+            keywords: 关键词列表
+            time_range: 时间窗口，同 search_structured
             
+        Returns:
+            List[Tuple]: 去重的 (moment_id, entity_type, keyword, timestamp_epoch)
+        """
+        keywords = [kw for kw in dict.fromkeys(keywords) if kw]
+        if not keywords:
+            return []
+        
+        kw_values = ", ".join(["(?)"] * len(keywords))
+        params: List[Any] = list(keywords)
+        
+        # 全文索引预过滤候选（关键词都含中文时，二元组短语与子串匹配等价）
+        prefilter = ""
+        matches = [fts_query(kw) for kw in keywords]
+        if self.fts_enabled and all(matches) and all(not kw.isascii() for kw in keywords):
+            entity_columns = " ".join(dict.fromkeys(FTS_ENTITY_COLUMNS.values()))
+            prefilter = "AND e.moment_id IN (SELECT moment_id FROM moments_fts WHERE moments_fts MATCH ?)"
+            params.append(f"{{{entity_columns}}} : (" + " OR ".join(f"({m})" for m in matches) + ")")
+        
+        # 时间窗口（epoch 秒比较，不受时区后缀 / 小数秒格式影响）
+        if time_range:
+            prefilter += " AND m.timestamp_epoch >= ? AND m.timestamp_epoch <= ?"
+            params.extend(epoch_range(time_range))
+        
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
             cursor.execute(f"""
-                UPDATE moments SET {', '.join(set_clauses)} WHERE id = ?
-            """, values)
-            
-            conn.commit()
-            return cursor.rowcount > 0
+                WITH kw(keyword) AS (VALUES {kw_values})
+                SELECT DISTINCT e.moment_id, e.entity_type, kw.keyword, m.timestamp_epoch
+                FROM entities e
+                JOIN kw ON instr(lower(e.entity_name), lower(kw.keyword)) > 0
+                JOIN moments m ON m.id = e.moment_id
+                WHERE 1 = 1 {prefilter}
+            """, params)
+            return [tuple(row) for row in cursor.fetchall()]
     
-    def delete_moment(self, moment_id: str) -> bool:
-        """删除 Moment"""
+    def _search_fts(self, match: str, top_k: int) -> List[Dict]:
+        """执行 FTS MATCH 查询，按 BM25 排序（分数越小越相关）"""
         with self._get_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM moments WHERE id = ?", (moment_id,))
-            cursor.execute("DELETE FROM entities WHERE moment_id = ?", (moment_id,))
-            conn.commit()
-            return cursor.rowcount > 0
+            try:
+                cursor.execute(f"""
+                    SELECT m.* FROM moments_fts f
+                    JOIN moments m ON m.id = f.moment_id
+                    WHERE moments_fts MATCH ?
+                    ORDER BY bm25(moments_fts, {FTS_BM25_WEIGHTS}), m.timestamp DESC
+                    LIMIT ?
+                """, (match, top_k))
+            except sqlite3.OperationalError as e:
+                print(f"   ⚠️ 全文检索失败: {e}")
+                return []
+            return [self._row_to_moment(row) for row in cursor.fetchall()]
+    
+    def update_moment(self, moment_id: str, updates: Dict) -> bool:
+        """更新 Moment 字段"""
+        return self.update_moment_async(moment_id, updates).result()
+    
+    def update_moment_async(self, moment_id: str, updates: Dict) -> Future:
+        """排队更新 Moment 字段，返回 Future（结果为是否更新成功）"""
+        return self._submit_write(self._update_moment_tx, moment_id, updates)
+    
+    def _update_moment_tx(self, cursor, moment_id: str, updates: Dict) -> bool:
+        """更新 Moment 字段（写线程事务内执行）"""
+        # 构建 UPDATE 语句
+        set_clauses = []
+        values = []
+        
+        for key, value in updates.items():
+            if key in ('summary', 'emotion_tag', 'card_generated'):
+                set_clauses.append(f"{key} = ?")
+                if key == 'card_generated':
+                    values.append(1 if value else 0)
+                else:
+                    values.append(value)
+        
+        if not set_clauses:
+            return False
+        
+        values.append(moment_id)
+        
+        cursor.execute(f"""
+            UPDATE moments SET {', '.join(set_clauses)} WHERE id = ?
+        """, values)
+        updated = cursor.rowcount > 0
+        
+        # 摘要参与全文索引
+        if 'summary' in updates:
+            self._reindex_fts(cursor, moment_id)
+        
+        return updated
+    
+    def delete_moment(self, moment_id: str) -> bool:
+        """删除 Moment"""
+        return self._submit_write(self._delete_moment_tx, moment_id).result()
+    
+    def _delete_moment_tx(self, cursor, moment_id: str) -> bool:
+        """删除 Moment（写线程事务内执行）"""
+        cursor.execute("DELETE FROM moments WHERE id = ?", (moment_id,))
+        deleted = cursor.rowcount > 0
+        cursor.execute("DELETE FROM entities WHERE moment_id = ?", (moment_id,))
+        if self.fts_enabled:
+            cursor.execute("DELETE FROM moments_fts WHERE moment_id = ?", (moment_id,))
+        return deleted
     
     def get_moment_count(self) -> int:
         """获取 Moment 总数"""
@@ -405,19 +981,54 @@ class MomentStorage:
             cursor.execute("SELECT COUNT(*) FROM moments")
             return cursor.fetchone()[0]
     
+    def get_entity_names(self, min_length: int = 2,
+                         entity_types: Optional[List[str]] = None) -> List[str]:
+        """
+        获取用户实体名称（去重，检索门控匹配用）
+
+        Args:
+            min_length: 最短名称长度
+            entity_types: 只取这些实体类型（None 表示全部类型）
+        """
+        sql = "SELECT DISTINCT entity_name FROM entities WHERE length(entity_name) >= ?"
+        params: List = [min_length]
+        if entity_types:
+            sql += f" AND entity_type IN ({','.join('?' * len(entity_types))})"
+            params.extend(entity_types)
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+    
     def _row_to_moment(self, row: sqlite3.Row) -> Dict:
         """将数据库行转换为 Moment 字典"""
+        messages = json.loads(row['messages'])
         return {
             "moment_id": row['id'],
             "timestamp": row['timestamp'],
-            "messages": json.loads(row['messages']),
+            "messages": messages,
             "summary": row['summary'],
             "emotion_tag": row['emotion_tag'],
             "card_generated": bool(row['card_generated']),
             "entities": json.loads(row['entities']) if row['entities'] else {},
-            "message_count": len(json.loads(row['messages']))
+            "message_count": len(messages)
         }
     
+    def _row_to_retrieval_moment(self, row: sqlite3.Row) -> Dict:
+        """将数据库行转换为检索投影（只保留前 N 条消息）"""
+        moment = self._row_to_moment(row)
+        messages = moment["messages"]
+        
+        head = messages[:RETRIEVAL_MESSAGE_LIMIT]
+        user_in_head = sum(1 for m in head if m.get('role') == 'user')
+        if user_in_head < RETRIEVAL_USER_MESSAGE_LIMIT:
+            head += [m for m in messages[RETRIEVAL_MESSAGE_LIMIT:]
+                     if m.get('role') == 'user'][:RETRIEVAL_USER_MESSAGE_LIMIT - user_in_head]
+        
+        moment["messages"] = head
+        moment["projection"] = "retrieval"
+        return moment
+    
     def migrate_from_json(self, json_dir: str) -> int:
         """
         从 JSON 文件迁移数据
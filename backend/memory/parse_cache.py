@@ -0,0 +1,422 @@
+"""
+Parse Cache - 查询解析缓存
+缓存 QueryParser 的解析结果，命中时跳过 qwen-turbo 调用
+
+结构：
+1. 精确层（get）：规范化查询文本 → 解析结果，LRU + TTL
+2. 近似层（get_similar，可选）：调用方传入查询向量，与已缓存查询的余弦相似度 >= 阈值时复用
+   （"我昨天喝的咖啡" ≈ "昨天那杯咖啡"）；缓存本身不做向量化
+3. 持久化：SQLite，重启后加载未过期的条目
+
+时间引用（今天 / 昨天 / 上周……）不同的查询不会近似命中；
+缓存的 time_range 为解析时刻的绝对时间，由 QueryParser 在命中后按 time_reference 重新计算；
+近似命中的关键词属于另一条查询，由 QueryParser 按当前查询重新提取
+"""
+
+import os
+import re
+import json
+import time
+import math
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# 近似层矩阵计算（可选）
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+# 默认持久化路径
+DEFAULT_PARSE_CACHE_PATH = "storage/parse_cache.db"
+
+# 默认条数上限
+DEFAULT_MAX_ITEMS = 1000
+
+# 默认过期时间（秒）
+DEFAULT_TTL = 24 * 3600
+
+# 默认近似命中阈值（余弦相似度）
+DEFAULT_SIMILARITY_THRESHOLD = 0.92
+
+# 时间引用词（近似命中要求两边完全一致）
+TIME_WORDS_PATTERN = re.compile(
+    r'(今天|今早|今晚|昨天|昨晚|前天|上周|这周|本周|上个月|这个月|最近|刚才|上次|去年|今年)'
+)
+
+
+def normalize_query(query: str) -> str:
+    """精确层缓存键：去首尾空白、小写、去掉句末标点"""
+    return re.sub(r'[\s？?！!。.，,～~]+$', '', query.strip().lower())
+
+
+def time_signature(query: str) -> str:
+    """查询中出现的时间引用词（排序去重后拼接）"""
+    return "|".join(sorted(set(TIME_WORDS_PATTERN.findall(query))))
+
+
+class ParseCache:
+    """
+    查询解析缓存（线程安全）
+
+    semantic 为 False 时只有精确层；否则 get_similar 按调用方提供的查询向量查找近似条目
+    """
+
+    def __init__(self, db_path: Optional[str] = DEFAULT_PARSE_CACHE_PATH,
+                 max_items: Optional[int] = None,
+                 ttl: Optional[float] = None,
+                 similarity_threshold: Optional[float] = None,
+                 semantic: bool = False):
+        """
+        初始化缓存
+
+        Args:
+            db_path: 持久化 SQLite 路径，None 表示只在内存中
+            max_items: 条数上限，默认读取 PARSE_CACHE_ITEMS
+            ttl: 过期秒数，默认读取 PARSE_CACHE_TTL
+            similarity_threshold: 近似命中阈值，默认读取 PARSE_CACHE_SIMILARITY
+            semantic: 是否启用近似层
+        """
+        self.max_items = max_items or int(os.getenv("PARSE_CACHE_ITEMS", DEFAULT_MAX_ITEMS))
+        self.ttl = ttl if ttl is not None else float(os.getenv("PARSE_CACHE_TTL", DEFAULT_TTL))
+        self.similarity_threshold = similarity_threshold or float(
+            os.getenv("PARSE_CACHE_SIMILARITY", DEFAULT_SIMILARITY_THRESHOLD)
+        )
+        self.semantic = semantic
+
+        # key -> {"query", "time_sig", "result", "embedding", "latency_ms", "created_at"}
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        # 近似层矩阵（条目变化后重建）
+        self._matrix = None
+        self._matrix_keys: List[str] = []
+        self._matrix_dirty = True
+
+        self._stats = {
+            "exact_hits": 0,
+            "semantic_hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "evictions": 0,
+            "saved_ms": 0.0,
+        }
+
+        self._conn = None
+        if db_path:
+            self.db_path = Path(db_path)
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS parse_cache (
+                    key TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    time_sig TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    embedding BLOB,
+                    latency_ms REAL NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.commit()
+            self._load()
+        else:
+            self.db_path = None
+
+        print(f"🗃️ ParseCache 初始化: {self.db_path or 'memory'} "
+              f"(items={self.max_items}, ttl={self.ttl}s, "
+              f"semantic={'✅' if self.semantic else '❌'} {self.similarity_threshold})")
+
+    # ============================================================
+    # 持久化
+    # ============================================================
+
+    @staticmethod
+    def _encode(embedding: Optional[List[float]]) -> Optional[bytes]:
+        return array("f", embedding).tobytes() if embedding else None
+
+    @staticmethod
+    def _decode(blob: Optional[bytes]) -> Optional[List[float]]:
+        if not blob:
+            return None
+        vec = array("f")
+        vec.frombytes(blob)
+        return vec.tolist()
+
+    def _load(self):
+        """加载未过期的条目（最新的 max_items 条），删除其余"""
+        try:
+            cutoff = time.time() - self.ttl
+            self._conn.execute("DELETE FROM parse_cache WHERE created_at < ?", (cutoff,))
+            rows = self._conn.execute("""
+                SELECT key, query, time_sig, result, embedding, latency_ms, created_at
+                FROM parse_cache ORDER BY created_at DESC LIMIT ?
+            """, (self.max_items,)).fetchall()
+            self._conn.execute("""
+                DELETE FROM parse_cache WHERE key NOT IN (
+                    SELECT key FROM parse_cache ORDER BY created_at DESC LIMIT ?
+                )
+            """, (self.max_items,))
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"   ⚠️ ParseCache 加载失败: {e}")
+            return
+
+        for key, query, time_sig, result, embedding, latency_ms, created_at in reversed(rows):
+            self._entries[key] = {
+                "query": query,
+                "time_sig": time_sig,
+                "result": json.loads(result),
+                "embedding": self._normalize(self._decode(embedding)),
+                "latency_ms": latency_ms,
+                "created_at": created_at,
+            }
+        if rows:
+            print(f"   🗃️ ParseCache 已加载 {len(rows)} 条")
+
+    def _disk_put(self, key: str, entry: Dict):
+        """写入磁盘（需持有锁）"""
+        if self._conn is None:
+            return
+        try:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parse_cache "
+                "(key, query, time_sig, result, embedding, latency_ms, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, entry["query"], entry["time_sig"],
+                 json.dumps(entry["result"], ensure_ascii=False),
+                 self._encode(entry["embedding"]), entry["latency_ms"], entry["created_at"])
+            )
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"   ⚠️ ParseCache 写入失败: {e}")
+
+    def _disk_delete(self, keys: List[str]):
+        """从磁盘删除（需持有锁）"""
+        if self._conn is None or not keys:
+            return
+        try:
+            self._conn.executemany("DELETE FROM parse_cache WHERE key = ?", [(k,) for k in keys])
+            self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"   ⚠️ ParseCache 删除失败: {e}")
+
+    # ============================================================
+    # 查询 / 写入
+    # ============================================================
+
+    @staticmethod
+    def _normalize(embedding: Optional[List[float]]) -> Optional[List[float]]:
+        """L2 归一化（点积即余弦相似度）"""
+        if not embedding:
+            return None
+        norm = math.sqrt(sum(x * x for x in embedding))
+        if norm == 0:
+            return None
+        return [x / norm for x in embedding]
+
+    def get(self, query: str) -> Optional[Dict]:
+        """
+        精确层查询（未命中不计数，由调用方在所有层都未命中时调用 record_miss）
+
+        Args:
+            query: 原始查询
+
+        Returns:
+            Optional[Dict]: 解析结果
+        """
+        key = normalize_query(query)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry["created_at"] <= self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["exact_hits"] += 1
+                self._stats["saved_ms"] += entry["latency_ms"]
+                return entry["result"]
+            self._remove(key)
+            self._stats["expired"] += 1
+        return None
+
+    def get_similar(self, query: str, embedding: Optional[List[float]]) -> Optional[Dict]:
+        """
+        近似层查询
+
+        Args:
+            query: 原始查询（用于比较时间引用）
+            embedding: 查询向量（调用方提供，不需要归一化）
+
+        Returns:
+            Optional[Dict]: 相似查询的解析结果（关键词属于那条查询）
+        """
+        embedding = self._normalize(embedding) if self.semantic else None
+        if embedding is None:
+            return None
+
+        with self._lock:
+            match = self._nearest(embedding, time_signature(query), time.time())
+            if match is None:
+                return None
+            entry = self._entries[match]
+            self._entries.move_to_end(match)
+            self._stats["semantic_hits"] += 1
+            self._stats["saved_ms"] += entry["latency_ms"]
+            return entry["result"]
+
+    def record_miss(self):
+        """记录一次未命中（精确层和近似层都没有命中）"""
+        with self._lock:
+            self._stats["misses"] += 1
+
+    def _nearest(self, embedding: List[float], time_sig: str, now: float) -> Optional[str]:
+        """最相似且时间引用一致、未过期的条目（需持有锁）"""
+        if self._matrix_dirty:
+            self._rebuild_matrix()
+        if not self._matrix_keys:
+            return None
+
+        if NUMPY_AVAILABLE:
+            sims = self._matrix @ np.asarray(embedding, dtype=np.float32)
+            order = np.argsort(-sims)
+            candidates = ((self._matrix_keys[i], float(sims[i])) for i in order)
+        else:
+            scored = [(k, sum(a * b for a, b in zip(vec, embedding)))
+                      for k, vec in zip(self._matrix_keys, self._matrix)]
+            candidates = iter(sorted(scored, key=lambda x: x[1], reverse=True))
+
+        for key, sim in candidates:
+            if sim < self.similarity_threshold:
+                return None
+            entry = self._entries.get(key)
+            if entry is None or now - entry["created_at"] > self.ttl:
+                continue
+            if entry["time_sig"] == time_sig:
+                return key
+        return None
+
+    def _rebuild_matrix(self):
+        """重建近似层矩阵（需持有锁）"""
+        keys = [k for k, e in self._entries.items() if e["embedding"] is not None]
+        vectors = [self._entries[k]["embedding"] for k in keys]
+        if NUMPY_AVAILABLE and vectors:
+            self._matrix = np.asarray(vectors, dtype=np.float32)
+        else:
+            self._matrix = vectors
+        self._matrix_keys = keys
+        self._matrix_dirty = False
+
+    def put(self, query: str, result: Dict, latency_ms: float = 0.0,
+            embedding: Optional[List[float]] = None):
+        """
+        写入缓存
+
+        Args:
+            query: 原始查询
+            result: 解析结果
+            latency_ms: 本次解析耗时（命中时计入 saved_ms）
+            embedding: 查询向量，没有则不参与近似层
+        """
+        key = normalize_query(query)
+        entry = {
+            "query": query,
+            "time_sig": time_signature(query),
+            "result": result,
+            "embedding": self._normalize(embedding) if self.semantic else None,
+            "latency_ms": latency_ms,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._matrix_dirty = True
+            self._disk_put(key, entry)
+
+            evicted = []
+            while len(self._entries) > self.max_items:
+                old_key, _ = self._entries.popitem(last=False)
+                evicted.append(old_key)
+                self._stats["evictions"] += 1
+            self._disk_delete(evicted)
+
+    def _remove(self, key: str):
+        """删除条目（需持有锁）"""
+        self._entries.pop(key, None)
+        self._matrix_dirty = True
+        self._disk_delete([key])
+
+    def get_stats(self) -> Dict:
+        """获取统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["items"] = len(self._entries)
+        stats["saved_ms"] = round(stats["saved_ms"], 1)
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix_dirty = True
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM parse_cache")
+                self._conn.commit()
+
+    def close(self):
+        """关闭持久化连接"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_parse_cache():
+    """测试解析缓存"""
+    print("\n" + "="*60)
+    print("🧪 测试 ParseCache")
+    print("="*60 + "\n")
+
+    # 用字符集合模拟向量，相似查询的向量接近
+    vocab = "昨天今咖啡奶茶心情不好"
+
+    def fake_embed(text: str) -> List[float]:
+        return [1.0 if ch in text else 0.0 for ch in vocab]
+
+    cache = ParseCache(db_path="storage/test/parse_cache.db",
+                       similarity_threshold=0.8, semantic=True)
+    cache.clear()
+
+    cache.put("我昨天喝的咖啡", {"keywords": ["咖啡"], "time_reference": "yesterday"},
+              latency_ms=600, embedding=fake_embed("我昨天喝的咖啡"))
+
+    for q in ["我昨天喝的咖啡？", "昨天那杯咖啡", "今天喝的咖啡", "心情不好"]:
+        result = cache.get(q) or cache.get_similar(q, fake_embed(q))
+        if result is None:
+            cache.record_miss()
+        print(f"   {q}: {'命中' if result else '未命中'}")
+
+    print(f"\n📊 统计: {cache.get_stats()}")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_parse_cache()
@@ -0,0 +1,392 @@
+"""
+Query Classifier - 本地查询分类（QueryParser 的快速通道）
+常见查询在本地完成解析，只有置信度不足时才调用 LLM
+
+组成：
+1. jieba 分词 + 字二元组特征
+2. 规则（原 _parse_with_rules / is_fact_query 的正则）作为特征和一致性校验
+3. 朴素贝叶斯分类器（内置训练样本，初始化时训练，毫秒级）
+
+输出与 QueryParser.parse 结构一致（time_range 由 QueryParser 按 time_reference 计算）
+"""
+
+import os
+import re
+import math
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# 中文分词
+try:
+    import jieba
+    jieba.setLogLevel(jieba.logging.INFO)  # 减少日志输出
+    JIEBA_AVAILABLE = True
+except ImportError:
+    JIEBA_AVAILABLE = False
+
+
+# 默认置信度阈值（低于阈值交给 LLM）
+DEFAULT_CONFIDENCE_THRESHOLD = 0.85
+
+# 似然缩放（对数似然按特征数平均后乘以该系数，控制后验的"尖锐"程度）
+FEATURE_SCALE = 4.0
+
+# 查询类型
+QUERY_TYPES = ["fact", "emotion", "fuzzy"]
+
+# 事实查询正则（ContextRAG.is_fact_query 的降级规则也使用）
+FACT_PATTERNS = [
+    r'(什么|啥)(颜色|口味|味道|配色|名字)',
+    r'(记得|记不记得).*(吗|嘛)',
+    r'(哪|哪里|哪儿|在哪)',
+    r'(几点|什么时候|多久)',
+    r'(谁|是谁)',
+    r'(多少|几个|几次)',
+]
+
+# 情绪查询正则
+EMOTION_PATTERN = r'(心情|感觉|开心|难过|情绪|伤心|生气|焦虑|委屈|高兴|烦)'
+
+# 实体类型正则（QueryParser 规则解析也使用）
+ENTITY_TYPE_PATTERNS = {
+    "objects": r'(咖啡|拿铁|奶茶|吃|喝|饭|菜)',
+    "places": r'(公司|学校|家|店|哪里|在哪)',
+    "people": r'(谁|朋友|同事|家人)',
+}
+
+# 物品关键词
+OBJECT_KEYWORD_PATTERN = r'(咖啡|拿铁|奶茶|饭|菜|茶)'
+
+# 时间引用（与 QueryParser._parse_time_reference 对应）
+# recent：最近 / 这几天 等模糊说法，只对近期 Moment 软加权，不作为时间过滤
+TIME_REFERENCE_PATTERNS = [
+    ("today", r'(今天|今早|今晚)'),
+    ("yesterday", r'(昨天|昨晚)'),
+    ("last_week", r'(上周)'),
+    ("recent", r'(最近|这几天|这阵子|近来)'),
+]
+
+# 关键词停用词（问句词、时间词不作为检索关键词）
+KEYWORD_STOPWORDS = {
+    '的', '了', '是', '在', '我', '你', '吗', '呢', '啊', '吧', '嘛',
+    '什么', '怎么', '记得', '记不记得', '还', '有', '没有', '那个', '这个',
+    '今天', '昨天', '上周', '最近', '这几天', '之前', '上次', '那次', '时候', '一下',
+    '是不是', '哪个', '多少', '知道', '告诉', '还记', '我们', '聊过', '说过',
+}
+
+# 内置训练样本（query, query_type）
+TRAINING_EXAMPLES: List[Tuple[str, str]] = [
+    # fact：问具体事实
+    ("你记得我昨天喝的咖啡是什么口味吗", "fact"),
+    ("我方案的配色是什么", "fact"),
+    ("我上次去的那家店叫什么名字", "fact"),
+    ("我周末去哪里玩了", "fact"),
+    ("我几点下班的", "fact"),
+    ("我跟谁一起吃的饭", "fact"),
+    ("我买的那杯奶茶是什么味道", "fact"),
+    ("我们公司在哪", "fact"),
+    ("我上周加了几次班", "fact"),
+    ("我说的那本书叫什么", "fact"),
+    ("我养的猫叫什么名字", "fact"),
+    ("我昨天中午吃了什么", "fact"),
+    ("还记得我在星巴克点的什么吗", "fact"),
+    ("我同事叫什么", "fact"),
+    ("我的生日是哪天", "fact"),
+    ("我最喜欢的颜色是什么", "fact"),
+    ("我什么时候开始健身的", "fact"),
+    ("我花了多少钱买的耳机", "fact"),
+    ("那家火锅店在哪里", "fact"),
+    ("我早上喝的是拿铁还是美式", "fact"),
+    ("我住在哪个城市", "fact"),
+    ("我去年去了哪些地方旅行", "fact"),
+    # emotion：问感受、情绪回忆
+    ("上次我心情不好的时候", "emotion"),
+    ("我最近心情怎么样", "emotion"),
+    ("那天我为什么那么难过", "emotion"),
+    ("我开心的时候都在做什么", "emotion"),
+    ("我之前焦虑的事", "emotion"),
+    ("上次让我很生气的那件事", "emotion"),
+    ("我被表扬那天的感觉", "emotion"),
+    ("最近工作上有什么开心的事吗", "emotion"),
+    ("我伤心的时候你陪我聊过", "emotion"),
+    ("我最近是不是很烦", "emotion"),
+    ("我委屈的那次", "emotion"),
+    ("有什么让我高兴的事", "emotion"),
+    ("我情绪低落的时候说过什么", "emotion"),
+    ("那次吵架之后我的感受", "emotion"),
+    ("我压力大的时候", "emotion"),
+    ("我感觉很累的那天", "emotion"),
+    ("让我感动的事", "emotion"),
+    ("我害怕的东西", "emotion"),
+    # fuzzy：模糊回忆
+    ("之前聊过的那个事", "fuzzy"),
+    ("我们上次说的那个", "fuzzy"),
+    ("你还记得那件事吗", "fuzzy"),
+    ("之前跟你说过的", "fuzzy"),
+    ("上次那个话题", "fuzzy"),
+    ("我们聊过工作的事", "fuzzy"),
+    ("最近发生的事", "fuzzy"),
+    ("我之前提过的计划", "fuzzy"),
+    ("我跟你讲过的那个人", "fuzzy"),
+    ("那天的事情", "fuzzy"),
+    ("我们以前聊的内容", "fuzzy"),
+    ("继续说刚才的话题", "fuzzy"),
+    ("之前那个想法", "fuzzy"),
+    ("你还记得我们聊过旅行吗", "fuzzy"),
+    ("关于我工作的那些事", "fuzzy"),
+    ("之前说的周末安排", "fuzzy"),
+    ("上次讲到一半的故事", "fuzzy"),
+    ("我以前跟你说的梦想", "fuzzy"),
+]
+
+
+def tokenize(text: str) -> List[str]:
+    """分词：jieba 词 + 字二元组（jieba 不可用时只有二元组和单字）"""
+    text = text.strip().lower()
+    tokens = []
+    if JIEBA_AVAILABLE:
+        tokens.extend(w for w in jieba.lcut(text) if w.strip())
+    else:
+        tokens.extend(ch for ch in text if not ch.isspace())
+    tokens.extend(f"bi:{text[i:i+2]}" for i in range(len(text) - 1))
+    return tokens
+
+
+def rule_query_type(query: str) -> Optional[str]:
+    """规则判断查询类型，未命中返回 None"""
+    if re.search(EMOTION_PATTERN, query):
+        return "emotion"
+    if any(re.search(p, query) for p in FACT_PATTERNS) or re.search(r'(什么|哪个|几|多少)', query):
+        return "fact"
+    return None
+
+
+class QueryClassifier:
+    """
+    本地查询分类器
+
+    classify 返回解析结果和置信度；confident 为 False 时应交给 LLM
+    """
+
+    def __init__(self, threshold: Optional[float] = None, alpha: float = 0.5):
+        """
+        初始化并用内置样本训练
+
+        Args:
+            threshold: 置信度阈值，默认读取 QUERY_CLASSIFIER_THRESHOLD
+            alpha: 拉普拉斯平滑系数
+        """
+        self.threshold = threshold or float(
+            os.getenv("QUERY_CLASSIFIER_THRESHOLD", DEFAULT_CONFIDENCE_THRESHOLD)
+        )
+        self.alpha = alpha
+        self.train(TRAINING_EXAMPLES)
+
+    def _features(self, query: str) -> List[str]:
+        """分词特征 + 规则特征"""
+        features = tokenize(query)
+        rule_type = rule_query_type(query)
+        if rule_type:
+            features.append(f"rule:{rule_type}")
+        return features
+
+    def train(self, examples: List[Tuple[str, str]]):
+        """训练朴素贝叶斯（覆盖已有模型）"""
+        self._class_counts: Counter = Counter()
+        self._token_counts: Dict[str, Counter] = defaultdict(Counter)
+        self._vocab = set()
+        for query, label in examples:
+            self._class_counts[label] += 1
+            for token in self._features(query):
+                self._token_counts[label][token] += 1
+                self._vocab.add(token)
+        self._token_totals = {label: sum(c.values()) for label, c in self._token_counts.items()}
+        self._total = sum(self._class_counts.values())
+
+    def predict_proba(self, query: str) -> Dict[str, float]:
+        """各查询类型的后验概率"""
+        features = [t for t in self._features(query) if t in self._vocab]
+        vocab_size = len(self._vocab)
+        log_probs = {}
+        for label in QUERY_TYPES:
+            count = self._class_counts.get(label, 0)
+            if not count:
+                continue
+            denom = self._token_totals[label] + self.alpha * vocab_size
+            ll = sum(math.log((self._token_counts[label][token] + self.alpha) / denom)
+                     for token in features)
+            # 特征之间并不独立（词与二元组重叠），按特征数缩放似然，避免后验全部接近 1
+            log_probs[label] = math.log(count / self._total) + ll * FEATURE_SCALE / max(len(features), 1)
+        top = max(log_probs.values())
+        exp = {label: math.exp(lp - top) for label, lp in log_probs.items()}
+        total = sum(exp.values())
+        return {label: v / total for label, v in exp.items()}
+
+    def extract_keywords(self, query: str) -> List[str]:
+        """检索关键词：jieba 词（两字以上）+ 物品词，去掉问句词和时间词"""
+        keywords = []
+        if JIEBA_AVAILABLE:
+            for word in jieba.lcut(query):
+                word = word.strip()
+                if len(word) >= 2 and word not in KEYWORD_STOPWORDS:
+                    keywords.append(word)
+        else:
+            for i in range(len(query) - 1):
+                bigram = query[i:i+2]
+                if bigram not in KEYWORD_STOPWORDS:
+                    keywords.append(bigram)
+        keywords.extend(re.findall(OBJECT_KEYWORD_PATTERN, query))
+        return list(dict.fromkeys(keywords))[:10]
+
+    def classify(self, query: str) -> Tuple[Dict, bool]:
+        """
+        本地解析查询
+
+        Args:
+            query: 用户查询
+
+        Returns:
+            Tuple: (解析结果, 是否达到置信度阈值)
+        """
+        proba = self.predict_proba(query)
+        query_type, confidence = max(proba.items(), key=lambda x: x[1])
+
+        # 规则与分类器不一致时降低置信度
+        rule_type = rule_query_type(query)
+        if rule_type and rule_type != query_type:
+            confidence = min(confidence, 0.6)
+
+        keywords = self.extract_keywords(query)
+
+        entity_types = [et for et, pattern in ENTITY_TYPE_PATTERNS.items() if re.search(pattern, query)]
+        entity_types = entity_types or ["objects", "events"]
+
+        time_reference = "none"
+        for ref, pattern in TIME_REFERENCE_PATTERNS:
+            if re.search(pattern, query):
+                time_reference = ref
+                break
+
+        if query_type == "fact":
+            search_strategy = "structured"
+            if not keywords:
+                confidence = min(confidence, 0.5)  # 没有关键词无法精确匹配
+        elif query_type == "emotion":
+            search_strategy = "vector"
+        else:
+            search_strategy = "hybrid"
+
+        result = {
+            "keywords": keywords,
+            "entity_types": entity_types,
+            "time_reference": time_reference,
+            "query_type": query_type,
+            "search_strategy": search_strategy,
+            "expanded_queries": [query],
+            "confidence": round(confidence, 3),
+            "source": "local"
+        }
+        return result, confidence >= self.threshold
+
+
+# 全局单例
+_query_classifier: Optional[QueryClassifier] = None
+
+
+def get_query_classifier() -> QueryClassifier:
+    """获取本地分类器单例"""
+    global _query_classifier
+    if _query_classifier is None:
+        _query_classifier = QueryClassifier()
+    return _query_classifier
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+# 基准测试样本（不在训练集中）
+BENCHMARK_QUERIES: List[Tuple[str, str]] = [
+    ("我昨天喝的拿铁是什么口味", "fact"),
+    ("我上次去的咖啡店在哪里", "fact"),
+    ("我同事叫什么名字来着", "fact"),
+    ("我几点到的公司", "fact"),
+    ("我周末和谁去看的电影", "fact"),
+    ("我买的奶茶多少钱", "fact"),
+    ("上次我难过是因为什么", "emotion"),
+    ("最近有什么开心的事", "emotion"),
+    ("我生气的那天", "emotion"),
+    ("我焦虑的时候你说过什么", "emotion"),
+    ("之前聊的那件事", "fuzzy"),
+    ("我们说过的那个计划", "fuzzy"),
+    ("你还记得我们聊过的电影吗", "fuzzy"),
+    ("上次那个话题继续聊", "fuzzy"),
+]
+
+
+def benchmark_classifier(queries: List[Tuple[str, str]] = None, use_llm: bool = True):
+    """
+    基准测试：本地分类准确率、升级到 LLM 的比例、耗时
+
+    有 LLM 时以 LLM 的 query_type 为参照，否则以样本标注为参照
+    """
+    from .query_parser import QueryParser
+
+    queries = queries or BENCHMARK_QUERIES
+    classifier = QueryClassifier()
+    parser = QueryParser() if use_llm else None
+    if parser and not parser.client:
+        parser = None
+
+    agree_confident = 0
+    agree_all = 0
+    confident_count = 0
+    local_ms = 0.0
+    llm_ms = 0.0
+
+    for query, label in queries:
+        t0 = time.perf_counter()
+        result, confident = classifier.classify(query)
+        local_ms += (time.perf_counter() - t0) * 1000
+
+        if parser:
+            t0 = time.perf_counter()
+            reference = parser._parse_with_llm(query).get("query_type", label)
+            llm_ms += (time.perf_counter() - t0) * 1000
+        else:
+            reference = label
+
+        correct = result["query_type"] == reference
+        agree_all += correct
+        if confident:
+            confident_count += 1
+            agree_confident += correct
+        print(f"   {'✅' if correct else '❌'} {'快速' if confident else '升级'} "
+              f"{result['query_type']:<7} (参照 {reference:<7} 置信度 {result['confidence']:.2f}) | {query}")
+
+    n = len(queries)
+    print(f"\n📊 参照: {'LLM' if parser else '人工标注'}")
+    print(f"   全部准确率: {agree_all / n:.1%}")
+    print(f"   快速通道准确率: {agree_confident / confident_count:.1%}" if confident_count else "   快速通道准确率: -")
+    print(f"   升级到 LLM 比例: {(n - confident_count) / n:.1%}")
+    print(f"   本地平均耗时: {local_ms / n:.2f}ms")
+    if parser:
+        print(f"   LLM 平均耗时: {llm_ms / n:.0f}ms")
+
+
+def test_query_classifier():
+    """测试本地分类器"""
+    print("\n" + "="*60)
+    print("🧪 测试 QueryClassifier")
+    print("="*60 + "\n")
+
+    benchmark_classifier(use_llm=os.getenv("QUERY_CLASSIFIER_BENCH_LLM", "1") != "0")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_query_classifier()
@@ -12,15 +12,21 @@ Query Parser - LLM 查询理解
 import os
 import json
 import re
-from typing import Dict, List, Optional, Tuple
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 
-# LLM 客户端
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
+from .parse_cache import ParseCache, DEFAULT_PARSE_CACHE_PATH
+from .query_classifier import (
+    get_query_classifier, ENTITY_TYPE_PATTERNS, OBJECT_KEYWORD_PATTERN, TIME_REFERENCE_PATTERNS
+)
+
+# LLM 客户端（共享的 LLM 网关）
+from ..utils.llm_gateway import OPENAI_AVAILABLE, get_llm_client
+
+# 模糊时间引用（recent）的加权窗口：窗口内的 Moment 检索分数上浮，窗口外不过滤
+RECENCY_WINDOW_DAYS = float(os.getenv("RECENCY_WINDOW_DAYS", 7))
 
 
 class QueryParser:
@@ -39,9 +45,22 @@ class QueryParser:
         """初始化查询理解器"""
         self._init_client()
         
-        # 简单缓存（避免重复调用）
-        self._cache: Dict[str, Dict] = {}
-        self._cache_max_size = 100
+        # 解析缓存（LRU + TTL + 持久化；PARSE_CACHE_SEMANTIC=0 关闭近似命中）
+        semantic = self.client is not None and os.getenv("PARSE_CACHE_SEMANTIC", "1") != "0"
+        self._cache = ParseCache(
+            db_path=os.getenv("PARSE_CACHE_PATH", DEFAULT_PARSE_CACHE_PATH),
+            semantic=semantic
+        )
+        
+        # 本地分类器快速通道（QUERY_CLASSIFIER_ENABLED=0 关闭，全部走 LLM）
+        if os.getenv("QUERY_CLASSIFIER_ENABLED", "1") != "0":
+            self.classifier = get_query_classifier()
+        else:
+            self.classifier = None
+        
+        # 各解析通道次数（多个检索线程并发解析）
+        self._stats = {"local": 0, "llm": 0, "rules": 0}
+        self._stats_lock = threading.Lock()
     
     def _init_client(self):
         """初始化 LLM 客户端"""
@@ -58,19 +77,59 @@ class QueryParser:
                 pass
         
         if api_key:
-            self.client = OpenAI(
-                api_key=api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+            self.client = get_llm_client(api_key)
         else:
             self.client = None
     
-    def parse(self, query: str) -> Dict:
+    def _embed_query(self, query: str) -> Optional[List[float]]:
+        """查询向量化（调用方没有提供查询向量时，解析缓存近似层使用；与向量检索共享 Embedding 客户端和缓存）"""
+        from .vector_store import VectorStore, _get_embedding_client
+        from .embedding_cache import get_embedding_cache
+        
+        model, dimension = VectorStore.EMBEDDING_MODEL, VectorStore.EMBEDDING_DIMENSION
+        # 与 VectorStore 一致，EMBEDDING_CACHE_ENABLED=0 时不读写 Embedding 缓存
+        cache = get_embedding_cache() if os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0" else None
+        if cache is not None:
+            embedding = cache.get(model, dimension, query)
+            if embedding is not None:
+                return embedding
+        
+        response = _get_embedding_client(self.client.api_key).embeddings.create(
+            model=model,
+            input=[query],
+            dimensions=dimension
+        )
+        embedding = response.data[0].embedding
+        if cache is not None:
+            cache.put(model, dimension, query, embedding)
+        return embedding
+    
+    def get_cache_stats(self) -> Dict:
+        """解析缓存统计 + 各解析通道次数（local / llm / rules）"""
+        stats = self._cache.get_stats()
+        with self._stats_lock:
+            parsed_by = dict(self._stats)
+        stats["parsed_by"] = parsed_by
+        parsed = sum(parsed_by.values())
+        stats["escalation_rate"] = round(parsed_by["llm"] / parsed, 3) if parsed else 0.0
+        return stats
+    
+    def _count(self, channel: str):
+        """解析通道计数 +1"""
+        with self._stats_lock:
+            self._stats[channel] += 1
+    
+    def parse(self, query: str,
+              embed_fn: Optional[Callable[[str], Optional[List[float]]]] = None) -> Dict:
         """
         解析用户查询
         
+        顺序：精确缓存 → 本地分类器 → 近似缓存（需要查询向量）→ LLM，
+        只有前两层都没结果时才向量化查询
+        
         Args:
             query: 用户查询文本
+            embed_fn: 查询向量化函数（如 ContextRAG 复用推测执行的查询向量），默认自行向量化
             
         Returns:
             Dict: 解析结果
@@ -84,26 +143,57 @@ class QueryParser:
                 "confidence": 0.9
             }
         """
-        # 检查缓存
-        cache_key = query.strip().lower()
-        if cache_key in self._cache:
-            return self._cache[cache_key]
+        # 1. 精确缓存
+        cached = self._cache.get(query)
+        if cached is not None:
+            # 时间范围是相对当前时间的，按时间引用重新计算
+            result = dict(cached)
+            result["time_range"] = self._parse_time_reference(result.get("time_reference", "none"))
+            return result
         
-        # LLM 解析
+        t0 = time.perf_counter()
+        
+        # 2. 本地分类器置信度足够时不向量化、不调用 LLM
+        local_result, confident = self.classifier.classify(query) if self.classifier else (None, False)
+        if confident:
+            result = local_result
+            result["time_range"] = self._parse_time_reference(result["time_reference"])
+            self._count("local")
+            self._cache.record_miss()
+            self._cache.put(query, result, latency_ms=(time.perf_counter() - t0) * 1000)
+            return result
+        
+        # 3. 近似缓存：复用相似查询的意图（类型 / 策略 / 实体类型），关键词按当前查询重新提取
+        query_embedding = None
+        if self._cache.semantic:
+            try:
+                query_embedding = (embed_fn or self._embed_query)(query)
+            except Exception as e:
+                print(f"   ⚠️ 查询向量化失败: {e}")
+            similar = self._cache.get_similar(query, query_embedding)
+            if similar is not None:
+                result = dict(similar)
+                keywords = local_result["keywords"] if local_result else self._parse_with_rules(query)["keywords"]
+                result["keywords"] = keywords
+                result["expanded_queries"] = [query]
+                result["time_range"] = self._parse_time_reference(result.get("time_reference", "none"))
+                return result
+        self._cache.record_miss()
+        
+        # 4. LLM 解析
         if self.client:
+            # LLM 解析
             result = self._parse_with_llm(query)
+            self._count("llm")
         else:
             # 降级到规则解析
             result = self._parse_with_rules(query)
+            self._count("rules")
         
-        # 缓存结果
-        if len(self._cache) >= self._cache_max_size:
-            # 简单清理：删除一半
-            keys_to_delete = list(self._cache.keys())[:self._cache_max_size // 2]
-            for k in keys_to_delete:
-                del self._cache[k]
-        
-        self._cache[cache_key] = result
+        # 缓存结果（LLM 失败降级的规则结果不缓存，下次重试 LLM）
+        if not (self.client and result.get("source") == "rules"):
+            latency_ms = (time.perf_counter() - t0) * 1000
+            self._cache.put(query, result, latency_ms=latency_ms, embedding=query_embedding)
         return result
     
     def _parse_with_llm(self, query: str) -> Dict:
@@ -116,7 +206,7 @@ class QueryParser:
 {{
     "keywords": ["关键词1", "关键词2"],  // 用于检索的核心关键词，包括同义词扩展
     "entity_types": ["objects"],  // 相关实体类型：objects/places/people/events/habits
-    "time_reference": "today/yesterday/last_week/specific_date/none",  // 时间引用
+    "time_reference": "today/yesterday/last_week/recent/specific_date/none",  // 时间引用，"最近""这几天"等模糊说法用 recent
     "query_type": "fact",  // fact=问具体事实, emotion=问感受回忆, fuzzy=模糊查询
     "search_strategy": "hybrid",  // structured=精确匹配, vector=语义匹配, hybrid=混合
     "expanded_queries": ["扩展查询1"],  // 语义扩展的查询（用于向量检索）
@@ -190,14 +280,14 @@ class QueryParser:
                 keywords.append(bigram)
         
         # 检测实体类型
-        if re.search(r'(咖啡|拿铁|奶茶|吃|喝|饭|菜)', query):
+        if re.search(ENTITY_TYPE_PATTERNS["objects"], query):
             entity_types.append("objects")
-            keywords.extend(re.findall(r'(咖啡|拿铁|奶茶|饭|菜|茶)', query))
+            keywords.extend(re.findall(OBJECT_KEYWORD_PATTERN, query))
         
-        if re.search(r'(公司|学校|家|店|哪里|在哪)', query):
+        if re.search(ENTITY_TYPE_PATTERNS["places"], query):
             entity_types.append("places")
         
-        if re.search(r'(谁|朋友|同事|家人)', query):
+        if re.search(ENTITY_TYPE_PATTERNS["people"], query):
             entity_types.append("people")
         
         # 检测查询类型
@@ -209,13 +299,12 @@ class QueryParser:
             search_strategy = "vector"
         
         # 检测时间
-        time_range = None
-        if "今天" in query:
-            time_range = self._parse_time_reference("today")
-        elif "昨天" in query:
-            time_range = self._parse_time_reference("yesterday")
-        elif "上周" in query or "最近" in query:
-            time_range = self._parse_time_reference("last_week")
+        time_reference = "none"
+        for ref, pattern in TIME_REFERENCE_PATTERNS:
+            if re.search(pattern, query):
+                time_reference = ref
+                break
+        time_range = self._parse_time_reference(time_reference)
         
         # 去重
         keywords = list(set(keywords))[:10]
@@ -224,12 +313,13 @@ class QueryParser:
         return {
             "keywords": keywords,
             "entity_types": entity_types,
-            "time_reference": "none",
+            "time_reference": time_reference,
             "time_range": time_range,
             "query_type": query_type,
             "search_strategy": search_strategy,
             "expanded_queries": [query],
-            "confidence": 0.5
+            "confidence": 0.5,
+            "source": "rules"
         }
     
     def _parse_time_reference(self, ref: str) -> Optional[Dict]:
@@ -266,14 +356,27 @@ class QueryParser:
                 "end": now.isoformat()
             }
         
+        # recent 等模糊引用不过滤（见 _parse_recency_window）
         return None
     
-    def get_search_config(self, query: str) -> Dict:
+    def _parse_recency_window(self, ref: Optional[str]) -> Optional[Dict]:
+        """模糊时间引用的加权窗口（只用于软加权，不作为过滤条件）"""
+        if ref != "recent":
+            return None
+        now = datetime.now()
+        return {
+            "start": (now - timedelta(days=RECENCY_WINDOW_DAYS)).isoformat(),
+            "end": now.isoformat()
+        }
+    
+    def get_search_config(self, query: str,
+                          embed_fn: Optional[Callable[[str], Optional[List[float]]]] = None) -> Dict:
         """
         获取检索配置（简化接口）
         
         Args:
             query: 用户查询
+            embed_fn: 查询向量化函数，透传给 parse
             
         Returns:
             Dict: 检索配置
@@ -284,10 +387,13 @@ class QueryParser:
                 "vector_weight": 0.4,
                 "keywords": [...],
                 "entity_types": [...],
-                "time_range": {...}
+                "time_range": {...},       // 时间过滤
+                "recency_window": {...},   // 时间软加权（最近 / 这几天）
+                "query_type": "fact"       // 查询类型（ContextRAG 据此判断事实查询）
             }
         """
-        parsed = self.parse(query)
+        parsed = self.parse(query, embed_fn=embed_fn)
+        recency_window = self._parse_recency_window(parsed.get("time_reference"))
         
         strategy = parsed.get("search_strategy", "hybrid")
         
@@ -300,6 +406,8 @@ class QueryParser:
                 "keywords": parsed.get("keywords", []),
                 "entity_types": parsed.get("entity_types", []),
                 "time_range": parsed.get("time_range"),
+                "recency_window": recency_window,
+                "query_type": parsed.get("query_type"),
                 "expanded_queries": parsed.get("expanded_queries", [query])
             }
         
@@ -312,6 +420,8 @@ class QueryParser:
                 "keywords": parsed.get("keywords", []),
                 "entity_types": parsed.get("entity_types", []),
                 "time_range": parsed.get("time_range"),
+                "recency_window": recency_window,
+                "query_type": parsed.get("query_type"),
                 "expanded_queries": parsed.get("expanded_queries", [query])
             }
         
@@ -336,6 +446,8 @@ class QueryParser:
                 "keywords": parsed.get("keywords", []),
                 "entity_types": parsed.get("entity_types", []),
                 "time_range": parsed.get("time_range"),
+                "recency_window": recency_window,
+                "query_type": parsed.get("query_type"),
                 "expanded_queries": parsed.get("expanded_queries", [query])
             }
 
@@ -352,6 +464,11 @@ def get_query_parser() -> QueryParser:
     return _query_parser
 
 
+def get_query_parser_stats() -> Optional[Dict]:
+    """查询解析统计（解析器尚未创建时返回 None，不为输出指标而初始化解析器）"""
+    return _query_parser.get_cache_stats() if _query_parser is not None else None
+
+
 # ============================================================
 # 测试代码
 # ============================================================
@@ -385,6 +502,8 @@ def test_query_parser():
         print(f"   置信度: {result.get('confidence', 0)}")
         print()
     
+    print(f"📊 解析缓存: {parser.get_cache_stats()}")
+    
     print("="*60)
     print("✅ 测试完成！")
     print("="*60 + "\n")
@@ -1,42 +1,260 @@
 """
 Reranker - 检索结果重排序
-使用 LLM 对候选结果进行相关性排序
+可插拔重排序器，RERANKER_BACKEND 选择实现
 
-功能：
-1. LLM Rerank（使用 Qwen 判断相关性）
-2. 交叉编码器风格的评分
-3. 结果融合优化
+实现：
+1. local（默认）：BM25 + Embedding 相似度融合，纯本地计算（查询向量通常已在缓存中）
+2. onnx：本地 ONNX 交叉编码器（需 onnxruntime + tokenizers 和模型文件）
+3. llm：qwen-turbo 批量打分
+4. tiered：先本地打分，只有分数难以区分时才调用 LLM
 """
 
 import os
-import json
-from typing import List, Dict, Optional, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, List, Dict, Optional
 
-# LLM 客户端
+# LLM 客户端（共享的 LLM 网关）
+from ..utils.llm_gateway import OPENAI_AVAILABLE, get_llm_client
+
+# ONNX 交叉编码器（可选）
 try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
+    import numpy as np
+    import onnxruntime
+    from tokenizers import Tokenizer
+    ONNX_AVAILABLE = True
 except ImportError:
-    OPENAI_AVAILABLE = False
+    ONNX_AVAILABLE = False
+
+from .query_classifier import tokenize
+
+
+# 默认 BM25 权重（其余为 Embedding 相似度权重）
+DEFAULT_BM25_WEIGHT = 0.4
+
+# 默认歧义阈值：本地分数在截断位置的差距小于该值时交给 LLM（tiered）
+DEFAULT_AMBIGUITY_MARGIN = 0.05
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 交叉编码器最大输入长度（token）
+CROSS_ENCODER_MAX_LENGTH = 256
+
+# 批量 Embedding 函数类型（VectorStore.get_embeddings_batch）
+EmbedFn = Callable[[List[str]], List[Optional[List[float]]]]
+
+# 已索引向量读取函数类型（VectorStore.get_moment_embeddings：moment_id -> 向量）
+StoredEmbedFn = Callable[[List[str]], Dict[str, List[float]]]
+
 
+def candidate_text(candidate: Dict, max_chars: int = 200) -> str:
+    """候选的打分文本：摘要 + 前 3 条用户消息"""
+    messages = candidate.get('messages', [])
+    user_msgs = [m['content'] for m in messages if m.get('role') == 'user']
+    text = " ".join(user_msgs[:3])[:max_chars]
+    summary = candidate.get('summary', '')
+    if summary:
+        text = f"{summary} | {text}"
+    return text
 
-class Reranker:
+
+class BaseReranker(ABC):
+    """
+    重排序器接口
+
+    rerank 写入 candidate['rerank_score']（0-1），返回按分数排序的前 top_k 个
     """
-    检索结果重排序器
+
+    name = "base"
+
+    def rerank(self, query: str, candidates: List[Dict], top_k: int = 3,
+               score_key: str = "rerank_score",
+               embed_fn: Optional[EmbedFn] = None,
+               stored_fn: Optional[StoredEmbedFn] = None) -> List[Dict]:
+        """
+        对候选结果重排序
+
+        Args:
+            query: 用户查询
+            candidates: 候选结果列表，每个包含 moment_id 和 messages
+                （可以是 MomentStorage.get_moments 的 retrieval 投影，只需摘要和前几条用户消息）
+            top_k: 返回数量
+            score_key: 分数字段名
+            embed_fn: 批量向量化函数（本地重排序使用，命中 Embedding 缓存时不请求 API）
+            stored_fn: 已索引向量读取函数（本地重排序直接使用候选的 _full 文档向量）
+
+        Returns:
+            List[Dict]: 重排序后的结果
+        """
+        if not candidates:
+            return []
+
+        print(f"🔄 Rerank [{self.name}]: 对 {len(candidates)} 个候选重排序")
+        scored = self._score(query, candidates, embed_fn, stored_fn)
+        scored.sort(key=lambda x: x.get(score_key, 0), reverse=True)
+
+        for i, item in enumerate(scored[:top_k]):
+            print(f"   #{i+1} score={item.get(score_key, 0):.2f} | {item.get('moment_id', '')}")
+
+        return scored[:top_k]
+
+    @abstractmethod
+    def _score(self, query: str, candidates: List[Dict],
+               embed_fn: Optional[EmbedFn],
+               stored_fn: Optional[StoredEmbedFn] = None) -> List[Dict]:
+        """为候选写入 rerank_score"""
+        pass
+
+    def shutdown(self):
+        """释放资源"""
+        pass
+
+
+class LocalReranker(BaseReranker):
+    """
+    本地重排序：BM25（候选集内 IDF）+ 查询与候选的 Embedding 余弦相似度
+
+    候选向量优先读取向量库中已索引的 _full 文档向量（候选是 retrieval 投影，
+    消息不完整，重新拼接的文本与索引文档不一致，向量化会绕过缓存）；
+    没有 embed_fn 或向量化失败时，用检索阶段的分数代替语义相似度
+    """
+
+    name = "local"
+
+    def __init__(self, bm25_weight: Optional[float] = None):
+        """
+        初始化
+
+        Args:
+            bm25_weight: BM25 权重，默认读取 RERANKER_BM25_WEIGHT
+        """
+        self.bm25_weight = bm25_weight if bm25_weight is not None else float(
+            os.getenv("RERANKER_BM25_WEIGHT", DEFAULT_BM25_WEIGHT)
+        )
+
+    @staticmethod
+    def bm25_scores(query: str, texts: List[str]) -> List[float]:
+        """查询对每个文本的 BM25 分数（IDF 在这组文本内计算）"""
+        docs = [tokenize(t) for t in texts]
+        query_tokens = set(tokenize(query))
+        n = len(docs)
+        avg_len = sum(len(d) for d in docs) / n if n else 0
+        df = {tok: sum(1 for d in docs if tok in d) for tok in query_tokens}
+
+        scores = []
+        for doc in docs:
+            tf = {}
+            for tok in doc:
+                if tok in query_tokens:
+                    tf[tok] = tf.get(tok, 0) + 1
+            score = 0.0
+            for tok, freq in tf.items():
+                idf = math.log(1 + (n - df[tok] + 0.5) / (df[tok] + 0.5))
+                norm = freq + BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / (avg_len or 1))
+                score += idf * freq * (BM25_K1 + 1) / norm
+            scores.append(score)
+        return scores
+
+    @staticmethod
+    def _cosine(a: List[float], b: List[float]) -> float:
+        dot = sum(x * y for x, y in zip(a, b))
+        na = math.sqrt(sum(x * x for x in a))
+        nb = math.sqrt(sum(y * y for y in b))
+        return dot / (na * nb) if na and nb else 0.0
+
+    def _semantic_scores(self, query: str, candidates: List[Dict],
+                         embed_fn: Optional[EmbedFn],
+                         stored_fn: Optional[StoredEmbedFn] = None) -> List[float]:
+        """语义分数：Embedding 余弦相似度，不可用时用检索分数（归一化到 0-1）"""
+        if embed_fn:
+            stored = stored_fn([c.get('moment_id', '') for c in candidates]) if stored_fn else {}
+            # 尚未索引的候选（如刚保存、向量还在写入）才用已加载的消息向量化
+            missing = [i for i, c in enumerate(candidates) if c.get('moment_id') not in stored]
+            texts = [" ".join(m['content'] for m in candidates[i].get('messages', []) if m.get('role') == 'user')
+                     or candidates[i].get('summary') or "" for i in missing]
+            embeddings = embed_fn([query] + texts)
+            query_emb = embeddings[0]
+            candidate_embs = [stored.get(c.get('moment_id')) for c in candidates]
+            for i, emb in zip(missing, embeddings[1:]):
+                candidate_embs[i] = emb
+            if query_emb is not None and all(e is not None for e in candidate_embs):
+                return [max(self._cosine(query_emb, e), 0.0) for e in candidate_embs]
+
+        retrieval = [c.get('retrieval_score', 0.0) for c in candidates]
+        top = max(retrieval) if retrieval else 0
+        return [r / top if top > 0 else 0.0 for r in retrieval]
+
+    def _score(self, query, candidates, embed_fn, stored_fn=None):
+        bm25 = self.bm25_scores(query, [candidate_text(c) for c in candidates])
+        top = max(bm25) if bm25 else 0
+        bm25_norm = [b / top if top > 0 else 0.0 for b in bm25]
+        semantic = self._semantic_scores(query, candidates, embed_fn, stored_fn)
+
+        for c, b, s in zip(candidates, bm25_norm, semantic):
+            c['bm25_score'] = round(b, 4)
+            c['semantic_score'] = round(s, 4)
+            c['rerank_score'] = self.bm25_weight * b + (1 - self.bm25_weight) * s
+        return candidates
+
+
+class OnnxCrossEncoderReranker(BaseReranker):
+    """
+    本地 ONNX 交叉编码器（如 bge-reranker 导出的 ONNX 模型）
+
+    model_dir 需包含 model.onnx 和 tokenizer.json
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str):
+        """
+        加载模型
+
+        Args:
+            model_dir: 模型目录
+        """
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=CROSS_ENCODER_MAX_LENGTH)
+        self.tokenizer.enable_padding()
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"),
+            providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def _score(self, query, candidates, embed_fn, stored_fn=None):
+        encodings = self.tokenizer.encode_batch([(query, candidate_text(c)) for c in candidates])
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+        }
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        logits = self.session.run(None, inputs)[0].reshape(len(candidates), -1)[:, 0]
+        for c, logit in zip(candidates, logits):
+            c['rerank_score'] = float(1 / (1 + np.exp(-logit)))
+        return candidates
+
+
+class LLMReranker(BaseReranker):
+    """
+    LLM 重排序器
     
     策略：
     1. LLM Rerank：让 LLM 判断每个候选与查询的相关性
-    2. 批量处理：并行评估多个候选
+    2. 批量处理：一次调用评估所有候选
     3. 分数归一化：将 LLM 评分转换为 0-1 分数
     """
     
+    name = "llm"
+    
     def __init__(self):
         """初始化 Reranker"""
         self._init_client()
-        
-        # 并行线程池
-        self._executor = ThreadPoolExecutor(max_workers=3)
     
     def _init_client(self):
         """初始化 LLM 客户端"""
@@ -53,65 +271,30 @@ class Reranker:
                 pass
         
         if api_key:
-            self.client = OpenAI(
-                api_key=api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+            self.client = get_llm_client(api_key)
         else:
             self.client = None
     
-    def rerank(self, query: str, candidates: List[Dict], 
-               top_k: int = 3, score_key: str = "rerank_score") -> List[Dict]:
-        """
-        对候选结果重排序
-        
-        Args:
-            query: 用户查询
-            candidates: 候选结果列表，每个包含 moment_id 和 messages
-            top_k: 返回数量
-            score_key: 分数字段名
-            
-        Returns:
-            List[Dict]: 重排序后的结果
-        """
-        if not candidates:
-            return []
-        
-        if not self.client:
+    def rerank(self, query: str, candidates: List[Dict], top_k: int = 3,
+               score_key: str = "rerank_score",
+               embed_fn: Optional[EmbedFn] = None,
+               stored_fn: Optional[StoredEmbedFn] = None) -> List[Dict]:
+        """对候选结果重排序（LLM 客户端未初始化时保持原顺序）"""
+        if candidates and not self.client:
             print("⚠️ Reranker: LLM 客户端未初始化，跳过重排序")
             return candidates[:top_k]
-        
-        print(f"🔄 Rerank: 对 {len(candidates)} 个候选重排序")
-        
+        return super().rerank(query, candidates, top_k, score_key, embed_fn, stored_fn)
+    
+    def _score(self, query, candidates, embed_fn, stored_fn=None):
         # 方法1：批量评分（更快）
-        scored = self._batch_score(query, candidates)
-        
-        # 按分数排序
-        scored.sort(key=lambda x: x.get(score_key, 0), reverse=True)
-        
-        # 打印结果
-        for i, item in enumerate(scored[:top_k]):
-            print(f"   #{i+1} score={item.get(score_key, 0):.2f} | {item.get('moment_id', '')}")
-        
-        return scored[:top_k]
+        return self._batch_score(query, candidates)
     
     def _batch_score(self, query: str, candidates: List[Dict]) -> List[Dict]:
         """
         批量评分（一次 LLM 调用评估所有候选）
         """
         # 构建候选摘要
-        candidate_texts = []
-        for i, c in enumerate(candidates):
-            # 提取关键内容
-            messages = c.get('messages', [])
-            user_msgs = [m['content'] for m in messages if m.get('role') == 'user']
-            text = " ".join(user_msgs[:3])[:200]  # 限制长度
-            
-            summary = c.get('summary', '')
-            if summary:
-                text = f"{summary} | {text}"
-            
-            candidate_texts.append(f"[{i}] {text}")
+        candidate_texts = [f"[{i}] {candidate_text(c)}" for i, c in enumerate(candidates)]
         
         if not candidate_texts:
             return candidates
@@ -144,12 +327,16 @@ class Reranker:
             # 解析分数
             scores = self._parse_scores(result, len(candidates))
             
-            # 合并分数到候选
+            # 合并分数到候选（没解析出分数的候选保留检索分数，不再默认 5 分）
+            missing = 0
             for i, c in enumerate(candidates):
-                if i < len(scores):
-                    c['rerank_score'] = scores[i] / 10.0  # 归一化到 0-1
+                if scores[i] is not None:
+                    c['rerank_score'] = min(scores[i] / 10.0, 1.0)  # 归一化到 0-1
                 else:
-                    c['rerank_score'] = 0.0
+                    c['rerank_score'] = c.get('retrieval_score', 0.0)
+                    missing += 1
+            if missing:
+                print(f"⚠️ Rerank: {missing} 个候选未解析出分数，保留检索分数")
             
             return candidates
             
@@ -160,98 +347,119 @@ class Reranker:
                 c['rerank_score'] = c.get('retrieval_score', 0.5)
             return candidates
     
-    def _parse_scores(self, result: str, expected_count: int) -> List[float]:
-        """解析 LLM 返回的分数"""
-        import re
-        
-        scores = []
-        
-        # 尝试多种格式
+    def _parse_scores(self, result: str, expected_count: int) -> List[Optional[float]]:
+        """解析 LLM 返回的分数（未解析出的候选为 None）"""
         # 格式1: [0]: 8
-        pattern1 = re.findall(r'\[(\d+)\]:\s*(\d+(?:\.\d+)?)', result)
-        if pattern1:
-            score_map = {int(idx): float(score) for idx, score in pattern1}
-            for i in range(expected_count):
-                scores.append(score_map.get(i, 5.0))
-            return scores
+        pairs = re.findall(r'\[(\d+)\]:\s*(\d+(?:\.\d+)?)', result)
+        if not pairs:
+            # 格式2: 0: 8 或 0 - 8
+            pairs = re.findall(r'(\d+)[\s:\-]+(\d+(?:\.\d+)?)', result)
+        if pairs:
+            score_map = {int(idx): float(score) for idx, score in pairs}
+            return [score_map.get(i) for i in range(expected_count)]
         
-        # 格式2: 0: 8 或 0 - 8
-        pattern2 = re.findall(r'(\d+)[\s:\-]+(\d+(?:\.\d+)?)', result)
-        if pattern2:
-            score_map = {int(idx): float(score) for idx, score in pattern2}
-            for i in range(expected_count):
-                scores.append(score_map.get(i, 5.0))
-            return scores
-        
-        # 格式3: 纯数字列表
-        numbers = re.findall(r'(\d+(?:\.\d+)?)', result)
-        for num in numbers[:expected_count]:
-            scores.append(float(num))
-        
-        # 补齐
-        while len(scores) < expected_count:
-            scores.append(5.0)
-        
-        return scores
-    
-    def _parallel_score(self, query: str, candidates: List[Dict]) -> List[Dict]:
+        # 格式3: 纯数字列表（数量对不上时不可信）
+        numbers = [float(n) for n in re.findall(r'(\d+(?:\.\d+)?)', result)]
+        if len(numbers) == expected_count:
+            return numbers
+        return [None] * expected_count
+
+
+class TieredReranker(BaseReranker):
+    """
+    分层重排序：先本地打分，截断位置附近分数难以区分时才调用 LLM 重排本地前几名
+    """
+
+    name = "tiered"
+
+    def __init__(self, local: BaseReranker, llm: LLMReranker,
+                 margin: Optional[float] = None):
         """
-        并行评分（每个候选单独评估，更准确但更慢）
+        初始化
+
+        Args:
+            local: 本地重排序器
+            llm: LLM 重排序器
+            margin: 歧义阈值，默认读取 RERANKER_AMBIGUITY_MARGIN
         """
-        def score_one(candidate: Dict) -> Tuple[Dict, float]:
-            messages = candidate.get('messages', [])
-            user_msgs = [m['content'] for m in messages if m.get('role') == 'user']
-            text = " ".join(user_msgs[:3])[:300]
-            
-            prompt = f"""判断以下内容与查询的相关程度。
+        self.local = local
+        self.llm = llm
+        self.margin = margin if margin is not None else float(
+            os.getenv("RERANKER_AMBIGUITY_MARGIN", DEFAULT_AMBIGUITY_MARGIN)
+        )
+        self.stats = {"local": 0, "escalated": 0}
 
-查询："{query}"
-内容："{text}"
+    def is_ambiguous(self, scores: List[float], top_k: int) -> bool:
+        """第一名和第二名、或第 top_k 名和第 top_k+1 名的差距小于阈值"""
+        if len(scores) < 2:
+            return False
+        if scores[0] - scores[1] < self.margin:
+            return True
+        return len(scores) > top_k and scores[top_k - 1] - scores[top_k] < self.margin
 
-相关程度（只返回数字 0-10）："""
+    def rerank(self, query, candidates, top_k=3, score_key="rerank_score", embed_fn=None, stored_fn=None):
+        if not candidates:
+            return []
+        ranked = self.local.rerank(query, candidates, top_k=len(candidates),
+                                   score_key=score_key, embed_fn=embed_fn, stored_fn=stored_fn)
+        scores = [c.get(score_key, 0) for c in ranked]
+        if not self.llm.client or not self.is_ambiguous(scores, top_k):
+            self.stats["local"] += 1
+            return ranked[:top_k]
+
+        self.stats["escalated"] += 1
+        print(f"   🔄 本地分数难以区分，升级到 LLM 重排序")
+        return self.llm.rerank(query, ranked[:top_k * 2], top_k=top_k, score_key=score_key)
+
+    def _score(self, query, candidates, embed_fn, stored_fn=None):
+        # rerank 已覆盖，直接打分时使用本地分数
+        return self.local._score(query, candidates, embed_fn, stored_fn)
 
-            try:
-                response = self.client.chat.completions.create(
-                    model="qwen-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.1,
-                    max_tokens=10
-                )
-                
-                score_text = response.choices[0].message.content.strip()
-                score = float(re.search(r'(\d+(?:\.\d+)?)', score_text).group(1))
-                return candidate, min(score / 10.0, 1.0)
-                
-            except:
-                return candidate, 0.5
-        
-        # 并行执行
-        import re
-        futures = []
-        for c in candidates:
-            futures.append(self._executor.submit(score_one, c))
-        
-        # 收集结果
-        for future in as_completed(futures):
-            candidate, score = future.result()
-            candidate['rerank_score'] = score
-        
-        return candidates
-    
     def shutdown(self):
-        """关闭线程池"""
-        self._executor.shutdown(wait=False)
+        self.llm.shutdown()
+
+
+# 兼容旧名称
+Reranker = LLMReranker
+
+
+def create_reranker(backend: Optional[str] = None) -> BaseReranker:
+    """
+    按 RERANKER_BACKEND 创建重排序器
+
+    Args:
+        backend: local / onnx / llm / tiered，默认读取 RERANKER_BACKEND（local）
+    """
+    backend = (backend or os.getenv("RERANKER_BACKEND", "local")).lower()
+
+    if backend == "llm":
+        return LLMReranker()
+
+    local: BaseReranker = LocalReranker()
+    if backend in ("onnx", "tiered"):
+        model_dir = os.getenv("RERANKER_ONNX_MODEL")
+        if model_dir and ONNX_AVAILABLE:
+            try:
+                local = OnnxCrossEncoderReranker(model_dir)
+            except Exception as e:
+                print(f"⚠️ ONNX 交叉编码器加载失败，使用 BM25 + Embedding: {e}")
+        elif backend == "onnx":
+            print("⚠️ 未配置 RERANKER_ONNX_MODEL 或未安装 onnxruntime / tokenizers，使用 BM25 + Embedding")
+
+    if backend == "tiered":
+        return TieredReranker(local, LLMReranker())
+    return local
 
 
 # 全局单例
-_reranker: Optional[Reranker] = None
+_reranker: Optional[BaseReranker] = None
 
 
-def get_reranker() -> Reranker:
-    """获取 Reranker 单例"""
+def get_reranker() -> BaseReranker:
+    """获取 Reranker 单例（RERANKER_BACKEND 选择实现）"""
     global _reranker
     if _reranker is None:
-        _reranker = Reranker()
+        _reranker = create_reranker()
     return _reranker
 
 
@@ -265,8 +473,6 @@ def test_reranker():
     print("🧪 测试 Reranker")
     print("="*60 + "\n")
     
-    reranker = Reranker()
-    
     # 模拟候选
     candidates = [
         {
@@ -295,17 +501,19 @@ def test_reranker():
         }
     ]
     
-    query = "被表扬的事"
+    query = "被主管表扬的事"
     print(f"🔍 查询: '{query}'")
     print(f"📋 候选数: {len(candidates)}")
     
-    results = reranker.rerank(query, candidates, top_k=3)
-    
-    print("\n📊 重排序结果:")
-    for i, r in enumerate(results):
-        print(f"   #{i+1} {r['moment_id']}: rerank={r.get('rerank_score', 0):.2f}")
-    
-    reranker.shutdown()
+    for backend in ("local", "llm", "tiered"):
+        reranker = create_reranker(backend)
+        results = reranker.rerank(query, [dict(c) for c in candidates], top_k=3)
+        
+        print(f"\n📊 [{backend}] 重排序结果:")
+        for i, r in enumerate(results):
+            print(f"   #{i+1} {r['moment_id']}: rerank={r.get('rerank_score', 0):.2f}")
+        
+        reranker.shutdown()
     
     print("\n" + "="*60)
     print("✅ 测试完成！")
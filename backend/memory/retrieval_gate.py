@@ -0,0 +1,224 @@
+"""
+Retrieval Gate - 检索门控
+在 ContextRAG 之前判断这一轮是否需要历史记忆，闲聊（"哈哈"、"好的"）直接跳过检索
+
+判断依据（全部本地计算，无 LLM / Embedding 调用）：
+1. 用户还没有任何 Moment → 跳过
+2. 提到用户已知实体（entities 表中的名称）→ 检索
+3. 回忆 / 提问标记（记得、上次、之前、？、什么……）→ 检索
+4. 闲聊套话或过短的消息 → 跳过
+5. 追问（上一轮检索过，本轮带指代词）→ 检索
+6. 其余按长度：较长的叙述检索，较短的跳过
+"""
+
+import os
+import re
+import time
+import threading
+from typing import Dict, List, Optional
+
+
+# 实体名称缓存刷新间隔（秒）
+ENTITY_REFRESH_INTERVAL = 60
+
+# 参与门控匹配的实体类型（time_markers / daily_routines 是"今天""早上"这类泛化词，会让闲聊也触发检索）
+GATE_ENTITY_TYPES = ["people", "places", "objects", "events"]
+
+# 默认最短检索长度（字符，短于此且无其他信号时跳过）
+DEFAULT_MIN_LENGTH = 4
+
+# 默认长消息阈值（字符，无其他信号时长消息也检索）
+DEFAULT_LONG_MESSAGE = 12
+
+# 回忆 / 提问标记
+MEMORY_MARKER_PATTERN = re.compile(
+    r'(记得|记不记得|还记|上次|之前|以前|那次|那天|昨天|前天|上周|上个月|聊过|说过|提过|讲过'
+    r'|[？?]|什么|啥|哪|谁|几点|多少|怎么样|为什么)'
+)
+
+# 闲聊套话（整句匹配）
+CHITCHAT_PATTERN = re.compile(
+    r'^(哈+|嘿+|呵+|嗯+|哦+|噢+|啊+|好+的?|好吧|行|可以|对+|是的?|没事|没有|ok|okay|收到|知道了'
+    r'|谢谢你?|谢啦|晚安|早安?|早上好|午安|拜拜|再见|88|666+|hhh+|[。.!！~～，,\s]*)'
+    r'[呀啊哈呢吧嘛啦~～。.!！，,\s]*$',
+    re.IGNORECASE
+)
+
+# 追问指代词
+FOLLOW_UP_PATTERN = re.compile(r'(那|它|这个|那个|后来|然后|为啥|为什么|怎么|真的吗|是吗)')
+
+# 表情 / 标点等非文字字符
+NON_TEXT_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+
+# 全局统计（所有用户）
+_stats = {
+    "retrieve": 0,
+    "skip": 0,
+    "reasons": {},
+    "retrieval_ms_total": 0.0,
+    "retrievals_timed": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def get_gate_stats() -> Dict:
+    """门控统计：检索 / 跳过次数、各原因次数、估算节省的检索耗时"""
+    with _stats_lock:
+        stats = {
+            "retrieve": _stats["retrieve"],
+            "skip": _stats["skip"],
+            "reasons": dict(_stats["reasons"]),
+        }
+        timed = _stats["retrievals_timed"]
+        avg_ms = _stats["retrieval_ms_total"] / timed if timed else 0.0
+    total = stats["retrieve"] + stats["skip"]
+    stats["skip_rate"] = round(stats["skip"] / total, 3) if total else 0.0
+    stats["avg_retrieval_ms"] = round(avg_ms, 1)
+    stats["saved_ms"] = round(avg_ms * stats["skip"], 1)
+    return stats
+
+
+class RetrievalGate:
+    """
+    检索门控（每个用户一个，持有该用户的实体名称缓存）
+    """
+
+    def __init__(self, storage, min_length: Optional[int] = None,
+                 long_message: Optional[int] = None):
+        """
+        初始化门控
+
+        Args:
+            storage: MomentStorage（读取实体名称和 Moment 数量）
+            min_length: 最短检索长度，默认读取 RETRIEVAL_GATE_MIN_LENGTH
+            long_message: 长消息阈值，默认读取 RETRIEVAL_GATE_LONG_MESSAGE
+        """
+        self.storage = storage
+        self.min_length = min_length or int(os.getenv("RETRIEVAL_GATE_MIN_LENGTH", DEFAULT_MIN_LENGTH))
+        self.long_message = long_message or int(
+            os.getenv("RETRIEVAL_GATE_LONG_MESSAGE", DEFAULT_LONG_MESSAGE)
+        )
+
+        self._entity_names: List[str] = []
+        self._has_moments = False
+        self._refreshed_at = 0.0
+        self._refresh_lock = threading.Lock()
+
+        # 上一轮是否检索（判断追问）
+        self._last_retrieved = False
+
+    def _refresh(self):
+        """定期刷新实体名称和是否有 Moment（还没有 Moment 时每次都查，第一个 Moment 保存后立即生效）"""
+        now = time.monotonic()
+        if self._has_moments and now - self._refreshed_at < ENTITY_REFRESH_INTERVAL:
+            return
+        with self._refresh_lock:
+            if self._has_moments and now - self._refreshed_at < ENTITY_REFRESH_INTERVAL:
+                return
+            try:
+                self._has_moments = self.storage.get_moment_count() > 0
+                names = self.storage.get_entity_names(entity_types=GATE_ENTITY_TYPES) if self._has_moments else []
+                # 长名称优先匹配
+                self._entity_names = sorted({n.lower() for n in names}, key=len, reverse=True)
+            except Exception as e:
+                print(f"⚠️ RetrievalGate 刷新实体失败: {e}")
+                self._has_moments = True  # 失败时不拦截检索
+                self._entity_names = []
+            self._refreshed_at = now
+
+    def invalidate(self):
+        """实体缓存失效（切换用户后调用）"""
+        self._has_moments = False
+        self._refreshed_at = 0.0
+        self._last_retrieved = False
+
+    def _mentioned_entity(self, text: str) -> Optional[str]:
+        """消息中提到的已知实体"""
+        for name in self._entity_names:
+            if name in text:
+                return name
+        return None
+
+    def decide(self, message: str, recent_messages: Optional[List[Dict]] = None) -> Dict:
+        """
+        判断本轮是否需要检索
+
+        Args:
+            message: 用户消息
+            recent_messages: 当前 Moment 中之前的消息（role / content）
+
+        Returns:
+            Dict: {"retrieve": bool, "reason": str, "entity": 命中的实体或 None}
+        """
+        self._refresh()
+        text = message.strip().lower()
+        content_length = len(NON_TEXT_PATTERN.sub("", text))
+        entity = self._mentioned_entity(text) if self._has_moments else None
+
+        if not self._has_moments:
+            retrieve, reason = False, "no_memory"
+        elif entity is not None:
+            retrieve, reason = True, "entity"
+        elif MEMORY_MARKER_PATTERN.search(text):
+            retrieve, reason = True, "memory_marker"
+        elif CHITCHAT_PATTERN.match(text) or content_length == 0:
+            retrieve, reason = False, "chitchat"
+        elif self._last_retrieved and recent_messages and FOLLOW_UP_PATTERN.search(text):
+            retrieve, reason = True, "follow_up"
+        elif content_length < self.min_length:
+            retrieve, reason = False, "short"
+        elif content_length >= self.long_message:
+            retrieve, reason = True, "long_message"
+        else:
+            retrieve, reason = False, "no_signal"
+
+        self._last_retrieved = retrieve
+        with _stats_lock:
+            _stats["retrieve" if retrieve else "skip"] += 1
+            _stats["reasons"][reason] = _stats["reasons"].get(reason, 0) + 1
+
+        return {"retrieve": retrieve, "reason": reason, "entity": entity}
+
+    @staticmethod
+    def record_retrieval(elapsed_ms: float):
+        """记录一次实际检索的耗时（用于估算跳过节省的时间）"""
+        with _stats_lock:
+            _stats["retrieval_ms_total"] += elapsed_ms
+            _stats["retrievals_timed"] += 1
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_retrieval_gate():
+    """测试检索门控"""
+    print("\n" + "="*60)
+    print("🧪 测试 RetrievalGate")
+    print("="*60 + "\n")
+
+    class FakeStorage:
+        def get_moment_count(self):
+            return 3
+
+        def get_entity_names(self, entity_types=None):
+            return ["桂花拿铁", "小王", "公司"]
+
+    gate = RetrievalGate(FakeStorage())
+    recent = [{"role": "user", "content": "你还记得桂花拿铁吗"}]
+    for message in ["哈哈哈", "好的～", "嗯", "桂花拿铁好好喝", "你记得我上次说的事吗",
+                    "那后来呢", "今天天气不错", "今天下班路上看到一只特别可爱的小狗"]:
+        decision = gate.decide(message, recent)
+        print(f"   {'🔍' if decision['retrieve'] else '⏭️ '} {decision['reason']:<14} | {message}")
+
+    gate.record_retrieval(800)
+    print(f"\n📊 统计: {get_gate_stats()}")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_retrieval_gate()
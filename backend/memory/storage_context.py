@@ -0,0 +1,69 @@
+"""
+Storage Context - 用户存储上下文
+每个用户一份 SQLite 存储 + 向量 Collection，由 MomentManager 和 ContextRAG 共享
+
+改进点：
+1. 每个用户只创建一次 MomentStorage / VectorStore（之前两个管理器各建一份）
+2. SQLite 连接、ChromaDB 句柄数量减半
+3. 写入和检索看到的是同一份存储，不存在跨实例缓存不一致
+"""
+
+from pathlib import Path
+from typing import Optional
+
+# 导入存储层
+from .moment_storage import MomentStorage
+
+# 导入向量存储层
+try:
+    from .vector_store import VectorStore
+    VECTOR_AVAILABLE = True
+except ImportError:
+    VECTOR_AVAILABLE = False
+
+
+class UserStorageContext:
+    """
+    用户存储上下文
+
+    持有：
+    - storage: MomentStorage（SQLite）
+    - vector_store: VectorStore（向量 Collection + 共享的 Embedding 客户端），不可用时为 None
+    """
+
+    def __init__(self, user_id: str = "default_user", base_dir: str = "storage"):
+        """
+        初始化存储上下文
+
+        Args:
+            user_id: 用户唯一标识
+            base_dir: 基础存储目录
+        """
+        self.user_id = user_id
+        self.base_dir = Path(base_dir)
+
+        self.storage = MomentStorage(
+            user_id=self.user_id,
+            base_dir=str(self.base_dir)
+        )
+
+        if VECTOR_AVAILABLE:
+            self.vector_store: Optional[VectorStore] = VectorStore(
+                user_id=self.user_id,
+                base_dir=str(self.base_dir)
+            )
+        else:
+            self.vector_store = None
+
+    def set_user_id(self, user_name: str, agent_name: str):
+        """切换用户（重复设置同一用户不会重新初始化）"""
+        self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+        self.storage.set_user_id(user_name, agent_name)
+        if self.vector_store:
+            self.vector_store.set_user_id(user_name, agent_name)
+
+    def close(self):
+        """释放 SQLite 连接和向量存储句柄"""
+        self.storage.close()
+        if self.vector_store:
+            self.vector_store.close()
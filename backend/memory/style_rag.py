@@ -2,13 +2,21 @@
 Style RAG - 风格学习（V2 改进版）
 分析用户对话风格，让 Agent 逐渐模仿
 
-改进：使用 jieba 中文分词
+改进：
+1. 使用 jieba 中文分词
+2. 学习只更新内存，写盘由后台延迟合并（STYLE_FLUSH_DELAY 秒内的多条消息只写一次），
+   对话请求不做文件 I/O
+3. 写盘先写临时文件再 rename，进程中断不会留下半个 JSON
+4. 紧凑格式：句长只存计数和总和，词汇 / 短语 / emoji 只保留高频的前 N 个，文件大小不再随消息数线性增长；
+   旧格式（sentence_lengths 列表）加载时自动迁移
 """
 
+import os
 import json
 import re
+import threading
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 from collections import Counter
 
 # 中文分词
@@ -21,6 +29,18 @@ except ImportError:
     print("⚠️ jieba 未安装，使用简单分词。建议运行: pip install jieba")
 
 
+# 风格数据格式版本
+STYLE_FORMAT_VERSION = 2
+
+# 默认写盘延迟（秒）
+DEFAULT_FLUSH_DELAY = 5.0
+
+# 各统计项保留的条目上限（内存中超过 2 倍上限时裁剪到上限）
+MAX_VOCABULARY = 2000
+MAX_PHRASES = 500
+MAX_EMOJIS = 100
+
+
 class StyleRAG:
     """
     用户风格学习系统
@@ -64,6 +84,16 @@ class StyleRAG:
         """
         self.user_id = user_id or "default_user"
         self.base_storage_path = Path(base_storage_path)
+        self.flush_delay = float(os.getenv("STYLE_FLUSH_DELAY", DEFAULT_FLUSH_DELAY))
+        
+        # 内存数据锁 + 写盘状态
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        # 快照序号：快照在 _lock 内编号，写盘时跳过比该文件已写入快照更旧的快照
+        self._snapshot_seq = 0
+        self._written_seq: Dict[Path, int] = {}
+        self._flush_timer: Optional[threading.Timer] = None
         
         # 用户专属文件
         self.storage_path = self.base_storage_path / f"{self.user_id}_style.json"
@@ -71,6 +101,8 @@ class StyleRAG:
         
         # 加载现有风格数据
         self.style_data = self._load_style()
+        if self._dirty:
+            self._schedule_flush()
         
         if JIEBA_AVAILABLE:
             print("✅ jieba 中文分词已启用")
@@ -83,32 +115,99 @@ class StyleRAG:
             user_name: 用户名
             agent_name: Agent 名
         """
-        self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
-        self.storage_path = self.base_storage_path / f"{self.user_id}_style.json"
-        self.storage_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # 重新加载该用户的风格数据
-        self.style_data = self._load_style()
+        with self._lock:
+            # 旧用户未写盘的数据先落盘
+            self.flush()
+            
+            self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+            self.storage_path = self.base_storage_path / f"{self.user_id}_style.json"
+            self.storage_path.parent.mkdir(parents=True, exist_ok=True)
+            
+            # 重新加载该用户的风格数据
+            self.style_data = self._load_style()
+        if self._dirty:
+            self._schedule_flush()
+    
+    @staticmethod
+    def _empty_style() -> Dict:
+        """空的风格数据"""
+        return {
+            "version": STYLE_FORMAT_VERSION,
+            "vocabulary": {},  # 词频统计（高频前 MAX_VOCABULARY 个）
+            "sentence_length": {"count": 0, "total": 0},
+            "english_ratio": 0.0,
+            "emoji_usage": {},
+            "common_phrases": {},
+            "total_messages": 0
+        }
     
     def _load_style(self) -> Dict:
-        """加载风格数据"""
-        if self.storage_path.exists():
-            with open(self.storage_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        else:
-            return {
-                "vocabulary": {},  # 词频统计
-                "sentence_lengths": [],
-                "english_ratio": 0.0,
-                "emoji_usage": {},
-                "common_phrases": {},
-                "total_messages": 0
-            }
+        """加载风格数据（旧格式自动迁移）"""
+        if not self.storage_path.exists():
+            return self._empty_style()
+        
+        with open(self.storage_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        if data.get("version") == STYLE_FORMAT_VERSION and "sentence_lengths" not in data:
+            return data
+        
+        # 旧格式：sentence_lengths 列表 → 计数 + 总和，统计项裁剪到上限
+        style = self._empty_style()
+        for key in ("vocabulary", "emoji_usage", "common_phrases", "english_ratio", "total_messages"):
+            if key in data:
+                style[key] = data[key]
+        lengths = data.get("sentence_lengths") or []
+        style["sentence_length"] = data.get("sentence_length") or {"count": len(lengths), "total": sum(lengths)}
+        self._prune(style, force=True)
+        print(f"🔄 StyleRAG 迁移旧格式: {self.storage_path.name}")
+        
+        # 迁移结果由调用方安排写盘
+        self._dirty = True
+        return style
+    
+    @staticmethod
+    def _prune(style: Dict, force: bool = False):
+        """统计项裁剪到上限（force=False 时超过 2 倍上限才裁剪，摊薄排序开销）"""
+        for key, limit in (("vocabulary", MAX_VOCABULARY),
+                           ("common_phrases", MAX_PHRASES),
+                           ("emoji_usage", MAX_EMOJIS)):
+            counts = style[key]
+            if len(counts) > (limit if force else 2 * limit):
+                style[key] = dict(Counter(counts).most_common(limit))
+    
+    def _schedule_flush(self):
+        """安排一次延迟写盘（已有待执行的写盘时合并）"""
+        with self._lock:
+            if self._flush_timer is not None:
+                return
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
     
     def _save_style(self):
-        """保存风格数据"""
-        with open(self.storage_path, 'w', encoding='utf-8') as f:
-            json.dump(self.style_data, f, ensure_ascii=False, indent=2)
+        """
+        保存风格数据（临时文件 + rename 原子替换）
+
+        快照在 _lock 内取并编号；定时器线程和 flush 并发写盘时，
+        较旧的快照不会覆盖已写入的较新快照
+        """
+        with self._lock:
+            self._prune(self.style_data, force=True)
+            payload = json.dumps(self.style_data, ensure_ascii=False, separators=(",", ":"))
+            path = self.storage_path
+            self._snapshot_seq += 1
+            seq = self._snapshot_seq
+            self._dirty = False
+        
+        with self._write_lock:
+            if self._written_seq.get(path, 0) > seq:
+                return
+            tmp_path = path.with_suffix(".json.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            self._written_seq[path] = seq
     
     def learn_from_message(self, message: str):
         """
@@ -117,15 +216,27 @@ class StyleRAG:
         Args:
             message: 用户消息
         """
+        words = self._tokenize(message)
+        
+        with self._lock:
+            self._learn(message, words)
+            self._prune(self.style_data)
+            self._dirty = True
+        
+        # 写盘交给后台延迟执行
+        self._schedule_flush()
+    
+    def _learn(self, message: str, words: List[str]):
+        """更新内存中的风格统计（需持有锁）"""
         
         # 1. 统计词频（使用 jieba 分词）
-        words = self._tokenize(message)
         for word in words:
             self.style_data['vocabulary'][word] = \
                 self.style_data['vocabulary'].get(word, 0) + 1
         
         # 2. 记录句子长度
-        self.style_data['sentence_lengths'].append(len(message))
+        self.style_data['sentence_length']['count'] += 1
+        self.style_data['sentence_length']['total'] += len(message)
         
         # 3. 计算英文比例
         english_chars = len(re.findall(r'[a-zA-Z]', message))
@@ -154,9 +265,21 @@ class StyleRAG:
         
         # 更新消息计数
         self.style_data['total_messages'] += 1
-        
-        # 保存
-        self._save_style()
+    
+    def flush(self):
+        """把内存中未写盘的风格数据写入磁盘（回收 / 切换用户时调用）"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+        try:
+            self._save_style()
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            print(f"⚠️ StyleRAG 写盘失败 ({self.user_id}): {e}")
     
     def learn_from_messages(self, messages: List[str]):
         """从多条消息中学习"""
@@ -170,46 +293,39 @@ class StyleRAG:
         Returns:
             Dict: 风格特征
         """
-        
-        # 统计平均句长
-        avg_length = (
-            sum(self.style_data['sentence_lengths']) / 
-            len(self.style_data['sentence_lengths'])
-            if self.style_data['sentence_lengths'] else 0
-        )
-        
-        # 提取高频词（前 20）
-        vocab_counter = Counter(self.style_data['vocabulary'])
-        top_words = [word for word, _ in vocab_counter.most_common(20)]
-        
-        # 提取常用短语（前 10）
-        phrase_counter = Counter(self.style_data['common_phrases'])
-        top_phrases = [phrase for phrase, _ in phrase_counter.most_common(10)]
-        
-        # 提取常用 emoji（前 5）
-        emoji_counter = Counter(self.style_data['emoji_usage'])
-        top_emojis = [emoji for emoji, _ in emoji_counter.most_common(5)]
-        
-        profile = {
-            "avg_sentence_length": round(avg_length, 1),
-            "english_ratio": round(self.style_data['english_ratio'], 2),
-            "top_words": top_words,
-            "top_phrases": top_phrases,
-            "top_emojis": top_emojis,
-            "total_messages": self.style_data['total_messages'],
-            "style_description": self._generate_description()
-        }
+        # 学习在其它线程更新统计，读取期间持有锁
+        with self._lock:
+            # 统计平均句长
+            avg_length = self._avg_sentence_length()
+            
+            # 提取高频词（前 20）
+            vocab_counter = Counter(self.style_data['vocabulary'])
+            top_words = [word for word, _ in vocab_counter.most_common(20)]
+            
+            # 提取常用短语（前 10）
+            phrase_counter = Counter(self.style_data['common_phrases'])
+            top_phrases = [phrase for phrase, _ in phrase_counter.most_common(10)]
+            
+            # 提取常用 emoji（前 5）
+            emoji_counter = Counter(self.style_data['emoji_usage'])
+            top_emojis = [emoji for emoji, _ in emoji_counter.most_common(5)]
+            
+            profile = {
+                "avg_sentence_length": round(avg_length, 1),
+                "english_ratio": round(self.style_data['english_ratio'], 2),
+                "top_words": top_words,
+                "top_phrases": top_phrases,
+                "top_emojis": top_emojis,
+                "total_messages": self.style_data['total_messages'],
+                "style_description": self._generate_description()
+            }
         
         return profile
     
     def _generate_description(self) -> str:
-        """生成风格描述"""
+        """生成风格描述（需持有锁）"""
         
-        avg_length = (
-            sum(self.style_data['sentence_lengths']) / 
-            len(self.style_data['sentence_lengths'])
-            if self.style_data['sentence_lengths'] else 0
-        )
+        avg_length = self._avg_sentence_length()
         
         english_ratio = self.style_data['english_ratio']
         
@@ -242,6 +358,11 @@ class StyleRAG:
         
         return "、".join(descriptions)
     
+    def _avg_sentence_length(self) -> float:
+        """平均句长（需持有锁）"""
+        stats = self.style_data['sentence_length']
+        return stats['total'] / stats['count'] if stats['count'] else 0
+    
     def _tokenize(self, text: str) -> List[str]:
         """
         分词（中英文）
@@ -274,10 +395,9 @@ class StyleRAG:
             str: 风格提示文本
         """
         
-        if self.style_data['total_messages'] < 5:
-            return ""  # 样本太少，不生成提示
-        
         profile = self.get_style_profile()
+        if profile['total_messages'] < 5:
+            return ""  # 样本太少，不生成提示
         
         prompt = f"""
 用户风格特征：
@@ -341,6 +461,19 @@ def test_style_rag():
     print("\n💬 风格提示：")
     print(style.get_style_prompt())
     
+    style.flush()
+    print(f"\n💾 风格文件: {style.storage_path} ({style.storage_path.stat().st_size} 字节)")
+    
+    # 旧格式迁移
+    legacy_path = style.base_storage_path / "test_legacy_style.json"
+    with open(legacy_path, 'w', encoding='utf-8') as f:
+        json.dump({"vocabulary": {"项目": 3}, "sentence_lengths": [10, 20, 30],
+                   "english_ratio": 0.1, "emoji_usage": {}, "common_phrases": {},
+                   "total_messages": 3}, f, ensure_ascii=False)
+    legacy = StyleRAG(user_id="test_legacy")
+    print(f"🔄 旧格式迁移后平均句长: {legacy.get_style_profile()['avg_sentence_length']}")
+    legacy.flush()
+    
     print("\n" + "="*60)
     print("✅ 测试完成！")
     print("="*60 + "\n")
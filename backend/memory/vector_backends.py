@@ -0,0 +1,576 @@
+"""
+Vector Backends - 可插拔的向量存储后端
+VectorStore 通过统一接口访问向量库，由 VECTOR_BACKEND 选择实现
+
+后端：
+1. chroma: ChromaDB PersistentClient（默认）
+2. numpy: 进程内 NumPy 索引
+   - 每个用户一个 float32 / float16 向量文件（内存映射）+ 元数据日志
+   - 余弦 top-k：一次矩阵乘法 + argpartition
+   - 先按 metadata 过滤再打分
+   - 只追加写入，删除 / 覆盖的行达到阈值时压缩
+
+接口返回结构与 ChromaDB 一致（get / query 的 ids / documents / metadatas / distances），
+VectorStore 不需要区分后端
+"""
+
+import os
+import json
+import time
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import chromadb
+    CHROMADB_AVAILABLE = True
+except ImportError:
+    CHROMADB_AVAILABLE = False
+
+
+# 默认后端
+DEFAULT_VECTOR_BACKEND = "chroma"
+
+# 失效行占比超过该值时压缩（NumPy 后端）
+COMPACT_DEAD_RATIO = 0.3
+
+# 失效行少于该数量时不压缩
+COMPACT_MIN_DEAD_ROWS = 64
+
+
+class VectorBackend(ABC):
+    """
+    向量后端接口（与 ChromaDB Collection 的用法保持一致）
+
+    - upsert(ids, documents, embeddings, metadatas)
+    - update(ids, metadatas)
+    - get(ids=None, where=None, include=...) -> {"ids", "documents", "metadatas", "embeddings"?}
+    - query(query_embeddings, n_results, where=None, include=...)
+        -> {"ids", "documents", "metadatas", "distances"}（每个查询一个列表）
+    - delete(ids)
+    - count()
+    - close()
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def upsert(self, ids: List[str], documents: List[str],
+               embeddings: List[List[float]], metadatas: List[Dict]):
+        ...
+
+    @abstractmethod
+    def update(self, ids: List[str], metadatas: List[Dict]):
+        ...
+
+    @abstractmethod
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            include: Optional[List[str]] = None) -> Dict:
+        ...
+
+    @abstractmethod
+    def query(self, query_embeddings: List[List[float]], n_results: int = 5,
+              where: Optional[Dict] = None,
+              include: Optional[List[str]] = None) -> Dict:
+        ...
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        ...
+
+    @abstractmethod
+    def count(self) -> int:
+        ...
+
+    def close(self):
+        pass
+
+
+class ChromaBackend(VectorBackend):
+    """ChromaDB 后端（直接委托给 Collection）"""
+
+    name = "chroma"
+
+    def __init__(self, client, collection_name: str):
+        self.collection = client.get_or_create_collection(
+            name=collection_name,
+            metadata={"hnsw:space": "cosine"}  # 使用余弦相似度
+        )
+
+    def upsert(self, ids, documents, embeddings, metadatas):
+        self.collection.upsert(ids=ids, documents=documents,
+                               embeddings=embeddings, metadatas=metadatas)
+
+    def update(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+
+    def get(self, ids=None, where=None, include=None):
+        return self.collection.get(ids=ids, where=where,
+                                   include=include if include is not None else ["metadatas", "documents"])
+
+    def query(self, query_embeddings, n_results=5, where=None, include=None):
+        return self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            include=include if include is not None else ["documents", "metadatas", "distances"]
+        )
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def count(self):
+        return self.collection.count()
+
+
+def match_where(metadata: Dict, where: Optional[Dict]) -> bool:
+    """
+    判断 metadata 是否满足 ChromaDB 风格的 where 条件
+
+    支持：{"k": v}、$eq / $ne / $gt / $gte / $lt / $lte / $in / $nin、$and / $or
+    """
+    if not where:
+        return True
+
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(match_where(metadata, c) for c in cond):
+                return False
+            continue
+        if key == "$or":
+            if not any(match_where(metadata, c) for c in cond):
+                return False
+            continue
+
+        value = metadata.get(key)
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+
+        for op, target in cond.items():
+            if op == "$eq":
+                ok = value == target
+            elif op == "$ne":
+                ok = value != target
+            elif op in ("$gt", "$gte", "$lt", "$lte"):
+                if value is None:
+                    return False
+                try:
+                    ok = {
+                        "$gt": value > target,
+                        "$gte": value >= target,
+                        "$lt": value < target,
+                        "$lte": value <= target,
+                    }[op]
+                except TypeError:
+                    return False
+            elif op == "$in":
+                ok = value in target
+            elif op == "$nin":
+                ok = value not in target
+            else:
+                raise ValueError(f"不支持的 where 操作符: {op}")
+            if not ok:
+                return False
+    return True
+
+
+class NumpyBackend(VectorBackend):
+    """
+    NumPy 向量后端
+
+    目录结构（每个用户一个目录）：
+    - manifest.json: 维度、数据类型
+    - vectors.bin: 归一化后的向量，按行追加（内存映射读取）
+    - records.jsonl: 操作日志（add / meta / del），启动时回放得到 id -> 行号映射
+
+    行号映射只在内存中，同一目录的多个实例会互相覆盖对方的行，
+    因此通过 create_backend / _get_numpy_backend 获取，进程内每个目录只有一个实例
+    """
+
+    name = "numpy"
+
+    def __init__(self, data_dir: str, dimension: int, dtype: str = "float32"):
+        if not NUMPY_AVAILABLE:
+            raise ImportError("NumPy 未安装，请运行: pip install numpy")
+
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self._manifest_path = self.data_dir / "manifest.json"
+        self._vectors_path = self.data_dir / "vectors.bin"
+        self._records_path = self.data_dir / "records.jsonl"
+
+        # 已有数据以 manifest 为准
+        if self._manifest_path.exists():
+            manifest = json.loads(self._manifest_path.read_text(encoding="utf-8"))
+            dimension = manifest["dimension"]
+            dtype = manifest["dtype"]
+        else:
+            self._manifest_path.write_text(
+                json.dumps({"dimension": dimension, "dtype": dtype}), encoding="utf-8"
+            )
+
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.RLock()
+
+        # 行号 -> 记录（None 表示已失效）
+        self._rows: List[Optional[Dict]] = []
+        # id -> 行号
+        self._index: Dict[str, int] = {}
+        self._matrix = None  # 内存映射，写入后失效
+
+        self._load()
+
+    # ---------- 持久化 ----------
+
+    def _load(self):
+        """回放操作日志"""
+        row_bytes = self.dimension * self.dtype.itemsize
+        vector_rows = self._vectors_path.stat().st_size // row_bytes if self._vectors_path.exists() else 0
+
+        if self._records_path.exists():
+            with open(self._records_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # 写入中断的最后一行
+                    op = rec.get("op")
+                    if op == "add":
+                        if len(self._rows) >= vector_rows:
+                            break  # 向量未写完整
+                        self._kill(rec["id"])
+                        self._index[rec["id"]] = len(self._rows)
+                        self._rows.append({
+                            "id": rec["id"],
+                            "document": rec.get("document", ""),
+                            "metadata": rec.get("metadata") or {},
+                        })
+                    elif op == "meta":
+                        row = self._index.get(rec["id"])
+                        if row is not None:
+                            self._rows[row]["metadata"] = rec.get("metadata") or {}
+                    elif op == "del":
+                        self._kill(rec["id"])
+
+        # 向量文件多出的行（日志未写入）截掉
+        if vector_rows > len(self._rows):
+            with open(self._vectors_path, "r+b") as f:
+                f.truncate(len(self._rows) * row_bytes)
+
+    def _kill(self, doc_id: str):
+        row = self._index.pop(doc_id, None)
+        if row is not None:
+            self._rows[row] = None
+
+    def _append_records(self, records: List[Dict]):
+        with open(self._records_path, "a", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def _get_matrix(self):
+        """内存映射的向量矩阵（N x D）"""
+        if self._matrix is None:
+            n = len(self._rows)
+            if n == 0:
+                self._matrix = np.zeros((0, self.dimension), dtype=self.dtype)
+            else:
+                self._matrix = np.memmap(self._vectors_path, dtype=self.dtype,
+                                         mode="r", shape=(n, self.dimension))
+        return self._matrix
+
+    def _maybe_compact(self):
+        """失效行过多时重写向量文件和日志"""
+        dead = len(self._rows) - len(self._index)
+        if dead < COMPACT_MIN_DEAD_ROWS or dead < COMPACT_DEAD_RATIO * len(self._rows):
+            return
+        self.compact()
+
+    def compact(self):
+        """压缩：只保留有效行"""
+        with self._lock:
+            alive = [i for i, rec in enumerate(self._rows) if rec is not None]
+            matrix = np.array(self._get_matrix()[alive], dtype=self.dtype) if alive else \
+                np.zeros((0, self.dimension), dtype=self.dtype)
+            self._matrix = None
+
+            tmp_vectors = self._vectors_path.with_suffix(".bin.tmp")
+            tmp_records = self._records_path.with_suffix(".jsonl.tmp")
+            matrix.tofile(tmp_vectors)
+            with open(tmp_records, "w", encoding="utf-8") as f:
+                for i in alive:
+                    rec = self._rows[i]
+                    f.write(json.dumps({"op": "add", "id": rec["id"], "document": rec["document"],
+                                        "metadata": rec["metadata"]}, ensure_ascii=False) + "\n")
+            os.replace(tmp_vectors, self._vectors_path)
+            os.replace(tmp_records, self._records_path)
+
+            self._rows = [self._rows[i] for i in alive]
+            self._index = {rec["id"]: i for i, rec in enumerate(self._rows)}
+
+    # ---------- 接口 ----------
+
+    def upsert(self, ids, documents, embeddings, metadatas):
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), self.dimension)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = (vectors / np.maximum(norms, 1e-12)).astype(self.dtype)
+
+        with self._lock:
+            # 先写向量再写日志：中断时多出的向量行在加载时截掉
+            with open(self._vectors_path, "ab") as f:
+                vectors.tofile(f)
+            records = []
+            for doc_id, doc, meta in zip(ids, documents, metadatas):
+                self._kill(doc_id)
+                self._index[doc_id] = len(self._rows)
+                self._rows.append({"id": doc_id, "document": doc, "metadata": meta or {}})
+                records.append({"op": "add", "id": doc_id, "document": doc, "metadata": meta or {}})
+            self._append_records(records)
+            self._matrix = None
+            self._maybe_compact()
+
+    def update(self, ids, metadatas):
+        with self._lock:
+            records = []
+            for doc_id, meta in zip(ids, metadatas):
+                row = self._index.get(doc_id)
+                if row is None:
+                    continue
+                self._rows[row]["metadata"] = meta or {}
+                records.append({"op": "meta", "id": doc_id, "metadata": meta or {}})
+            if records:
+                self._append_records(records)
+
+    def delete(self, ids):
+        with self._lock:
+            records = [{"op": "del", "id": doc_id} for doc_id in ids if doc_id in self._index]
+            for rec in records:
+                self._kill(rec["id"])
+            if records:
+                self._append_records(records)
+                self._maybe_compact()
+
+    def get(self, ids=None, where=None, include=None):
+        include = include if include is not None else ["metadatas", "documents"]
+        with self._lock:
+            if ids is not None:
+                rows = [self._index[i] for i in ids if i in self._index]
+            else:
+                rows = list(self._index.values())
+            rows = [r for r in rows if match_where(self._rows[r]["metadata"], where)]
+
+            result: Dict[str, Any] = {"ids": [self._rows[r]["id"] for r in rows]}
+            result["documents"] = [self._rows[r]["document"] for r in rows] if "documents" in include else None
+            result["metadatas"] = [self._rows[r]["metadata"] for r in rows] if "metadatas" in include else None
+            if "embeddings" in include:
+                matrix = self._get_matrix()
+                result["embeddings"] = [np.asarray(matrix[r], dtype=np.float32).tolist() for r in rows]
+            return result
+
+    def query(self, query_embeddings, n_results=5, where=None, include=None):
+        include = include if include is not None else ["documents", "metadatas", "distances"]
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dimension)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            # metadata 预过滤
+            if where:
+                candidates = [r for r in self._index.values()
+                              if match_where(self._rows[r]["metadata"], where)]
+            else:
+                candidates = list(self._index.values())
+            candidates = np.asarray(sorted(candidates), dtype=np.int64)
+
+            result: Dict[str, Any] = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            if len(candidates) == 0:
+                for _ in range(len(queries)):
+                    for key in result:
+                        result[key].append([])
+                return result
+
+            matrix = self._get_matrix()
+            sub = matrix if len(candidates) == len(self._rows) else matrix[candidates]
+            # (Q x D) @ (D x C) -> Q x C 余弦相似度
+            scores = queries @ np.asarray(sub, dtype=np.float32).T
+
+            k = min(n_results, len(candidates))
+            for qi in range(len(queries)):
+                row_scores = scores[qi]
+                if k < len(candidates):
+                    top = np.argpartition(-row_scores, k - 1)[:k]
+                else:
+                    top = np.arange(len(candidates))
+                top = top[np.argsort(-row_scores[top])]
+                recs = [self._rows[candidates[i]] for i in top]
+                result["ids"].append([rec["id"] for rec in recs])
+                result["documents"].append([rec["document"] for rec in recs])
+                result["metadatas"].append([rec["metadata"] for rec in recs])
+                result["distances"].append([float(1 - row_scores[i]) for i in top])
+
+        for key in ("documents", "metadatas", "distances"):
+            if key not in include:
+                result[key] = None
+        return result
+
+    def count(self):
+        with self._lock:
+            return len(self._index)
+
+    def close(self):
+        with self._lock:
+            self._matrix = None
+
+
+# 进程内共享：同一持久化目录只建一个 ChromaDB 客户端
+_chroma_clients: Dict[str, Any] = {}
+_chroma_lock = threading.Lock()
+
+
+def _get_chroma_client(persist_path: str):
+    """获取持久化目录对应的共享 ChromaDB 客户端"""
+    with _chroma_lock:
+        if persist_path not in _chroma_clients:
+            _chroma_clients[persist_path] = chromadb.PersistentClient(path=persist_path)
+        return _chroma_clients[persist_path]
+
+
+# 进程内共享：同一数据目录只建一个 NumPy 后端（id -> 行号映射只能有一份）
+_numpy_backends: Dict[str, "NumpyBackend"] = {}
+_numpy_lock = threading.Lock()
+
+
+def _get_numpy_backend(data_dir: str, dimension: int, dtype: str) -> NumpyBackend:
+    """获取数据目录对应的共享 NumPy 后端"""
+    key = str(Path(data_dir).resolve())
+    with _numpy_lock:
+        if key not in _numpy_backends:
+            _numpy_backends[key] = NumpyBackend(data_dir=key, dimension=dimension, dtype=dtype)
+        return _numpy_backends[key]
+
+
+def get_backend_name() -> str:
+    """当前配置的后端名（VECTOR_BACKEND），配置的后端不可用时退回另一个"""
+    name = os.getenv("VECTOR_BACKEND", DEFAULT_VECTOR_BACKEND).lower()
+    if name == "numpy" and not NUMPY_AVAILABLE and CHROMADB_AVAILABLE:
+        return "chroma"
+    if name != "numpy" and not CHROMADB_AVAILABLE and NUMPY_AVAILABLE:
+        return "numpy"
+    return name
+
+
+def create_backend(vector_dir: Path, collection_name: str,
+                   dimension: int) -> Optional[VectorBackend]:
+    """
+    按配置创建用户的向量后端
+
+    Args:
+        vector_dir: 向量根目录（storage/vectors）
+        collection_name: 用户 Collection 名
+        dimension: 向量维度
+
+    Returns:
+        VectorBackend，依赖都不可用时返回 None
+    """
+    name = get_backend_name()
+    if name == "numpy" and NUMPY_AVAILABLE:
+        return _get_numpy_backend(
+            data_dir=str(Path(vector_dir) / "numpy" / collection_name),
+            dimension=dimension,
+            dtype=os.getenv("VECTOR_NUMPY_DTYPE", "float32")
+        )
+    if CHROMADB_AVAILABLE:
+        client = _get_chroma_client(str(Path(vector_dir) / "chromadb"))
+        return ChromaBackend(client, collection_name)
+    return None
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def benchmark_backends(n_docs: int = 500, n_queries: int = 50, dimension: int = 1024):
+    """对比 ChromaDB 与 NumPy 后端：写入、查询延迟和 top-k 召回（以精确结果为准）"""
+    import shutil
+    import tempfile
+
+    print("\n" + "="*60)
+    print(f"🧪 向量后端对比: {n_docs} 条 x {dimension} 维, {n_queries} 次查询")
+    print("="*60 + "\n")
+
+    rng = np.random.default_rng(42)
+    vectors = rng.standard_normal((n_docs, dimension)).astype(np.float32)
+    queries = rng.standard_normal((n_queries, dimension)).astype(np.float32)
+    ids = [f"m{i // 4}_msg_{i % 4}" for i in range(n_docs)]
+    metadatas = [{"moment_id": f"m{i // 4}", "type": "single_message",
+                  "ts_epoch": float(i)} for i in range(n_docs)]
+    documents = [f"doc {i}" for i in range(n_docs)]
+
+    # 精确 top-10 作为召回基准
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    qn = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    truth = [set(np.argsort(-(normed @ q))[:10]) for q in qn]
+
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        backends = []
+        if NUMPY_AVAILABLE:
+            backends.append(("numpy", lambda: NumpyBackend(str(tmp / "numpy"), dimension)))
+        if CHROMADB_AVAILABLE:
+            backends.append(("chroma", lambda: ChromaBackend(
+                chromadb.PersistentClient(path=str(tmp / "chroma")), "bench")))
+
+        for name, factory in backends:
+            t0 = time.perf_counter()
+            backend = factory()
+            init_ms = (time.perf_counter() - t0) * 1000
+
+            t0 = time.perf_counter()
+            for start in range(0, n_docs, 100):
+                backend.upsert(ids[start:start + 100], documents[start:start + 100],
+                               vectors[start:start + 100].tolist(), metadatas[start:start + 100])
+            upsert_ms = (time.perf_counter() - t0) * 1000
+
+            latencies, hits = [], 0
+            for qi, q in enumerate(queries):
+                t0 = time.perf_counter()
+                res = backend.query([q.tolist()], n_results=10)
+                latencies.append((time.perf_counter() - t0) * 1000)
+                hits += len({ids.index(i) for i in res["ids"][0]} & truth[qi])
+
+            t0 = time.perf_counter()
+            backend.query([queries[0].tolist()], n_results=10,
+                          where={"$and": [{"ts_epoch": {"$gte": 100.0}}, {"ts_epoch": {"$lte": 300.0}}]})
+            filter_ms = (time.perf_counter() - t0) * 1000
+
+            latencies.sort()
+            print(f"   [{name}] 初始化 {init_ms:.1f}ms | 写入 {upsert_ms:.1f}ms | "
+                  f"查询 p50={latencies[len(latencies) // 2]:.2f}ms "
+                  f"p95={latencies[int(len(latencies) * 0.95)]:.2f}ms | "
+                  f"过滤查询 {filter_ms:.2f}ms | recall@10={hits / (10 * n_queries):.3f}")
+
+            # 重新加载耗时（NumPy 回放日志 + 内存映射）
+            if name == "numpy":
+                backend.close()
+                t0 = time.perf_counter()
+                reloaded = NumpyBackend(str(tmp / "numpy"), dimension)
+                reloaded.query([queries[0].tolist()], n_results=10)
+                print(f"   [numpy] 重新加载 + 首次查询 {(time.perf_counter() - t0) * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    benchmark_backends()
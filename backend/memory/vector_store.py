@@ -1,37 +1,47 @@
 """
 Vector Store - 向量存储层
-使用 ChromaDB + 阿里云 text-embedding-v3
+使用 ChromaDB / NumPy 后端 + 阿里云 text-embedding-v3
 
 功能：
 1. 文本向量化（阿里云 Embedding API）
-2. 向量存储（ChromaDB 本地持久化）
+2. 向量存储（VECTOR_BACKEND=chroma|numpy，本地持久化）
 3. 语义检索（相似度搜索）
 """
 
 import os
 import json
 import hashlib
+import threading
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 
-# ChromaDB
-try:
-    import chromadb
-    from chromadb.config import Settings
-    CHROMADB_AVAILABLE = True
-except ImportError:
-    CHROMADB_AVAILABLE = False
-    print("⚠️ ChromaDB 未安装，请运行: pip install chromadb")
-
-# 阿里云 Embedding API
-try:
-    from openai import OpenAI
-    OPENAI_AVAILABLE = True
-except ImportError:
-    OPENAI_AVAILABLE = False
+# 阿里云 Embedding API（经共享的 LLM 网关）
+from ..utils.llm_gateway import OPENAI_AVAILABLE, get_llm_client
+if not OPENAI_AVAILABLE:
     print("⚠️ OpenAI SDK 未安装，请运行: pip install openai")
 
+from .embedding_cache import get_embedding_cache
+from .moment_storage import timestamp_epoch
+from .vector_backends import create_backend, CHROMADB_AVAILABLE, NUMPY_AVAILABLE
+
+if not CHROMADB_AVAILABLE and not NUMPY_AVAILABLE:
+    print("⚠️ ChromaDB / NumPy 均未安装，请运行: pip install chromadb")
+
+
+# 进程内共享：Embedding 客户端全局一个
+_embedding_client = None
+_shared_lock = threading.Lock()
+
+
+def _get_embedding_client(api_key: str):
+    """获取共享的 Embedding 客户端（LLM 网关：连接池 + 限流 + 重试）"""
+    global _embedding_client
+    with _shared_lock:
+        if _embedding_client is None:
+            _embedding_client = get_llm_client(api_key)
+        return _embedding_client
+
 
 class VectorStore:
     """
@@ -39,7 +49,7 @@ class VectorStore:
     
     特性：
     1. 阿里云 text-embedding-v3 生成向量
-    2. ChromaDB 本地持久化存储
+    2. ChromaDB / NumPy 本地持久化存储（可插拔后端）
     3. 支持语义相似度检索
     4. 多用户数据隔离
     """
@@ -64,8 +74,14 @@ class VectorStore:
         # 初始化 Embedding 客户端
         self._init_embedding_client()
         
-        # 初始化 ChromaDB
-        self._init_chromadb()
+        # Embedding 缓存（同目录所有用户共享，EMBEDDING_CACHE_ENABLED=0 可关闭）
+        if os.getenv("EMBEDDING_CACHE_ENABLED", "1") != "0":
+            self.embedding_cache = get_embedding_cache(str(self.vector_dir / "embedding_cache.db"))
+        else:
+            self.embedding_cache = None
+        
+        # 初始化向量后端
+        self._init_backend()
         
         print(f"🔮 VectorStore 初始化: user={user_id}, dir={self.vector_dir}")
     
@@ -84,42 +100,38 @@ class VectorStore:
                 pass
         
         if api_key:
-            self.embedding_client = OpenAI(
-                api_key=api_key,
-                base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
-            )
+            self.embedding_client = _get_embedding_client(api_key)
             print("   ✅ Embedding 客户端已初始化")
         else:
             self.embedding_client = None
             print("   ⚠️ 未配置 API Key，Embedding 功能不可用")
     
-    def _init_chromadb(self):
-        """初始化 ChromaDB"""
-        if not CHROMADB_AVAILABLE:
-            self.chroma_client = None
-            self.collection = None
-            return
-        
-        # 持久化存储路径
-        persist_path = str(self.vector_dir / "chromadb")
-        
-        # 创建客户端（持久化模式）
-        self.chroma_client = chromadb.PersistentClient(path=persist_path)
+    def _init_backend(self):
+        """初始化向量后端（VECTOR_BACKEND 选择 chroma / numpy）"""
+        # 旧文档的 timestamp_epoch 在第一次按时间过滤时补写
+        self._epoch_backfilled = False
         
-        # 获取或创建 Collection（按用户隔离）
+        # 按用户隔离
         collection_name = f"moments_{self.user_id}".replace("-", "_")[:63]  # ChromaDB 名称限制
         
-        self.collection = self.chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata={"hnsw:space": "cosine"}  # 使用余弦相似度
+        # collection 为 VectorBackend，接口与 ChromaDB Collection 一致
+        self.collection = create_backend(
+            vector_dir=self.vector_dir,
+            collection_name=collection_name,
+            dimension=self.EMBEDDING_DIMENSION
         )
+        if self.collection is None:
+            return
         
-        print(f"   ✅ ChromaDB Collection: {collection_name} (共 {self.collection.count()} 条)")
+        print(f"   ✅ 向量后端 [{self.collection.name}]: {collection_name} (共 {self.collection.count()} 条)")
     
     def set_user_id(self, user_name: str, agent_name: str):
         """切换用户"""
-        self.user_id = f"{user_name}_{agent_name}".replace(" ", "_")
-        self._init_chromadb()  # 重新初始化 Collection
+        new_user_id = f"{user_name}_{agent_name}".replace(" ", "_")
+        if new_user_id == self.user_id and self.collection is not None:
+            return  # 共享存储时多个管理器会重复设置同一用户
+        self.user_id = new_user_id
+        self._init_backend()  # 重新初始化 Collection
         print(f"🔮 VectorStore 切换用户: {self.user_id}")
     
     def get_embedding(self, text: str) -> Optional[List[float]]:
@@ -139,6 +151,11 @@ class VectorStore:
         if not text or not text.strip():
             return None
         
+        if self.embedding_cache:
+            cached = self.embedding_cache.get(self.EMBEDDING_MODEL, self.EMBEDDING_DIMENSION, text)
+            if cached is not None:
+                return cached
+        
         try:
             response = self.embedding_client.embeddings.create(
                 model=self.EMBEDDING_MODEL,
@@ -147,6 +164,8 @@ class VectorStore:
             )
             
             embedding = response.data[0].embedding
+            if self.embedding_cache:
+                self.embedding_cache.put(self.EMBEDDING_MODEL, self.EMBEDDING_DIMENSION, text, embedding)
             return embedding
             
         except Exception as e:
@@ -166,22 +185,39 @@ class VectorStore:
         if not self.embedding_client:
             return [None] * len(texts)
         
-        # 过滤空文本
-        valid_texts = [t for t in texts if t and t.strip()]
+        # 过滤空文本（去重）
+        valid_texts = list(dict.fromkeys(t for t in texts if t and t.strip()))
         if not valid_texts:
             return [None] * len(texts)
         
-        try:
-            response = self.embedding_client.embeddings.create(
-                model=self.EMBEDDING_MODEL,
-                input=valid_texts,
-                dimensions=self.EMBEDDING_DIMENSION
+        # 先查缓存，只对未命中的文本请求 API
+        embeddings_map = {}
+        if self.embedding_cache:
+            cached = self.embedding_cache.get_many(
+                self.EMBEDDING_MODEL, self.EMBEDDING_DIMENSION, valid_texts
             )
-            
-            # 构建结果映射
-            embeddings_map = {}
-            for i, data in enumerate(response.data):
-                embeddings_map[valid_texts[i]] = data.embedding
+            for t, emb in zip(valid_texts, cached):
+                if emb is not None:
+                    embeddings_map[t] = emb
+        missing_texts = [t for t in valid_texts if t not in embeddings_map]
+        
+        try:
+            if missing_texts:
+                response = self.embedding_client.embeddings.create(
+                    model=self.EMBEDDING_MODEL,
+                    input=missing_texts,
+                    dimensions=self.EMBEDDING_DIMENSION
+                )
+                
+                # 构建结果映射
+                new_embeddings = [data.embedding for data in response.data]
+                for t, emb in zip(missing_texts, new_embeddings):
+                    embeddings_map[t] = emb
+                if self.embedding_cache:
+                    self.embedding_cache.put_many(
+                        self.EMBEDDING_MODEL, self.EMBEDDING_DIMENSION,
+                        missing_texts, new_embeddings
+                    )
             
             # 按原始顺序返回
             result = []
@@ -197,9 +233,90 @@ class VectorStore:
             print(f"   ⚠️ 批量 Embedding 生成失败: {e}")
             return [None] * len(texts)
     
+    def get_moment_embeddings(self, moment_ids: List[str]) -> Dict[str, List[float]]:
+        """
+        读取已索引的整段对话向量（{moment_id}_full 文档），不请求 API
+        
+        Args:
+            moment_ids: Moment ID 列表
+            
+        Returns:
+            Dict: moment_id -> 向量，未索引的 Moment 不在结果中
+        """
+        if not self.collection or not moment_ids:
+            return {}
+        
+        try:
+            result = self.collection.get(
+                ids=[f"{moment_id}_full" for moment_id in moment_ids],
+                include=["embeddings"]
+            )
+        except Exception as e:
+            print(f"   ⚠️ 读取已索引向量失败: {e}")
+            return {}
+        
+        embeddings = result.get("embeddings")
+        if embeddings is None:
+            return {}
+        return {
+            doc_id[:-len("_full")]: [float(x) for x in emb]
+            for doc_id, emb in zip(result["ids"], embeddings)
+            if emb is not None
+        }
+    
+    @staticmethod
+    def _text_hash(text: str) -> str:
+        """文档内容哈希（存入 metadata，用于增量索引）"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    
+    @classmethod
+    def time_range_filter(cls, time_range: Optional[Dict]) -> Optional[Dict]:
+        """
+        QueryParser 的 time_range 转为 where 条件
+        
+        Args:
+            time_range: {"start": ISO 时间, "end": ISO 时间}
+            
+        Returns:
+            Dict: timestamp_epoch 上的范围条件，time_range 为空时返回 None
+        """
+        if not time_range:
+            return None
+        conditions = []
+        if time_range.get("start"):
+            conditions.append({"timestamp_epoch": {"$gte": timestamp_epoch(time_range["start"])}})
+        if time_range.get("end"):
+            conditions.append({"timestamp_epoch": {"$lte": timestamp_epoch(time_range["end"])}})
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+    
+    def _backfill_timestamp_epoch(self):
+        """为旧文档补写 timestamp_epoch（每个后端只执行一次）"""
+        if self._epoch_backfilled or not self.collection:
+            return
+        self._epoch_backfilled = True
+        try:
+            existing = self.collection.get(include=["metadatas"])
+            ids, metadatas = [], []
+            for doc_id, meta in zip(existing["ids"], existing["metadatas"] or []):
+                if meta is not None and "timestamp_epoch" not in meta:
+                    ids.append(doc_id)
+                    metadatas.append({**meta, "timestamp_epoch": timestamp_epoch(meta.get("timestamp", ""))})
+            if ids:
+                self.collection.update(ids=ids, metadatas=metadatas)
+                print(f"   🕒 已为 {len(ids)} 条旧向量补写 timestamp_epoch")
+        except Exception as e:
+            print(f"   ⚠️ 补写 timestamp_epoch 失败: {e}")
+    
     def add_moment(self, moment_id: str, moment_data: Dict) -> bool:
         """
-        将 Moment 添加到向量库
+        将 Moment 添加到向量库（增量）
+        
+        与已存储的文档按 doc_id + text_hash 比对：
+        - 内容未变、metadata 变了：只更新 metadata，不重新向量化
+        - 新增或内容变了：向量化后 upsert
+        - 已不存在的文档（如消息变少后的 _msg_i）：删除
         
         Args:
             moment_id: Moment ID
@@ -209,11 +326,12 @@ class VectorStore:
             bool: 是否成功
         """
         if not self.collection:
-            print("   ⚠️ ChromaDB 未初始化")
+            print("   ⚠️ 向量后端未初始化")
             return False
         
         try:
             # 1. 构建要向量化的文本
+            epoch = timestamp_epoch(moment_data.get("timestamp", ""))
             texts_to_embed = []
             doc_ids = []
             metadatas = []
@@ -231,6 +349,7 @@ class VectorStore:
                     "moment_id": moment_id,
                     "type": "full_conversation",
                     "timestamp": moment_data.get("timestamp", ""),
+                    "timestamp_epoch": epoch,
                     "message_count": len(messages)
                 })
             
@@ -243,7 +362,8 @@ class VectorStore:
                         "moment_id": moment_id,
                         "type": "single_message",
                         "message_index": i,
-                        "timestamp": moment_data.get("timestamp", "")
+                        "timestamp": moment_data.get("timestamp", ""),
+                        "timestamp_epoch": epoch
                     })
             
             # 摘要（如果有）
@@ -254,41 +374,73 @@ class VectorStore:
                 metadatas.append({
                     "moment_id": moment_id,
                     "type": "summary",
-                    "timestamp": moment_data.get("timestamp", "")
+                    "timestamp": moment_data.get("timestamp", ""),
+                    "timestamp_epoch": epoch
                 })
             
             if not texts_to_embed:
                 return False
             
-            # 2. 批量生成向量
-            embeddings = self.get_embeddings_batch(texts_to_embed)
+            for text, meta in zip(texts_to_embed, metadatas):
+                meta["text_hash"] = self._text_hash(text)
+            
+            # 2. 与已存储的文档比对
+            existing = self.collection.get(
+                where={"moment_id": moment_id},
+                include=["metadatas"]
+            )
+            existing_meta = dict(zip(existing["ids"], existing["metadatas"] or []))
+            
+            embed_texts, embed_ids, embed_metadatas = [], [], []
+            meta_only_ids, meta_only_metadatas = [], []
+            for text, doc_id, meta in zip(texts_to_embed, doc_ids, metadatas):
+                old_meta = existing_meta.get(doc_id)
+                if old_meta is None or old_meta.get("text_hash") != meta["text_hash"]:
+                    embed_texts.append(text)
+                    embed_ids.append(doc_id)
+                    embed_metadatas.append(meta)
+                elif old_meta != meta:
+                    meta_only_ids.append(doc_id)
+                    meta_only_metadatas.append(meta)
             
-            # 3. 过滤掉失败的
+            stale_ids = [doc_id for doc_id in existing_meta if doc_id not in set(doc_ids)]
+            
+            # 3. 只对新增 / 变化的文档生成向量，过滤掉失败的
             valid_docs = []
             valid_ids = []
             valid_embeddings = []
             valid_metadatas = []
             
-            for text, doc_id, emb, meta in zip(texts_to_embed, doc_ids, embeddings, metadatas):
-                if emb is not None:
-                    valid_docs.append(text)
-                    valid_ids.append(doc_id)
-                    valid_embeddings.append(emb)
-                    valid_metadatas.append(meta)
+            if embed_texts:
+                embeddings = self.get_embeddings_batch(embed_texts)
+                for text, doc_id, emb, meta in zip(embed_texts, embed_ids, embeddings, embed_metadatas):
+                    if emb is not None:
+                        valid_docs.append(text)
+                        valid_ids.append(doc_id)
+                        valid_embeddings.append(emb)
+                        valid_metadatas.append(meta)
+                
+                if not valid_docs:
+                    print(f"   ⚠️ 所有文本向量化失败")
+                    return False
             
-            if not valid_docs:
-                print(f"   ⚠️ 所有文本向量化失败")
-                return False
-            
-            # 4. 添加到 ChromaDB（upsert 模式，避免重复）
-            self.collection.upsert(
-                ids=valid_ids,
-                documents=valid_docs,
-                embeddings=valid_embeddings,
-                metadatas=valid_metadatas
-            )
+            # 4. 写入 ChromaDB
+            if valid_ids:
+                self.collection.upsert(
+                    ids=valid_ids,
+                    documents=valid_docs,
+                    embeddings=valid_embeddings,
+                    metadatas=valid_metadatas
+                )
+            if meta_only_ids:
+                self.collection.update(ids=meta_only_ids, metadatas=meta_only_metadatas)
+            if stale_ids:
+                self.collection.delete(ids=stale_ids)
             
-            print(f"   ✅ 向量已添加: {moment_id} ({len(valid_docs)} 条)")
+            unchanged = len(doc_ids) - len(embed_ids) - len(meta_only_ids)
+            print(f"   ✅ 向量已更新: {moment_id} (向量化 {len(valid_ids)} 条, "
+                  f"仅更新 metadata {len(meta_only_ids)} 条, 未变 {unchanged} 条, "
+                  f"删除 {len(stale_ids)} 条)")
             return True
             
         except Exception as e:
@@ -296,7 +448,8 @@ class VectorStore:
             return False
     
     def search(self, query: str, top_k: int = 5, 
-               filter_dict: Optional[Dict] = None) -> List[Dict]:
+               filter_dict: Optional[Dict] = None,
+               time_range: Optional[Dict] = None) -> List[Dict]:
         """
         语义检索
         
@@ -304,49 +457,83 @@ class VectorStore:
             query: 查询文本
             top_k: 返回数量
             filter_dict: 过滤条件（ChromaDB where 语法）
+            time_range: 时间窗口 {"start", "end"}（ISO 时间）
             
         Returns:
             List[Dict]: 检索结果，包含 moment_id, score, text, metadata
         """
-        if not self.collection:
-            return []
+        return self.search_many([query], top_k=top_k, filter_dict=filter_dict,
+                                time_range=time_range)[0]
+    
+    def search_many(self, queries: List[str], top_k: int = 5,
+                    filter_dict: Optional[Dict] = None,
+                    query_embeddings: Optional[List[Optional[List[float]]]] = None,
+                    time_range: Optional[Dict] = None) -> List[List[Dict]]:
+        """
+        多查询语义检索（一次批量 Embedding + 一次向量查询）
+        
+        Args:
+            queries: 查询文本列表
+            top_k: 每个查询的返回数量
+            filter_dict: 过滤条件（ChromaDB where 语法）
+            query_embeddings: 已算好的查询向量（与 queries 对齐，None 表示需要向量化）
+            time_range: 时间窗口 {"start", "end"}（ISO 时间），按 timestamp_epoch 过滤
+            
+        Returns:
+            List[List[Dict]]: 与 queries 一一对应的检索结果
+        """
+        output: List[List[Dict]] = [[] for _ in queries]
+        if not self.collection or not queries:
+            return output
+        
+        time_filter = self.time_range_filter(time_range)
+        if time_filter:
+            self._backfill_timestamp_epoch()
+            filter_dict = {"$and": [filter_dict, time_filter]} if filter_dict else time_filter
         
         try:
-            # 1. 获取查询向量
-            query_embedding = self.get_embedding(query)
-            if not query_embedding:
+            # 1. 批量获取查询向量（已提供的直接使用）
+            embeddings = list(query_embeddings) if query_embeddings else [None] * len(queries)
+            missing = [i for i, emb in enumerate(embeddings) if emb is None]
+            if missing:
+                computed = self.get_embeddings_batch([queries[i] for i in missing])
+                for i, emb in zip(missing, computed):
+                    embeddings[i] = emb
+            valid = [(i, emb) for i, emb in enumerate(embeddings) if emb is not None]
+            if not valid:
                 print("   ⚠️ 查询向量化失败")
-                return []
+                return output
             
-            # 2. 检索
+            # 2. 检索（多个查询向量一次查询）
             results = self.collection.query(
-                query_embeddings=[query_embedding],
+                query_embeddings=[emb for _, emb in valid],
                 n_results=top_k,
                 where=filter_dict,
                 include=["documents", "metadatas", "distances"]
             )
             
             # 3. 整理结果
-            output = []
-            if results and results["ids"] and results["ids"][0]:
-                for i, doc_id in enumerate(results["ids"][0]):
-                    # ChromaDB 返回的是距离，转换为相似度分数
-                    distance = results["distances"][0][i] if results["distances"] else 0
+            for qi, (query_index, _) in enumerate(valid):
+                if not results or not results["ids"] or not results["ids"][qi]:
+                    continue
+                for i, doc_id in enumerate(results["ids"][qi]):
+                    # 返回的是距离，转换为相似度分数
+                    distance = results["distances"][qi][i] if results["distances"] else 0
                     score = 1 - distance  # 余弦距离转相似度
                     
-                    output.append({
+                    output[query_index].append({
                         "doc_id": doc_id,
-                        "moment_id": results["metadatas"][0][i].get("moment_id", ""),
-                        "text": results["documents"][0][i] if results["documents"] else "",
+                        "moment_id": results["metadatas"][qi][i].get("moment_id", ""),
+                        "text": results["documents"][qi][i] if results["documents"] else "",
                         "score": score,
-                        "metadata": results["metadatas"][0][i] if results["metadatas"] else {}
+                        "metadata": results["metadatas"][qi][i] if results["metadatas"] else {}
                     })
             
             return output
             
         except Exception as e:
             print(f"   ❌ 向量检索失败: {e}")
-            return []
+            return output
     
     def delete_moment(self, moment_id: str) -> bool:
         """删除 Moment 的所有向量"""
@@ -370,6 +557,12 @@ class VectorStore:
             print(f"   ❌ 删除向量失败: {e}")
             return False
     
+    def close(self):
+        """释放向量后端（ChromaDB 客户端和 NumPy 后端为同目录共享，close 只释放内存映射等可重建的句柄）"""
+        if self.collection:
+            self.collection.close()
+        self.collection = None
+    
     def get_stats(self) -> Dict:
         """获取统计信息"""
         if not self.collection:
@@ -378,9 +571,11 @@ class VectorStore:
         return {
             "status": "ok",
             "user_id": self.user_id,
+            "backend": self.collection.name,
             "document_count": self.collection.count(),
             "embedding_model": self.EMBEDDING_MODEL,
-            "embedding_dimension": self.EMBEDDING_DIMENSION
+            "embedding_dimension": self.EMBEDDING_DIMENSION,
+            "embedding_cache": self.embedding_cache.get_stats() if self.embedding_cache else None
         }
 
 
@@ -0,0 +1,450 @@
+"""
+LLM Gateway - 共享的模型调用网关
+所有 DashScope（对话 / Embedding，OpenAI 兼容接口）和 TTS HTTP 调用都经过这里
+
+改进点：
+1. 进程内只有一个 OpenAI 客户端和一个 requests.Session，HTTP 连接池 + keep-alive 复用，
+   不再每次调用都新建客户端、重新握手
+2. 按模型的并发上限（LLM_MODEL_LIMITS 配置，如 "qwen-max=4,qwen-turbo=16"），超出时排队
+3. 统一超时（LLM_TIMEOUT，流式对话 LLM_STREAM_TIMEOUT）和带抖动的指数退避重试（LLM_MAX_RETRIES），
+   只重试连接错误、超时、429、5xx；对话请求超时不重试（用户在等，重试只会把等待时间翻倍）
+4. 按模型统计请求数、错误、重试、排队次数、耗时（/api/metrics 输出）
+
+LLMClient 与 OpenAI 客户端接口一致（chat.completions.create / embeddings.create / api_key），
+调用方只需替换客户端的创建方式
+"""
+
+import os
+import time
+import random
+import threading
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# OpenAI SDK（DashScope 兼容模式）
+try:
+    import httpx
+    import openai
+    from openai import OpenAI
+    OPENAI_AVAILABLE = True
+except ImportError:
+    OPENAI_AVAILABLE = False
+
+
+# DashScope OpenAI 兼容接口
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
+
+# 默认超时（秒）
+DEFAULT_TIMEOUT = 60.0
+
+# 流式对话默认超时（秒，首个分片和分片间隔）
+DEFAULT_STREAM_TIMEOUT = 20.0
+
+# 默认重试次数（不含首次调用）
+DEFAULT_MAX_RETRIES = 2
+
+# 重试退避基数 / 上限（秒）
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# 连接池大小
+DEFAULT_MAX_CONNECTIONS = 64
+
+# 默认并发上限（未配置的模型使用 DEFAULT_MODEL_LIMIT）
+DEFAULT_MODEL_LIMITS = {
+    "qwen-max": 8,
+    "qwen-plus": 16,
+    "qwen-turbo": 32,
+    "text-embedding-v3": 32,
+    "minimax-tts": 8,
+}
+DEFAULT_MODEL_LIMIT = 16
+
+# HTTP 调用重试的状态码
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def _parse_model_limits(value: str) -> Dict[str, int]:
+    """解析 "qwen-max=4,qwen-turbo=16" 格式的并发上限"""
+    limits = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        model, limit = item.split("=", 1)
+        try:
+            limits[model.strip()] = int(limit)
+        except ValueError:
+            print(f"⚠️ LLM_MODEL_LIMITS 配置无效: {item}")
+    return limits
+
+
+def _resolve_qwen_key() -> Optional[str]:
+    """DashScope API Key：系统环境变量 → .env → config.api_config"""
+    api_key = os.getenv("ALIYUN_QWEN_KEY")
+    if not api_key:
+        load_dotenv()
+        api_key = os.getenv("ALIYUN_QWEN_KEY")
+    if not api_key:
+        try:
+            from config.api_config import APIConfig
+            api_key = APIConfig.QWEN_API_KEY
+        except Exception:
+            pass
+    return api_key or None
+
+
+def _is_retryable(error: Exception) -> bool:
+    """连接错误、超时、限流、服务端错误可以重试"""
+    if OPENAI_AVAILABLE and isinstance(error, (
+        openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError
+    )):
+        return True
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def _is_timeout(error: Exception) -> bool:
+    """请求超时（APITimeoutError 是 APIConnectionError 的子类，需单独识别）"""
+    if OPENAI_AVAILABLE and isinstance(error, openai.APITimeoutError):
+        return True
+    return isinstance(error, requests.Timeout)
+
+
+def _should_retry(error: Exception, retry_timeouts: bool) -> bool:
+    """可重试的错误；retry_timeouts=False 时超时直接抛出"""
+    if not retry_timeouts and _is_timeout(error):
+        return False
+    return _is_retryable(error)
+
+
+def _backoff_delay(attempt: int) -> float:
+    """第 attempt 次重试前的等待时间（指数退避 + 抖动）"""
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay * (0.5 + random.random() / 2)
+
+
+class _ModelStats:
+    """单个模型的并发控制 + 统计"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.total_ms = 0.0
+
+    def acquire(self):
+        if not self.semaphore.acquire(blocking=False):
+            with self.lock:
+                self.throttled += 1
+            self.semaphore.acquire()
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self, elapsed_ms: float, error: bool):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.total_ms += elapsed_ms
+            if error:
+                self.errors += 1
+        self.semaphore.release()
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                "limit": self.limit,
+                "requests": self.requests,
+                "errors": self.errors,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "in_flight": self.in_flight,
+                "avg_ms": round(self.total_ms / self.requests, 1) if self.requests else 0.0,
+            }
+
+
+class LLMGateway:
+    """
+    调用网关：按模型限流 + 重试 + 统计（LLMClient 和 http_request 共用）
+    """
+
+    def __init__(self, max_retries: Optional[int] = None, model_limits: Optional[Dict[str, int]] = None):
+        """
+        初始化网关
+
+        Args:
+            max_retries: 重试次数，默认读取 LLM_MAX_RETRIES
+            model_limits: 按模型的并发上限，默认 DEFAULT_MODEL_LIMITS + LLM_MODEL_LIMITS
+        """
+        self.max_retries = max_retries if max_retries is not None else int(
+            os.getenv("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+        )
+        if model_limits is None:
+            model_limits = dict(DEFAULT_MODEL_LIMITS)
+            model_limits.update(_parse_model_limits(os.getenv("LLM_MODEL_LIMITS", "")))
+        self.model_limits = model_limits
+        self._models: Dict[str, _ModelStats] = {}
+        self._lock = threading.Lock()
+
+    def _get_model(self, model: str) -> _ModelStats:
+        with self._lock:
+            if model not in self._models:
+                self._models[model] = _ModelStats(self.model_limits.get(model, DEFAULT_MODEL_LIMIT))
+            return self._models[model]
+
+    def call(self, model: str, func: Callable, /, *args, retry_timeouts: bool = True, **kwargs):
+        """
+        按模型限流执行调用，可重试的错误按退避重试
+
+        Args:
+            model: 模型名（并发上限和统计的键）
+            func: 实际调用
+            retry_timeouts: 超时是否重试
+        """
+        stats = self._get_model(model)
+        stats.acquire()
+        t0 = time.perf_counter()
+        error = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = func(*args, **kwargs)
+                    error = False
+                    return result
+                except Exception as e:
+                    if attempt >= self.max_retries or not _should_retry(e, retry_timeouts):
+                        raise
+                    delay = _backoff_delay(attempt)
+                    with stats.lock:
+                        stats.retries += 1
+                    print(f"⚠️ [{model}] 调用失败，{delay:.1f}s 后重试 ({attempt + 1}/{self.max_retries}): {e}")
+                    time.sleep(delay)
+        finally:
+            stats.release((time.perf_counter() - t0) * 1000, error)
+
+    def stream(self, model: str, func: Callable, /, *args, retry_timeouts: bool = True, **kwargs) -> Iterator:
+        """
+        流式调用：建立连接阶段可重试（开始迭代后不再重试），迭代结束（或中断）时释放并发名额
+        """
+        stats = self._get_model(model)
+        stats.acquire()
+        t0 = time.perf_counter()
+        error = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = func(*args, **kwargs)
+                    break
+                except Exception as e:
+                    if attempt >= self.max_retries or not _should_retry(e, retry_timeouts):
+                        raise
+                    with stats.lock:
+                        stats.retries += 1
+                    time.sleep(_backoff_delay(attempt))
+            yield from response
+            error = False
+        finally:
+            stats.release((time.perf_counter() - t0) * 1000, error)
+
+    def get_stats(self) -> Dict:
+        """按模型的统计"""
+        with self._lock:
+            models = dict(self._models)
+        return {model: stats.snapshot() for model, stats in sorted(models.items())}
+
+
+class LLMClient:
+    """
+    DashScope 客户端（OpenAI 兼容接口，所有模块共享一个实例）
+
+    chat.completions.create / embeddings.create 的参数与 OpenAI SDK 一致；
+    stream=True 时返回的迭代器在迭代结束前占用该模型的一个并发名额，单次请求超时为 LLM_STREAM_TIMEOUT。
+    对话请求超时不重试（连接错误、429、5xx 照常重试），Embedding 超时照常重试
+    """
+
+    def __init__(self, api_key: str, gateway: LLMGateway,
+                 base_url: str = DASHSCOPE_BASE_URL, timeout: Optional[float] = None):
+        self.api_key = api_key
+        self.gateway = gateway
+        timeout = timeout or float(os.getenv("LLM_TIMEOUT", DEFAULT_TIMEOUT))
+        self.stream_timeout = float(os.getenv("LLM_STREAM_TIMEOUT", DEFAULT_STREAM_TIMEOUT))
+        max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS))
+        # 重试由网关负责（统一退避和统计），SDK 内部不再重试
+        self._client = OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.Client(
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=60
+                )
+            )
+        )
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.embeddings = SimpleNamespace(create=self._embeddings_create)
+
+    def _chat_create(self, **kwargs):
+        model = kwargs.get("model", "")
+        if kwargs.get("stream"):
+            kwargs.setdefault("timeout", self.stream_timeout)
+            return self.gateway.stream(model, self._client.chat.completions.create,
+                                       retry_timeouts=False, **kwargs)
+        return self.gateway.call(model, self._client.chat.completions.create,
+                                 retry_timeouts=False, **kwargs)
+
+    def _embeddings_create(self, **kwargs):
+        return self.gateway.call(kwargs.get("model", ""), self._client.embeddings.create, **kwargs)
+
+
+# 全局单例
+_gateway: Optional[LLMGateway] = None
+_llm_client: Optional[LLMClient] = None
+_http_session: Optional[requests.Session] = None
+_singleton_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """获取调用网关单例"""
+    global _gateway
+    with _singleton_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
+
+
+def get_llm_client(api_key: Optional[str] = None) -> LLMClient:
+    """
+    获取共享的 DashScope 客户端
+
+    进程内只有一个客户端：api_key 只在首次创建时生效，之后传入不同的 Key 会被忽略（打印警告），
+    需要其他 Key 时直接构造 LLMClient
+
+    Args:
+        api_key: 首次创建时使用的 Key，默认读取 ALIYUN_QWEN_KEY（系统环境变量 → .env → config）
+    """
+    global _llm_client
+    gateway = get_gateway()
+    with _singleton_lock:
+        if _llm_client is None:
+            if not OPENAI_AVAILABLE:
+                raise ImportError("OpenAI SDK 未安装，请运行: pip install openai")
+            _llm_client = LLMClient(api_key or _resolve_qwen_key(), gateway)
+        elif api_key and api_key != _llm_client.api_key:
+            print("⚠️ get_llm_client: 共享客户端已用其他 API Key 创建，忽略本次传入的 Key")
+        return _llm_client
+
+
+def get_http_session() -> requests.Session:
+    """共享的 requests.Session（连接池 + keep-alive，TTS 等 HTTP 接口使用）"""
+    global _http_session
+    with _singleton_lock:
+        if _http_session is None:
+            pool_size = int(os.getenv("LLM_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+class _RetryableStatus(requests.ConnectionError):
+    """可重试的 HTTP 状态码（作为连接错误交给网关重试）"""
+
+    def __init__(self, response: requests.Response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+
+
+def http_request(model: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    经网关发送 HTTP 请求（共享连接池 + 按模型限流 + 重试）
+
+    429 / 5xx 响应按退避重试，重试用尽后返回最后一次响应，由调用方按原逻辑处理
+
+    Args:
+        model: 限流和统计的键（如 "minimax-tts"）
+        method: HTTP 方法
+        url: 请求地址
+        **kwargs: 透传给 requests（headers / json / timeout……）
+    """
+    session = get_http_session()
+    kwargs.setdefault("timeout", float(os.getenv("LLM_TIMEOUT", DEFAULT_TIMEOUT)))
+
+    def send() -> requests.Response:
+        response = session.request(method, url, **kwargs)
+        if response.status_code in RETRY_STATUS_CODES:
+            raise _RetryableStatus(response)
+        return response
+
+    try:
+        return get_gateway().call(model, send)
+    except _RetryableStatus as e:
+        return e.response
+
+
+def get_gateway_stats() -> Dict:
+    """网关统计（按模型）"""
+    return get_gateway().get_stats()
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_llm_gateway():
+    """测试网关限流、重试和统计"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    print("\n" + "="*60)
+    print("🧪 测试 LLMGateway")
+    print("="*60 + "\n")
+
+    global RETRY_BASE_DELAY
+    RETRY_BASE_DELAY = 0.05
+    gateway = LLMGateway(max_retries=2, model_limits={"slow-model": 2})
+
+    def slow_call(i: int) -> int:
+        time.sleep(0.1)
+        return i
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda i: gateway.call("slow-model", slow_call, i), range(8)))
+    print(f"   8 次调用（并发上限 2）: {time.perf_counter() - t0:.2f}s, 结果 {results}")
+
+    attempts = {"n": 0}
+
+    def flaky_call() -> str:
+        attempts["n"] += 1
+        if attempts["n"] < 3:
+            raise requests.ConnectionError("连接被重置")
+        return "ok"
+
+    print(f"   重试: {gateway.call('flaky-model', flaky_call)} (共 {attempts['n']} 次)")
+
+    try:
+        gateway.call("flaky-model", lambda: 1 / 0)
+    except ZeroDivisionError:
+        print("   不可重试的错误直接抛出 ✅")
+
+    print(f"\n📊 统计: {gateway.get_stats()}")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_llm_gateway()
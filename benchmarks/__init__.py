@@ -0,0 +1,9 @@
+"""
+Benchmarks - 离线检索基准测试
+
+- corpus: 合成 Moment 语料和带标注的查询
+- fixtures: 录制 / 回放 DashScope 响应（Embedding + 对话补全）
+- retrieval_benchmark: ContextRAG.search 基准（recall@k、MRR、分阶段 p50/p95、内存）
+
+运行: python -m benchmarks.retrieval_benchmark --moments 3000
+"""
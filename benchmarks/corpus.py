@@ -0,0 +1,156 @@
+"""
+Corpus - 合成 Moment 语料
+按固定种子生成几千个 Moment（人物 / 地点 / 物品 / 事件组合，分布在最近 90 天），
+同时生成带标注（相关 Moment 集合）的查询
+
+查询类型：
+1. fact：地点 + 物品（"我在XX买的什么"），相关集合为同时包含两者的 Moment
+2. fuzzy：人物 + 事件（"和XX一起XX的那次"），相关集合为同时包含两者的 Moment
+"""
+
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+
+PEOPLE = ["小王", "小李", "阿杰", "妈妈", "爸爸", "老张", "小美", "室友", "同事小陈", "表姐",
+          "阿强", "小雨", "师兄", "领导", "小周", "外婆", "晓晓", "老同学", "房东", "邻居阿姨"]
+
+PLACES = ["星巴克", "公司楼下", "西湖", "健身房", "地铁站", "超市", "图书馆", "火锅店", "电影院", "公园",
+          "机场", "医院", "学校门口", "奶茶店", "书店", "菜市场", "海边", "便利店", "商场", "咖啡馆",
+          "烧烤摊", "游泳馆", "寺庙", "博物馆", "江边", "夜市", "面馆", "宜家", "动物园", "游乐园"]
+
+OBJECTS = ["桂花拿铁", "耳机", "雨伞", "跑鞋", "盆栽", "蛋糕", "围巾", "手机壳", "保温杯", "小说",
+           "口红", "键盘", "台灯", "风筝", "拼图", "吉他", "相机", "帽子", "钱包", "抱枕",
+           "冰淇淋", "月饼", "粽子", "草莓", "西瓜", "烤红薯", "奶茶", "火锅底料", "咖啡豆", "红酒",
+           "乐高", "手表", "香水", "背包", "毛绒玩具", "眼镜", "笔记本", "钢笔", "水彩", "瑜伽垫"]
+
+EVENTS = ["加班", "面试", "生日", "搬家", "跑步", "爬山", "看电影", "吃火锅", "逛街", "考试",
+          "出差", "旅行", "相亲", "聚餐", "看病", "开会", "健身", "钓鱼", "露营", "看演唱会",
+          "学做饭", "打羽毛球", "拍照", "散步", "放风筝"]
+
+EMOTIONS = ["开心", "平静", "疲惫", "焦虑", "感动", "失落", "兴奋"]
+
+# 消息模板（{person} {place} {object} {event}）
+MESSAGE_TEMPLATES = [
+    "今天和{person}去{place}{event}了",
+    "在{place}买了{object}，感觉还不错",
+    "{person}送了我一个{object}",
+    "{event}完在{place}待了一会儿",
+    "跟{person}聊了很久{event}的事情",
+    "{place}人好多，差点没买到{object}",
+    "最近总想起和{person}{event}的那天",
+    "{object}有点贵，不过{person}说值得",
+]
+
+# 闲聊填充消息（不含实体）
+FILLER_MESSAGES = ["哈哈哈", "好累啊", "今天天气不错", "嗯嗯", "有点困了", "晚上吃什么呢", "心情还行"]
+
+FACT_QUERY_TEMPLATES = ["我在{place}买的{object}是什么样的", "还记得{place}那个{object}吗"]
+FUZZY_QUERY_TEMPLATES = ["和{person}一起{event}的那次", "上次跟{person}{event}是什么时候"]
+
+
+def generate_corpus(num_moments: int, seed: int = 42,
+                    now: datetime = None) -> List[Dict]:
+    """
+    生成合成 Moment
+
+    Args:
+        num_moments: Moment 数量
+        seed: 随机种子（相同种子生成相同语料）
+        now: 时间基准（默认当前时间）
+
+    Returns:
+        List[Dict]: MomentStorage.save_moment 格式的 Moment
+    """
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    moments = []
+
+    for i in range(num_moments):
+        person, place = rng.choice(PEOPLE), rng.choice(PLACES)
+        obj, event = rng.choice(OBJECTS), rng.choice(EVENTS)
+        slots = {"person": person, "place": place, "object": obj, "event": event}
+
+        messages = []
+        for template in rng.sample(MESSAGE_TEMPLATES, rng.randint(2, 4)):
+            messages.append({"role": "user", "content": template.format(**slots)})
+            messages.append({"role": "assistant", "content": "听起来不错呀，然后呢？"})
+        if rng.random() < 0.5:
+            messages.append({"role": "user", "content": rng.choice(FILLER_MESSAGES)})
+
+        timestamp = now - timedelta(days=rng.uniform(0, 90))
+        moments.append({
+            "moment_id": f"bench_{i:05d}",
+            "timestamp": timestamp.isoformat(),
+            "messages": messages,
+            "summary": f"和{person}在{place}{event}，提到了{obj}",
+            "emotion_tag": rng.choice(EMOTIONS),
+            "entities": {
+                "people": {person: {"relation": "朋友"}},
+                "places": {place: {"description": ""}},
+                "objects": {obj: {"description": ""}},
+                "events": [event],
+            },
+        })
+
+    return moments
+
+
+def _index(moments: List[Dict]) -> Dict[Tuple[str, str], List[str]]:
+    """(实体类型:名称) 组合 -> Moment ID"""
+    index: Dict[Tuple[str, str], List[str]] = {}
+    for m in moments:
+        e = m["entities"]
+        person, place = next(iter(e["people"])), next(iter(e["places"]))
+        obj, event = next(iter(e["objects"])), e["events"][0]
+        index.setdefault(("fact", f"{place}|{obj}"), []).append(m["moment_id"])
+        index.setdefault(("fuzzy", f"{person}|{event}"), []).append(m["moment_id"])
+    return index
+
+
+def generate_queries(moments: List[Dict], num_queries: int, seed: int = 42) -> List[Dict]:
+    """
+    生成带标注的查询（只从语料中实际出现的组合中抽取，保证每个查询至少有一个相关 Moment）
+
+    Returns:
+        List[Dict]: {"query", "query_type", "relevant": [moment_id, ...]}
+    """
+    rng = random.Random(seed + 1)
+    combos = sorted(_index(moments).items())
+    rng.shuffle(combos)
+
+    queries = []
+    for (query_type, combo), relevant in combos[:num_queries]:
+        a, b = combo.split("|")
+        if query_type == "fact":
+            text = rng.choice(FACT_QUERY_TEMPLATES).format(place=a, object=b)
+        else:
+            text = rng.choice(FUZZY_QUERY_TEMPLATES).format(person=a, event=b)
+        queries.append({"query": text, "query_type": query_type, "relevant": relevant})
+    return queries
+
+
+# ============================================================
+# 测试代码
+# ============================================================
+
+def test_corpus():
+    """测试语料生成"""
+    print("\n" + "="*60)
+    print("🧪 测试 Corpus")
+    print("="*60 + "\n")
+
+    moments = generate_corpus(200)
+    queries = generate_queries(moments, 10)
+    print(f"📦 {len(moments)} 个 Moment，示例: {moments[0]['messages'][0]['content']}")
+    for q in queries:
+        print(f"   [{q['query_type']}] {q['query']} → {len(q['relevant'])} 个相关")
+
+    print("\n" + "="*60)
+    print("✅ 测试完成！")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    test_corpus()
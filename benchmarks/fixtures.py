@@ -0,0 +1,157 @@
+"""
+Fixtures - DashScope 响应录制 / 回放
+替代 OpenAI 兼容客户端，基准测试不需要网络
+
+回放：
+1. Embedding：命中录制的向量直接返回；未命中用本地确定性向量（字二元组哈希投影）
+2. 对话补全：命中录制的回复直接返回；未命中抛出异常，调用方走各自的降级逻辑
+
+录制（--record）：未命中时请求真实 API 并写入 fixture 文件
+"""
+
+import json
+import time
+import math
+import hashlib
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+
+# 默认 fixture 文件
+DEFAULT_FIXTURE_PATH = Path(__file__).parent / "fixtures" / "dashscope.json"
+
+
+def _key(*parts: str) -> str:
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def local_embedding(text: str, dimension: int) -> List[float]:
+    """
+    本地确定性向量：字二元组哈希到维度上（带符号），L2 归一化
+
+    字面重叠越多余弦相似度越高，足以区分合成语料中的不同 Moment
+    """
+    vec = [0.0] * dimension
+    text = "".join(text.split())
+    grams = [text[i:i+2] for i in range(len(text) - 1)] or [text]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dimension
+        vec[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+class FixtureStore:
+    """录制的响应（JSON 文件：{"embeddings": {key: vector}, "chat": {key: content}}）"""
+
+    def __init__(self, path: Path = DEFAULT_FIXTURE_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self.embeddings: Dict[str, List[float]] = {}
+        self.chat: Dict[str, str] = {}
+        self.dirty = False
+        if self.path.exists():
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.embeddings = data.get("embeddings", {})
+            self.chat = data.get("chat", {})
+        self.stats = {"embedding_hits": 0, "embedding_local": 0, "chat_hits": 0, "chat_misses": 0,
+                      "recorded": 0}
+
+    def save(self):
+        """写回 fixture 文件（只在录制了新响应时）"""
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            data = {"embeddings": self.embeddings, "chat": self.chat}
+            self.path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            self.dirty = False
+
+
+class _Embeddings:
+    def __init__(self, client: "ReplayClient"):
+        self._client = client
+
+    def create(self, model: str, input, dimensions: int = 1024, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        store = self._client.store
+        vectors: List[Optional[List[float]]] = []
+        missing = []
+        for i, text in enumerate(texts):
+            vec = store.embeddings.get(_key(model, str(dimensions), text))
+            if vec is not None:
+                store.stats["embedding_hits"] += 1
+            else:
+                missing.append(i)
+            vectors.append(vec)
+
+        if missing and self._client.upstream is not None:
+            response = self._client.upstream.embeddings.create(
+                model=model, input=[texts[i] for i in missing], dimensions=dimensions
+            )
+            with store._lock:
+                for i, data in zip(missing, response.data):
+                    vectors[i] = data.embedding
+                    store.embeddings[_key(model, str(dimensions), texts[i])] = data.embedding
+                    store.stats["recorded"] += 1
+                store.dirty = True
+        else:
+            for i in missing:
+                vectors[i] = local_embedding(texts[i], dimensions)
+                store.stats["embedding_local"] += 1
+
+        self._client.sleep()
+        return SimpleNamespace(data=[SimpleNamespace(embedding=v, index=i) for i, v in enumerate(vectors)])
+
+
+class _Completions:
+    def __init__(self, client: "ReplayClient"):
+        self._client = client
+
+    def create(self, model: str, messages: List[Dict], **kwargs):
+        store = self._client.store
+        key = _key(model, json.dumps(messages, ensure_ascii=False, sort_keys=True))
+        content = store.chat.get(key)
+        if content is None:
+            if self._client.upstream is None:
+                store.stats["chat_misses"] += 1
+                raise RuntimeError("fixture 中没有录制该请求")
+            response = self._client.upstream.chat.completions.create(
+                model=model, messages=messages, **kwargs
+            )
+            content = response.choices[0].message.content
+            with store._lock:
+                store.chat[key] = content
+                store.stats["recorded"] += 1
+                store.dirty = True
+        else:
+            store.stats["chat_hits"] += 1
+
+        self._client.sleep()
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class ReplayClient:
+    """
+    OpenAI 兼容客户端的回放版本（embeddings.create / chat.completions.create）
+
+    Args:
+        store: 录制的响应
+        upstream: 真实客户端（录制模式），None 为纯回放
+        latency_ms: 每次调用模拟的网络延迟
+    """
+
+    def __init__(self, store: FixtureStore, upstream=None, latency_ms: float = 0.0):
+        self.store = store
+        self.upstream = upstream
+        self.latency_ms = latency_ms
+        self.api_key = "replay"
+        self.embeddings = _Embeddings(self)
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def sleep(self):
+        if self.latency_ms > 0 and self.upstream is None:
+            time.sleep(self.latency_ms / 1000)
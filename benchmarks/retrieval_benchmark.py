@@ -0,0 +1,365 @@
+"""
+Retrieval Benchmark - ContextRAG.search 离线基准 / 回归测试
+
+流程：
+1. 临时目录中生成合成语料（默认 3000 个 Moment），写入 SQLite + 向量库
+2. DashScope 客户端替换为回放客户端（fixtures.py），不访问网络
+3. 逐条执行带标注的查询，统计：
+   - 质量：recall@k、hit@k、MRR（总体 + 按查询类型）
+   - 延迟：各阶段（last_timings）p50 / p95
+   - 内存：RSS 峰值（导入后 / 写入后 / 检索后），可选 tracemalloc 峰值
+4. --compare 与基线 JSON 对比，质量下降或 p95 变慢超过阈值时返回非零退出码
+
+回放模式（报告 config.mode）：
+- replay: 使用录制的 fixture（benchmarks/fixtures/dashscope.json），Embedding / 解析 / 重排回复来自真实 API
+- fallback: 仓库不附带录制的 fixture（录制需要 API Key，向量体积也大），没有 fixture 时
+  Embedding 是本地哈希向量，对话补全全部未命中，解析走本地分类器 / 规则、重排走本地打分；
+  这时的质量和延迟只反映降级链路，不代表线上 DashScope 的效果
+- record: --record 录制中
+--compare 只和同一模式的基线对比，模式不一致时直接判为回归
+
+用法：
+    python -m benchmarks.retrieval_benchmark --moments 3000 --output bench.json
+    python -m benchmarks.retrieval_benchmark --compare bench.json
+    python -m benchmarks.retrieval_benchmark --record   # 用真实 API 录制 fixture（需要 ALIYUN_QWEN_KEY）
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import contextlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# 仓库根目录（python benchmarks/retrieval_benchmark.py 直接运行时）
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from benchmarks.corpus import generate_corpus, generate_queries
+from benchmarks.fixtures import FixtureStore, ReplayClient, DEFAULT_FIXTURE_PATH
+
+
+# 回归阈值默认值
+DEFAULT_MAX_RECALL_DROP = 0.02
+DEFAULT_MAX_P95_REGRESSION = 1.25
+
+# p95 增加不足该值（毫秒）时不算回归（亚毫秒级阶段的比值抖动很大）
+MIN_REGRESSION_MS = 2.0
+
+
+def _rss_mb() -> float:
+    """进程 RSS 峰值（MB，Linux 下 ru_maxrss 单位为 KB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 if sys.platform != "darwin" else peak / 1024 / 1024, 1)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近秩百分位"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def score_query(retrieved: List[str], relevant: List[str], k: int) -> Dict:
+    """单条查询的 recall@k（分母取 min(k, 相关数)）、hit@k、倒数排名"""
+    relevant_set = set(relevant)
+    top = retrieved[:k]
+    found = len(relevant_set & set(top))
+    rr = 0.0
+    for rank, mid in enumerate(top, 1):
+        if mid in relevant_set:
+            rr = 1.0 / rank
+            break
+    return {
+        "recall": found / min(k, len(relevant_set)) if relevant_set else 0.0,
+        "hit": 1.0 if found else 0.0,
+        "rr": rr,
+    }
+
+
+def _quiet(verbose: bool):
+    """检索流水线的逐条日志量很大，默认静默"""
+    return contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+
+
+def _upstream_client():
+    """录制模式的真实客户端"""
+    from openai import OpenAI
+    api_key = os.getenv("ALIYUN_QWEN_KEY")
+    if not api_key or api_key == "replay":
+        raise SystemExit("❌ 录制模式需要 ALIYUN_QWEN_KEY")
+    return OpenAI(api_key=api_key, base_url="https://dashscope.aliyuncs.com/compatible-mode/v1")
+
+
+def run_benchmark(args) -> Dict:
+    """执行基准，返回报告"""
+    upstream = _upstream_client() if args.record else None
+    store = FixtureStore(Path(args.fixtures).resolve())
+    if args.record:
+        mode = "record"
+    elif store.embeddings or store.chat:
+        mode = "replay"
+    else:
+        mode = "fallback"
+        print(f"⚠️ 未找到录制的 fixture（{store.path}），Embedding 为本地哈希向量、LLM 调用全部降级，"
+              f"结果只反映降级链路")
+    replay = ReplayClient(store, upstream=upstream, latency_ms=args.latency_ms)
+    # 客户端只在配置了 Key 时初始化，回放时给一个占位 Key
+    os.environ.setdefault("ALIYUN_QWEN_KEY", "replay")
+    if args.backend:
+        os.environ["VECTOR_BACKEND"] = args.backend
+
+    # 所有存储（SQLite、向量库、Embedding / 解析缓存）都放在临时目录
+    work_dir = Path(tempfile.mkdtemp(prefix="retrieval_bench_"))
+    old_cwd = os.getcwd()
+    os.chdir(work_dir)
+    os.environ["PARSE_CACHE_PATH"] = str(work_dir / "parse_cache.db")
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    try:
+        with _quiet(args.verbose):
+            from backend.memory import vector_store as vector_store_module
+            from backend.memory.storage_context import UserStorageContext
+            from backend.memory.context_rag import ContextRAG
+            from backend.memory.query_parser import get_query_parser
+            from backend.memory.reranker import get_reranker
+
+            # 替换 DashScope 客户端：Embedding 共享客户端、Query 解析、Reranker（LLM / 分层）
+            vector_store_module._embedding_client = replay
+            parser = get_query_parser()
+            parser.client = replay
+            reranker = get_reranker()
+            for target in (reranker, getattr(reranker, "llm", None)):
+                if target is not None and getattr(target, "client", None) is not None:
+                    target.client = replay
+
+            context = UserStorageContext(user_id="bench_user", base_dir=str(work_dir))
+            rag = ContextRAG(user_id="bench_user", base_moments_dir=str(work_dir),
+                             enable_rerank=not args.no_rerank, storage_context=context)
+        rss_start = _rss_mb()
+
+        # 1. 写入语料
+        moments = generate_corpus(args.moments, seed=args.seed)
+        queries = generate_queries(moments, args.queries, seed=args.seed)
+        print(f"📦 写入 {len(moments)} 个 Moment...")
+        t0 = time.perf_counter()
+        with _quiet(args.verbose):
+            futures = [context.storage.save_moment_async(m) for m in moments]
+            for future in futures:
+                future.result()
+            sqlite_s = time.perf_counter() - t0
+            if context.vector_store:
+                for m in moments:
+                    context.vector_store.add_moment(m["moment_id"], m)
+        ingest = {
+            "sqlite_s": round(sqlite_s, 2),
+            "total_s": round(time.perf_counter() - t0, 2),
+        }
+        rss_ingested = _rss_mb()
+        print(f"   ✅ 写入完成: {ingest}")
+
+        # 2. 执行查询
+        print(f"🔍 执行 {len(queries)} 条查询 (top_k={args.top_k})...")
+        stage_ms: Dict[str, List[float]] = {}
+        per_query = []
+        for q in queries:
+            with _quiet(args.verbose):
+                results = rag.search(q["query"], top_k=args.top_k)
+            retrieved = [r["moment_id"] for r in results]
+            scores = score_query(retrieved, q["relevant"], args.top_k)
+            per_query.append({**scores, "query_type": q["query_type"]})
+            for key, value in rag.last_timings.items():
+                if key.endswith("_ms"):
+                    stage_ms.setdefault(key[:-3], []).append(value)
+        rss_searched = _rss_mb()
+
+        # 3. 汇总
+        def summarize(rows: List[Dict]) -> Dict:
+            n = len(rows) or 1
+            return {
+                "queries": len(rows),
+                f"recall@{args.top_k}": round(sum(r["recall"] for r in rows) / n, 4),
+                f"hit@{args.top_k}": round(sum(r["hit"] for r in rows) / n, 4),
+                "mrr": round(sum(r["rr"] for r in rows) / n, 4),
+            }
+
+        quality = {"all": summarize(per_query)}
+        for query_type in sorted({r["query_type"] for r in per_query}):
+            quality[query_type] = summarize([r for r in per_query if r["query_type"] == query_type])
+
+        latency = {
+            stage: {
+                "p50": round(percentile(values, 50), 1),
+                "p95": round(percentile(values, 95), 1),
+                "mean": round(sum(values) / len(values), 1),
+                "count": len(values),
+            }
+            for stage, values in sorted(stage_ms.items())
+        }
+
+        memory = {"rss_start_mb": rss_start, "rss_ingested_mb": rss_ingested,
+                  "rss_searched_mb": rss_searched}
+        if args.trace_memory:
+            memory["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1)
+
+        report = {
+            "config": {
+                "mode": mode,
+                "moments": args.moments,
+                "queries": len(queries),
+                "top_k": args.top_k,
+                "seed": args.seed,
+                "vector_backend": context.vector_store.collection.name
+                if context.vector_store and context.vector_store.collection else None,
+                "reranker": type(rag.reranker).__name__ if rag.reranker else None,
+                "latency_ms": args.latency_ms,
+            },
+            "ingest": ingest,
+            "quality": quality,
+            "latency_ms": latency,
+            "memory": memory,
+            "fixtures": dict(store.stats),
+            "parser": parser.get_cache_stats(),
+        }
+
+        store.save()
+        with _quiet(args.verbose):
+            rag.close()
+        return report
+
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+        os.chdir(old_cwd)
+        if args.keep:
+            print(f"📁 保留工作目录: {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report: Dict):
+    """打印报告"""
+    print("\n" + "="*60)
+    print("📊 检索基准报告")
+    print("="*60)
+    print(f"配置: {report['config']}")
+    if report["config"].get("mode") == "fallback":
+        print("⚠️ fallback 模式：没有录制的 fixture，以下数字只反映本地降级链路（哈希向量 + 本地解析 / 重排）")
+    print(f"写入: {report['ingest']}")
+
+    print("\n质量:")
+    for name, row in report["quality"].items():
+        metrics = "  ".join(f"{k}={v}" for k, v in row.items() if k != "queries")
+        print(f"   {name:<6} (n={row['queries']:>4})  {metrics}")
+
+    print("\n延迟 (ms):")
+    print(f"   {'阶段':<24}{'p50':>8}{'p95':>8}{'mean':>8}")
+    for stage, row in report["latency_ms"].items():
+        print(f"   {stage:<24}{row['p50']:>8}{row['p95']:>8}{row['mean']:>8}")
+
+    print(f"\n内存: {report['memory']}")
+    print(f"Fixture: {report['fixtures']}")
+    print(f"解析: parsed_by={report['parser'].get('parsed_by')}, "
+          f"hit_rate={report['parser'].get('hit_rate')}")
+    print("="*60 + "\n")
+
+
+def compare_reports(current: Dict, baseline: Dict, max_recall_drop: float,
+                    max_p95_regression: float) -> List[str]:
+    """
+    与基线对比
+
+    Returns:
+        List[str]: 回归项（为空表示通过）
+    """
+    failures = []
+    print("📐 与基线对比:")
+    current_mode = current["config"].get("mode")
+    baseline_mode = baseline.get("config", {}).get("mode")
+    if current_mode != baseline_mode:
+        # 降级链路和真实回放的数字不可比
+        print(f"   ❌ 模式不一致: 基线 {baseline_mode} / 当前 {current_mode}")
+        failures.append(f"mode: {baseline_mode} → {current_mode}")
+        return failures
+    for name, row in baseline.get("quality", {}).items():
+        for metric, base_value in row.items():
+            if metric == "queries" or name not in current["quality"]:
+                continue
+            value = current["quality"][name].get(metric)
+            if value is None:
+                continue
+            delta = value - base_value
+            flag = ""
+            if delta < -max_recall_drop:
+                flag = " ❌"
+                failures.append(f"{name}.{metric}: {base_value} → {value}")
+            print(f"   {name}.{metric}: {base_value} → {value} ({delta:+.4f}){flag}")
+
+    for stage, row in baseline.get("latency_ms", {}).items():
+        current_row = current["latency_ms"].get(stage)
+        if not current_row or row["p95"] <= 0:
+            continue
+        ratio = current_row["p95"] / row["p95"]
+        flag = ""
+        if ratio > max_p95_regression and current_row["p95"] - row["p95"] >= MIN_REGRESSION_MS:
+            flag = " ❌"
+            failures.append(f"{stage}.p95: {row['p95']} → {current_row['p95']} ms")
+        print(f"   {stage}.p95: {row['p95']} → {current_row['p95']} ms (x{ratio:.2f}){flag}")
+    return failures
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="ContextRAG.search 离线基准")
+    parser.add_argument("--moments", type=int, default=3000, help="语料 Moment 数量")
+    parser.add_argument("--queries", type=int, default=200, help="查询数量")
+    parser.add_argument("--top-k", type=int, default=5, help="检索数量")
+    parser.add_argument("--seed", type=int, default=42, help="语料随机种子")
+    parser.add_argument("--backend", choices=["chroma", "numpy"], help="向量后端（默认读取 VECTOR_BACKEND）")
+    parser.add_argument("--no-rerank", action="store_true", help="关闭 Rerank")
+    parser.add_argument("--fixtures", default=str(DEFAULT_FIXTURE_PATH), help="fixture 文件")
+    parser.add_argument("--record", action="store_true", help="未命中时调用真实 API 并录制")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="回放时模拟的每次调用延迟")
+    parser.add_argument("--trace-memory", action="store_true", help="启用 tracemalloc（明显变慢）")
+    parser.add_argument("--output", help="报告写入 JSON 文件")
+    parser.add_argument("--compare", help="基线报告 JSON，回归时返回非零退出码")
+    parser.add_argument("--max-recall-drop", type=float, default=DEFAULT_MAX_RECALL_DROP,
+                        help="质量指标允许的最大下降")
+    parser.add_argument("--max-p95-regression", type=float, default=DEFAULT_MAX_P95_REGRESSION,
+                        help="p95 延迟允许的最大倍数")
+    parser.add_argument("--keep", action="store_true", help="保留临时工作目录")
+    parser.add_argument("--verbose", action="store_true", help="输出检索流水线日志")
+    args = parser.parse_args(argv)
+
+    # 先读基线，路径错误时不必跑完整个基准
+    baseline = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else None
+
+    report = run_benchmark(args)
+    print_report(report)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"💾 报告已保存: {args.output}")
+
+    if baseline is not None:
+        failures = compare_reports(report, baseline, args.max_recall_drop, args.max_p95_regression)
+        if failures:
+            print(f"❌ 检测到 {len(failures)} 项回归")
+            return 1
+        print("✅ 无回归")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
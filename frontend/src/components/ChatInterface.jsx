@@ -1,5 +1,5 @@
 import { useState, useRef, useEffect, forwardRef, useImperativeHandle } from 'react'
-import { chatAPI, startMomentAPI, saveMomentAPI, asrAPI, getAudioBaseURL } from '../services/api'
+import { chatStreamAPI, startMomentAPI, saveMomentAPI, waitForMomentCardAPI, asrAPI, getAudioBaseURL } from '../services/api'
 import { useBackgroundStore } from '../store/backgroundStore'
 import BackgroundCarousel from './BackgroundCarousel'
 import ParticleBackground from './ParticleBackground'
@@ -749,8 +749,10 @@ const ChatInterface = forwardRef(({ userInfo, onCapture, isCrystallizing }, ref)
       // 【移动端修复】发送消息前标记用户交互（确保后续音频可以播放）
       userInteractedRef.current = true
       
-      // 发送消息（使用最新的消息列表）
-      const result = await chatAPI(userInfo.user_id, userMessage, newMessages)
+      // 发送消息（使用最新的消息列表，流式显示回复）
+      const result = await chatStreamAPI(userInfo.user_id, userMessage, newMessages, (replySoFar) => {
+        setMessages([...newMessages, { role: 'assistant', content: replySoFar }])
+      })
       
       // 添加 Agent 回复（不更新subtitle，避免闪烁）
       const assistantMsg = { role: 'assistant', content: result.reply }
@@ -819,6 +821,12 @@ const ChatInterface = forwardRef(({ userInfo, onCapture, isCrystallizing }, ref)
       // 保存完成后才清除状态（但保留字幕直到Moment Card显示）
       // 字幕会在Moment Card显示后由父组件控制清除
       
+      // Moment 已落盘，Card 在后台生成：轮询直到完成（失败或超时使用占位卡片）
+      if (result.status !== 'done' && result.job_id) {
+        const card = await waitForMomentCardAPI(userInfo.user_id, result.moment_id)
+        return card || result.card
+      }
+      
       // 返回Moment Card数据
       return result.card
     } catch (error) {
@@ -1154,7 +1162,7 @@ const ChatInterface = forwardRef(({ userInfo, onCapture, isCrystallizing }, ref)
         setRecordingState('idle')
         setAudioStatus('PROCESSING...')
         
-        // 2. 自动触发 AI 回复流程（调用 chatAPI）
+        // 2. 自动触发 AI 回复流程（调用 chatStreamAPI）
         try {
           // 如果没有活跃的 Moment，自动开始一个（但不重置消息）
           if (!currentMomentId) {
@@ -1167,8 +1175,10 @@ const ChatInterface = forwardRef(({ userInfo, onCapture, isCrystallizing }, ref)
           // 【移动端修复】发送消息前标记用户交互（确保后续音频可以播放）
           userInteractedRef.current = true
           
-          // 发送消息（使用最新的消息列表）
-          const chatResult = await chatAPI(userInfo.user_id, recognizedText, newMessages)
+          // 发送消息（使用最新的消息列表，流式显示回复）
+          const chatResult = await chatStreamAPI(userInfo.user_id, recognizedText, newMessages, (replySoFar) => {
+            setMessages([...newMessages, { role: 'assistant', content: replySoFar }])
+          })
           
           // 3. AI 回复也自动添加到消息列表（AI 消息）
           const assistantMsg = { role: 'assistant', content: chatResult.reply }
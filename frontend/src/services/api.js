@@ -74,6 +74,82 @@ export const chatAPI = async (userId, message, history = []) => {
   return response.data
 }
 
+// 发送消息（SSE 流式回复，默认路径）
+// onToken(textSoFar, chunk) 在每个回复片段到达时调用
+// 返回值与 chatAPI 一致：{ reply, emotion, audio_path, moment_id, message_count }
+export const chatStreamAPI = async (userId, message, history = [], onToken = null) => {
+  const response = await fetch(`${API_BASE_URL}/chat/stream`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Accept': 'text/event-stream',
+    },
+    body: JSON.stringify({
+      user_id: userId,
+      message: message,
+      history: history.map(msg => ({
+        role: msg.role,
+        content: msg.content,
+      })),
+    }),
+  })
+
+  // 后端不支持流式接口（旧版本）时回退到非流式接口
+  if (!response.ok || !response.body) {
+    console.warn('⚠️ [API] 流式接口不可用，回退到 /chat, status:', response.status)
+    return chatAPI(userId, message, history)
+  }
+
+  const reader = response.body.getReader()
+  const decoder = new TextDecoder('utf-8')
+  let buffer = ''
+  let replySoFar = ''
+  let result = null
+
+  // 解析一条 SSE 事件（event: xxx\ndata: {...}）
+  const handleEvent = (rawEvent) => {
+    let eventName = 'message'
+    let dataStr = ''
+    for (const line of rawEvent.split('\n')) {
+      if (line.startsWith('event:')) {
+        eventName = line.slice(6).trim()
+      } else if (line.startsWith('data:')) {
+        dataStr += line.slice(5).trim()
+      }
+    }
+    if (!dataStr) return
+    const data = JSON.parse(dataStr)
+    if (eventName === 'token') {
+      replySoFar += data.text
+      if (onToken) onToken(replySoFar, data.text)
+    } else if (eventName === 'done') {
+      result = data
+    } else if (eventName === 'error') {
+      throw new Error(data.detail || 'Chat API 错误')
+    }
+  }
+
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += decoder.decode(value, { stream: true })
+    let boundary = buffer.indexOf('\n\n')
+    while (boundary !== -1) {
+      handleEvent(buffer.slice(0, boundary))
+      buffer = buffer.slice(boundary + 2)
+      boundary = buffer.indexOf('\n\n')
+    }
+  }
+  if (buffer.trim()) {
+    handleEvent(buffer)
+  }
+
+  if (!result) {
+    throw new Error('流式回复意外中断')
+  }
+  return result
+}
+
 // 保存 Moment
 export const saveMomentAPI = async (userId) => {
   const response = await api.post('/moments/save', {
@@ -82,6 +158,32 @@ export const saveMomentAPI = async (userId) => {
   return response.data
 }
 
+// 查询 Moment Card 生成状态（pending / running / done / failed）
+export const getMomentCardAPI = async (userId, momentId) => {
+  const response = await api.get(`/moments/${momentId}/card`, {
+    params: { user_id: userId },
+  })
+  return response.data
+}
+
+// 轮询直到 Moment Card 生成完成，失败或超时返回 null
+export const waitForMomentCardAPI = async (userId, momentId, { interval = 1000, timeout = 60000 } = {}) => {
+  const deadline = Date.now() + timeout
+  while (Date.now() < deadline) {
+    const result = await getMomentCardAPI(userId, momentId)
+    if (result.status === 'done') {
+      return result.card
+    }
+    if (result.status === 'failed') {
+      console.error('Moment Card 生成失败:', result.error)
+      return null
+    }
+    await new Promise((resolve) => setTimeout(resolve, interval))
+  }
+  console.warn('Moment Card 生成超时:', momentId)
+  return null
+}
+
 // 获取所有 Moments
 export const getMomentsAPI = async (userId) => {
   const response = await api.get('/moments', {
@@ -14,6 +14,7 @@ if __name__ == "__main__":
     print("   ✅ POST /api/init - 初始化连接")
     print("   ✅ POST /api/moments/start - 开始新 Moment")
     print("   ✅ POST /api/chat - 发送消息")
+    print("   ✅ POST /api/chat/stream - 发送消息（SSE 流式回复）")
     print("   ✅ POST /api/moments/save - 保存 Moment")
     print("   ✅ GET  /api/moments - 获取所有 Moments")
     print("   ✅ GET  /api/style/profile - 获取风格画像")
@@ -0,0 +1,62 @@
+"""
+测试公共配置
+
+- 仓库根目录加入 sys.path（backend / api 以包的形式导入）
+- 模块导入时会创建 DashScope 客户端，测试环境给一个占位 Key（测试中不会发起网络请求）
+- FakeEmbeddingClient：与 OpenAI 客户端 embeddings.create 接口一致，记录每次请求的输入
+"""
+
+import os
+import sys
+import math
+import hashlib
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("ALIYUN_QWEN_KEY", "test-key")
+
+
+def hashed_embedding(text: str, dimension: int) -> List[float]:
+    """确定性向量：字二元组哈希到维度上，L2 归一化"""
+    vec = [0.0] * dimension
+    grams = [text[i:i + 2] for i in range(len(text) - 1)] or [text]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        vec[int.from_bytes(digest[:4], "little") % dimension] += 1.0
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+class FakeEmbeddingClient:
+    """记录请求的 Embedding 客户端"""
+
+    def __init__(self):
+        self.calls: List[List[str]] = []
+        self.embeddings = SimpleNamespace(create=self._create)
+
+    def _create(self, model, input, dimensions, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.calls.append(texts)
+        return SimpleNamespace(data=[
+            SimpleNamespace(embedding=hashed_embedding(t, dimensions)) for t in texts
+        ])
+
+
+@pytest.fixture
+def fake_embeddings():
+    return FakeEmbeddingClient()
+
+
+@pytest.fixture
+def numpy_backend(monkeypatch):
+    """向量后端使用 NumPy（不依赖 ChromaDB），每个测试使用独立的共享实例表"""
+    from backend.memory import vector_backends
+    monkeypatch.setenv("VECTOR_BACKEND", "numpy")
+    monkeypatch.setattr(vector_backends, "_numpy_backends", {})
@@ -0,0 +1,104 @@
+"""
+CardJobQueue 测试：失败重试、租约过期恢复、多进程共用任务表
+"""
+
+import sqlite3
+import time
+
+from backend.memory.card_jobs import CardJobQueue, STATUS_DONE, STATUS_FAILED, STATUS_RUNNING
+
+
+def _wait_for(queue, moment_id, status, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get_job(moment_id)
+        if job and job["status"] == status:
+            return job
+        time.sleep(0.02)
+    return queue.get_job(moment_id)
+
+
+def test_failed_job_is_retried_with_backoff(tmp_path):
+    calls = []
+
+    def handler(user_id, moment_id):
+        calls.append(moment_id)
+        if len(calls) == 1:
+            raise RuntimeError("LLM 超时")
+        return {"moment_id": moment_id}
+
+    queue = CardJobQueue(handler, db_path=str(tmp_path / "jobs.db"), workers=1, retry_backoff=0.05)
+    queue.start()
+    try:
+        queue.enqueue("u", "m1")
+        job = _wait_for(queue, "m1", STATUS_DONE)
+        assert job["status"] == STATUS_DONE
+        assert job["attempts"] == 2
+        assert job["card"] == {"moment_id": "m1"}
+        assert queue.get_stats()["retried"] == 1
+    finally:
+        queue.close()
+
+
+def test_job_fails_after_max_attempts(tmp_path):
+    def handler(user_id, moment_id):
+        raise RuntimeError("boom")
+
+    queue = CardJobQueue(handler, db_path=str(tmp_path / "jobs.db"), workers=1,
+                         max_attempts=2, retry_backoff=0.01)
+    queue.start()
+    try:
+        queue.enqueue("u", "m1")
+        job = _wait_for(queue, "m1", STATUS_FAILED)
+        assert job["status"] == STATUS_FAILED
+        assert job["attempts"] == 2
+        assert job["error"] == "boom"
+    finally:
+        queue.close()
+
+
+def _mark_running(db_path, moment_id, owner, lease_expires):
+    conn = sqlite3.connect(db_path)
+    conn.execute("UPDATE card_jobs SET status = ?, owner = ?, lease_expires = ? WHERE moment_id = ?",
+                 (STATUS_RUNNING, owner, lease_expires, moment_id))
+    conn.commit()
+    conn.close()
+
+
+def test_only_expired_leases_are_recovered(tmp_path):
+    db_path = str(tmp_path / "jobs.db")
+    seeded = CardJobQueue(lambda u, m: {}, db_path=db_path, workers=1)
+    seeded.enqueue("u", "dead")
+    seeded.enqueue("u", "alive")
+    seeded.close()
+    # dead: 持有进程已退出（租约过期）；alive: 另一个进程仍在执行（租约有效）
+    _mark_running(db_path, "dead", "worker-a", 0)
+    _mark_running(db_path, "alive", "worker-b", time.time() + 60)
+
+    handled = []
+    queue = CardJobQueue(lambda u, m: handled.append(m) or {"moment_id": m},
+                         db_path=db_path, workers=1)
+    queue.start()
+    try:
+        assert _wait_for(queue, "dead", STATUS_DONE)["status"] == STATUS_DONE
+        time.sleep(0.2)
+        alive = queue.get_job("alive")
+        assert alive["status"] == STATUS_RUNNING
+        assert alive["owner"] == "worker-b"
+        assert handled == ["dead"]
+    finally:
+        queue.close()
+
+
+def test_result_is_dropped_after_lease_takeover(tmp_path):
+    queue = CardJobQueue(lambda u, m: {}, db_path=str(tmp_path / "jobs.db"), workers=1)
+    try:
+        queue.enqueue("u", "m1")
+        job = queue._claim()
+        # 租约被其他 worker 接管
+        queue._conn.execute("UPDATE card_jobs SET owner = 'other' WHERE moment_id = 'm1'")
+        queue._conn.commit()
+        assert queue._finish(job, card={"title": "stale"}) == STATUS_RUNNING
+        assert queue.get_job("m1")["card"] is None
+    finally:
+        queue.close()
@@ -0,0 +1,79 @@
+"""
+ContextRAG 测试：模糊时间引用（最近 / 这几天）在 Rerank 之后软加权
+"""
+
+from datetime import datetime, timedelta
+
+from backend.memory.context_rag import ContextRAG
+from backend.memory.reranker import LocalReranker
+
+
+class FakeVectorStore:
+    """查询向量 [1, 0]；旧 Moment 与查询更相似"""
+
+    def get_embeddings_batch(self, texts):
+        return [[1.0, 0.0] for _ in texts]
+
+    def get_moment_embeddings(self, moment_ids):
+        vectors = {"m_old": [1.0, 0.0], "m_recent": [0.9, 0.436]}
+        return {mid: vectors[mid] for mid in moment_ids}
+
+
+def _candidate(moment_id, days_ago):
+    return {
+        "moment_id": moment_id,
+        "timestamp": (datetime.now() - timedelta(days=days_ago)).isoformat(),
+        "summary": "和同事去喝咖啡",
+        "messages": [],
+        "retrieval_score": 0.5,
+    }
+
+
+def _rag():
+    rag = ContextRAG.__new__(ContextRAG)
+    rag.reranker = LocalReranker()
+    rag.vector_store = FakeVectorStore()
+    return rag
+
+
+def test_recent_moment_outranks_older_after_rerank():
+    window = {"start": (datetime.now() - timedelta(days=7)).isoformat(), "end": datetime.now().isoformat()}
+    candidates = [_candidate("m_old", 30), _candidate("m_recent", 2)]
+
+    plain = _rag()._rank_results("咖啡", [dict(c) for c in candidates], 1, None, {})
+    assert [m["moment_id"] for m in plain] == ["m_old"]
+
+    boosted = _rag()._rank_results("咖啡", [dict(c) for c in candidates], 1, window, {})
+    assert [m["moment_id"] for m in boosted] == ["m_recent"]
+
+
+class FakeStorage:
+    def structured_hits(self, keywords, time_range=None):
+        return []
+
+    def get_moments(self, moment_ids, projection=None):
+        return []
+
+
+class FakeQueryParser:
+    """检索配置带出查询类型；再次调用 parse 视为重复解析"""
+
+    def get_search_config(self, query, embed_fn=None):
+        return {"use_structured": True, "use_vector": False, "keywords": ["咖啡"],
+                "entity_types": [], "query_type": "fact", "expanded_queries": [query]}
+
+    def parse(self, query, embed_fn=None):
+        raise AssertionError("查询不应被重复解析")
+
+
+def test_fact_query_reuses_parsed_query_type():
+    rag = ContextRAG.__new__(ContextRAG)
+    rag.storage = FakeStorage()
+    rag.vector_store = None
+    rag.reranker = None
+    rag.gate = None
+    rag.query_parser = FakeQueryParser()
+
+    prompt = rag.generate_context_prompt("我上次喝的什么咖啡？")
+    assert rag.last_query_type == "fact"
+    assert prompt == rag._build_fact_prompt_not_found()
@@ -0,0 +1,50 @@
+"""
+EmbeddingCache 测试：磁盘命中的访问时间批量落盘，淘汰时按落盘后的访问时间
+"""
+
+import sqlite3
+
+import pytest
+
+from backend.memory.embedding_cache import EmbeddingCache
+
+
+MODEL, DIM = "text-embedding-v3", 2
+
+
+def _last_access(db_path, cache, text):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        return conn.execute("SELECT last_access FROM embeddings WHERE key = ?",
+                            (cache.make_key(MODEL, DIM, text),)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_disk_hits_defer_access_time_until_flush(tmp_path):
+    db_path = tmp_path / "cache.db"
+    cache = EmbeddingCache(db_path=str(db_path), max_memory_items=1)
+    cache.put_many(MODEL, DIM, ["咖啡", "奶茶"], [[0.1, 0.2], [0.3, 0.4]])
+    written = _last_access(db_path, cache, "咖啡")
+
+    # "咖啡" 已被挤出内存层，磁盘命中不立即写库
+    assert cache.get(MODEL, DIM, "咖啡") == pytest.approx([0.1, 0.2])
+    assert cache.get_stats()["disk_hits"] == 1
+    assert _last_access(db_path, cache, "咖啡") == written
+
+    cache.put(MODEL, DIM, "拿铁", [0.5, 0.6])
+    assert _last_access(db_path, cache, "咖啡") > written
+    cache.close()
+
+
+def test_eviction_sees_pending_access_times(tmp_path):
+    cache = EmbeddingCache(db_path=str(tmp_path / "cache.db"), max_memory_items=1, max_disk_items=2)
+    cache.put_many(MODEL, DIM, ["咖啡", "奶茶"], [[0.1, 0.2], [0.3, 0.4]])
+    cache.get(MODEL, DIM, "咖啡")  # 磁盘命中，访问时间晚于 "奶茶"
+
+    cache.put(MODEL, DIM, "拿铁", [0.5, 0.6])
+    cache._evict_disk()
+    cache._memory.clear()
+    assert cache.get(MODEL, DIM, "咖啡") is not None
+    assert cache.get(MODEL, DIM, "奶茶") is None
+    cache.close()
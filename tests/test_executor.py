@@ -0,0 +1,38 @@
+"""
+BlockingExecutor 测试：线程池排队深度自行计数（任务被取走或取消后减一）
+"""
+
+import asyncio
+import threading
+
+from api.executor import BlockingExecutor
+
+
+def test_pool_queue_depth_counts_waiting_tasks():
+    executor = BlockingExecutor(max_workers=1, route_limits={})
+    gate = threading.Event()
+
+    async def scenario():
+        # 每个路由的并发上限不超过线程数，排队发生在不同路由之间
+        tasks = [asyncio.create_task(executor.run(route, gate.wait, 5)) for route in ("chat", "tts", "asr")]
+        await asyncio.sleep(0.1)
+        # 一个任务占用唯一的线程，其余两个在线程池队列中
+        assert executor.get_metrics()["pool_queue_depth"] == 2
+
+        tasks[2].cancel()
+        await asyncio.sleep(0.05)
+        assert executor.get_metrics()["pool_queue_depth"] == 1
+
+        gate.set()
+        await asyncio.gather(*tasks[:2])
+        assert executor.get_metrics()["pool_queue_depth"] == 0
+
+        chunks = [chunk async for chunk in executor.iterate("chat", iter(["你", "好"]))]
+        assert chunks == ["你", "好"]
+        assert executor.get_metrics()["pool_queue_depth"] == 0
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        gate.set()
+        executor.shutdown()
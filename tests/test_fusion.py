@@ -0,0 +1,51 @@
+"""
+结果融合测试：max_pool、RRF / 加权融合、MMR 去冗余
+"""
+
+import pytest
+
+from backend.memory.fusion import fuse, max_pool, mmr
+
+
+def test_max_pool_keeps_best_hit_and_all_match_types():
+    pooled = max_pool([
+        {"moment_id": "m1", "score": 0.2, "match_types": ["keyword:咖啡"]},
+        {"moment_id": "m1", "score": 0.9, "match_types": ["objects:咖啡"]},
+        {"moment_id": "m2", "score": 0.5},
+    ])
+    assert [p["moment_id"] for p in pooled] == ["m1", "m2"]
+    assert pooled[0]["score"] == 0.9
+    assert pooled[0]["match_types"] == ["keyword:咖啡", "objects:咖啡"]
+
+
+@pytest.mark.parametrize("method", ["rrf", "weighted"])
+def test_fuse_rewards_hits_from_both_sources(method):
+    sources = {
+        "structured": ([{"moment_id": "m1", "score": 3.0}, {"moment_id": "m2", "score": 1.0}], 0.5),
+        "vector": ([{"moment_id": "m3", "score": 0.9}, {"moment_id": "m1", "score": 0.8}], 0.5),
+    }
+    merged = fuse(sources, top_k=3, method=method, mmr_lambda=1.0)
+    assert merged[0]["moment_id"] == "m1"
+    assert merged[0]["source"] == "hybrid"
+    assert merged[0]["sources"] == ["structured", "vector"]
+    assert {m["source"] for m in merged[1:]} == {"structured", "vector"}
+
+
+def test_fuse_rrf_ignores_score_scale():
+    # 结构化分数量级远大于向量分数，RRF 只看名次
+    sources = {
+        "structured": ([{"moment_id": "a", "score": 100.0}], 0.5),
+        "vector": ([{"moment_id": "b", "score": 0.1}], 0.5),
+    }
+    merged = fuse(sources, top_k=2, method="rrf", mmr_lambda=1.0)
+    assert merged[0]["weighted_score"] == pytest.approx(merged[1]["weighted_score"])
+
+
+def test_mmr_demotes_near_duplicates():
+    candidates = [
+        {"moment_id": "a", "weighted_score": 1.0, "text": "周末去西湖散步看荷花"},
+        {"moment_id": "b", "weighted_score": 0.95, "text": "周末去西湖散步看荷花了"},
+        {"moment_id": "c", "weighted_score": 0.8, "text": "加班写方案到很晚"},
+    ]
+    assert [c["moment_id"] for c in mmr(candidates, 2, lambda_=1.0)] == ["a", "b"]
+    assert [c["moment_id"] for c in mmr(candidates, 2, lambda_=0.5)] == ["a", "c"]
@@ -0,0 +1,54 @@
+"""
+LLMGateway 测试：对话超时不重试，连接错误照常重试
+"""
+
+import pytest
+import requests
+
+from backend.utils import llm_gateway
+from backend.utils.llm_gateway import LLMGateway
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    monkeypatch.setattr(llm_gateway, "RETRY_BASE_DELAY", 0.001)
+    return LLMGateway(max_retries=2, model_limits={})
+
+
+def _failing(error, calls):
+    def func():
+        calls.append(1)
+        raise error
+    return func
+
+
+def test_timeouts_are_not_retried_when_disabled(gateway):
+    calls = []
+    with pytest.raises(requests.Timeout):
+        gateway.call("qwen-max", _failing(requests.Timeout("read timeout"), calls), retry_timeouts=False)
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(requests.Timeout):
+        gateway.call("text-embedding-v3", _failing(requests.Timeout("read timeout"), calls))
+    assert len(calls) == 3
+
+
+def test_stream_retries_connection_errors_but_not_timeouts(gateway):
+    calls = []
+
+    def connect():
+        calls.append(1)
+        if len(calls) == 1:
+            raise requests.ConnectionError("连接被重置")
+        return iter(["你", "好"])
+
+    assert list(gateway.stream("qwen-max", connect, retry_timeouts=False)) == ["你", "好"]
+    assert len(calls) == 2
+
+    calls.clear()
+    with pytest.raises(requests.Timeout):
+        list(gateway.stream("qwen-max", _failing(requests.Timeout("no first chunk"), calls),
+                            retry_timeouts=False))
+    assert len(calls) == 1
+    assert gateway.get_stats()["qwen-max"]["in_flight"] == 0
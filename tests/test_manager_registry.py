@@ -0,0 +1,91 @@
+"""
+ManagerRegistry 测试：正在使用的条目不回收（暂时超出上限），租约归还后再回收；rename 回调在锁外执行
+"""
+
+import threading
+
+from api.manager_registry import ManagerRegistry
+
+
+class FakeStorageContext:
+    def __init__(self):
+        self.close_calls = 0
+
+    def close(self):
+        self.close_calls += 1
+
+
+class FakeMomentManager:
+    def __init__(self):
+        self.current_messages = []
+
+    def shutdown(self):
+        pass
+
+
+def _factory(user_id):
+    return {
+        'storage_context': FakeStorageContext(),
+        'moment_manager': FakeMomentManager(),
+    }
+
+
+def test_leased_entry_is_evicted_after_release():
+    registry = ManagerRegistry(factory=_factory, max_users=1, idle_ttl=0)
+    closed = threading.Event()
+    original_close = registry._close_managers
+
+    def close_and_signal(user_id, mgrs):
+        original_close(user_id, mgrs)
+        closed.set()
+
+    registry._close_managers = close_and_signal
+
+    with registry.lease("alice") as alice:
+        registry.get("bob")  # 超过上限，但 alice 正在使用，暂时超出上限
+        assert registry.contains("alice")
+        assert registry.contains("bob")
+        assert registry.get_stats()["overflows"] == 1
+
+    # 租约归还后按最久未使用回收 alice
+    assert closed.wait(2)
+    assert not registry.contains("alice")
+    assert alice['storage_context'].close_calls == 1
+    assert registry.get_stats()["leased_entries"] == 0
+
+
+def test_entries_with_unsaved_messages_are_not_evicted():
+    registry = ManagerRegistry(factory=_factory, max_users=1, idle_ttl=0)
+    alice = registry.get("alice")
+    alice['moment_manager'].current_messages.append({"role": "user", "content": "你好"})
+    registry.get("bob")
+    assert registry.contains("alice")
+    assert alice['storage_context'].close_calls == 0
+
+
+def test_rename_callback_runs_outside_lock():
+    registry = ManagerRegistry(factory=_factory, max_users=2, idle_ttl=0)
+    registry.get("guest")
+    touched = []
+
+    def update(mgrs):
+        # 回调期间其它线程可以正常访问注册表
+        worker = threading.Thread(target=lambda: touched.append(registry.get("bob")))
+        worker.start()
+        worker.join(1)
+        assert not worker.is_alive()
+
+    assert registry.rename("guest", "alice", update)
+    assert touched
+    assert registry.contains("alice")
+    assert not registry.contains("guest")
+    assert registry.get_stats()["leased_entries"] == 0
+
+
+def test_unleased_entries_are_evicted_first():
+    registry = ManagerRegistry(factory=_factory, max_users=2, idle_ttl=0)
+    with registry.lease("alice"):
+        registry.get("bob")
+        registry.get("carol")
+        assert registry.contains("alice")
+        assert not registry.contains("bob")
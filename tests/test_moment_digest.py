@@ -0,0 +1,77 @@
+"""
+Moment Digest 测试：实体校验、Card 字段与实体提取分开调用、缓存
+"""
+
+import pytest
+
+from backend.memory import moment_digest
+from backend.memory.moment_digest import DigestCache, generate_moment_digest, validate_entities
+from backend.memory.moment_storage import MomentStorage
+
+
+MESSAGES = [{"role": "user", "content": "今天在星巴克买了一杯桂花拿铁"}]
+
+
+def test_validate_entities_coerces_list_elements(tmp_path):
+    entities = validate_entities({
+        "events": ["买咖啡", 3, None, {"name": "散步"}, "  "],
+        "time_info": {"time_markers": [2024, "早上"]},
+        "objects": {"桂花拿铁": {}},
+    })
+    assert entities["events"] == ["买咖啡", "3"]
+    assert entities["time_info"]["time_markers"] == ["2024", "早上"]
+    assert validate_entities({"objects": ["桂花拿铁"]}) is None
+
+    # 校验后的实体可以直接写入实体索引
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    try:
+        storage.save_moment({"moment_id": "m1", "messages": MESSAGES})
+        assert storage.update_moment_entities("m1", entities)
+        assert storage.search_structured(["3"], ["events"])[0][0] == "m1"
+    finally:
+        storage.close()
+
+
+@pytest.fixture
+def digest(monkeypatch, tmp_path):
+    monkeypatch.setattr(moment_digest, "_digest_cache", DigestCache(str(tmp_path / "digest.db")))
+    calls = []
+
+    def single_call(messages):
+        calls.append(messages)
+        return {"emotion": "开心", "summary": "今天喝到了桂花拿铁", "title": "桂花拿铁"}
+
+    monkeypatch.setattr(moment_digest, "_digest_single_call", single_call)
+    return calls
+
+
+def test_entities_come_from_extraction_fn_and_are_cached(digest):
+    extracted = []
+
+    def extract(messages):
+        extracted.append(messages)
+        return validate_entities({"objects": {"桂花拿铁": {}}, "places": {"星巴克": {}}})
+
+    fields = generate_moment_digest(MESSAGES, extract_entities_fn=extract)
+    assert fields["title"] == "桂花拿铁"
+    assert list(fields["entities"]["objects"]) == ["桂花拿铁"]
+
+    again = generate_moment_digest(MESSAGES, extract_entities_fn=extract)
+    assert again == fields
+    assert len(digest) == 1
+    assert len(extracted) == 1
+
+
+def test_empty_entities_are_not_cached(digest):
+    extracted = []
+
+    def extract(messages):
+        extracted.append(messages)
+        return moment_digest.empty_entities()
+
+    generate_moment_digest(MESSAGES, extract_entities_fn=extract)
+    fields = generate_moment_digest(MESSAGES, extract_entities_fn=extract)
+    # Card 字段命中缓存，实体重新提取
+    assert len(digest) == 1
+    assert len(extracted) == 2
+    assert fields["summary"] == "今天喝到了桂花拿铁"
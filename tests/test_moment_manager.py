@@ -0,0 +1,68 @@
+"""
+MomentManager 测试：会话状态修改按 session_lock 串行，保存期间到达的消息不会被重置静默丢掉
+"""
+
+import threading
+
+from backend.memory.moment_manager import MomentManager
+
+
+class BlockingStorage:
+    def __init__(self):
+        self.saving = threading.Event()
+        self.proceed = threading.Event()
+        self.saved = []
+
+    def save_moment(self, moment_data):
+        self.saving.set()
+        self.proceed.wait(2)
+        self.saved.append(moment_data)
+
+
+def _manager(storage):
+    manager = MomentManager.__new__(MomentManager)
+    manager.storage = storage
+    manager.vector_store = None
+    manager.current_moment_id = None
+    manager.current_messages = []
+    manager.session_lock = threading.RLock()
+    return manager
+
+
+def test_ensure_moment_starts_only_once():
+    manager = _manager(BlockingStorage())
+    moment_id = manager.ensure_moment()
+    manager.add_message("user", "你好")
+    assert manager.ensure_moment() == moment_id
+    assert len(manager.current_messages) == 1
+
+
+def test_add_message_waits_for_end_moment():
+    storage = BlockingStorage()
+    manager = _manager(storage)
+    manager.start_new_moment()
+    manager.add_message("user", "今天喝了桂花拿铁")
+
+    ender = threading.Thread(target=manager.end_moment, args=(False,))
+    ender.start()
+    assert storage.saving.wait(2)
+
+    errors = []
+
+    def add():
+        try:
+            manager.add_message("user", "明天还去")
+        except ValueError as e:
+            errors.append(e)
+
+    adder = threading.Thread(target=add)
+    adder.start()
+    adder.join(0.2)
+    # 保存期间添加消息被挡住，不会写进即将被重置的列表
+    assert adder.is_alive()
+
+    storage.proceed.set()
+    ender.join(2)
+    adder.join(2)
+    assert storage.saved[0]["message_count"] == 1
+    assert errors and manager.current_messages == []
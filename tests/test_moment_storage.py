@@ -0,0 +1,154 @@
+"""
+MomentStorage 测试：全文索引切词 / 迁移、结构化检索（命中复用、时间过滤）
+"""
+
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from backend.memory.moment_storage import (
+    SCHEMA_VERSION, MomentStorage, fts_index_text, fts_query, fts_tokens, score_structured_hits
+)
+
+
+def _moment(moment_id: str, days_ago: float, objects=(), places=(), events=()):
+    return {
+        "moment_id": moment_id,
+        "timestamp": (datetime.now() - timedelta(days=days_ago)).isoformat(),
+        "messages": [{"role": "user", "content": f"{moment_id} 的对话"}],
+        "summary": "",
+        "entities": {
+            "objects": {name: {} for name in objects},
+            "places": {name: {} for name in places},
+            "events": list(events),
+        },
+    }
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    storage.save_moment(_moment("m_coffee", 1, objects=["桂花拿铁", "咖啡"], places=["星巴克"]))
+    storage.save_moment(_moment("m_tea", 3, objects=["奶茶"], places=["星巴克"]))
+    storage.save_moment(_moment("m_walk", 10, places=["西湖"], events=["散步"]))
+    yield storage
+    storage.close()
+
+
+def test_structured_hits_merge_matches_single_query(storage):
+    keywords = ["拿铁", "星巴克", "散步"]
+    types = ["objects", "places"]
+    expected = storage.search_structured(keywords, types, top_k=10)
+
+    # 推测执行只覆盖部分关键词，其余补查，合并后打分结果一致
+    spec_hits = storage.structured_hits(["拿铁", "星巴克", "奶茶"])
+    extra_hits = storage.structured_hits(["散步"])
+    merged = score_structured_hits(spec_hits + extra_hits, keywords, types, top_k=10)
+
+    assert merged == expected
+    assert [m[0] for m in merged][:1] == ["m_coffee"]
+    # 奶茶不在本次关键词中，不参与打分
+    assert all("keyword:奶茶" not in m[2] for m in merged)
+
+
+def test_score_structured_hits_applies_time_range(storage):
+    hits = storage.structured_hits(["星巴克", "西湖"])
+    time_range = {
+        "start": (datetime.now() - timedelta(days=5)).isoformat(),
+        "end": datetime.now().isoformat(),
+    }
+    scored = score_structured_hits(hits, ["星巴克", "西湖"], ["places"], time_range=time_range)
+    assert {m[0] for m in scored} == {"m_coffee", "m_tea"}
+
+
+def test_get_entity_names_filters_entity_types(storage):
+    assert sorted(storage.get_entity_names(entity_types=["places"])) == ["星巴克", "西湖"]
+    assert {"桂花拿铁", "奶茶", "星巴克"} <= set(storage.get_entity_names())
+
+
+def test_fts_tokens_split_cjk_into_bigrams_and_ascii_into_words():
+    assert fts_tokens("桂花拿铁 Latte2") == [["桂花", "花拿", "拿铁", "铁"], ["latte2"]]
+    assert fts_tokens("桂花拿铁", for_query=True) == [["桂花", "花拿", "拿铁"]]
+    assert fts_index_text("喝了拿铁") == "喝了 了拿 拿铁 铁"
+
+
+def test_fts_query_phrases_and_prefixes():
+    assert fts_query("拿铁") == '"拿铁"'
+    assert fts_query("铁") == '"铁"*'
+    assert fts_query("星巴克 latte") == '"星巴 巴克" AND "latte"*'
+    assert fts_query("？！") is None
+
+
+def test_fts_single_char_prefix_matches_every_position(storage):
+    # 索引补上片段末字，单字查询能命中词尾
+    assert [m["moment_id"] for m in storage.search_by_keywords(["铁"])] == ["m_coffee"]
+
+
+def test_time_range_compares_epochs_across_timestamp_formats(tmp_path):
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    try:
+        # 带时区后缀的时间戳：08:30+08:00 即 00:30 UTC，字符串比较会误判
+        moment = _moment("m_tz", 0, places=["星巴克"])
+        moment["timestamp"] = "2024-05-01T08:30:00+08:00"
+        storage.save_moment(moment)
+        time_range = {"start": "2024-05-01T00:00:00+00:00", "end": "2024-05-01T01:00:00+00:00"}
+        assert [m[0] for m in storage.search_structured(["星巴克"], ["places"], time_range=time_range)] == ["m_tz"]
+        late = {"start": "2024-05-01T08:00:00+00:00", "end": "2024-05-01T09:00:00+00:00"}
+        assert storage.search_structured(["星巴克"], ["places"], time_range=late) == []
+    finally:
+        storage.close()
+
+
+def test_ascii_keywords_keep_substring_matching(tmp_path):
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    try:
+        moment = _moment("m_iced", 1, objects=["IcedLatte"])
+        moment["messages"] = [{"role": "user", "content": "今天喝了一杯icedlatte"}]
+        storage.save_moment(moment)
+        storage.save_moment(_moment("m_latte", 2, objects=["latte"]))
+
+        # 全文检索前缀命中 m_latte 在前，LIKE 子串匹配补上 m_iced
+        assert [m["moment_id"] for m in storage.search_by_keywords(["latte"])] == ["m_latte", "m_iced"]
+        assert [m["moment_id"] for m in storage.search_by_entity("objects", "latte")] == ["m_latte", "m_iced"]
+        assert [m["moment_id"] for m in storage.search_by_text("latte")] == ["m_latte", "m_iced"]
+        assert len(storage.search_by_keywords(["latte"], top_k=1)) == 1
+    finally:
+        storage.close()
+
+
+def test_migration_backfills_fts_index_and_epochs(tmp_path):
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    storage.save_moment(_moment("m1", 1, objects=["桂花拿铁"]))
+    db_path = storage.db_path
+    storage.close()
+
+    # 模拟 v0 数据库：没有全文索引内容，也没有 timestamp_epoch
+    conn = sqlite3.connect(str(db_path))
+    conn.execute("DELETE FROM moments_fts")
+    conn.execute("DROP INDEX idx_moments_timestamp_epoch")
+    conn.execute("ALTER TABLE moments DROP COLUMN timestamp_epoch")
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    conn.close()
+
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    try:
+        assert [m["moment_id"] for m in storage.search_by_keywords(["拿铁"])] == ["m1"]
+        time_range = {"start": (datetime.now() - timedelta(days=2)).isoformat()}
+        assert [m[0] for m in storage.search_structured(["拿铁"], ["objects"], time_range=time_range)] == ["m1"]
+        with storage._get_conn() as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    finally:
+        storage.close()
+
+
+def test_search_structured_filters_by_time_range(storage):
+    keywords, types = ["星巴克", "西湖"], ["places"]
+    assert {m[0] for m in storage.search_structured(keywords, types)} == {"m_coffee", "m_tea", "m_walk"}
+
+    time_range = {
+        "start": (datetime.now() - timedelta(days=2)).isoformat(),
+        "end": datetime.now().isoformat(),
+    }
+    assert [m[0] for m in storage.search_structured(keywords, types, time_range=time_range)] == ["m_coffee"]
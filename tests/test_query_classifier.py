@@ -0,0 +1,58 @@
+"""
+QueryClassifier 测试：查询类型、置信度、关键词和时间引用
+"""
+
+import pytest
+
+from backend.memory.query_classifier import QueryClassifier, TRAINING_EXAMPLES
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return QueryClassifier(threshold=0.85)
+
+
+def test_training_examples_are_separable(classifier):
+    correct = sum(
+        max(classifier.predict_proba(q).items(), key=lambda x: x[1])[0] == label
+        for q, label in TRAINING_EXAMPLES
+    )
+    assert correct / len(TRAINING_EXAMPLES) >= 0.95
+
+
+@pytest.mark.parametrize("query, query_type, strategy", [
+    ("我昨天喝的咖啡是什么口味", "fact", "structured"),
+    ("上次我很难过的那天", "emotion", "vector"),
+    ("之前聊过的那个事", "fuzzy", "hybrid"),
+])
+def test_confident_classification(classifier, query, query_type, strategy):
+    result, confident = classifier.classify(query)
+    assert confident
+    assert result["query_type"] == query_type
+    assert result["search_strategy"] == strategy
+    assert result["source"] == "local"
+
+
+def test_low_confidence_escalates(classifier):
+    # 没有任何记忆线索的闲聊，交给 LLM
+    _, confident = classifier.classify("你好呀")
+    assert not confident
+
+
+def test_keywords_drop_question_and_time_words(classifier):
+    result, _ = classifier.classify("你记得我昨天喝的咖啡是什么口味吗")
+    assert "咖啡" in result["keywords"]
+    assert "口味" in result["keywords"]
+    assert not {"昨天", "什么", "记得"} & set(result["keywords"])
+    assert result["time_reference"] == "yesterday"
+    assert result["entity_types"] == ["objects"]
+
+
+@pytest.mark.parametrize("query,ref", [
+    ("我最近心情怎么样", "recent"),
+    ("这几天我喝了几杯奶茶", "recent"),
+    ("我上周加了几次班", "last_week"),
+])
+def test_time_reference(classifier, query, ref):
+    result, _ = classifier.classify(query)
+    assert result["time_reference"] == ref
@@ -0,0 +1,136 @@
+"""
+QueryParser 测试：解析顺序（精确缓存 → 本地分类器 → 近似缓存 → LLM）和近似命中的关键词
+"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from backend.memory import query_parser
+from backend.memory.parse_cache import ParseCache
+from backend.memory.query_parser import QueryParser, get_query_parser_stats
+
+
+class StubClassifier:
+    """固定返回低置信度的本地结果"""
+
+    def __init__(self, confident=False):
+        self.confident = confident
+        self.calls = []
+
+    def classify(self, query):
+        self.calls.append(query)
+        keywords = [w for w in ("奶茶", "咖啡") if w in query]
+        return {
+            "keywords": keywords,
+            "entity_types": ["objects"],
+            "time_reference": "yesterday",
+            "query_type": "fact",
+            "search_strategy": "structured",
+            "expanded_queries": [query],
+            "confidence": 0.9 if self.confident else 0.4,
+            "source": "local",
+        }, self.confident
+
+
+@pytest.fixture
+def parser(monkeypatch):
+    parser = QueryParser.__new__(QueryParser)
+    parser.client = None
+    parser._cache = ParseCache(db_path=None, similarity_threshold=0.5, semantic=True)
+    parser.classifier = StubClassifier()
+    parser._stats = {"local": 0, "llm": 0, "rules": 0}
+    parser._stats_lock = threading.Lock()
+    monkeypatch.setattr(parser, "_embed_query", lambda q: pytest.fail("不应自行向量化"))
+    return parser
+
+
+@pytest.fixture
+def rules_parser():
+    parser = QueryParser.__new__(QueryParser)
+    parser.client = None
+    parser._cache = ParseCache(db_path=None, semantic=False)
+    parser.classifier = None
+    parser._stats = {"local": 0, "llm": 0, "rules": 0}
+    parser._stats_lock = threading.Lock()
+    return parser
+
+
+def _cache_coffee(parser):
+    parser._cache.put("我昨天喝的咖啡", {
+        "keywords": ["咖啡", "饮品"],
+        "entity_types": ["objects"],
+        "time_reference": "yesterday",
+        "query_type": "fact",
+        "search_strategy": "structured",
+        "expanded_queries": ["昨天的咖啡"],
+        "confidence": 0.95,
+    }, latency_ms=600, embedding=[1.0, 0.0])
+
+
+def test_semantic_hit_rederives_keywords_from_current_query(parser):
+    _cache_coffee(parser)
+    embed_calls = []
+
+    def embed_fn(query):
+        embed_calls.append(query)
+        return [0.9, 0.1]
+
+    result = parser.parse("我昨天喝的奶茶", embed_fn=embed_fn)
+
+    assert embed_calls == ["我昨天喝的奶茶"]
+    assert result["keywords"] == ["奶茶"]
+    assert result["expanded_queries"] == ["我昨天喝的奶茶"]
+    assert result["query_type"] == "fact"
+    assert result["time_range"] is not None
+    assert parser._cache.get_stats()["semantic_hits"] == 1
+
+
+def test_exact_hit_skips_classifier_and_embedding(parser):
+    _cache_coffee(parser)
+    result = parser.parse("我昨天喝的咖啡？", embed_fn=lambda q: pytest.fail("不应向量化"))
+    assert result["keywords"] == ["咖啡", "饮品"]
+    assert parser.classifier.calls == []
+
+
+def test_confident_classifier_skips_embedding(parser):
+    parser.classifier.confident = True
+    result = parser.parse("我昨天喝的奶茶", embed_fn=lambda q: pytest.fail("不应向量化"))
+    assert result["source"] == "local"
+    assert parser._stats["local"] == 1
+
+
+def test_fuzzy_time_reference_is_boost_not_filter(rules_parser):
+    config = rules_parser.get_search_config("这几天我喝了几杯奶茶")
+    assert config["time_range"] is None
+    assert config["recency_window"] is not None
+
+    config = rules_parser.get_search_config("我上周加了几次班")
+    assert config["time_range"] is not None
+    assert config["recency_window"] is None
+
+
+def test_stats_do_not_create_parser(monkeypatch, rules_parser):
+    monkeypatch.setattr(query_parser, "_query_parser", None)
+    assert get_query_parser_stats() is None
+    assert query_parser._query_parser is None
+
+    monkeypatch.setattr(query_parser, "_query_parser", rules_parser)
+    rules_parser.parse("我上周加了几次班")
+    assert get_query_parser_stats()["parsed_by"]["rules"] == 1
+
+
+def test_embed_query_skips_cache_when_disabled(monkeypatch, rules_parser):
+    from backend.memory import embedding_cache, vector_store
+
+    class FakeEmbeddings:
+        def create(self, model, input, dimensions):
+            return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1, 0.2])])
+
+    monkeypatch.setenv("EMBEDDING_CACHE_ENABLED", "0")
+    monkeypatch.setattr(embedding_cache, "get_embedding_cache", lambda *a, **k: pytest.fail("缓存已关闭"))
+    monkeypatch.setattr(vector_store, "_get_embedding_client",
+                        lambda api_key: SimpleNamespace(embeddings=FakeEmbeddings()))
+    rules_parser.client = SimpleNamespace(api_key="key")
+    assert rules_parser._embed_query("咖啡") == [0.1, 0.2]
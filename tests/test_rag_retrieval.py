@@ -0,0 +1,76 @@
+"""检索链路：Rerank 使用已索引的向量"""
+
+from datetime import datetime
+
+from backend.memory.moment_storage import MomentStorage
+from backend.memory.reranker import LocalReranker
+from backend.memory.vector_store import VectorStore
+
+
+def _moment(moment_id: str, topic: str) -> dict:
+    """每个 Moment 5 条用户消息（检索投影只保留其中一部分）"""
+    messages = []
+    for i in range(5):
+        messages.append({"role": "user", "content": f"{topic}的第{i}件事，聊了很久很久"})
+        messages.append({"role": "assistant", "content": "然后呢？"})
+    return {
+        "moment_id": moment_id,
+        "timestamp": datetime.now().isoformat(),
+        "messages": messages,
+        "summary": f"关于{topic}",
+        "entities": {},
+    }
+
+
+def test_local_rerank_reads_indexed_embeddings(tmp_path, numpy_backend, fake_embeddings):
+    storage = MomentStorage(user_id="u", base_dir=str(tmp_path))
+    store = VectorStore(user_id="u", base_dir=str(tmp_path))
+    store.embedding_client = fake_embeddings
+
+    for moment_id, topic in [("m1", "桂花拿铁"), ("m2", "西湖散步"), ("m3", "加班写方案")]:
+        moment = _moment(moment_id, topic)
+        storage.save_moment(moment)
+        store.add_moment(moment_id, moment)
+
+    candidates = storage.get_moments(["m1", "m2", "m3"], projection="retrieval")
+    assert all(c["projection"] == "retrieval" for c in candidates)
+    for c in candidates:
+        c["retrieval_score"] = 0.5
+
+    # ContextRAG 推测执行阶段已向量化查询
+    query = "那杯桂花拿铁"
+    store.get_embeddings_batch([query])
+    fake_embeddings.calls.clear()
+
+    ranked = LocalReranker().rerank(
+        query, candidates, top_k=2,
+        embed_fn=store.get_embeddings_batch,
+        stored_fn=store.get_moment_embeddings
+    )
+
+    assert fake_embeddings.calls == []
+    assert ranked[0]["moment_id"] == "m1"
+    assert all(c["semantic_score"] >= 0 for c in ranked)
+    storage.close()
+    store.close()
+
+
+def test_local_rerank_embeds_only_unindexed_candidates(tmp_path, numpy_backend, fake_embeddings):
+    store = VectorStore(user_id="u", base_dir=str(tmp_path))
+    store.embedding_client = fake_embeddings
+    store.add_moment("m1", _moment("m1", "桂花拿铁"))
+
+    candidates = [
+        {"moment_id": "m1", "messages": [], "retrieval_score": 0.5},
+        {"moment_id": "m_new", "messages": [{"role": "user", "content": "刚聊完的火锅"}],
+         "retrieval_score": 0.4},
+    ]
+    store.get_embeddings_batch(["火锅"])
+    fake_embeddings.calls.clear()
+
+    LocalReranker().rerank("火锅", candidates, top_k=2,
+                           embed_fn=store.get_embeddings_batch,
+                           stored_fn=store.get_moment_embeddings)
+
+    assert fake_embeddings.calls == [["刚聊完的火锅"]]
+    store.close()
@@ -0,0 +1,42 @@
+"""
+流式回复解码测试：不完整的转义序列留到下一段，每次结果都是下一次结果的前缀
+"""
+
+import json
+
+from backend.agent.reply_generator import _decode_partial_reply
+
+
+def _prefixes(full: str):
+    return [_decode_partial_reply(full[:i]) for i in range(len(full) + 1)]
+
+
+def _assert_monotonic(full: str):
+    decoded = _prefixes(full)
+    for shorter, longer in zip(decoded, decoded[1:]):
+        assert longer.startswith(shorter)
+    return decoded
+
+
+def test_partial_unicode_escape_waits_for_four_digits():
+    assert _decode_partial_reply('{"reply": "咖\\u55') == "咖"
+    assert _decode_partial_reply('{"reply": "咖\\u5561') == "咖啡"
+    _assert_monotonic('{"reply": "咖\\u5561", "emotion": "开心"}')
+
+
+def test_split_surrogate_pair_decodes_together():
+    full = '{"reply": "好\\ud83d\\ude0a"}'
+    assert _decode_partial_reply('{"reply": "好\\ud83d') == "好"
+    assert _decode_partial_reply('{"reply": "好\\ud83d\\ude0') == "好"
+    assert _assert_monotonic(full)[-1] == "好😊"
+
+
+def test_trailing_backslash_is_held_back():
+    assert _decode_partial_reply('{"reply": "第一行\\') == "第一行"
+    assert _decode_partial_reply('{"reply": "第一行\\n第二行') == "第一行\n第二行"
+
+
+def test_escaped_quote_does_not_end_reply():
+    full = json.dumps({"reply": '他说"你好"就走了', "emotion": "平静"}, ensure_ascii=False)
+    decoded = _assert_monotonic(full)
+    assert decoded[-1] == '他说"你好"就走了'
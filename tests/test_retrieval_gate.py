@@ -0,0 +1,66 @@
+"""
+检索门控测试：没有记忆 / 实体命中 / 时间标记不算实体 / 记忆线索 / 闲聊 / 追问
+"""
+
+from backend.memory.retrieval_gate import RetrievalGate
+
+
+class FakeStorage:
+    def __init__(self, moments=1, entities=None):
+        self.moments = moments
+        # 实体名称 -> 实体类型
+        self.entities = entities or {"桂花拿铁": "objects", "西湖": "places"}
+        self.count_calls = 0
+
+    def get_moment_count(self):
+        self.count_calls += 1
+        return self.moments
+
+    def get_entity_names(self, entity_types=None):
+        return [name for name, entity_type in self.entities.items()
+                if entity_types is None or entity_type in entity_types]
+
+
+def test_no_memory_skips_until_first_moment():
+    storage = FakeStorage(moments=0)
+    gate = RetrievalGate(storage)
+    assert gate.decide("你记得我上次说的那件事吗")["reason"] == "no_memory"
+
+    # 第一个 Moment 保存后下一轮立即生效（没有 Moment 时每轮都查）
+    storage.moments = 1
+    assert gate.decide("你记得我上次说的那件事吗")["retrieve"]
+
+
+def test_known_entity_triggers_retrieval():
+    decision = RetrievalGate(FakeStorage()).decide("今天又喝了桂花拿铁")
+    assert decision == {"retrieve": True, "reason": "entity", "entity": "桂花拿铁"}
+
+
+def test_time_markers_do_not_trigger_retrieval():
+    storage = FakeStorage(entities={"桂花拿铁": "objects", "今天": "time_markers", "早上": "daily_routines"})
+    gate = RetrievalGate(storage)
+    assert gate.decide("今天好开心")["retrieve"] is False
+    assert gate.decide("今天又喝了桂花拿铁")["entity"] == "桂花拿铁"
+
+
+def test_memory_marker_and_chitchat():
+    gate = RetrievalGate(FakeStorage())
+    assert gate.decide("还记得上次聊的吗")["reason"] == "memory_marker"
+    assert gate.decide("哈哈哈")["retrieve"] is False
+    assert gate.decide("嗯嗯")["retrieve"] is False
+
+
+def test_follow_up_after_retrieval():
+    gate = RetrievalGate(FakeStorage())
+    recent = [{"role": "user", "content": "今天又喝了桂花拿铁"}]
+    assert gate.decide("今天又喝了桂花拿铁")["retrieve"]
+    assert gate.decide("那后来呢", recent_messages=recent)["reason"] == "follow_up"
+    # 上一轮没有检索时，同样的追问不触发
+    gate.decide("哈哈哈")
+    assert gate.decide("那后来呢", recent_messages=recent)["retrieve"] is False
+
+
+def test_long_message_without_signal_retrieves():
+    gate = RetrievalGate(FakeStorage(), min_length=4, long_message=12)
+    assert gate.decide("今天加班到很晚回家路上下起了大雨")["reason"] == "long_message"
+    assert gate.decide("好累")["reason"] == "short"
@@ -0,0 +1,76 @@
+"""
+StyleRAG 测试：延迟合并写盘、旧格式迁移
+"""
+
+import json
+
+from backend.memory.style_rag import STYLE_FORMAT_VERSION, StyleRAG
+
+
+def _style_rag(tmp_path, monkeypatch, delay="0.2"):
+    monkeypatch.setenv("STYLE_FLUSH_DELAY", delay)
+    return StyleRAG(user_id="u", base_storage_path=str(tmp_path))
+
+
+def test_learning_is_debounced_into_one_write(tmp_path, monkeypatch):
+    style = _style_rag(tmp_path, monkeypatch)
+    saves = []
+    original_save = style._save_style
+
+    def counting_save():
+        saves.append(1)
+        original_save()
+
+    style._save_style = counting_save
+
+    for message in ["今天喝了桂花拿铁", "明天还想去星巴克", "好开心😊"]:
+        style.learn_from_message(message)
+    # 学习只更新内存，写盘在延迟之后
+    assert not style.storage_path.exists()
+
+    style._flush_timer.join(2)
+    assert len(saves) == 1
+    data = json.loads(style.storage_path.read_text(encoding="utf-8"))
+    assert data["total_messages"] == 3
+
+    # 没有新数据时 flush 不写盘
+    style.flush()
+    assert len(saves) == 1
+
+
+def test_stale_snapshot_does_not_overwrite_newer_write(tmp_path, monkeypatch):
+    style = _style_rag(tmp_path, monkeypatch, delay="60")
+    style.learn_from_message("今天喝了桂花拿铁")
+    style.flush()
+    written = style._written_seq[style.storage_path]
+
+    # 模拟更早取的快照晚于较新的快照写盘
+    style._written_seq[style.storage_path] = written + 1
+    style.learn_from_message("明天还想去星巴克")
+    style._snapshot_seq = written - 1
+    style.flush()
+    data = json.loads(style.storage_path.read_text(encoding="utf-8"))
+    assert data["total_messages"] == 1
+
+
+def test_legacy_format_is_migrated(tmp_path, monkeypatch):
+    legacy = {
+        "vocabulary": {"拿铁": 3},
+        "sentence_lengths": [10, 20],
+        "english_ratio": 0.1,
+        "emoji_usage": {},
+        "common_phrases": {},
+        "total_messages": 2,
+    }
+    (tmp_path / "u_style.json").write_text(json.dumps(legacy, ensure_ascii=False), encoding="utf-8")
+
+    style = _style_rag(tmp_path, monkeypatch, delay="60")
+    assert style.style_data["sentence_length"] == {"count": 2, "total": 30}
+    assert style.get_style_profile()["avg_sentence_length"] == 15.0
+
+    # 迁移结果已安排写盘，flush 后文件为新格式
+    style.flush()
+    data = json.loads((tmp_path / "u_style.json").read_text(encoding="utf-8"))
+    assert data["version"] == STYLE_FORMAT_VERSION
+    assert "sentence_lengths" not in data
+    assert data["vocabulary"] == {"拿铁": 3}
@@ -0,0 +1,66 @@
+"""
+向量后端测试：NumPy 后端的目录共享、失效行压缩
+"""
+
+import pytest
+
+from backend.memory import vector_backends
+from backend.memory.vector_backends import (
+    COMPACT_MIN_DEAD_ROWS, NumpyBackend, VectorBackend, create_backend
+)
+
+
+DIM = 8
+
+
+def _vec(i: int):
+    v = [0.0] * DIM
+    v[i % DIM] = 1.0
+    return v
+
+
+def test_vector_backend_is_abstract():
+    with pytest.raises(TypeError):
+        VectorBackend()
+
+
+def test_same_directory_shares_one_numpy_backend(tmp_path, numpy_backend):
+    a = create_backend(tmp_path, "u1", DIM)
+    b = create_backend(tmp_path, "u1", DIM)
+    assert isinstance(a, NumpyBackend)
+    assert a is b
+    assert create_backend(tmp_path, "u2", DIM) is not a
+
+    # 一个持有者写入，另一个持有者立即可见，重新加载后行号映射一致
+    a.upsert(["x"], ["doc x"], [_vec(0)], [{"moment_id": "m1"}])
+    b.upsert(["y"], ["doc y"], [_vec(1)], [{"moment_id": "m2"}])
+    assert a.count() == 2
+
+    vector_backends._numpy_backends.clear()
+    reloaded = create_backend(tmp_path, "u1", DIM)
+    assert reloaded is not a
+    assert reloaded.query([_vec(1)], n_results=1)["ids"] == [["y"]]
+    assert reloaded.get(ids=["x"])["documents"] == ["doc x"]
+
+
+def test_deletes_trigger_compaction_and_survive_reload(tmp_path, numpy_backend):
+    backend = create_backend(tmp_path, "u1", DIM)
+    total = COMPACT_MIN_DEAD_ROWS * 2
+    ids = [f"d{i}" for i in range(total)]
+    backend.upsert(ids, [f"doc {i}" for i in ids], [_vec(i) for i in range(total)],
+                   [{"moment_id": f"m{i}"} for i in range(total)])
+    # 覆盖写入同样留下失效行
+    backend.upsert(["d0"], ["doc d0 v2"], [_vec(3)], [{"moment_id": "m0"}])
+
+    backend.delete(ids[1:COMPACT_MIN_DEAD_ROWS + 1])
+    keep = ["d0"] + ids[COMPACT_MIN_DEAD_ROWS + 1:]
+    assert backend.count() == len(keep)
+    assert len(backend._rows) == len(keep)
+    assert backend._vectors_path.stat().st_size == len(keep) * DIM * backend.dtype.itemsize
+
+    vector_backends._numpy_backends.clear()
+    reloaded = create_backend(tmp_path, "u1", DIM)
+    assert sorted(reloaded.get()["ids"]) == sorted(keep)
+    assert reloaded.get(ids=["d0"])["documents"] == ["doc d0 v2"]
+    last = total - 1
+    assert reloaded.query([_vec(last)], n_results=1, where={"moment_id": f"m{last}"})["ids"] == [[f"d{last}"]]